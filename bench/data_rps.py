@@ -0,0 +1,126 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Measure how many data API requests per second each kind of data server
+(see C{siloscript serve --data-server}) can answer.
+
+    python bench/data_rps.py [--seconds N] [--connections N] [--pipeline N]
+
+Each server runs in its own process with a L{MemoryStore} so that the
+numbers are about the web layer.  The load comes from one process keeping
+C{--pipeline} GETs (or PUTs, with C{--put}) outstanding on each of
+C{--connections} kept-alive connections.
+"""
+
+import os
+import sys
+import time
+import select
+import socket
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from siloscript.clientcore import ResponseParser, encodeRequest
+
+
+KINDS = ['klein', 'raw']
+
+
+def serve(kind):
+    """
+    Serve the data API and print the port and silo key.
+    """
+    from twisted.internet import reactor, endpoints
+    from twisted.web.server import Site
+    from siloscript.server import Machine, DataWebApp, DataResource
+    from siloscript.server import KleinSite
+    from siloscript.storage import MemoryStore
+
+    machine = Machine(MemoryStore(), None)
+    silo_key = machine.control_makeSilo('bench', 'bench', None)
+    machine.data_put(silo_key, 'foo', 'bar')
+    if kind == 'raw':
+        site = Site(DataResource(machine))
+    else:
+        site = KleinSite(DataWebApp(machine).app.resource())
+    site.log = lambda request: None
+    ep = endpoints.serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
+    def listening(port):
+        print port.getHost().port, silo_key
+        sys.stdout.flush()
+    ep.listen(site).addCallback(listening)
+    reactor.run()
+
+
+def load(port, request, seconds, connections, pipeline):
+    """
+    Keep C{pipeline} copies of C{request} outstanding on each connection
+    for C{seconds}.
+
+    @return: Requests answered per second.
+    """
+    socks = {}
+    for i in xrange(connections):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(request * pipeline)
+        socks[sock] = ResponseParser()
+
+    answered = 0
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        readable, _, _ = select.select(list(socks), [], [], 1)
+        for sock in readable:
+            responses = socks[sock].feed(sock.recv(65536))
+            for response in responses:
+                if response.status != 200:
+                    raise Exception('Got %d' % (response.status,))
+            answered += len(responses)
+            if responses:
+                sock.sendall(request * len(responses))
+    elapsed = time.time() - start
+    for sock in socks:
+        sock.close()
+    return answered / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', '-t', type=float, default=5)
+    parser.add_argument('--connections', '-c', type=int, default=4)
+    parser.add_argument('--pipeline', '-p', type=int, default=8)
+    parser.add_argument('--put', action='store_true',
+        help='Measure PUTs instead of GETs.')
+    parser.add_argument('--serve', choices=KINDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    results = []
+    for kind in KINDS:
+        server = subprocess.Popen([sys.executable, __file__,
+            '--serve', kind], stdout=subprocess.PIPE)
+        try:
+            port, silo_key = server.stdout.readline().split()
+            if args.put:
+                request = encodeRequest('PUT', '/%s/foo' % (silo_key,),
+                    'bar')
+            else:
+                request = encodeRequest('GET', '/%s/foo' % (silo_key,))
+            rps = load(int(port), request, args.seconds, args.connections,
+                args.pipeline)
+        finally:
+            server.terminate()
+            server.wait()
+        results.append(rps)
+        print '%-6s %9.0f requests/s' % (kind, rps)
+    print '%-6s %9.2fx' % ('raw', results[1] / results[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Measure how long scripts spend importing the siloscript client.
+
+    python bench/import_time.py [--runs N]
+
+Each import is timed in a fresh interpreter.  Exits non-zero if importing
+siloscript takes longer than siloscript.lite.IMPORT_BUDGET.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from siloscript.lite import IMPORT_BUDGET
+
+
+TIMER = ('import time; start = time.time(); import %s;'
+         ' print time.time() - start')
+
+
+def importTime(module, runs):
+    """
+    @return: The fastest of C{runs} times (in seconds) to import C{module}
+        in a new interpreter.
+    """
+    env = dict(os.environ, PYTHONPATH=root)
+    # time importing compiled modules, as installed scripts do
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+    for i in xrange(runs):
+        out, _ = subprocess.Popen([sys.executable, '-c', TIMER % module],
+            env=env, stdout=subprocess.PIPE).communicate()
+        times.append(float(out))
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', '-n', type=int, default=10)
+    args = parser.parse_args()
+
+    results = []
+    for module in ['siloscript', 'siloscript.client', 'requests']:
+        elapsed = importTime(module, args.runs)
+        results.append((module, elapsed))
+        print '%-20s %7.2f ms' % (module, elapsed * 1000)
+    print '%-20s %7.2f ms' % ('budget', IMPORT_BUDGET * 1000)
+    if results[0][1] > IMPORT_BUDGET:
+        print 'siloscript is over budget'
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Measure how many control API requests per second C{siloscript serve
+--workers N} answers for each N from 1 to C{--max-workers}.
+
+    python bench/serve_workers.py [--max-workers N] [--seconds N]
+        [--connections N] [--pipeline N] [--load-processes N]
+
+Each server is a real C{siloscript serve} (logging to /dev/null) with a
+memory store.  The load is C{GET /channel/open} from C{--load-processes}
+processes, each keeping C{--pipeline} requests outstanding on each of
+C{--connections} kept-alive connections (see C{data_rps.py}).
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from siloscript.clientcore import encodeRequest
+from data_rps import load
+
+
+def startServer(workers, base_port, gpg_home):
+    """
+    Start C{siloscript serve --workers} and wait until every worker is
+    listening.
+
+    @return: The server process.
+    """
+    control, public, data = base_port, base_port + 100, base_port + 200
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-m', 'siloscript.cli',
+            '--gpg-home', gpg_home, 'serve',
+            '--workers', str(workers),
+            '-c', 'tcp:%d:interface=127.0.0.1' % (control,),
+            '-p', 'tcp:%d:interface=127.0.0.1' % (public,),
+            '-d', 'tcp:%d:interface=127.0.0.1' % (data,),
+            '--data-url', 'http://127.0.0.1:%d' % (data,)],
+            stdout=devnull, stderr=devnull, cwd=root)
+    # Workers listen on their own data port last, so once all of those
+    # accept connections, they're all ready.
+    deadline = time.time() + 30
+    for port in range(data, data + workers):
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED or time.time() > deadline:
+                    server.terminate()
+                    raise
+                time.sleep(0.05)
+    return server
+
+
+def _load(args):
+    return load(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-workers', '-n', type=int,
+        default=multiprocessing.cpu_count())
+    parser.add_argument('--seconds', '-t', type=float, default=5)
+    parser.add_argument('--connections', '-c', type=int, default=4)
+    parser.add_argument('--pipeline', '-p', type=int, default=8)
+    parser.add_argument('--load-processes', '-l', type=int, default=None,
+        help='Processes generating load.  (default: --max-workers)')
+    parser.add_argument('--base-port', type=int, default=17600)
+    args = parser.parse_args()
+    load_processes = args.load_processes or args.max_workers
+
+    request = encodeRequest('GET', '/channel/open')
+    pool = multiprocessing.Pool(load_processes)
+    gpg_home = tempfile.mkdtemp()
+    first = None
+    try:
+        for workers in range(1, args.max_workers + 1):
+            server = startServer(workers, args.base_port, gpg_home)
+            try:
+                rps = sum(pool.map(_load, [(args.base_port, request,
+                    args.seconds, args.connections, args.pipeline)]
+                    * load_processes))
+            finally:
+                server.terminate()
+                server.wait()
+            if first is None:
+                first = rps
+            print '%2d workers %9.0f requests/s %6.2fx' % (workers, rps,
+                rps / first)
+    finally:
+        pool.terminate()
+        shutil.rmtree(gpg_home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
-__all__ = ['__version__', 'getValue', 'putValue', 'getToken', 'Client']
+__all__ = ['__version__', 'getValue', 'putValue', 'getValues', 'putValues',
+           'getToken', 'getVersion', 'getFile', 'putFile', 'Client']
 
 from siloscript.version import __version__
-from siloscript.client import Client, getValue, putValue, getToken
+# These are cheap to import.  See siloscript.lite
+from siloscript.lite import getValue, putValue, getToken
+from siloscript.lite import getValues, putValues, getVersion
+from siloscript.lite import getFile, putFile
+from siloscript.client import Client
 
@@ -0,0 +1,127 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Admission control: limiting how much work is in progress at once, and
+turning away what would wait too long for its turn, so that an overloaded
+server answers quickly with C{503 Service Unavailable} (see
+L{siloscript.error.Overloaded}) instead of slowly for everyone.
+"""
+
+from twisted.internet import reactor, defer
+
+from collections import deque
+
+from siloscript.error import Overloaded
+
+
+
+class Limiter(object):
+    """
+    I let at most C{max_in_flight} calls run at once.  Calls beyond that
+    wait their turn, first come first served, but at most C{max_queued}
+    of them and for at most C{queue_timeout} seconds; others fail with
+    L{Overloaded}.  Urgent calls (see L{runUrgent}) go ahead of them.
+
+    @ivar in_flight: The number of calls running.
+    @ivar rejected: The number of calls turned away.
+    @ivar queue: Calls waiting their turn.
+    @ivar urgent: Urgent calls waiting their turn.
+    """
+
+    def __init__(self, name, max_in_flight, max_queued=1000,
+            queue_timeout=10, retry_after=1, clock=reactor):
+        """
+        @param name: What I'm limiting, for error messages.
+        @param retry_after: Whole seconds a caller that was turned away
+            should wait before trying again (sent as C{Retry-After}).
+        """
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.clock = clock
+        self.in_flight = 0
+        self.rejected = 0
+        self.queue = deque()
+        self.urgent = deque()
+
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call C{f(*args, **kwargs)} when it's its turn.
+
+        @return: A L{Deferred} result of the call, which fails with
+            L{Overloaded} if it couldn't be made.
+        """
+        if self.in_flight < self.max_in_flight:
+            return self._call(f, args, kwargs)
+        if len(self.queue) >= self.max_queued:
+            return self._reject()
+
+        def cancel(d):
+            if entry in self.queue:
+                self.queue.remove(entry)
+                entry[1].cancel()
+        d = defer.Deferred(cancel)
+        def timeUp():
+            self.queue.remove(entry)
+            self._reject().addBoth(_fire, d)
+        entry = (d, self.clock.callLater(self.queue_timeout, timeUp),
+            f, args, kwargs)
+        self.queue.append(entry)
+        return d
+
+
+    def runUrgent(self, f, *args, **kwargs):
+        """
+        Call C{f(*args, **kwargs)} when it's its turn, ahead of any calls
+        waiting in L{run}.  Urgent calls are never turned away: they wait as
+        long as it takes, first come first served among themselves.  Use
+        me for work that would be lost if it were turned away.
+
+        @return: A L{Deferred} result of the call.
+        """
+        if self.in_flight < self.max_in_flight:
+            return self._call(f, args, kwargs)
+
+        def cancel(d):
+            if entry in self.urgent:
+                self.urgent.remove(entry)
+        d = defer.Deferred(cancel)
+        entry = (d, None, f, args, kwargs)
+        self.urgent.append(entry)
+        return d
+
+
+    def _reject(self):
+        self.rejected += 1
+        return defer.fail(Overloaded(self.name, self.retry_after))
+
+
+    def _call(self, f, args, kwargs):
+        self.in_flight += 1
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._done)
+        return d
+
+
+    def _done(self, result):
+        self.in_flight -= 1
+        if self.in_flight < self.max_in_flight:
+            if self.urgent:
+                d, deadline, f, args, kwargs = self.urgent.popleft()
+            elif self.queue:
+                d, deadline, f, args, kwargs = self.queue.popleft()
+                deadline.cancel()
+            else:
+                return result
+            self._call(f, args, kwargs).addBoth(_fire, d)
+        return result
+
+
+
+def _fire(result, d):
+    # unless it was cancelled while it waited
+    if not d.called:
+        d.callback(result)
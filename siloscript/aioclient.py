@@ -0,0 +1,146 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+A non-blocking data API client for scripts that use C{asyncio} (Python
+3.4+).  This module doesn't use any Python 3-only syntax.
+"""
+
+import asyncio
+
+from zope.interface import implementer
+
+from siloscript.clientcore import AsyncClient, PipelinedConnection
+from siloscript.clientcore import UNIX_SCHEME
+from siloscript.interfaces import IClientLoop
+
+
+
+class _DataProtocol(asyncio.Protocol):
+    """
+    I connect a L{PipelinedConnection} to a transport.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.conn = None
+
+
+    def connection_made(self, transport):
+        self.conn = PipelinedConnection(transport.write, transport.close)
+        self.client.pool.added(self.conn)
+
+
+    def data_received(self, data):
+        self.conn.dataReceived(data)
+
+
+    def connection_lost(self, exc):
+        self.client.pool.lost(self.conn)
+
+
+
+@implementer(IClientLoop)
+class _AsyncioLoop(object):
+    """
+    I'm the L{IClientLoop} of an C{asyncio} event loop.
+    """
+
+    def __init__(self, loop=None):
+        """
+        @param loop: The event loop to use.  By default, the one running
+            when the first request is made.
+        """
+        self._loop = loop
+
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+
+    def connect(self, client):
+        factory = lambda: _DataProtocol(client)
+        if client.scheme == UNIX_SCHEME:
+            coro = self.loop.create_unix_connection(factory, client.address)
+        else:
+            coro = self.loop.create_connection(factory, *client.address)
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        def connected(task):
+            if task.cancelled():
+                client.pool.failed(asyncio.CancelledError())
+            elif task.exception() is not None:
+                client.pool.failed(task.exception())
+        task.add_done_callback(connected)
+
+
+    def newFuture(self):
+        future = self.loop.create_future()
+        def callback(result):
+            if not future.done():
+                future.set_result(result)
+        def errback(exc):
+            if not future.done():
+                future.set_exception(exc)
+        return future, callback, errback
+
+
+    def then(self, future, f, *args):
+        result, callback, errback = self.newFuture()
+        def done(future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                errback(future.exception())
+            else:
+                try:
+                    callback(f(future.result(), *args))
+                except Exception as e:
+                    errback(e)
+        future.add_done_callback(done)
+        return result
+
+
+    def succeed(self, value):
+        future = self.loop.create_future()
+        future.set_result(value)
+        return future
+
+
+    def callLater(self, delay, f):
+        return self.loop.call_later(delay, f)
+
+
+
+class Client(AsyncClient):
+    """
+    I am a non-blocking client for the data API for scripts that use
+    C{asyncio}.  My methods are those of L{siloscript.client.Client} (but
+    for C{getFile} and C{putFile}) but return futures.
+
+        client = Client(os.environ['DATASTORE_URL'])
+        username, password = await asyncio.gather(
+            client.getValue('username'),
+            client.getValue('password', prompt='Password?'))
+
+    Many requests can be outstanding at once.  They are pipelined over up
+    to C{pool_size} connections.  Keep in mind that a request waiting for a
+    person to answer a prompt holds up the ones pipelined behind it.
+    """
+
+    def __init__(self, data_url, pool_size=2, cache=True, timeout=None,
+            loop=None):
+        """
+        See L{siloscript.clientcore.AsyncClient}.
+
+        @param loop: The event loop to use.  By default, the one running
+            when the first request is made.
+        """
+        AsyncClient.__init__(self, data_url, _AsyncioLoop(loop),
+            pool_size=pool_size, cache=cache, timeout=timeout)
+
+
+    @property
+    def loop(self):
+        return self.client_loop.loop
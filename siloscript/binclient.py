@@ -0,0 +1,381 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I am a synchronous client for the msgpack data protocol (see
+L{siloscript.dataproto}).  I need C{msgpack} but not Twisted.
+
+Scripts are given a C{DATASTORE_BINARY_URL} like
+C{msgpack+tcp://127.0.0.1:8601/SILO-...} or
+C{msgpack+unix://%2Ftmp%2Fdata.sock/SILO-...} when the server offers the
+protocol; L{siloscript.lite} uses me when it is set.
+
+    client = Client(os.environ['DATASTORE_BINARY_URL'])
+    password = client.getValue('password', prompt='Password?')
+
+Unlike the HTTP clients, threads can share one of me: all requests go over
+one connection and each waits only for its own response, so a request
+waiting for a person to answer a prompt doesn't hold up the others.
+"""
+
+import select
+import socket
+import struct
+import threading
+import time
+
+import msgpack
+
+from siloscript.error import Error, NotFound, Unavailable, VersionMismatch
+from siloscript.error import NoAnswer, Overloaded, Timeout
+from siloscript.clientcore import BINARY_UNIX_SCHEME, OK, ERROR
+from siloscript.clientcore import VERSION_MISMATCH, NO_ANSWER, OVERLOADED
+from siloscript.clientcore import RETRIES, _retryDelay, _prompts
+from siloscript.clientcore import _utf8, _native, _text, _cached, _remember
+from siloscript.clientcore import splitURL
+
+
+_header = struct.Struct('!I')
+
+# What Client._wait reads when no response came in time.
+_NOTHING = object()
+
+
+
+class Client(object):
+    """
+    I am a client for the msgpack data protocol.  My methods are those of
+    L{siloscript.lite.Client}.
+
+    I remember values I've gotten or put so that getting them again doesn't
+    need a request.  Values gotten with C{save=False} aren't remembered.
+    """
+
+    def __init__(self, data_url, timeout=None, cache=True, retries=RETRIES):
+        """
+        @param data_url: The C{DATASTORE_BINARY_URL} given to the script.
+        @param timeout: Seconds to wait for the server to connect or to
+            answer a request, or C{None} to wait forever.  Requests that
+            prompt wait for a person to answer, so they never time out.
+            A request that times out fails with L{Timeout} without
+            affecting the others sharing the connection.
+        @param cache: If C{False}, don't remember values.
+        @param retries: Times to try a request again, after a growing,
+            jittered delay, if the server is too busy for it.
+        """
+        self.url = data_url
+        self.scheme, self.address, path = splitURL(data_url)
+        self.silo_key = path.strip('/')
+        self.timeout = timeout
+        self.cache = {} if cache else None
+        self.retries = retries
+        self.versions = {}
+
+        self._sock = None
+        # Incremented each time the connection is lost, so that requests
+        # made on it know they won't be answered.
+        self._generation = 0
+        self._next_id = 0
+        self._responses = {}
+        # ids of requests that timed out, whose responses are unwanted
+        self._abandoned = set()
+        self._reading = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+
+    def close(self):
+        """
+        Close my connection, if it's open.
+        """
+        with self._lock:
+            self._lost()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _connect(self):
+        if self.scheme == BINARY_UNIX_SCHEME:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except:
+            sock.close()
+            raise
+        return sock
+
+
+    def _lost(self):
+        """
+        Forget my connection.  Call with C{_lock} held.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._generation += 1
+            self._abandoned.clear()
+            self._changed.notify_all()
+
+
+    def _readFrame(self, sock):
+        size = _header.unpack(self._readExactly(sock, _header.size))[0]
+        return self._readExactly(sock, size)
+
+
+    def _readExactly(self, sock, size):
+        chunks = []
+        while size:
+            chunk = sock.recv(min(size, 65536))
+            if not chunk:
+                raise socket.error('Connection closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+
+    def _call(self, operation, *args, **kwargs):
+        """
+        Make a request and wait for its response, trying again (up to
+        C{retries} times) while the server is too busy for it.
+
+        @param prompt: (keyword) If C{True}, the request may ask a person,
+            so don't time out.
+
+        @return: The result.
+        """
+        timeout = None if kwargs.get('prompt') else self.timeout
+        attempt = 0
+        while True:
+            status, result = self._send(operation, args, timeout)
+            if status != OVERLOADED or attempt >= self.retries:
+                break
+            attempt += 1
+            time.sleep(_retryDelay(attempt))
+        if status == OK:
+            return result
+        elif status == ERROR:
+            raise Error(result)
+        elif status == VERSION_MISMATCH:
+            raise VersionMismatch(result)
+        elif status == NO_ANSWER:
+            raise NoAnswer(result)
+        elif status == OVERLOADED:
+            raise Overloaded(result)
+        raise NotFound(result)
+
+
+    def _send(self, operation, args, timeout):
+        """
+        Send a request and wait up to C{timeout} seconds for its response.
+
+        @return: A tuple of status and result.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            reused = self._sock is not None
+            if not reused:
+                self._sock = self._connect()
+            request_id = self._next_id
+            self._next_id += 1
+            generation = self._generation
+            frame = msgpack.packb([request_id, operation, self.silo_key]
+                + list(args))
+            try:
+                self._sock.sendall(_header.pack(len(frame)) + frame)
+            except socket.error:
+                self._lost()
+                if not reused:
+                    raise
+                # The server may have closed the connection while it sat
+                # idle, so try once more on a new one.
+                generation = self._generation
+                self._sock = self._connect()
+                self._sock.sendall(_header.pack(len(frame)) + frame)
+            return self._wait(request_id, generation, deadline)
+
+
+    def _wait(self, request_id, generation, deadline):
+        """
+        Wait for the response to a request.  One waiting thread at a time
+        reads from the connection, handing off responses meant for others.
+        Call with C{_lock} held.
+
+        @param deadline: The C{time.time()} to give up waiting at, or
+            C{None} to wait forever.  Giving up leaves the connection open
+            for other requests; the response is thrown away if it comes.
+
+        @raise Timeout: If the deadline passes.
+
+        @return: A tuple of status and result.
+        """
+        while request_id not in self._responses:
+            if self._generation != generation:
+                raise Unavailable()
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._abandoned.add(request_id)
+                    raise Timeout(request_id)
+            if self._reading:
+                self._changed.wait(remaining)
+                continue
+            self._reading = True
+            sock = self._sock
+            self._lock.release()
+            try:
+                try:
+                    # Only time out waiting for a response to start: one
+                    # cut short would leave the connection unusable.
+                    if select.select([sock], [], [], remaining)[0]:
+                        response = msgpack.unpackb(self._readFrame(sock))
+                    else:
+                        response = _NOTHING
+                except (socket.error, select.error, ValueError):
+                    response = None
+            finally:
+                self._lock.acquire()
+                self._reading = False
+                # let another waiting thread read
+                self._changed.notify_all()
+            if response is _NOTHING:
+                continue
+            if response is None:
+                if sock is self._sock:
+                    self._lost()
+                continue
+            if response[0] in self._abandoned:
+                self._abandoned.discard(response[0])
+                continue
+            self._responses[response[0]] = (response[1], response[2])
+            self._changed.notify_all()
+        return self._responses.pop(request_id)
+
+
+    def forget(self, key=None):
+        """
+        Forget a remembered value so that it's fetched again next time.
+
+        @param key: The key to forget, or C{None} to forget everything.
+        """
+        if key is None:
+            self.versions.clear()
+        else:
+            self.versions.pop(key, None)
+        if self.cache is not None:
+            if key is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
+
+
+    def getVersion(self, key):
+        """
+        Get the version of the value I last put for C{key}, for use with
+        L{putValue}'s C{if_version}.  Unlike the HTTP clients, I don't learn
+        versions from getting values.
+
+        @return: The version, or C{None} if I don't know it.
+        """
+        return self.versions.get(key)
+
+
+    def getValue(self, key, prompt=None, save=True, options=None,
+            revalidate=False):
+        """
+        Get a value from the data store.
+
+        See L{siloscript.client.Client.getValue}, except that with
+        C{revalidate=True} the value is always fetched again.
+        """
+        key = _native(key)
+        if (save is not False and self.cache is not None and key in self.cache
+                and not revalidate):
+            return _text(self.cache[key], 'text/plain; charset=utf-8')
+        if options is not None:
+            options = [_utf8(x) for x in options]
+        value = _utf8(self._call('get', _utf8(key), _utf8(prompt),
+            save is not False, options, prompt=bool(prompt)))
+        if save is not False and self.cache is not None:
+            self.cache[key] = value
+        return _text(value, 'text/plain; charset=utf-8')
+
+
+    def putValue(self, key, value, if_version=None):
+        """
+        Save a value in a data store.
+
+        @param if_version: If given, only save the value if the current one
+            is at this version (see L{getVersion}), or if there is one at
+            all when C{'*'}.
+
+        @raise VersionMismatch: If it isn't.
+
+        @return: The new version of the value.
+        """
+        value = _utf8(value)
+        try:
+            version = self._call('put', _utf8(key), value, if_version)
+        except VersionMismatch:
+            self.forget(_native(key))
+            raise
+        version = _native(version)
+        self.versions[_native(key)] = version
+        if self.cache is not None:
+            self.cache[_native(key)] = value
+        return version
+
+
+    def getValues(self, keys):
+        """
+        Get several values from the data store in one request.
+
+        See L{siloscript.client.Client.getValues}.
+        """
+        values, keys = _cached(self.cache, keys)
+        if not keys:
+            return values
+        requests = []
+        for req in keys:
+            if not isinstance(req, dict):
+                req = {'key': req}
+            req = dict([(str(k), v) for k, v in req.items()])
+            req['key'] = _utf8(req['key'])
+            if req.get('prompt') is not None:
+                req['prompt'] = _utf8(req['prompt'])
+            if req.get('options') is not None:
+                req['options'] = [_utf8(x) for x in req['options']]
+            requests.append(req)
+        fetched = dict([(_native(k), _native(v)) for k, v in
+            self._call('getMany', requests, prompt=_prompts(keys)).items()])
+        _remember(self.cache, keys, fetched)
+        values.update(fetched)
+        return values
+
+
+    def putValues(self, values):
+        """
+        Save several values in the data store in one request.
+        """
+        values = dict([(_utf8(k), _utf8(v)) for k, v in values.items()])
+        self._call('putMany', values)
+        for k, v in values.items():
+            self.versions.pop(_native(k), None)
+            if self.cache is not None:
+                self.cache[_native(k)] = v
+
+
+    def getToken(self, value):
+        """
+        Exchange a sensitive value for a consistent opaque token.
+        """
+        return _text(_utf8(self._call('token', _utf8(value))),
+            'text/plain; charset=utf-8')
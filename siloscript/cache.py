@@ -0,0 +1,128 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import reactor
+
+from collections import deque
+import json
+
+
+
+class ResultCache(object):
+    """
+    I remember the results of successful script runs for a while so that
+    identical runs don't have to spawn the script again.
+
+    Only results with an exit code of C{0} are remembered.  I hold at most
+    C{max_entries} results and C{max_bytes} of output; when full, the
+    oldest results are forgotten first.
+    """
+
+    def __init__(self, ttl=60, ttls=None, max_entries=1000,
+            max_bytes=64 * 1024 * 1024, env_keys=(), clock=reactor):
+        """
+        @param ttl: Default number of seconds to remember a result.
+        @param ttls: A dict of executable name to number of seconds, which
+            overrides C{ttl}.  A TTL of C{0} means don't cache that
+            executable.
+        @param max_entries: Maximum number of results to hold.
+        @param max_bytes: Maximum total size of stdout and stderr to hold.
+        @param env_keys: Names of environment variables that are part of
+            the cache key.  Other environment variables are ignored.
+        """
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.env_keys = tuple(env_keys)
+        self.clock = clock
+
+        self._entries = {}
+        self._order = deque()
+        self._serial = 0
+        self._bytes = 0
+
+
+    def key(self, user, executable, args, env):
+        """
+        Compute the cache key for a run.  C{args} may contain anything
+        JSON can represent, so it is keyed by its canonical serialization.
+        """
+        env = env or {}
+        return (user, executable, json.dumps(args or [], sort_keys=True),
+            tuple([(k, env.get(k)) for k in self.env_keys]))
+
+
+    def ttlFor(self, executable):
+        return self.ttls.get(executable, self.ttl)
+
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        @param key: As returned by L{key}.
+        @return: The C{(stdout, stderr, rc)} result or C{None} if there isn't
+            a current one.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, result, size, serial = entry
+        if expires <= self.clock.seconds():
+            self._remove(key)
+            return None
+        return result
+
+
+    def put(self, key, result):
+        """
+        Remember a result, if it's a successful one.
+
+        @param key: As returned by L{key}.
+        @param result: A C{(stdout, stderr, rc)} tuple.
+        """
+        out, err, rc = result
+        ttl = self.ttlFor(key[1])
+        if rc != 0 or not ttl:
+            return
+        size = len(out) + len(err)
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._serial += 1
+        self._entries[key] = (self.clock.seconds() + ttl, result, size,
+            self._serial)
+        self._order.append((key, self._serial))
+        self._bytes += size
+        self._evict()
+
+
+    def invalidate(self, key):
+        """
+        Forget a result.
+        """
+        self._remove(key)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+
+    def _evict(self):
+        while (len(self._entries) > self.max_entries
+                or self._bytes > self.max_bytes):
+            key, serial = self._order.popleft()
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] == serial:
+                self._remove(key)
+        if len(self._order) > 2 * max(len(self._entries), 1):
+            # drop the markers of results that were replaced or removed
+            self._order = deque([(k, s) for (k, s) in self._order
+                if k in self._entries and self._entries[k][3] == s])
@@ -6,17 +6,35 @@ import os
 import getpass
 import gnupg
 import json
+import shutil
+import tempfile
 
 from twisted.python.filepath import FilePath
 from twisted.internet import endpoints, task, defer
-from twisted.web.server import Site
 from twisted.python import log
 from twisted.python.procutils import which
+from twisted.web.server import Site
+from twisted.web.client import Agent
+from twisted.web.http_headers import Headers
 
 from siloscript.server import PublicWebApp, ControlWebApp, DataWebApp
-from siloscript.server import Machine
+from siloscript.server import Machine, KleinSite, DataResource
+from siloscript.dataproto import DataFactory
 from siloscript.storage import MemoryStore, SQLiteStore, gnupgWrapper
-from siloscript.process import SiloWrapper, LocalScriptRunner
+from siloscript.storage import BlobStore, LimitedStore, TimedStore
+from siloscript.storage import STREAM_THRESHOLD
+from siloscript.admission import Limiter
+from siloscript.silokey import SiloKeys, MemoryRevocationList
+from siloscript.silokey import SQLiteRevocationList
+from siloscript.process import SiloWrapper, LocalScriptRunner, unixSocketURL
+from siloscript.remote import RemoteScriptRunner, WorkerFactory
+from siloscript.hub import HubFactory, HubClient
+from siloscript.workers import WorkerPool, workerEndpoint, workerURL
+from siloscript.workers import listenReusePort
+from siloscript.cache import ResultCache
+from siloscript.jobs import JobStore
+from siloscript.sse import EventReader
+from siloscript.error import Timeout
 
 root = FilePath(__file__).parent()
 
@@ -34,12 +52,46 @@ def getStore(args):
         # in-memory
         store = MemoryStore()
         log.msg('memory', system='storage')
+    if args.blob_dir:
+        store = BlobStore(args.blob_dir, store)
+        log.msg('blobs: %r' % (args.blob_dir,), system='storage')
+    store = TimedStore(store)
 
     # layer on the encryption
     gpg = gnupg.GPG(
         homedir=args.gpg_home,
         binary=which('gpg')[0])
-    return gnupgWrapper(gpg, store, passphrase=args.gpg_passphrase)
+    store = gnupgWrapper(gpg, store, passphrase=args.gpg_passphrase)
+    if args.max_store_ops:
+        store = LimitedStore(store, Limiter('store', args.max_store_ops,
+            queue_timeout=args.store_queue_timeout))
+    return store
+
+
+
+def getRunner(args, scripts):
+    """
+    Get a script runner for the given command line args.
+
+    @param scripts: Root path of the executable scripts.
+    """
+    timeouts = {}
+    for spec in args.script_timeout:
+        name, seconds = spec.rsplit('=', 1)
+        timeouts[name] = float(seconds)
+    return LocalScriptRunner(scripts,
+        timeout=args.timeout,
+        timeouts=timeouts,
+        kill_grace=args.kill_grace,
+        limits={
+            'cpu': args.limit_cpu,
+            'memory': args.limit_memory,
+            'files': args.limit_files,
+        },
+        cgroup=args.cgroup,
+        output_interval=args.output_interval or None,
+        output_size=args.output_size,
+        output_lines=args.output_lines)
 
 
 
@@ -49,40 +101,261 @@ parser.add_argument('--sqlite',
     default=None,
     help='If given, then use SQLite as the storage mechanism.  This arg is '
          'the filename to store things in.')
+parser.add_argument('--blob-dir',
+    default=None,
+    metavar='DIR',
+    help='If given, keep large values (more than %d bytes, which are'
+         ' streamed) in files of their own in this directory instead of in'
+         ' the store.' % (STREAM_THRESHOLD,))
+parser.add_argument('--max-store-ops',
+    type=int,
+    default=32,
+    metavar='N',
+    help='Most store operations (each of which runs gpg) to have in progress'
+         ' at once.  Others wait their turn, and data requests that wait'
+         ' longer than --store-queue-timeout fail with 503.  0 means no'
+         ' limit.  (default: %(default)s)')
+parser.add_argument('--store-queue-timeout',
+    type=float,
+    default=5,
+    metavar='SECONDS',
+    help='Seconds a store operation may wait for its turn.'
+         '  (default: %(default)s)')
 parser.add_argument('--gpg-home', '-G',
     default='.gpghome',
     help='The directory where gpg keys live')
 parser.add_argument('--prompt-passphrase', '-P',
     action='store_true',
     help='Prompt for the passphrase before running.')
+parser.add_argument('--gpg-passphrase-fd',
+    type=int,
+    default=None,
+    metavar='FD',
+    help='Read the passphrase from the first line of this file descriptor.')
+parser.add_argument('--timeout',
+    type=float,
+    default=None,
+    help='Seconds a script may run before it is killed.  By default, scripts'
+         ' may run forever.')
+parser.add_argument('--script-timeout',
+    action='append',
+    default=[],
+    metavar='SCRIPT=SECONDS',
+    help='Override --timeout for a particular script.  May be given more'
+         ' than once.')
+parser.add_argument('--kill-grace',
+    type=float,
+    default=LocalScriptRunner.kill_grace,
+    help='Seconds between sending SIGTERM and SIGKILL to a script that has'
+         ' timed out.  (default: %(default)s)')
+parser.add_argument('--limit-cpu',
+    type=int,
+    default=None,
+    help='Maximum seconds of CPU time a script may use (RLIMIT_CPU).')
+parser.add_argument('--limit-memory',
+    type=int,
+    default=None,
+    help='Maximum bytes of address space a script may use (RLIMIT_AS).')
+parser.add_argument('--limit-files',
+    type=int,
+    default=None,
+    help='Maximum number of files a script may have open (RLIMIT_NOFILE).')
+parser.add_argument('--cgroup',
+    default=None,
+    help='Path of an existing cgroup directory to run scripts in.  Set the'
+         ' cgroup\'s limits yourself.')
+parser.add_argument('--output-interval',
+    type=float,
+    default=0.05,
+    help='Seconds to collect script output before logging it.  0 logs'
+         ' output as soon as it arrives.  (default: %(default)s)')
+parser.add_argument('--output-size',
+    type=int,
+    default=64 * 1024,
+    help='Bytes of script output to collect before logging it regardless of'
+         ' --output-interval.  (default: %(default)s)')
+parser.add_argument('--output-lines',
+    action='store_true',
+    help='Log whole lines of script output when possible.')
+parser.add_argument('--silo-secret-file',
+    default=None,
+    metavar='PATH',
+    help='If given, make signed silo keys with the secret in this file, so'
+         ' that any `siloscript data` process with the same secret (and'
+         ' --sqlite database) can serve data requests for them.')
+parser.add_argument('--silo-key-ttl',
+    type=float,
+    default=86400,
+    help='Seconds signed silo keys are good for.  Make it longer than any'
+         ' script runs.  (default: %(default)s)')
 parser.set_defaults(gpg_passphrase=None)
 
 
 subparsers = parser.add_subparsers(help='sub-command help')
 
 
+def getSiloKeys(args):
+    """
+    Get the signer of silo keys and the revocation list for the given
+    command line args, or C{(None, None)} if keys shouldn't be signed.
+    Processes sharing an SQLite database share its revocation list.
+    """
+    if not args.silo_secret_file:
+        return None, None
+    with open(args.silo_secret_file) as f:
+        secret = f.read().strip()
+    if args.sqlite:
+        revoked = SQLiteRevocationList.create(args.sqlite)
+    else:
+        revoked = MemoryRevocationList()
+    return SiloKeys(secret, ttl=args.silo_key_ttl), revoked
+
+
+def getResultCache(args):
+    """
+    Get a result cache for the given command line args (or C{None} if
+    results shouldn't be cached).
+    """
+    ttls = {}
+    for spec in args.script_cache_ttl:
+        name, seconds = spec.rsplit('=', 1)
+        ttls[name] = float(seconds)
+    if not args.cache_ttl and not any(ttls.values()):
+        return None
+    return ResultCache(ttl=args.cache_ttl, ttls=ttls,
+        max_entries=args.cache_size, env_keys=args.cache_env)
+
+
 def serve(reactor, args):
     """
     Start webserver
     """
     log.startLogging(sys.stdout)
+    if args.workers > 1 and args.worker_index is None:
+        return serveWorkers(reactor, args)
+    index = args.worker_index
+    if index is not None:
+        # Silos live in the worker that made them, so each worker's scripts
+        # use a data endpoint of its own.
+        args.data_endpoint = workerEndpoint(args.data_endpoint, index)
+        args.data_url = workerURL(args.data_url, index)
+        if args.data_socket:
+            args.data_socket = '%s.%d' % (args.data_socket, index)
+        if args.binary_endpoint:
+            args.binary_endpoint = workerEndpoint(args.binary_endpoint, index)
+        if args.binary_url:
+            args.binary_url = workerURL(args.binary_url, index)
+
     store = getStore(args)
-    runner = SiloWrapper(args.data_url, LocalScriptRunner(args.scripts))
-    machine = Machine(store, runner)
+    if args.worker:
+        script_runner = RemoteScriptRunner([
+            endpoints.clientFromString(reactor, x) for x in args.worker])
+        script_runner.connect()
+    else:
+        script_runner = getRunner(args, args.scripts)
+    data_url = args.data_url
+    if args.data_socket and not args.worker:
+        data_url = unixSocketURL(args.data_socket)
+    runner = SiloWrapper(data_url, script_runner,
+        binary_url_root=args.binary_url)
+    silo_keys, revoked = getSiloKeys(args)
+    machine = Machine(store, runner, result_cache=getResultCache(args),
+        coalesce_runs=args.coalesce_runs, silo_keys=silo_keys,
+        revoked=revoked, question_timeout=args.question_timeout or None)
 
     public_app = PublicWebApp(machine)
-    endpoints.serverFromString(reactor, args.public_endpoint)\
-        .listen(Site(public_app.app.resource()))
-
-    control_app = ControlWebApp(machine, args.static_root)
-    endpoints.serverFromString(reactor, args.control_endpoint)\
-        .listen(Site(control_app.app.resource()))
+    public_site = KleinSite(public_app.app.resource())
+    control_app = ControlWebApp(machine, args.static_root,
+        jobs=JobStore(ttl=args.job_ttl, max_jobs=args.max_jobs),
+        max_runs=args.max_runs or None)
+    control_site = KleinSite(control_app.app.resource())
+
+    if index is None:
+        endpoints.serverFromString(reactor, args.public_endpoint)\
+            .listen(public_site)
+        endpoints.serverFromString(reactor, args.control_endpoint)\
+            .listen(control_site)
+        listenData(reactor, args, machine)
+        return defer.Deferred()
+
+    listenReusePort(reactor, args.public_endpoint, public_site)
+    listenReusePort(reactor, args.control_endpoint, control_site)
+    listenData(reactor, args, machine)
+    # Run until the parent (and its hub) goes away.
+    hub = HubClient(machine, control_app)
+    d = endpoints.connectProtocol(endpoints.UNIXClientEndpoint(reactor,
+        args.hub), hub)
+    d.addCallback(lambda _: hub.disconnected)
+    return d
+
+
+def _workerArgv(argv):
+    """
+    Remove the options for getting a passphrase from C{argv}.
+    """
+    result = []
+    argv = iter(argv)
+    for arg in argv:
+        if arg in ('--prompt-passphrase', '-P'):
+            continue
+        elif arg == '--gpg-passphrase-fd':
+            next(argv, None)
+            continue
+        elif arg.startswith('--gpg-passphrase-fd='):
+            continue
+        result.append(arg)
+    return result
+
+
+def serveWorkers(reactor, args):
+    """
+    Run C{--workers} copies of C{serve} that share the public and control
+    ports and are linked by a hub.
+    """
+    if not args.sqlite:
+        log.msg('without --sqlite each worker has its own memory store',
+            system='workers')
+    hub_dir = tempfile.mkdtemp()
+    hub_path = os.path.join(hub_dir, 'hub.sock')
+    endpoints.UNIXServerEndpoint(reactor, hub_path, mode=0600)\
+        .listen(HubFactory())
+
+    argv = _workerArgv(sys.argv[1:])
+    stdin = None
+    if args.gpg_passphrase is not None:
+        argv = ['--gpg-passphrase-fd', '0'] + argv
+        stdin = args.gpg_passphrase + '\n'
+
+    def workerArgs(index):
+        return [sys.executable, '-m', 'siloscript.cli'] + argv + [
+            '--worker-index', str(index), '--hub', hub_path]
+    pool = WorkerPool(reactor, args.workers, workerArgs, stdin=stdin)
+    pool.start()
+
+    def stop():
+        d = pool.stop()
+        d.addBoth(lambda _: shutil.rmtree(hub_dir, ignore_errors=True))
+        return d
+    reactor.addSystemEventTrigger('before', 'shutdown', stop)
+    return defer.Deferred()
 
-    data_app = DataWebApp(machine)
-    endpoints.serverFromString(reactor, args.data_endpoint)\
-        .listen(Site(data_app.app.resource()))
 
-    return defer.Deferred()
+def listenData(reactor, args, machine):
+    """
+    Serve the data API (and the msgpack data protocol, if asked) as the
+    command line args say.
+    """
+    if args.data_server == 'raw':
+        data_site = Site(DataResource(machine))
+    else:
+        data_site = KleinSite(DataWebApp(machine).app.resource())
+    endpoints.serverFromString(reactor, args.data_endpoint).listen(data_site)
+    if args.data_socket:
+        endpoints.UNIXServerEndpoint(reactor, args.data_socket, mode=0600,
+            wantPID=True).listen(data_site)
+    if args.binary_endpoint:
+        endpoints.serverFromString(reactor, args.binary_endpoint)\
+            .listen(DataFactory(machine))
 
 
 server_parser = subparsers.add_parser('serve', help='Start HTTP server')
@@ -103,6 +376,31 @@ server_parser.add_argument('--data-url',
     default='http://127.0.0.1:8600',
     help='Base URL for the data endpoint as reachable by scripts.'
          '  (default: %(default)s)')
+server_parser.add_argument('--data-socket',
+    type=str,
+    default=None,
+    metavar='PATH',
+    help='Also serve the data HTTP server on a Unix socket at PATH and have'
+         ' locally run scripts use it instead of --data-url.')
+server_parser.add_argument('--data-server',
+    choices=['klein', 'raw'],
+    default='klein',
+    help='How to serve the data API: with Klein like the other servers, or'
+         ' directly on twisted.web, which is faster.  (default: %(default)s)')
+server_parser.add_argument('--binary-endpoint',
+    type=str,
+    default=None,
+    metavar='ENDPOINT',
+    help='Also serve the msgpack data protocol (see siloscript.dataproto) on'
+         ' this endpoint, such as tcp:8601.  This should NOT be exposed to'
+         ' the public Internet.')
+server_parser.add_argument('--binary-url',
+    type=str,
+    default=None,
+    metavar='URL',
+    help='Base URL for --binary-endpoint as reachable by scripts, such as'
+         ' msgpack+tcp://127.0.0.1:8601 or msgpack+unix://%%2Ftmp%%2Fd.sock.'
+         '  Scripts are given it as DATASTORE_BINARY_URL.')
 
 server_parser.add_argument('--public-endpoint', '-p',
     type=str,
@@ -118,10 +416,151 @@ server_parser.add_argument('--static-root', '-S',
     default=root.child('data').child('static').path,
     help='Path to static files served at /static.  (default: %(default)s)')
 
+server_parser.add_argument('--cache-ttl',
+    type=float,
+    default=0,
+    help='Seconds to remember the output of successful runs.  Identical runs'
+         ' within this time return the remembered output without running'
+         ' the script.  (default: %(default)s, which disables the cache)')
+server_parser.add_argument('--script-cache-ttl',
+    action='append',
+    default=[],
+    metavar='SCRIPT=SECONDS',
+    help='Override --cache-ttl for a particular script.  May be given more'
+         ' than once.')
+server_parser.add_argument('--cache-size',
+    type=int,
+    default=1000,
+    help='Maximum number of run results to remember.  (default: %(default)s)')
+server_parser.add_argument('--cache-env',
+    action='append',
+    default=[],
+    metavar='NAME',
+    help='Environment variable that distinguishes otherwise identical runs.'
+         '  May be given more than once.')
+server_parser.add_argument('--worker', '-w',
+    action='append',
+    default=[],
+    metavar='ENDPOINT',
+    help='Client endpoint of a `siloscript worker` to run scripts on, such as'
+         ' tcp:host=10.0.0.2:port=7700.  May be given more than once.  If'
+         ' given, scripts are not run locally and --data-url must be'
+         ' reachable from the workers.')
+server_parser.add_argument('--coalesce-runs',
+    action='store_true',
+    help='Let a run for the same user, script, args and environment as a'
+         ' run already in progress share the result of the one in progress.')
+server_parser.add_argument('--job-ttl',
+    type=float,
+    default=3600,
+    metavar='SECONDS',
+    help='Seconds to remember the result of a job started with /run after'
+         ' it finishes.  (default: %(default)s)')
+server_parser.add_argument('--max-jobs',
+    type=int,
+    default=1000,
+    help='Most finished jobs to remember; the oldest are forgotten first.'
+         '  (default: %(default)s)')
+server_parser.add_argument('--max-runs',
+    type=int,
+    default=64,
+    metavar='N',
+    help='Most jobs started with /run to have running at once.  Beyond that'
+         ' /run answers 503 with a Retry-After.  0 means no limit.'
+         '  (default: %(default)s)')
+server_parser.add_argument('--question-timeout',
+    type=float,
+    default=900,
+    metavar='SECONDS',
+    help='Seconds to wait for a user to answer a question.  After that the'
+         ' script\'s request fails with 504 (NoAnswer in Python clients).'
+         '  0 waits forever.  (default: %(default)s)')
+server_parser.add_argument('--workers',
+    type=int,
+    default=1,
+    metavar='N',
+    help='Run N server processes that share the public and control ports'
+         ' (with SO_REUSEPORT, so those must be tcp endpoints).  Worker i'
+         ' serves data on --data-endpoint\'s port + i (and --data-socket'
+         ' PATH.i); --data-url and --binary-url are changed to match.  Use'
+         ' --sqlite so they share data.  (default: %(default)s)')
+server_parser.add_argument('--worker-index',
+    type=int,
+    default=None,
+    help=argparse.SUPPRESS)
+server_parser.add_argument('--hub',
+    default=None,
+    help=argparse.SUPPRESS)
+
 server_parser.set_defaults(func=serve)
 
 
 
+def data(reactor, args):
+    """
+    Serve only the data API, for signed silo keys made by a `siloscript
+    serve` with the same --silo-secret-file.
+    """
+    log.startLogging(sys.stdout)
+    silo_keys, revoked = getSiloKeys(args)
+    if silo_keys is None:
+        raise SystemExit('siloscript data needs --silo-secret-file')
+    machine = Machine(getStore(args), None, silo_keys=silo_keys,
+        revoked=revoked)
+    listenData(reactor, args, machine)
+    return defer.Deferred()
+
+
+data_parser = subparsers.add_parser('data', help='Serve the data API for'
+    ' signed silo keys (see --silo-secret-file)')
+data_parser.add_argument('--data-endpoint', '-d',
+    type=str,
+    default='tcp:8600',
+    help='Endpoint to serve data HTTP server on. This should NOT be exposed'
+         ' to the public Internet.  (default: %(default)s)')
+data_parser.add_argument('--data-socket',
+    type=str,
+    default=None,
+    metavar='PATH',
+    help='Also serve the data HTTP server on a Unix socket at PATH.')
+data_parser.add_argument('--data-server',
+    choices=['klein', 'raw'],
+    default='klein',
+    help='How to serve the data API.  See `serve --help`.'
+         '  (default: %(default)s)')
+data_parser.add_argument('--binary-endpoint',
+    type=str,
+    default=None,
+    metavar='ENDPOINT',
+    help='Also serve the msgpack data protocol on this endpoint.')
+data_parser.set_defaults(func=data)
+
+
+
+def worker(reactor, args):
+    """
+    Run scripts on behalf of a `siloscript serve` on another machine.
+    """
+    log.startLogging(sys.stdout)
+    factory = WorkerFactory(getRunner(args, args.scripts))
+    endpoints.serverFromString(reactor, args.endpoint).listen(factory)
+    return defer.Deferred()
+
+
+worker_parser = subparsers.add_parser('worker', help='Run scripts for a'
+    ' remote `siloscript serve --worker`')
+worker_parser.add_argument('--endpoint', '-e',
+    type=str,
+    default='tcp:7700',
+    help='Endpoint to listen for the server on.  This should NOT be exposed'
+         ' to the public Internet.  (default: %(default)s)')
+worker_parser.add_argument('--scripts', '-s',
+    default=root.child('data').child('scripts').path,
+    help='Path to executable scripts.  (default: %(default)s)')
+worker_parser.set_defaults(func=worker)
+
+
+
 @defer.inlineCallbacks
 def run(reactor, args):
     """
@@ -132,19 +571,34 @@ def run(reactor, args):
     script_root = FilePath(args.script).parent()
 
     store = getStore(args)
-    runner = SiloWrapper('unknown', LocalScriptRunner(script_root.path))
+    runner = SiloWrapper('unknown', getRunner(args, script_root.path))
     machine = Machine(store, runner)
 
     # start the server
     data_app = DataWebApp(machine)
-    ep = endpoints.serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
-    p = yield ep.listen(Site(data_app.app.resource()))
-    host = p.getHost()
-    runner.data_url_root = 'http://%s:%s' % (host.host, host.port)
+    if args.data_socket or args.binary:
+        tmpdir = tempfile.mkdtemp()
+        reactor.addSystemEventTrigger('after', 'shutdown',
+            shutil.rmtree, tmpdir, True)
+    if args.binary:
+        socket_path = os.path.join(tmpdir, 'binary.sock')
+        ep = endpoints.UNIXServerEndpoint(reactor, socket_path, mode=0600)
+        yield ep.listen(DataFactory(machine))
+        runner.binary_url_root = unixSocketURL(socket_path,
+            scheme='msgpack+unix')
+    if args.data_socket:
+        socket_path = os.path.join(tmpdir, 'data.sock')
+        ep = endpoints.UNIXServerEndpoint(reactor, socket_path, mode=0600)
+        yield ep.listen(KleinSite(data_app.app.resource()))
+        runner.data_url_root = unixSocketURL(socket_path)
+    else:
+        ep = endpoints.serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
+        p = yield ep.listen(KleinSite(data_app.app.resource()))
+        host = p.getHost()
+        runner.data_url_root = 'http://%s:%s' % (host.host, host.port)
     
-    # open a channel
-    chan = machine.channel_open()
-    def receiver(question):
+    # ask questions on the terminal
+    def ask(question):
         answer = ''
         if question.get('options', []):
             prompt = '%s\n' % (question['prompt'],)
@@ -161,8 +615,16 @@ def run(reactor, args):
                     pass
         else:
             answer = getpass.getpass(question['prompt'] + ' ')
+        return answer
+
+    def receiver(question):
+        if 'fields' in question:
+            # a bundle of questions, answered all together
+            answer = json.dumps(dict([(field['key'], ask(field))
+                for field in question['fields']]))
+        else:
+            answer = ask(question)
         machine.answer_question(question['id'], answer)
-    machine.channel_connect(chan, receiver)
 
     # prepare output
     out_fd = sys.__stdout__
@@ -181,8 +643,13 @@ def run(reactor, args):
 
     # run the script
     script_name = FilePath(args.script).basename()
-    out, err, rc = yield machine.run(args.user, script_name,
-        args.args, os.environ.copy(), chan, logger=logger)
+    try:
+        out, err, rc = yield machine.run(args.user, script_name,
+            args.args, os.environ.copy(), receiver, logger=logger)
+    except Timeout as e:
+        sys.stderr.write('%s\n' % (e.args[0],))
+        # same as coreutils' timeout(1)
+        rc = 124
     
     sys.exit(rc)
 
@@ -198,6 +665,14 @@ run_parser.add_argument('--user', '-u',
     type=str,
     default='defaultuser',
     help="The user whose data should be used.")
+run_parser.add_argument('--data-socket',
+    action='store_true',
+    help="Give the script a data URL on a Unix socket instead of TCP.  The"
+         " script must use siloscript.client to talk to it.")
+run_parser.add_argument('--binary',
+    action='store_true',
+    help="Also serve the msgpack data protocol to the script on a Unix"
+         " socket given as DATASTORE_BINARY_URL.")
 run_parser.add_argument('--verbose', '-v',
     action='store_true',
     help="Verbose output?")
@@ -211,9 +686,61 @@ run_parser.set_defaults(func=run)
 
 
 
+@defer.inlineCallbacks
+def attach(reactor, args):
+    """
+    Follow the output of a job started through a control server.
+    """
+    url = '%s/job/%s/events' % (args.control_url.rstrip('/'), args.job_id)
+    response = yield Agent(reactor).request('GET', url,
+        Headers({'Accept': ['text/event-stream']}))
+    if response.code != 200:
+        sys.stderr.write('No such job: %s\n' % (args.job_id,))
+        sys.exit(1)
+
+    end = {}
+    def receiver(name, data, event_id):
+        if name == 'output':
+            out = sys.stdout if data['channel'] == 1 else sys.stderr
+            out.write(data['data'].encode('utf-8'))
+            out.flush()
+        elif name == 'dropped':
+            sys.stderr.write('(%d events missed)\n' % (data['count'],))
+        elif name == 'end':
+            end.update(data)
+    reader = EventReader(receiver)
+    response.deliverBody(reader)
+    yield reader.done
+
+    if end.get('state') == 'done':
+        sys.exit(end['rc'])
+    sys.stderr.write('%s\n' % (end.get('error', 'Job did not finish'),))
+    sys.exit(1)
+
+
+
+attach_parser = subparsers.add_parser('attach', help='Follow the output of a'
+    ' job started with POST /run and exit with its exit code')
+attach_parser.add_argument('--control-url',
+    type=str,
+    default='http://127.0.0.1:7600',
+    help='URL of the control server.  Default: %(default)s')
+attach_parser.add_argument('job_id',
+    help='The id returned by POST /run')
+attach_parser.set_defaults(func=attach)
+
+
+
 def run():
     args = parser.parse_args()
-    if args.prompt_passphrase:
+    if args.gpg_passphrase_fd is not None:
+        with os.fdopen(args.gpg_passphrase_fd) as f:
+            args.gpg_passphrase = f.readline().rstrip('\n')
+    elif args.prompt_passphrase:
         args.gpg_passphrase = getpass.getpass(
             'GPG passphrase (typing will be hidden): ')
     task.react(args.func, [args])
+
+
+if __name__ == '__main__':
+    run()
@@ -2,8 +2,14 @@
 # See LICENSE for details.
 
 import os
-import requests
-from siloscript.error import NotFound
+import json
+import time
+from functools import partial
+from siloscript.error import VersionMismatch
+from siloscript.clientcore import UNIX_SCHEME, _utf8, _text, _cached
+from siloscript.clientcore import _remember, _etagVersion, _fileLength
+from siloscript.clientcore import CHUNK_SIZE, RETRIES, _getFailed, _failed
+from siloscript.clientcore import _retryDelay, _prompts
 
 
 
@@ -11,13 +17,139 @@ class Client(object):
     """
     I am a synchronous client for interacting with the key value store
     provided in siloscript.
+
+    I keep HTTP connections to the data server open between requests.  Call
+    L{close} (or use me as a context manager) when you're done with me.
+
+    If the data URL is an C{http+unix://} URL, I connect to the server's
+    Unix socket instead of over TCP.
+
+    I remember values I've gotten or put so that getting them again doesn't
+    need a request.  Values gotten with C{save=False} aren't remembered.
+    Getting a remembered value with C{revalidate=True} asks the server
+    whether it has changed, which is cheaper than getting it again.
+
+    I also remember the versions of values I've gotten or put (see
+    L{getVersion}) so that they can be updated with C{putValue}'s
+    C{if_version} without overwriting someone else's change.
     """
 
-    def __init__(self, data_url):
+    def __init__(self, data_url, timeout=None, pool_size=4, cache=True,
+            retries=RETRIES):
+        """
+        @param data_url: The C{DATASTORE_URL} given to the script.
+        @param timeout: Seconds to wait for the server to connect or send
+            data, or C{None} to wait forever.  Requests that prompt wait
+            for a person to answer, so they never time out.
+        @param pool_size: Maximum number of connections to keep open.
+        @param cache: If C{False}, don't remember values.
+        @param retries: Times to try a request again, after a growing,
+            jittered delay, if the server is too busy for it.  After that
+            it fails with L{siloscript.error.Overloaded}.
+        """
         self.url = data_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache = {} if cache else None
+        self.retries = retries
+        self.versions = {}
+        self._session = None
+
+
+    @property
+    def session(self):
+        """
+        The L{requests.Session} holding my connections.
+        """
+        if self._session is None:
+            # requests is slow to import, so don't unless it's needed.
+            import requests
+            import requests.adapters
+            from siloscript.unixadapter import UnixAdapter
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.mount(UNIX_SCHEME + '://', UnixAdapter(self.pool_size))
+            self._session = session
+        return self._session
+
+
+    def close(self):
+        """
+        Close any open connections.
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
 
-    def getValue(self, key, prompt=None, save=True, options=None):
+    def _send(self, method, url, **kwargs):
+        """
+        Make a request with my session, trying it again (up to C{retries}
+        times) while the server is too busy for it.
+
+        @return: The C{requests} response.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        data = kwargs.get('data')
+        start = None
+        if hasattr(data, 'read') and _fileLength(data) is not None:
+            start = data.tell()
+        retryable = (data is None or isinstance(data, basestring)
+            or start is not None)
+        attempt = 0
+        while True:
+            r = self.session.request(method, url, **kwargs)
+            if r.status_code != 503 or attempt >= self.retries \
+                    or not retryable:
+                return r
+            attempt += 1
+            r.close()
+            if start is not None:
+                data.seek(start)
+            time.sleep(_retryDelay(attempt, r.headers.get('Retry-After')))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def forget(self, key=None):
+        """
+        Forget a remembered value so that it's fetched again next time.
+
+        @param key: The key to forget, or C{None} to forget everything.
+        """
+        if key is None:
+            self.versions.clear()
+        else:
+            self.versions.pop(key, None)
+        if self.cache is not None:
+            if key is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
+
+
+    def getVersion(self, key):
+        """
+        Get the version of the value I last got or put for C{key}, for use
+        with L{putValue}'s C{if_version}.
+
+        @return: The version, or C{None} if I don't know it.
+        """
+        return self.versions.get(key)
+
+
+    def getValue(self, key, prompt=None, save=True, options=None,
+            revalidate=False):
         """
         Get a value from the data store.
 
@@ -29,9 +161,19 @@ class Client(object):
             B{MIGHT NOT BE IN THIS LIST}.  The caller is responsible for
             validating answers (or not).
 
+        @param revalidate: If C{True} and I remember the value, ask the
+            server whether it has changed instead of returning it straight
+            away.  The value is only sent again if it has.
+
         @raise NotFound: If there is no such value and a user is not there to
             supply it.
+        @raise NoAnswer: If the user was asked for it but didn't answer in
+            time.
         """
+        cached = (save is not False and self.cache is not None
+            and key in self.cache)
+        if cached and not revalidate:
+            return _text(self.cache[key], None)
         params = {}
         if prompt:
             params['prompt'] = prompt
@@ -39,36 +181,180 @@ class Client(object):
             params['save'] = 'False'
         if options is not None:
             params['options'] = options
-        r = requests.get('%s/%s' % (self.url, key), params=params)
+        headers = {}
+        if cached and key in self.versions:
+            headers['If-None-Match'] = '"%s"' % (self.versions[key],)
+        r = self._send('GET', '%s/%s' % (self.url, key), params=params,
+            headers=headers, timeout=None if prompt else self.timeout)
+        if r.status_code == 304 and cached:
+            return _text(self.cache[key], None)
         if r.status_code == 200:
+            self._remember(key, _etagVersion(r.headers.get('ETag')))
+            if save is not False and self.cache is not None:
+                self.cache[key] = r.content
             return r.text
-        raise NotFound(key)
-            
+        raise _getFailed(r.status_code, key)
+
 
-    def putValue(self, key, value):
+    def _remember(self, key, version):
+        if version is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = version
+
+
+    def putValue(self, key, value, if_version=None):
         """
         Save a value in a data store.
+
+        @param if_version: If given, only save the value if the one in the
+            store is still at this version (see L{getVersion}), or if
+            there is one at all when C{'*'}.
+
+        @raise VersionMismatch: If it isn't, in which case I forget the
+            value I remember so that it's fetched again.
+
+        @return: The new version of the value.
+        """
+        value = _utf8(value)
+        version = self._put(key, value, if_version)
+        if self.cache is not None:
+            self.cache[key] = value
+        return version
+
+
+    def putFile(self, key, fileobj, if_version=None):
+        """
+        Save the contents of a file in the data store without reading it
+        all into memory.  Use this for large values, such as downloaded
+        statements, which the server can keep on disk.  They aren't
+        remembered.
+
+        The file is sent with a C{Content-Length} if its size can be found
+        by seeking, or in chunks otherwise (if it's a pipe, say).
+
+        @param fileobj: A file open for reading in binary mode.
+        @param if_version: See L{putValue}.
+
+        @return: The new version of the value.
+        """
+        body = fileobj
+        if _fileLength(fileobj) is None:
+            # requests sends iterators in chunks
+            body = iter(partial(fileobj.read, CHUNK_SIZE), '')
+        version = self._put(key, body, if_version)
+        if self.cache is not None:
+            self.cache.pop(key, None)
+        return version
+
+
+    def _put(self, key, body, if_version):
+        headers = {}
+        if if_version is not None:
+            if if_version != '*':
+                if_version = '"%s"' % (if_version,)
+            headers['If-Match'] = if_version
+        r = self._send('PUT', '%s/%s' % (self.url, key), data=body,
+            headers=headers)
+        if r.status_code == 200:
+            version = _etagVersion(r.headers.get('ETag'))
+            self._remember(key, version)
+            return version
+        elif r.status_code == 412:
+            self.forget(key)
+            raise VersionMismatch(key)
+        raise _failed(r.status_code, key)
+
+
+    def getFile(self, key, fileobj):
+        """
+        Get a stored value, writing it to a file a chunk at a time instead
+        of holding it in memory.  Nobody is asked for missing values and
+        the value isn't remembered.
+
+        @param fileobj: A file open for writing in binary mode.
+
+        @raise NotFound: If there is no such value.
+
+        @return: The version of the value.
+        """
+        r = self._send('GET', '%s/%s' % (self.url, key), stream=True)
+        try:
+            if r.status_code != 200:
+                raise _failed(r.status_code, key)
+            for chunk in r.iter_content(CHUNK_SIZE):
+                fileobj.write(chunk)
+        finally:
+            r.close()
+        version = _etagVersion(r.headers.get('ETag'))
+        self._remember(key, version)
+        return version
+
+
+    def getValues(self, keys):
+        """
+        Get several values from the data store in one request.
+
+        @param keys: A list of keys.  Each may be a string or a dict with
+            a C{'key'} and any of the C{'prompt'}, C{'save'} and C{'options'}
+            arguments of L{getValue}.
+
+        @return: A dict of key to value.  Keys that have no value (and
+            weren't supplied by a user) are left out.
+        """
+        values, keys = _cached(self.cache, keys)
+        if not keys:
+            return values
+        r = self._send('POST', '%s/:batch' % (self.url,),
+            data=json.dumps({'get': keys}),
+            timeout=None if _prompts(keys) else self.timeout)
+        if r.status_code == 200:
+            fetched = dict([(k.encode('utf-8'), v.encode('utf-8'))
+                for k, v in r.json()['values'].items()])
+            _remember(self.cache, keys, fetched)
+            for k in fetched:
+                self.versions.pop(k, None)
+            values.update(fetched)
+            return values
+        raise _getFailed(r.status_code, keys)
+
+
+    def putValues(self, values):
+        """
+        Save several values in the data store in one request.
+
+        @param values: A dict of key to value.  Values must be text.
         """
-        r = requests.put('%s/%s' % (self.url, key), data=value)
+        r = self._send('POST', '%s/:batch' % (self.url,),
+            data=json.dumps({'put': values}))
         if r.status_code == 200:
+            for k, v in values.items():
+                self.versions.pop(_utf8(k), None)
+                if self.cache is not None:
+                    self.cache[_utf8(k)] = _utf8(v)
             return
-        raise NotFound(key)
+        raise _failed(r.status_code, values.keys())
 
 
     def getToken(self, value):
         """
         Exchange a sensitive value for a consistent opaque token.
         """
-        r = requests.post(self.url, params={'value': value})
+        r = self._send('POST', self.url, params={'value': value})
         if r.status_code == 200:
             return r.text
-        raise NotFound()
+        raise _failed(r.status_code)
 
 
 
+# The module-level functions share this client's connections.
 _global_client = Client(os.environ.get('DATASTORE_URL',
         'DATASTORE_URL was not set'))
 
 getValue = _global_client.getValue
 putValue = _global_client.putValue
+getValues = _global_client.getValues
+putValues = _global_client.putValues
+getFile = _global_client.getFile
+putFile = _global_client.putFile
 getToken = _global_client.getToken
@@ -0,0 +1,905 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I am the part of the data API clients that doesn't do any I/O: building
+requests, interpreting responses, remembering values and parsing a stream
+of pipelined HTTP/1.1 responses.
+
+L{siloscript.lite}, L{siloscript.client}, L{siloscript.txclient} and
+L{siloscript.aioclient} share me.  I import nothing at import time (so
+that C{import siloscript} stays cheap) and work on Python 2 and 3 (so that
+L{siloscript.aioclient} can use me).
+"""
+
+from collections import deque
+
+from siloscript.error import NotFound, Unavailable, NoAnswer, Overloaded
+from siloscript.error import Timeout, VersionMismatch
+
+try:
+    unicode
+except NameError:
+    # Python 3
+    unicode = str
+
+
+# DATASTORE_URLs of this scheme name a Unix socket, url-quoted, in place of
+# the host.  See L{siloscript.process.unixSocketURL}.
+UNIX_SCHEME = 'http+unix'
+
+# URL schemes of the msgpack data protocol.  See L{siloscript.dataproto}.
+BINARY_TCP_SCHEME = 'msgpack+tcp'
+BINARY_UNIX_SCHEME = 'msgpack+unix'
+
+# Bytes read at a time when streaming a value to or from a file.
+CHUNK_SIZE = 65536
+
+# Times a request the server turned away for being too busy (503, or
+# OVERLOADED in the msgpack protocol) is tried again.  See _retryDelay.
+RETRIES = 4
+
+# Response statuses of the msgpack data protocol.
+OK = 0
+NOT_FOUND = 1
+BAD_REQUEST = 2
+ERROR = 3
+VERSION_MISMATCH = 4
+NO_ANSWER = 5
+OVERLOADED = 6
+
+
+
+def _utf8(s):
+    """
+    Encode text as UTF-8 bytes.
+    """
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+
+def _native(s):
+    """
+    Make a C{str} (bytes on Python 2, text on Python 3) of some UTF-8 bytes
+    or text.
+    """
+    if str is bytes:
+        return _utf8(s)
+    if isinstance(s, bytes):
+        return s.decode('utf-8')
+    return s
+
+
+
+def _text(body, content_type):
+    """
+    Decode a response body the way C{requests} does for C{text/*}.
+    """
+    charset = 'ISO-8859-1'
+    for param in (content_type or '').split(';')[1:]:
+        name, _, value = param.strip().partition('=')
+        if name.lower() == 'charset' and value:
+            charset = value.strip('"\'')
+    return body.decode(charset, 'replace')
+
+
+
+def _etagVersion(etag):
+    """
+    Get the version of a value from its C{ETag} header, if there is one.
+    """
+    if not etag:
+        return None
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"')
+
+
+
+def _getFailed(status, key):
+    """
+    Get the exception to raise when getting C{key} failed with C{status}.
+    """
+    if status == 504:
+        # a question was asked but not answered in time
+        return NoAnswer(key)
+    return _failed(status, key)
+
+
+
+def _failed(status, *args):
+    """
+    Get the exception (made with C{args}) to raise when a request failed
+    with C{status}.
+    """
+    if status == 503:
+        return Overloaded(*args)
+    return NotFound(*args)
+
+
+
+def _retryDelay(attempt, retry_after=None, base=0.1, cap=5.0):
+    """
+    Get the seconds to wait before trying a request the server was too busy
+    for again: its C{Retry-After}, if it sent one, plus a random part of an
+    exponential backoff ("full jitter"), so that clients turned away at the
+    same time don't all come back at the same time.
+
+    @param attempt: 1 for the first retry, 2 for the second and so on.
+    """
+    import random
+    try:
+        retry_after = float(retry_after or 0)
+    except ValueError:
+        retry_after = 0
+    return retry_after + random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+
+def _fileLength(f):
+    """
+    Get the number of bytes left to read in a file, or C{None} if that
+    can't be known because it can't seek (a pipe, say).
+    """
+    try:
+        start = f.tell()
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(start)
+    except (AttributeError, IOError, OSError):
+        return None
+    return end - start
+
+
+
+def _keyAndSave(req):
+    """
+    Get the key and whether it's saved from a C{getValues} request.
+    """
+    if isinstance(req, dict):
+        return _native(req['key']), req.get('save', True) is not False
+    return _native(req), True
+
+
+
+def _cached(cache, requests):
+    """
+    Find the values in C{cache} for a list of C{getValues} requests.
+
+    @return: A dict of the cached values and a list of the requests that
+        weren't cached.
+    """
+    if cache is None:
+        return {}, requests
+    values = {}
+    missing = []
+    for req in requests:
+        key, save = _keyAndSave(req)
+        if save and key in cache:
+            values[key] = _native(cache[key])
+        else:
+            missing.append(req)
+    return values, missing
+
+
+
+def _prompts(requests):
+    """
+    @return: C{True} if any of a list of C{getValues} requests may ask a
+        person, and so can take as long as they do to answer.
+    """
+    for req in requests:
+        if isinstance(req, dict) and req.get('prompt'):
+            return True
+    return False
+
+
+
+def _remember(cache, requests, values):
+    """
+    Put the C{values} fetched for C{getValues} C{requests} in C{cache},
+    except for the ones that shouldn't be saved.
+    """
+    if cache is None:
+        return
+    for req in requests:
+        key, save = _keyAndSave(req)
+        if save and key in values:
+            cache[key] = _utf8(values[key])
+
+
+
+def splitURL(data_url):
+    """
+    Split a C{DATASTORE_URL} into where to connect and the path of the silo.
+
+    @return: A tuple of scheme, address and path.  The address is a
+        C{(host, port)} tuple or, for Unix socket URLs, the socket's path.
+    """
+    try:
+        from urlparse import urlsplit
+        from urllib import unquote
+    except ImportError:
+        from urllib.parse import urlsplit, unquote
+    parsed = urlsplit(data_url)
+    if parsed.scheme in (UNIX_SCHEME, BINARY_UNIX_SCHEME):
+        address = unquote(parsed.netloc)
+    else:
+        address = (parsed.hostname, parsed.port or 80)
+    return parsed.scheme, address, parsed.path.rstrip('/')
+
+
+
+class Response(object):
+    """
+    I am an HTTP response.
+
+    @ivar status: Integer status code.
+    @ivar headers: A dict of lower-case header names to values.
+    @ivar body: The body bytes.
+    """
+
+    def __init__(self, version, status, headers, body):
+        self.version = version
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+    @property
+    def willClose(self):
+        """
+        Whether the server will close the connection after this response.
+        """
+        connection = self.header('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection != 'keep-alive'
+        return connection == 'close'
+
+
+
+class ResponseParser(object):
+    """
+    I parse a stream of HTTP/1.1 responses, such as the responses to
+    pipelined requests.  Bodies may be sized by C{Content-Length}, chunked
+    or run until the connection closes.
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._state = self._status
+        self._start()
+
+
+    def _start(self):
+        self._version = None
+        self._code = None
+        self._headers = {}
+        self._body = []
+        self._remaining = 0
+
+
+    def feed(self, data):
+        """
+        Parse some bytes.
+
+        @return: A list of the L{Response}s that are now complete.
+        """
+        self._buffer += data
+        responses = []
+        while self._buffer:
+            result = self._state()
+            if result is False:
+                break
+            if result is not None:
+                responses.append(result)
+        return responses
+
+
+    def finish(self):
+        """
+        The connection has closed.
+
+        @return: The L{Response} whose body ran until the connection closed,
+            if there is one, or else C{None}.
+        """
+        if self._state == self._untilClose:
+            self._body.append(self._buffer)
+            self._buffer = b''
+            return self._done()
+
+
+    def _line(self):
+        i = self._buffer.find(b'\r\n')
+        if i == -1:
+            return None
+        line = self._buffer[:i]
+        self._buffer = self._buffer[i+2:]
+        return line.decode('latin-1')
+
+
+    def _status(self):
+        line = self._line()
+        if line is None:
+            return False
+        parts = line.split(' ', 2)
+        self._version = parts[0]
+        self._code = int(parts[1])
+        self._state = self._header
+
+
+    def _header(self):
+        line = self._line()
+        if line is None:
+            return False
+        if line:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name in self._headers:
+                value = '%s, %s' % (self._headers[name], value)
+            self._headers[name] = value
+            return
+        if 100 <= self._code < 200:
+            # informational; the real response follows
+            self._state = self._status
+            self._start()
+        elif self._code in (204, 304):
+            return self._done()
+        elif 'chunked' in self._headers.get('transfer-encoding', ''):
+            self._state = self._chunkSize
+        elif 'content-length' in self._headers:
+            self._remaining = int(self._headers['content-length'])
+            self._state = self._sized
+            if not self._remaining:
+                return self._done()
+        else:
+            self._state = self._untilClose
+
+
+    def _sized(self):
+        data = self._buffer[:self._remaining]
+        self._buffer = self._buffer[len(data):]
+        self._body.append(data)
+        self._remaining -= len(data)
+        if not self._remaining:
+            return self._done()
+        return False
+
+
+    def _chunkSize(self):
+        line = self._line()
+        if line is None:
+            return False
+        size = int(line.split(';')[0].strip(), 16)
+        if size:
+            self._remaining = size
+            self._state = self._chunk
+        else:
+            self._state = self._trailer
+
+
+    def _chunk(self):
+        if len(self._buffer) < self._remaining + 2:
+            return False
+        self._body.append(self._buffer[:self._remaining])
+        self._buffer = self._buffer[self._remaining + 2:]
+        self._state = self._chunkSize
+
+
+    def _trailer(self):
+        line = self._line()
+        if line is None:
+            return False
+        if not line:
+            return self._done()
+
+
+    def _untilClose(self):
+        self._body.append(self._buffer)
+        self._buffer = b''
+        return False
+
+
+    def _done(self):
+        response = Response(self._version, self._code, self._headers,
+            b''.join(self._body))
+        self._state = self._status
+        self._start()
+        return response
+
+
+
+def encodeRequest(method, path, body=b'', host='localhost', headers=None):
+    """
+    Make the bytes of an HTTP/1.1 request.
+
+    @param headers: A dict of any other headers to send.
+    """
+    head = '%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n' % (
+        method, path, host, len(body))
+    for name, value in sorted((headers or {}).items()):
+        head += '%s: %s\r\n' % (name, value)
+    return (head + '\r\n').encode('latin-1') + body
+
+
+
+class _Pending(object):
+    """
+    A request waiting for its response.
+
+    @ivar retry: Whether it's safe to send again if the connection is lost
+        before the response comes.
+    @ivar abandoned: Whether the requester has given up waiting for it, so
+        that it isn't sent (again).
+    """
+
+    abandoned = False
+
+    def __init__(self, data, callback, errback, retry=False):
+        self.data = data
+        self.callback = callback
+        self.errback = errback
+        self.retry = retry
+        self.attempts = 0
+
+
+
+class PipelinedConnection(object):
+    """
+    I am one HTTP/1.1 connection that can have several requests
+    outstanding.  Responses come back in the order requests were sent.
+    """
+
+    def __init__(self, write, close):
+        """
+        @param write: A function that will send bytes to the server.
+        @param close: A function that will close the connection.
+        """
+        self.write = write
+        self.close = close
+        self.pending = deque()
+        self.closing = False
+        self._parser = ResponseParser()
+
+
+    def send(self, pending):
+        pending.attempts += 1
+        self.pending.append(pending)
+        self.write(pending.data)
+
+
+    def dataReceived(self, data):
+        for response in self._parser.feed(data):
+            pending = self.pending.popleft()
+            if response.willClose:
+                self.closing = True
+            pending.callback(response)
+
+
+    def connectionLost(self):
+        """
+        @return: The requests that never got a response.
+        """
+        response = self._parser.finish()
+        if response is not None and self.pending:
+            self.pending.popleft().callback(response)
+        unanswered = list(self.pending)
+        self.pending.clear()
+        return unanswered
+
+
+
+class ConnectionPool(object):
+    """
+    I spread requests over up to C{size} L{PipelinedConnection}s.  A request
+    goes to an idle connection if there is one, to a new connection if
+    there's room for one, or else is pipelined on the connection with the
+    fewest requests outstanding.
+
+    Requests left unanswered when a connection closes are sent once more
+    if they're safe to repeat (they only read); the others fail with
+    L{Unavailable}, since the server may have acted on them.
+
+    I don't do any I/O myself.  My C{connect} function should start
+    connecting and later call L{added} with a L{PipelinedConnection} (or
+    L{failed}), and L{lost} when that connection is lost.
+    """
+
+    def __init__(self, connect, size=2):
+        self.connect = connect
+        self.size = size
+        self.connections = []
+        self.connecting = 0
+        self.waiting = deque()
+
+
+    def request(self, data, callback, errback, retry=False):
+        """
+        Send a request.
+
+        @param data: The request's bytes.  See L{encodeRequest}.
+        @param callback: Will be called with the L{Response}.
+        @param errback: Will be called with an exception if there's no
+            response.
+        @param retry: If C{True}, the request only reads, so it can be sent
+            again if its connection is lost.
+
+        @return: The request, which can be L{abandon}ed.
+        """
+        pending = _Pending(data, callback, errback, retry)
+        self._dispatch(pending)
+        return pending
+
+
+    def abandon(self, pending):
+        """
+        Give up on a request (because it timed out, say).  It's not sent if
+        it hasn't been yet, nor again if its connection is lost.  Its
+        response, if it comes, is thrown away.
+        """
+        pending.abandoned = True
+        pending.callback = pending.errback = lambda result: None
+
+
+    def _usable(self):
+        return [c for c in self.connections if not c.closing]
+
+
+    def _dispatch(self, pending):
+        if pending.abandoned:
+            return
+        usable = self._usable()
+        idle = [c for c in usable if not c.pending]
+        if idle:
+            idle[0].send(pending)
+        elif len(usable) + self.connecting < self.size:
+            self.waiting.append(pending)
+            self.connecting += 1
+            self.connect()
+        elif usable:
+            min(usable, key=lambda c: len(c.pending)).send(pending)
+        else:
+            self.waiting.append(pending)
+
+
+    def _sendWaiting(self):
+        waiting = self.waiting
+        self.waiting = deque()
+        while waiting:
+            self._dispatch(waiting.popleft())
+
+
+    def added(self, conn):
+        """
+        A connection I asked for was made.
+        """
+        self.connecting -= 1
+        self.connections.append(conn)
+        self._sendWaiting()
+
+
+    def failed(self, reason):
+        """
+        A connection I asked for couldn't be made.
+        """
+        self.connecting -= 1
+        if self._usable() or self.connecting:
+            self._sendWaiting()
+            return
+        waiting = self.waiting
+        self.waiting = deque()
+        for pending in waiting:
+            pending.errback(reason)
+
+
+    def lost(self, conn):
+        """
+        A connection was lost.
+        """
+        if conn in self.connections:
+            self.connections.remove(conn)
+        for pending in conn.connectionLost():
+            if pending.abandoned:
+                continue
+            if pending.retry and pending.attempts == 1:
+                self._dispatch(pending)
+            else:
+                pending.errback(Unavailable('Lost connection to data server'))
+
+
+    def close(self):
+        """
+        Close all my connections.  Requests still waiting for a connection
+        or a response fail with L{Unavailable}.
+        """
+        unanswered = list(self.waiting)
+        self.waiting.clear()
+        for conn in list(self.connections):
+            conn.closing = True
+            unanswered.extend(conn.pending)
+            conn.pending.clear()
+            conn.close()
+        for pending in unanswered:
+            pending.errback(Unavailable('Closed the connection'))
+
+
+
+class AsyncClient(object):
+    """
+    I am the base of non-blocking clients for the data API with the same
+    methods as L{siloscript.client.Client}, except for C{getFile} and
+    C{putFile}.  Many requests can be outstanding at once; they share a
+    pool of pipelined connections.
+
+    Subclasses give me the L{siloscript.interfaces.IClientLoop} of their
+    event loop, which connects (see L{ConnectionPool}) and makes the kind of
+    future it uses.
+
+    @ivar versions: A dict of key to the version of the value last gotten
+        or put.  See L{getVersion}.
+    """
+
+    def __init__(self, data_url, client_loop, pool_size=2, cache=True,
+            timeout=None):
+        """
+        @param data_url: The C{DATASTORE_URL} given to the script.  Both
+            C{http} and C{http+unix} URLs work.
+        @param client_loop: An L{siloscript.interfaces.IClientLoop}.
+        @param pool_size: Maximum number of connections to open.
+        @param cache: If C{False}, don't remember values.  See
+            L{siloscript.client.Client}.
+        @param timeout: Seconds to wait for a response (including for a
+            connection to send it on), or C{None} to wait forever.
+            Requests that prompt wait for a person to answer, so they never
+            time out.  A request that times out fails with L{Timeout} and
+            is never sent again.
+        """
+        self.url = data_url
+        self.scheme, self.address, self.path = splitURL(data_url)
+        if self.scheme not in ('http', UNIX_SCHEME):
+            raise ValueError('Unsupported data URL: %r' % (data_url,))
+        self.host = 'localhost'
+        if self.scheme == 'http':
+            self.host = '%s:%d' % self.address
+        self.client_loop = client_loop
+        self.timeout = timeout
+        self.cache = {} if cache else None
+        self.versions = {}
+        self.retries = RETRIES
+        self.pool = ConnectionPool(lambda: client_loop.connect(self),
+            pool_size)
+
+
+    def _request(self, method, path, params=None, body=b'', headers=None,
+            prompt=False):
+        """
+        Make a request, trying it again if the server is too busy.
+
+        @param prompt: Whether a person may be asked, in which case the
+            request doesn't time out.
+
+        @return: A future L{Response}.
+        """
+        try:
+            from urllib import urlencode, quote
+        except ImportError:
+            from urllib.parse import urlencode, quote
+        path = self.path + quote(_utf8(path), safe='/:')
+        if params:
+            path += '?' + urlencode(params, True)
+        loop = self.client_loop
+        future, callback, errback = loop.newFuture()
+        data = encodeRequest(method, path, body, self.host, headers)
+        state = {'retries': 0, 'pending': None, 'timer': None, 'done': False}
+        def finish(f, result):
+            if state['done']:
+                return
+            state['done'] = True
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            f(result)
+        def respond(response):
+            if response.status == 503 and state['retries'] < self.retries:
+                state['retries'] += 1
+                loop.callLater(_retryDelay(state['retries'],
+                    response.header('retry-after')), send)
+            else:
+                finish(callback, response)
+        def send():
+            if not state['done']:
+                state['pending'] = self.pool.request(data, respond,
+                    lambda exc: finish(errback, exc), retry=method == 'GET')
+        def expire():
+            state['timer'] = None
+            self.pool.abandon(state['pending'])
+            finish(errback, Timeout(method, path))
+        timeout = None if prompt else self.timeout
+        if timeout is not None:
+            state['timer'] = loop.callLater(timeout, expire)
+        send()
+        return future
+
+
+    def close(self):
+        """
+        Close my connections.
+        """
+        self.pool.close()
+
+
+    def forget(self, key=None):
+        """
+        Forget a remembered value so that it's fetched again next time.
+
+        @param key: The key to forget, or C{None} to forget everything.
+        """
+        if key is None:
+            self.versions.clear()
+        else:
+            self.versions.pop(key, None)
+        if self.cache is not None:
+            if key is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
+
+
+    def getVersion(self, key):
+        """
+        Get the version of the value I last got or put for C{key}, for use
+        with L{putValue}'s C{if_version}.
+
+        @return: The version, or C{None} if I don't know it.
+        """
+        return self.versions.get(key)
+
+
+    def _remember(self, key, version):
+        if version is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = version
+
+
+    def getValue(self, key, prompt=None, save=True, options=None,
+            revalidate=False):
+        """
+        Get a value from the data store.
+
+        See L{siloscript.client.Client.getValue}.
+
+        @return: A future value.
+        """
+        cached = (save is not False and self.cache is not None
+            and key in self.cache)
+        if cached and not revalidate:
+            return self.client_loop.succeed(_text(self.cache[key], None))
+        params = []
+        if prompt:
+            params.append(('prompt', _utf8(prompt)))
+        if save is False:
+            params.append(('save', 'False'))
+        if options is not None:
+            params.append(('options', [_utf8(x) for x in options]))
+        headers = {}
+        if cached and key in self.versions:
+            headers['If-None-Match'] = '"%s"' % (self.versions[key],)
+        return self.client_loop.then(self._request('GET', '/' + key, params,
+            headers=headers, prompt=bool(prompt)), self._gotValue, key, save,
+            cached)
+
+
+    def _gotValue(self, response, key, save, cached):
+        if response.status == 304 and cached and key in self.cache:
+            return _text(self.cache[key], None)
+        if response.status != 200:
+            raise _getFailed(response.status, key)
+        self._remember(key, _etagVersion(response.header('etag')))
+        if save is not False and self.cache is not None:
+            self.cache[key] = response.body
+        return _text(response.body, response.header('content-type'))
+
+
+    def putValue(self, key, value, if_version=None):
+        """
+        Save a value in the data store.
+
+        See L{siloscript.client.Client.putValue}.
+
+        @return: A future of the new version of the value.  It fails with
+            L{VersionMismatch} if C{if_version} doesn't match.
+        """
+        value = _utf8(value)
+        headers = {}
+        if if_version is not None:
+            if if_version != '*':
+                if_version = '"%s"' % (if_version,)
+            headers['If-Match'] = if_version
+        return self.client_loop.then(self._request('PUT', '/' + key,
+            body=value, headers=headers), self._putValue, key, value)
+
+
+    def _putValue(self, response, key, value):
+        if response.status == 412:
+            self.forget(key)
+            raise VersionMismatch(key)
+        if response.status != 200:
+            raise _failed(response.status, key)
+        version = _etagVersion(response.header('etag'))
+        self._remember(key, version)
+        if self.cache is not None:
+            self.cache[key] = value
+        return version
+
+
+    def getValues(self, keys):
+        """
+        Get several values from the data store in one request.
+
+        See L{siloscript.client.Client.getValues}.
+
+        @return: A future dict.
+        """
+        import json
+        values, keys = _cached(self.cache, keys)
+        if not keys:
+            return self.client_loop.succeed(values)
+        body = json.dumps({'get': keys}).encode('utf-8')
+        return self.client_loop.then(self._request('POST', '/:batch',
+            body=body, prompt=_prompts(keys)), self._gotValues, keys, values)
+
+
+    def _gotValues(self, response, keys, values):
+        import json
+        if response.status != 200:
+            raise _getFailed(response.status, keys)
+        fetched = dict([(_native(k), _native(v)) for k, v
+            in json.loads(response.body.decode('utf-8'))['values'].items()])
+        _remember(self.cache, keys, fetched)
+        for k in fetched:
+            self.versions.pop(k, None)
+        values.update(fetched)
+        return values
+
+
+    def putValues(self, values):
+        """
+        Save several values in the data store in one request.
+
+        @return: A future that's done when the values are saved.
+        """
+        import json
+        body = json.dumps({'put': values}).encode('utf-8')
+        return self.client_loop.then(self._request('POST', '/:batch',
+            body=body), self._putValues, values)
+
+
+    def _putValues(self, response, values):
+        if response.status != 200:
+            raise _failed(response.status, list(values.keys()))
+        for k, v in values.items():
+            self.versions.pop(_native(k), None)
+            if self.cache is not None:
+                self.cache[_native(k)] = _utf8(v)
+
+
+    def getToken(self, value):
+        """
+        Exchange a sensitive value for a consistent opaque token.
+
+        @return: A future token.
+        """
+        return self.client_loop.then(self._request('POST', '',
+            [('value', _utf8(value))]), self._gotToken)
+
+
+    def _gotToken(self, response):
+        if response.status != 200:
+            raise _failed(response.status)
+        return _text(response.body, response.header('content-type'))
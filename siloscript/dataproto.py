@@ -0,0 +1,114 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+A compact alternative to L{siloscript.server.DataWebApp} for scripts.
+
+Each request and response is a msgpack array prefixed by its length (a
+4-byte big-endian integer).  Requests are::
+
+    [request_id, operation, silo_key, args...]
+
+where the operation is one of C{'get'}, C{'put'}, C{'token'}, C{'getMany'}
+or C{'putMany'} and the args are those of the matching C{Machine.data_*}
+method.  Responses are::
+
+    [request_id, status, result]
+
+where the status is one of the constants in L{siloscript.clientcore}.  Many
+requests may be outstanding on one connection; responses are sent as soon
+as they're ready, which may not be in the order the requests were made.
+
+L{siloscript.binclient.Client} speaks this protocol.
+"""
+
+from twisted.internet import defer, protocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+import msgpack
+
+from siloscript.error import NotFound, InvalidKey, VersionMismatch
+from siloscript.error import NoAnswer, Overloaded
+from siloscript.clientcore import OK, NOT_FOUND, BAD_REQUEST, ERROR
+from siloscript.clientcore import VERSION_MISMATCH, NO_ANSWER, OVERLOADED
+
+
+
+class DataProtocol(Int32StringReceiver):
+    """
+    I answer msgpack data requests for scripts.
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    operations = {
+        'get': 'data_get',
+        'put': 'data_put',
+        'token': 'data_createToken',
+        'getMany': 'data_getMany',
+        'putMany': 'data_putMany',
+    }
+
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.disconnected = False
+
+
+    def connectionLost(self, reason):
+        self.disconnected = True
+
+
+    def stringReceived(self, frame):
+        try:
+            msg = msgpack.unpackb(frame)
+            request_id, operation, args = msg[0], msg[1], msg[2:]
+        except Exception:
+            log.err(None, 'Bad data protocol frame')
+            self.transport.loseConnection()
+            return
+        name = self.operations.get(operation)
+        if name is None:
+            self._respond(request_id, BAD_REQUEST,
+                'Unknown operation: %r' % (operation,))
+            return
+        d = defer.maybeDeferred(getattr(self.machine, name), *args)
+        d.addCallbacks(lambda result: self._respond(request_id, OK, result),
+            self._failed, errbackArgs=(request_id,))
+        d.addErrback(log.err)
+
+
+    def _failed(self, err, request_id):
+        if err.check(NotFound, KeyError):
+            self._respond(request_id, NOT_FOUND, 'Not found')
+        elif err.check(VersionMismatch):
+            self._respond(request_id, VERSION_MISMATCH, 'Version mismatch')
+        elif err.check(NoAnswer):
+            self._respond(request_id, NO_ANSWER, 'No answer to the question')
+        elif err.check(Overloaded):
+            self._respond(request_id, OVERLOADED, 'Too busy, try again later')
+        elif err.check(TypeError, ValueError, InvalidKey):
+            log.msg(err.getErrorMessage())
+            self._respond(request_id, BAD_REQUEST, err.getErrorMessage())
+        else:
+            log.err(err)
+            self._respond(request_id, ERROR, 'Error, try again later.')
+
+
+    def _respond(self, request_id, status, result):
+        if not self.disconnected:
+            self.sendString(msgpack.packb([request_id, status, result]))
+
+
+
+class DataFactory(protocol.Factory):
+    """
+    I make L{DataProtocol}s for a L{siloscript.server.Machine}.
+    """
+
+    def __init__(self, machine):
+        self.machine = machine
+
+
+    def buildProtocol(self, addr):
+        return DataProtocol(self.machine)
@@ -5,3 +5,8 @@ class Error(Exception): pass
 class NotFound(Error): pass
 class InvalidKey(Error): pass
 class CryptError(Error): pass
+class Timeout(Error): pass
+class Unavailable(Error): pass
+class VersionMismatch(Error): pass
+class NoAnswer(Error): pass
+class Overloaded(Unavailable): pass
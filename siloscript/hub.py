@@ -0,0 +1,430 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I link the worker processes of C{siloscript serve --workers N}.
+
+Each worker has its own L{siloscript.server.Machine}, so a question asked
+by a script run by one worker has to reach the user's browser, whose
+event stream may be connected to another, and the answer, which may be
+posted to a third, has to get back.  Workers tell the hub (in the parent
+process) about questions and answers, and it passes them on to the other
+workers.  Likewise, a request for the status or log of a job can reach a
+worker other than the one running it, so workers ask the others through
+the hub about jobs they don't have.
+"""
+
+from twisted.internet import protocol, defer
+from twisted.protocols import amp
+from twisted.python import log
+
+import json
+from uuid import uuid4
+
+from siloscript.jobs import _jsonable
+
+
+
+class _BigString(amp.String):
+    """
+    A string that may be longer than an AMP value allows, sent as several
+    values (C{name.0}, C{name.1}, ...).
+    """
+
+    chunk_size = 60000
+
+    def toBox(self, name, strings, objects, proto):
+        value = objects[name]
+        for i in xrange(0, max(len(value), 1), self.chunk_size):
+            strings['%s.%d' % (name, i // self.chunk_size)] = \
+                value[i:i + self.chunk_size]
+
+
+    def fromBox(self, name, strings, objects, proto):
+        parts = []
+        while '%s.%d' % (name, len(parts)) in strings:
+            parts.append(strings.pop('%s.%d' % (name, len(parts))))
+        objects[name] = ''.join(parts)
+
+
+
+class Ask(amp.Command):
+    """
+    Worker <-> hub: a script asked a question of a channel.
+    """
+    arguments = [
+        ('channel_key', amp.Unicode()),
+        ('question', _BigString()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+
+class Answer(amp.Command):
+    """
+    Worker <-> hub: someone answered a question this worker didn't ask.
+    """
+    arguments = [
+        ('question_id', amp.Unicode()),
+        ('answer', _BigString()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+
+class Answered(amp.Command):
+    """
+    Worker <-> hub: a question has been answered, so channels should stop
+    offering it.
+    """
+    arguments = [
+        ('channel_key', amp.Unicode()),
+        ('question_id', amp.Unicode()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+
+class JobStatus(amp.Command):
+    """
+    Worker -> hub -> workers: get the status of a job (see
+    L{siloscript.jobs}) that another worker may be running, waiting up to
+    C{wait} seconds for it to finish.
+    """
+    arguments = [
+        ('job_id', amp.Unicode()),
+        ('wait', amp.Float()),
+    ]
+    response = [
+        # JSON, or empty if the worker doesn't have the job
+        ('status', _BigString()),
+    ]
+
+
+
+class WatchJob(amp.Command):
+    """
+    Worker -> hub -> workers: start sending a job's log messages after
+    number C{after} as L{JobEvent}s for C{watch_id}.
+    """
+    arguments = [
+        ('job_id', amp.Unicode()),
+        ('watch_id', amp.String()),
+        ('after', amp.Integer()),
+    ]
+    response = [
+        ('found', amp.Boolean()),
+    ]
+
+
+
+class JobEvent(amp.Command):
+    """
+    Worker -> hub -> worker: a message from the log of a watched job.
+    """
+    arguments = [
+        ('watch_id', amp.String()),
+        ('seq', amp.Integer()),
+        ('event', _BigString()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+
+class UnwatchJob(amp.Command):
+    """
+    Worker -> hub -> workers: stop sending L{JobEvent}s for C{watch_id}.
+    """
+    arguments = [
+        ('watch_id', amp.String()),
+    ]
+    response = []
+    requiresAnswer = False
+
+
+
+class _HubProtocol(amp.AMP):
+    """
+    I pass a worker's messages on to the other workers.
+    """
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.factory.workers.append(self)
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.factory.workers.remove(self)
+        for watch_id, watcher in self.factory.watchers.items():
+            if watcher is self:
+                del self.factory.watchers[watch_id]
+
+
+    @Ask.responder
+    def ask(self, **kwargs):
+        self.factory.relay(self, Ask, kwargs)
+        return {}
+
+
+    @Answer.responder
+    def answer(self, **kwargs):
+        self.factory.relay(self, Answer, kwargs)
+        return {}
+
+
+    @Answered.responder
+    def answered(self, **kwargs):
+        self.factory.relay(self, Answered, kwargs)
+        return {}
+
+
+    @JobStatus.responder
+    def jobStatus(self, **kwargs):
+        return self.factory.find(self, JobStatus, kwargs, 'status')
+
+
+    @WatchJob.responder
+    def watchJob(self, **kwargs):
+        # Events may come before the job's worker answers.
+        self.factory.watchers[kwargs['watch_id']] = self
+        d = self.factory.find(self, WatchJob, kwargs, 'found')
+        def found(response):
+            if not response['found']:
+                self.factory.watchers.pop(kwargs['watch_id'], None)
+            return {'found': response['found']}
+        return d.addCallback(found)
+
+
+    @JobEvent.responder
+    def jobEvent(self, **kwargs):
+        watcher = self.factory.watchers.get(kwargs['watch_id'])
+        if watcher is not None:
+            watcher.callRemote(JobEvent, **kwargs)
+        return {}
+
+
+    @UnwatchJob.responder
+    def unwatchJob(self, **kwargs):
+        self.factory.watchers.pop(kwargs['watch_id'], None)
+        self.factory.relay(self, UnwatchJob, kwargs)
+        return {}
+
+
+
+class HubFactory(protocol.Factory):
+    """
+    I am the hub that workers connect to.
+    """
+
+    protocol = _HubProtocol
+
+    def __init__(self):
+        self.workers = []
+        # watch ids of jobs (see WatchJob) -> worker watching
+        self.watchers = {}
+
+
+    def relay(self, sender, command, kwargs):
+        """
+        Send a command to every worker but C{sender}.
+        """
+        for worker in self.workers:
+            if worker is not sender:
+                worker.callRemote(command, **kwargs)
+
+
+    def find(self, sender, command, kwargs, name):
+        """
+        Send a command to every worker but C{sender} and return the first
+        non-empty C{name} value of their responses.
+
+        @return: A L{Deferred} response.
+        """
+        dl = [worker.callRemote(command, **kwargs) for worker in self.workers
+            if worker is not sender]
+        def found(results):
+            for success, response in results:
+                if success and response[name]:
+                    return response
+            return {name: ''}
+        return defer.DeferredList(dl, consumeErrors=True).addCallback(found)
+
+
+
+class HubClient(amp.AMP):
+    """
+    I connect a worker's L{Machine} and L{ControlWebApp} to the hub.
+
+    @ivar disconnected: A L{Deferred} that fires when I lose the hub.
+    """
+
+    def __init__(self, machine, control):
+        """
+        @param machine: The worker's L{siloscript.server.Machine}.
+        @param control: The worker's L{siloscript.server.ControlWebApp}.
+        """
+        amp.AMP.__init__(self)
+        self.machine = machine
+        self.control = control
+        self.disconnected = defer.Deferred()
+        # jobs on other workers I'm watching: watch id -> listener
+        self._watches = {}
+        # jobs of mine other workers are watching: watch id -> stop function
+        self._watched = {}
+        # questions other workers asked that my channels are offering:
+        # question id -> (channel key, expiry call or None)
+        self._relayed = {}
+
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.machine.hub = self
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if self.machine.hub is self:
+            self.machine.hub = None
+        # without the hub I'll never hear they're answered
+        for question_id in list(self._relayed):
+            self._forget(question_id)
+        log.msg('lost the hub: %s' % (reason.getErrorMessage(),),
+            system='hub')
+        self.disconnected.callback(None)
+
+
+    def ask(self, channel_key, question):
+        """
+        Tell the other workers about a question asked of a channel.
+        """
+        self.callRemote(Ask, channel_key=channel_key,
+            question=json.dumps(question))
+
+
+    def answer(self, question_id, answer):
+        """
+        Pass an answer to a question this worker didn't ask to the others.
+        """
+        self.callRemote(Answer, question_id=question_id, answer=answer)
+
+
+    def answered(self, channel_key, question_id):
+        """
+        Tell the other workers a question has been answered.
+        """
+        self.callRemote(Answered, channel_key=channel_key,
+            question_id=question_id)
+
+
+    def jobStatus(self, job_id, wait):
+        """
+        Get the status of a job run by another worker.
+
+        @return: A L{Deferred} status dict, or C{None} if no worker has
+            the job.
+        """
+        d = self.callRemote(JobStatus, job_id=job_id, wait=wait)
+        d.addCallback(lambda r: json.loads(r['status']) if r['status']
+            else None)
+        return d
+
+
+    def watchJob(self, job_id, listener, after):
+        """
+        Watch the log of a job run by another worker.  See
+        L{siloscript.server.ControlWebApp.watch_job}.
+        """
+        watch_id = uuid4().hex
+        self._watches[watch_id] = listener
+        d = self.callRemote(WatchJob, job_id=job_id, watch_id=watch_id,
+            after=after)
+        def stop():
+            if self._watches.pop(watch_id, None) is not None:
+                self.callRemote(UnwatchJob, watch_id=watch_id)
+        def watching(response):
+            if not response['found']:
+                self._watches.pop(watch_id, None)
+                return None
+            return stop
+        return d.addCallback(watching)
+
+
+    def _forget(self, question_id):
+        """
+        Stop offering a question another worker asked, because it's been
+        answered, the asker has given up on it or I've lost the hub.
+        """
+        channel_key, call = self._relayed.pop(question_id, (None, None))
+        if call is not None and call.active():
+            call.cancel()
+        if channel_key is not None:
+            self.control.channel_answered(channel_key, question_id)
+
+
+    @Ask.responder
+    def _ask(self, channel_key, question):
+        question = json.loads(question)
+        call = None
+        if self.machine.question_timeout is not None:
+            # the asker stops waiting by then, and if it died its
+            # Answered will never come
+            call = self.machine.clock.callLater(self.machine.question_timeout,
+                self._forget, question['id'])
+        self._relayed[question['id']] = (channel_key, call)
+        self.control.channel_question(channel_key, question)
+        return {}
+
+
+    @Answer.responder
+    def _answer(self, question_id, answer):
+        self.machine.answer_question(question_id, answer, relay=False)
+        return {}
+
+
+    @Answered.responder
+    def _answered(self, channel_key, question_id):
+        self._forget(question_id)
+        self.control.channel_answered(channel_key, question_id)
+        return {}
+
+
+    @JobStatus.responder
+    def _jobStatus(self, job_id, wait):
+        d = self.control.job_status(job_id, wait, relay=False)
+        d.addCallback(lambda status: {'status': json.dumps(status)
+            if status is not None else ''})
+        return d
+
+
+    @WatchJob.responder
+    def _watchJob(self, job_id, watch_id, after):
+        def forward(seq, msg):
+            self.callRemote(JobEvent, watch_id=watch_id, seq=seq,
+                event=json.dumps(_jsonable(msg)))
+        d = self.control.watch_job(job_id, forward, after, relay=False)
+        def watching(stop):
+            if stop is None:
+                return {'found': False}
+            self._watched[watch_id] = stop
+            return {'found': True}
+        return d.addCallback(watching)
+
+
+    @JobEvent.responder
+    def _jobEvent(self, watch_id, seq, event):
+        listener = self._watches.get(watch_id)
+        if listener is not None:
+            listener(seq, json.loads(event))
+        return {}
+
+
+    @UnwatchJob.responder
+    def _unwatchJob(self, watch_id):
+        stop = self._watched.pop(watch_id, None)
+        if stop is not None:
+            stop()
+        return {}
@@ -0,0 +1,54 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from zope.interface import Interface
+
+
+
+class IClientLoop(Interface):
+    """
+    An event loop as a L{siloscript.clientcore.AsyncClient} uses it: how
+    it connects to the data server, and the kind of future its methods
+    return.  L{siloscript.txclient} and L{siloscript.aioclient} provide one
+    each.
+    """
+
+    def connect(client):
+        """
+        Start connecting to C{client}'s data server, at C{client.address}
+        (the path of a Unix socket if C{client.scheme} is C{http+unix}).
+        Once connected, call C{client.pool.added} with a
+        L{siloscript.clientcore.PipelinedConnection} and C{client.pool.lost}
+        when it's lost.  If the connection can't be made, call
+        C{client.pool.failed} with the reason.
+        """
+
+
+    def newFuture():
+        """
+        @return: A tuple of a future and functions to call with its result
+            or with an exception.  Calling either once the future is done
+            does nothing.
+        """
+
+
+    def then(future, f, *args):
+        """
+        @return: A future of C{f(result, *args)}, where C{result} is that of
+            C{future}.  If C{future} fails, or C{f} raises an exception, so
+            does the new future.
+        """
+
+
+    def succeed(result):
+        """
+        @return: A future that already has C{result}.
+        """
+
+
+    def callLater(delay, f):
+        """
+        Call C{f()} in C{delay} seconds.
+
+        @return: An object whose C{cancel()} method stops the call.
+        """
@@ -0,0 +1,250 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+
+from collections import deque
+from uuid import uuid4
+
+from siloscript.error import Error, NotFound
+
+
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+
+def _jsonable(msg):
+    """
+    Make a log message (whose output is bytes) JSON-able.
+    """
+    if isinstance(msg.get('data'), str):
+        msg = dict(msg, data=_text(msg['data']))
+    return msg
+
+
+
+class JobLog(object):
+    """
+    I keep the tail of a job's log (the messages passed to the C{logger} of
+    L{siloscript.server.Machine.run}) and pass new messages to listeners.
+
+    Each message gets a sequence number, starting at 1, so that listeners
+    can tell if they've missed some.  I hold at most C{max_events}
+    messages and C{max_bytes} of output; older ones are forgotten.
+    """
+
+    def __init__(self, max_events=1000, max_bytes=256 * 1024):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.events = deque()
+        self.count = 0
+        self.listeners = []
+        self._bytes = 0
+
+
+    def log(self, msg):
+        """
+        Add a message.  Unlike some loggers, I never make the script wait.
+        """
+        self.count += 1
+        size = len(msg.get('data', ''))
+        self.events.append((self.count, msg, size))
+        self._bytes += size
+        while self.events and (len(self.events) > self.max_events
+                or self._bytes > self.max_bytes):
+            self._bytes -= self.events.popleft()[2]
+        for listener in list(self.listeners):
+            listener(self.count, msg)
+
+
+    def listen(self, listener, after=0):
+        """
+        Call C{listener(seq, msg)} with the messages I have after number
+        C{after}, then with each new one.
+
+        @return: A function to call to stop listening.
+        """
+        for seq, msg, _ in list(self.events):
+            if seq > after:
+                listener(seq, msg)
+        self.listeners.append(listener)
+        def stop():
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+        return stop
+
+
+
+class Job(object):
+    """
+    I am a script run started through the control server.
+
+    @ivar state: C{'running'}, C{'done'} (the script exited, whatever its
+        exit code) or C{'failed'} (it couldn't be run or was killed; see
+        C{error}).
+    @ivar result: The C{(stdout, stderr, rc)} of a job that's done.
+    @ivar error: The error message of a job that failed.
+    @ivar log: The job's L{JobLog}.  When the job finishes, an C{'end'}
+        message with its L{status} (less its output) is added.
+    """
+
+    def __init__(self, job_id, user, executable, args, started, log=None):
+        self.id = job_id
+        self.log = log or JobLog()
+        self.user = user
+        self.executable = executable
+        self.args = args
+        self.started = started
+        self.finished = None
+        self.state = 'running'
+        self.result = None
+        self.error = None
+
+
+    def status(self):
+        """
+        @return: A JSON-able dict describing me.
+        """
+        status = {
+            'id': self.id,
+            'user': _text(self.user),
+            'script': _text(self.executable),
+            'args': [_text(x) for x in self.args],
+            'state': self.state,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.result is not None:
+            out, err, rc = self.result
+            status['stdout'] = _text(out)
+            status['stderr'] = _text(err)
+            status['rc'] = rc
+        if self.error is not None:
+            status['error'] = _text(self.error)
+        return status
+
+
+
+class JobStore(object):
+    """
+    I keep track of running jobs and remember finished ones (and their
+    output) for C{ttl} seconds.  I hold at most C{max_jobs} finished jobs;
+    when full, the ones that finished first are forgotten first.
+    """
+
+    def __init__(self, ttl=3600, max_jobs=1000, clock=reactor):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.clock = clock
+        self.running = {}
+        self.finished = {}
+        # ids of finished jobs in the order they finished
+        self._order = deque()
+        self._waiting = {}
+
+
+    def __len__(self):
+        return len(self.running) + len(self.finished)
+
+
+    def start(self, d, user, executable, args, log=None):
+        """
+        Keep track of a run.
+
+        @param d: The L{Deferred} result of L{siloscript.server.Machine.run}.
+        @param log: The L{JobLog} given to the run as its C{logger}.
+
+        @return: A L{Job}.
+        """
+        job = Job('JOB-%s' % (uuid4().hex,), user, executable, args,
+            self.clock.seconds(), log)
+        self.running[job.id] = job
+        d.addCallbacks(self._done, self._failed, callbackArgs=(job,),
+            errbackArgs=(job,))
+        return job
+
+
+    def _done(self, result, job):
+        job.state = 'done'
+        job.result = result
+        self._finish(job)
+
+
+    def _failed(self, err, job):
+        if not err.check(Error):
+            log.err(err, 'Job %s failed' % (job.id,))
+        job.state = 'failed'
+        job.error = err.getErrorMessage()
+        self._finish(job)
+
+
+    def _finish(self, job):
+        job.finished = self.clock.seconds()
+        del self.running[job.id]
+        self.finished[job.id] = job
+        self._order.append(job.id)
+        self._expire()
+        for d, call in self._waiting.pop(job.id, []):
+            call.cancel()
+            d.callback(job)
+        end = job.status()
+        end.pop('stdout', None)
+        end.pop('stderr', None)
+        end['type'] = 'end'
+        job.log.log(end)
+
+
+    def _expire(self):
+        oldest = self.clock.seconds() - self.ttl
+        while self._order:
+            job = self.finished[self._order[0]]
+            if job.finished > oldest and len(self.finished) <= self.max_jobs:
+                break
+            del self.finished[self._order.popleft()]
+
+
+    def get(self, job_id):
+        """
+        @raise NotFound: If there's no such job (or it finished too long ago).
+
+        @return: A L{Job}.
+        """
+        self._expire()
+        job = self.running.get(job_id) or self.finished.get(job_id)
+        if job is None:
+            raise NotFound(job_id)
+        return job
+
+
+    def wait(self, job_id, timeout):
+        """
+        Wait up to C{timeout} seconds for a job to finish.
+
+        @raise NotFound: If there's no such job.
+
+        @return: A L{Deferred} which fires with the L{Job} once it's finished
+            or the time is up, whichever comes first.
+        """
+        job = self.get(job_id)
+        if job.state != 'running' or timeout <= 0:
+            return defer.succeed(job)
+        waiting = self._waiting.setdefault(job_id, [])
+        def stop(d):
+            waiting.remove(entry)
+            if not waiting:
+                self._waiting.pop(job_id, None)
+        def cancel(d):
+            entry[1].cancel()
+            stop(d)
+        d = defer.Deferred(cancel)
+        def timeUp():
+            stop(d)
+            d.callback(job)
+        entry = (d, self.clock.callLater(timeout, timeUp))
+        waiting.append(entry)
+        return d
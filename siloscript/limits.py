@@ -0,0 +1,91 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I start a new session, apply kernel-enforced resource limits to myself
+and then become the script being run.
+
+L{LocalScriptRunner} runs me by path (not with C{-m}) so that I work even
+when the script's environment can't find the C{siloscript} package.  That
+also means I may only use the standard library.
+
+    python limits.py --cpu 30 --memory 536870912 --files 64 -- script args..
+"""
+
+import os
+import sys
+import resource
+import argparse
+
+
+RLIMITS = {
+    'cpu': resource.RLIMIT_CPU,
+    'memory': resource.RLIMIT_AS,
+    'files': resource.RLIMIT_NOFILE,
+}
+
+
+def command(executable, args, limits=None, cgroup=None):
+    """
+    Build the argv that will run C{executable} under the given limits.
+
+    @param executable: Path of the script to run.
+    @param args: List of args for the script (not including C{executable}).
+    @param limits: A dict whose keys are in L{RLIMITS} and whose values are
+        integer limits (seconds for C{'cpu'}, bytes for C{'memory'}, a count
+        for C{'files'}).
+    @param cgroup: Optional path of an existing cgroup (v2) directory that
+        the script should be placed in.
+
+    @return: A list suitable as the C{args} of C{spawnProcess}.
+    """
+    path = os.path.abspath(__file__)
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+        path = path[:-1]
+    cmd = [sys.executable, path]
+    for name, value in sorted((limits or {}).items()):
+        if value is not None:
+            cmd.extend(['--%s' % (name,), str(value)])
+    if cgroup:
+        cmd.extend(['--cgroup', cgroup])
+    cmd.append('--')
+    cmd.append(executable)
+    cmd.extend(args)
+    return cmd
+
+
+parser = argparse.ArgumentParser()
+for _name in RLIMITS:
+    parser.add_argument('--%s' % (_name,), type=int, default=None)
+parser.add_argument('--cgroup', default=None)
+parser.add_argument('argv', nargs=argparse.REMAINDER)
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    cmd = args.argv
+    if cmd and cmd[0] == '--':
+        cmd = cmd[1:]
+    if not cmd:
+        parser.error('No command given')
+
+    # Put the script (and anything it spawns) in its own process group so
+    # that a timeout can kill the whole tree.
+    os.setsid()
+
+    if args.cgroup:
+        fh = open(os.path.join(args.cgroup, 'cgroup.procs'), 'wb')
+        try:
+            fh.write('%d\n' % (os.getpid(),))
+        finally:
+            fh.close()
+
+    for name, rlimit in RLIMITS.items():
+        value = getattr(args, name)
+        if value is not None:
+            resource.setrlimit(rlimit, (value, value))
+
+    os.execv(cmd[0], cmd)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,556 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I am a small client for the data API that only needs the standard library.
+
+Scripts are often short-lived, so importing me is kept cheap: nothing is
+imported until the first request and the C{DATASTORE_URL} isn't read until
+then either.  Importing C{siloscript} (whose C{getValue}, C{putValue},
+C{getToken}, C{getValues} and C{putValues} are mine) should take less than
+L{IMPORT_BUDGET} seconds; C{bench/import_time.py} measures it.
+
+    from siloscript import getValue, putValue
+    password = getValue('password', prompt='Password?')
+
+L{siloscript.client.Client} has the same methods plus connection pooling
+(and needs C{requests}).  If the server also gives scripts a
+C{DATASTORE_BINARY_URL} the module functions use
+L{siloscript.binclient.Client} instead, except for C{getFile} and
+C{putFile}, which stream large values over HTTP.
+"""
+
+import os
+
+from siloscript.error import VersionMismatch
+from siloscript.clientcore import UNIX_SCHEME, _utf8, _text, _cached
+from siloscript.clientcore import _remember, _etagVersion, _fileLength
+from siloscript.clientcore import CHUNK_SIZE, RETRIES, _getFailed, _failed
+from siloscript.clientcore import _retryDelay, _prompts
+
+
+# Seconds that importing siloscript (and me) may take.
+IMPORT_BUDGET = 0.01
+
+
+
+class Client(object):
+    """
+    I am a synchronous client for the key value store provided in
+    siloscript.  I keep one connection to the data server open between
+    requests.
+
+    I remember values I've gotten or put so that getting them again doesn't
+    need a request.  Values gotten with C{save=False} aren't remembered.
+    I also remember their versions.  See L{siloscript.client.Client}.
+    """
+
+    def __init__(self, data_url, timeout=None, cache=True, retries=RETRIES):
+        """
+        @param data_url: The C{DATASTORE_URL} given to the script.
+        @param timeout: Seconds to wait for the server to connect or send
+            data, or C{None} to wait forever.  Requests that prompt wait
+            for a person to answer, so they never time out.
+        @param cache: If C{False}, don't remember values.
+        @param retries: Times to try a request again, after a growing,
+            jittered delay, if the server is too busy for it.  After that
+            it fails with L{siloscript.error.Overloaded}.
+        """
+        self.url = data_url
+        self.timeout = timeout
+        self.cache = {} if cache else None
+        self.retries = retries
+        self.versions = {}
+        self._conn = None
+        self._path = None
+
+
+    def _connect(self):
+        import httplib
+        import urllib
+        import urlparse
+        parsed = urlparse.urlsplit(self.url)
+        self._path = parsed.path.rstrip('/')
+        if parsed.scheme == UNIX_SCHEME:
+            conn = _unixHTTPConnection(urllib.unquote(parsed.netloc),
+                timeout=self.timeout)
+        elif parsed.scheme == 'https':
+            conn = httplib.HTTPSConnection(parsed.netloc,
+                timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(parsed.netloc, timeout=self.timeout)
+        return conn
+
+
+    def close(self):
+        """
+        Close my connection, if it's open.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _request(self, method, path, params=None, body=None, headers=None,
+            sink=None, prompt=False):
+        """
+        Make a request of the data server, trying it again (up to
+        C{retries} times) while the server is too busy for it.
+
+        @param body: A string, or a file to send a chunk at a time.
+        @param sink: If given, a file to write a successful response's body
+            to a chunk at a time instead of returning it.
+        @param prompt: If C{True}, the request may ask a person, so don't
+            time out.
+
+        @return: A tuple of status code, response headers (an
+            C{httplib.HTTPMessage}) and body.
+        """
+        start = None
+        if hasattr(body, 'read') and _fileLength(body) is not None:
+            start = body.tell()
+        attempt = 0
+        while True:
+            status, response_headers, data = self._send(method, path, params,
+                body, headers, sink, prompt)
+            if (status != 503 or attempt >= self.retries
+                    or (hasattr(body, 'read') and start is None)):
+                return status, response_headers, data
+            attempt += 1
+            if start is not None:
+                body.seek(start)
+            import time
+            time.sleep(_retryDelay(attempt,
+                response_headers.get('retry-after')))
+
+
+    def _send(self, method, path, params, body, headers, sink, prompt):
+        """
+        Make a request once.  See L{_request}.
+
+        If a kept-alive connection turns out to have been closed, the
+        request is sent again on a new one, but only if it couldn't have
+        been handled: if it failed to be sent, or if it only reads and the
+        server closed the connection without answering.  Requests that
+        timed out are never sent again.
+        """
+        import httplib
+        import socket
+        import urllib
+        if self._conn is not None and _dropped(self._conn.sock):
+            self.close()
+        reused = self._conn is not None
+        if not reused:
+            self._conn = self._connect()
+        conn = self._conn
+        # requests that prompt wait for a person to answer
+        conn.timeout = None if prompt else self.timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        url = self._path + path
+        if params:
+            url += '?' + urllib.urlencode(params, True)
+        streaming = hasattr(body, 'read')
+        if streaming:
+            length = _fileLength(body)
+            start = body.tell() if length is not None else None
+        try:
+            if streaming:
+                self._sendFile(method, url, body, length, headers or {})
+            else:
+                conn.request(method, url, body, headers or {})
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            if not reused or (streaming and start is None):
+                raise
+            # The server closed the connection while it sat idle, so it
+            # never got the request.
+            if streaming:
+                body.seek(start)
+            return self._send(method, path, params, body, headers, sink,
+                prompt)
+        try:
+            response = conn.getresponse()
+            if sink is None or response.status != 200:
+                data = response.read()
+        except socket.timeout:
+            self.close()
+            raise
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            if not reused or method not in ('GET', 'HEAD'):
+                raise
+            # Reading is safe to do again, if the server closed the
+            # connection instead of answering.
+            return self._send(method, path, params, body, headers, sink,
+                prompt)
+        if sink is not None and response.status == 200:
+            try:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+            except:
+                self.close()
+                raise
+            data = None
+        return response.status, response.msg, data
+
+
+    def _sendFile(self, method, url, body, length, headers):
+        """
+        Send a request whose body is read from a file: with a
+        C{Content-Length} if C{length} is known, otherwise in chunks.
+        """
+        conn = self._conn
+        conn.putrequest(method, url)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        if length is None:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        else:
+            conn.putheader('Content-Length', str(length))
+        conn.endheaders()
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if length is None:
+                conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            elif chunk:
+                conn.send(chunk)
+            if not chunk:
+                break
+
+
+    def forget(self, key=None):
+        """
+        Forget a remembered value so that it's fetched again next time.
+
+        @param key: The key to forget, or C{None} to forget everything.
+        """
+        if key is None:
+            self.versions.clear()
+        else:
+            self.versions.pop(key, None)
+        if self.cache is not None:
+            if key is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
+
+
+    def getVersion(self, key):
+        """
+        Get the version of the value I last got or put for C{key}.
+
+        See L{siloscript.client.Client.getVersion}.
+        """
+        return self.versions.get(key)
+
+
+    def getValue(self, key, prompt=None, save=True, options=None,
+            revalidate=False):
+        """
+        Get a value from the data store.
+
+        See L{siloscript.client.Client.getValue}.
+        """
+        cached = (save is not False and self.cache is not None
+            and key in self.cache)
+        if cached and not revalidate:
+            return _text(self.cache[key], None)
+        params = []
+        if prompt:
+            params.append(('prompt', _utf8(prompt)))
+        if save is False:
+            params.append(('save', 'False'))
+        if options is not None:
+            params.append(('options', [_utf8(x) for x in options]))
+        headers = {}
+        if cached and key in self.versions:
+            headers['If-None-Match'] = '"%s"' % (self.versions[key],)
+        status, response_headers, body = self._request('GET', '/' + key,
+            params, headers=headers, prompt=bool(prompt))
+        if status == 304 and cached:
+            return _text(self.cache[key], None)
+        if status == 200:
+            self._remember(key, _etagVersion(response_headers.get('etag')))
+            if save is not False and self.cache is not None:
+                self.cache[key] = body
+            return _text(body, response_headers.get('content-type'))
+        raise _getFailed(status, key)
+
+
+    def _remember(self, key, version):
+        if version is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = version
+
+
+    def putValue(self, key, value, if_version=None):
+        """
+        Save a value in a data store.
+
+        See L{siloscript.client.Client.putValue}.
+        """
+        value = _utf8(value)
+        version = self._put(key, value, if_version)
+        if self.cache is not None:
+            self.cache[key] = value
+        return version
+
+
+    def putFile(self, key, fileobj, if_version=None):
+        """
+        Save the contents of a file in the data store a chunk at a time.
+
+        See L{siloscript.client.Client.putFile}.
+        """
+        version = self._put(key, fileobj, if_version)
+        if self.cache is not None:
+            self.cache.pop(key, None)
+        return version
+
+
+    def _put(self, key, body, if_version):
+        headers = {}
+        if if_version is not None:
+            if if_version != '*':
+                if_version = '"%s"' % (if_version,)
+            headers['If-Match'] = if_version
+        status, response_headers, _ = self._request('PUT', '/' + key,
+            body=body, headers=headers)
+        if status == 200:
+            version = _etagVersion(response_headers.get('etag'))
+            self._remember(key, version)
+            return version
+        elif status == 412:
+            self.forget(key)
+            raise VersionMismatch(key)
+        raise _failed(status, key)
+
+
+    def getFile(self, key, fileobj):
+        """
+        Write a stored value to a file a chunk at a time.
+
+        See L{siloscript.client.Client.getFile}.
+        """
+        status, response_headers, _ = self._request('GET', '/' + key,
+            sink=fileobj)
+        if status == 200:
+            version = _etagVersion(response_headers.get('etag'))
+            self._remember(key, version)
+            return version
+        raise _failed(status, key)
+
+
+    def getValues(self, keys):
+        """
+        Get several values from the data store in one request.
+
+        See L{siloscript.client.Client.getValues}.
+        """
+        import json
+        values, keys = _cached(self.cache, keys)
+        if not keys:
+            return values
+        status, _, body = self._request('POST', '/:batch',
+            body=json.dumps({'get': keys}), prompt=_prompts(keys))
+        if status == 200:
+            fetched = dict([(k.encode('utf-8'), v.encode('utf-8'))
+                for k, v in json.loads(body)['values'].items()])
+            _remember(self.cache, keys, fetched)
+            for k in fetched:
+                self.versions.pop(k, None)
+            values.update(fetched)
+            return values
+        raise _getFailed(status, keys)
+
+
+    def putValues(self, values):
+        """
+        Save several values in the data store in one request.
+        """
+        import json
+        status, _, _ = self._request('POST', '/:batch',
+            body=json.dumps({'put': values}))
+        if status == 200:
+            for k, v in values.items():
+                self.versions.pop(_utf8(k), None)
+                if self.cache is not None:
+                    self.cache[_utf8(k)] = _utf8(v)
+            return
+        raise _failed(status, values.keys())
+
+
+    def getToken(self, value):
+        """
+        Exchange a sensitive value for a consistent opaque token.
+        """
+        status, response_headers, body = self._request('POST', '',
+            [('value', _utf8(value))], body='')
+        if status == 200:
+            return _text(body, response_headers.get('content-type'))
+        raise _failed(status)
+
+
+
+def _dropped(sock):
+    """
+    @return: C{True} if the socket of an idle kept-alive connection is gone
+        or has been closed by the server (it's readable, which it shouldn't
+        be between responses), so the connection mustn't be reused.
+    """
+    if sock is None:
+        return True
+    import select
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return True
+
+
+
+_UnixHTTPConnection = None
+
+def _unixHTTPConnection(socket_path, timeout=None):
+    """
+    Make an C{httplib.HTTPConnection} that talks over a Unix socket.
+    """
+    global _UnixHTTPConnection
+    if _UnixHTTPConnection is None:
+        import httplib
+        import socket
+
+        class UnixHTTPConnection(httplib.HTTPConnection):
+
+            socket_path = None
+
+            def connect(self):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                if self.timeout is not None:
+                    sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.socket_path)
+                except:
+                    sock.close()
+                    raise
+                self.sock = sock
+
+        _UnixHTTPConnection = UnixHTTPConnection
+    conn = _UnixHTTPConnection('localhost', timeout=timeout)
+    conn.socket_path = socket_path
+    return conn
+
+
+
+_global_client = None
+
+def _client():
+    """
+    Get the client the module functions use: a L{siloscript.binclient.Client}
+    if the server gave us a C{DATASTORE_BINARY_URL} and C{msgpack} is
+    installed, otherwise a L{Client} for the C{DATASTORE_URL}.
+    """
+    global _global_client
+    if _global_client is None:
+        binary_url = os.environ.get('DATASTORE_BINARY_URL')
+        if binary_url:
+            try:
+                from siloscript import binclient
+            except ImportError:
+                pass
+            else:
+                _global_client = binclient.Client(binary_url)
+                return _global_client
+        _global_client = Client(os.environ.get('DATASTORE_URL',
+            'DATASTORE_URL was not set'))
+    return _global_client
+
+
+_global_http_client = None
+
+def _httpClient():
+    """
+    Get a L{Client} for the C{DATASTORE_URL}, for the module functions that
+    stream values (which the msgpack protocol doesn't).  It's the one
+    L{_client} gives unless that's a L{siloscript.binclient.Client}.
+    """
+    global _global_http_client
+    client = _client()
+    if isinstance(client, Client):
+        return client
+    if _global_http_client is None:
+        _global_http_client = Client(os.environ.get('DATASTORE_URL',
+            'DATASTORE_URL was not set'))
+    return _global_http_client
+
+
+def getValue(key, prompt=None, save=True, options=None, revalidate=False):
+    """
+    Get a value using the C{DATASTORE_URL}.  See L{Client.getValue}.
+
+    Values are remembered for the life of the process (see L{Client}).
+    """
+    return _client().getValue(key, prompt=prompt, save=save, options=options,
+        revalidate=revalidate)
+
+
+def putValue(key, value, if_version=None):
+    """
+    Save a value using the C{DATASTORE_URL}.  See L{Client.putValue}.
+    """
+    return _client().putValue(key, value, if_version=if_version)
+
+
+def putFile(key, fileobj, if_version=None):
+    """
+    Save the contents of a file using the C{DATASTORE_URL}.  See
+    L{Client.putFile}.
+    """
+    return _httpClient().putFile(key, fileobj, if_version=if_version)
+
+
+def getFile(key, fileobj):
+    """
+    Write a stored value to a file using the C{DATASTORE_URL}.  See
+    L{Client.getFile}.
+    """
+    return _httpClient().getFile(key, fileobj)
+
+
+def getVersion(key):
+    """
+    Get the version of a value last gotten or put.  See L{Client.getVersion}.
+    """
+    return _client().getVersion(key)
+
+
+def getValues(keys):
+    """
+    Get several values using the C{DATASTORE_URL}.
+    """
+    return _client().getValues(keys)
+
+
+def putValues(values):
+    """
+    Save several values using the C{DATASTORE_URL}.
+    """
+    return _client().putValues(values)
+
+
+def getToken(value):
+    """
+    Get a token for a value using the C{DATASTORE_URL}.
+    """
+    return _client().getToken(value)
@@ -0,0 +1,216 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Numbers about a running server, for monitoring.  A L{Registry} renders
+its metrics in the Prometheus text format, which the control server
+serves at C{/metrics}.
+"""
+
+from twisted.internet import defer, reactor
+
+from bisect import bisect_left
+
+
+# Upper bounds of the buckets of a Histogram, in seconds: from store
+# operations (milliseconds) to requests waiting for a person (minutes).
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+
+
+class Gauge(object):
+    """
+    I am a number that goes up and down, such as how many questions are
+    waiting for answers.  I'm read from a function when metrics are
+    collected, so keeping me up to date costs nothing.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func):
+        """
+        @param func: A function of no arguments that returns my value.
+        """
+        self.name = name
+        self.help = help
+        self.func = func
+
+
+    def samples(self):
+        """
+        @return: A list of C{(name, value)} tuples.
+        """
+        return [(self.name, self.func())]
+
+
+
+class Counter(object):
+    """
+    I am a number that only goes up, such as how many clients have been
+    disconnected.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, func=None):
+        """
+        @param func: If given, a function of no arguments that returns my
+            value, for counts kept by something else.
+        """
+        self.name = name
+        self.help = help
+        self.func = func
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        """
+        Add to my value.
+        """
+        self.value += amount
+
+
+    def samples(self):
+        """
+        @return: A list of C{(name, value)} tuples.
+        """
+        if self.func is not None:
+            return [(self.name, self.func())]
+        return [(self.name, self.value)]
+
+
+
+class Histogram(object):
+    """
+    I count observations, such as how long requests took, in buckets, so
+    that percentiles can be worked out from my samples.
+
+    I can have labels, such as the operation timed: each combination of
+    their values is counted separately.  Observing costs a dict lookup and
+    a binary search of the buckets, so I'm cheap enough to leave on.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS,
+            clock=reactor):
+        """
+        @param labels: The names of my labels.
+        @param buckets: The sorted upper bounds of my buckets.
+        @param clock: What L{time} reads the time from.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.clock = clock
+        # label values -> [count in each bucket (and over them all), sum]
+        self._series = {}
+
+
+    def observe(self, value, labels=()):
+        """
+        Count an observation.
+
+        @param labels: The values of my labels, in order.
+        """
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1),
+                0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+
+    def time(self, labels, f, *args, **kwargs):
+        """
+        Call C{f(*args, **kwargs)} and observe how many seconds it (or the
+        L{Deferred} it returns) took, whether it succeeded or failed.
+
+        @return: A L{Deferred} result of the call.
+        """
+        start = self.clock.seconds()
+        def done(result):
+            self.observe(self.clock.seconds() - start, labels)
+            return result
+        return defer.maybeDeferred(f, *args, **kwargs).addBoth(done)
+
+
+    def samples(self):
+        """
+        @return: A list of C{(name, value)} tuples.
+        """
+        samples = []
+        bounds = [_number(x) for x in self.buckets] + ['+Inf']
+        for values in sorted(self._series):
+            counts, total = self._series[values]
+            names = self.labels + ('le',)
+            count = 0
+            for bound, n in zip(bounds, counts):
+                count += n
+                samples.append((self.name + '_bucket' +
+                    _labels(names, values + (bound,)), count))
+            labels = _labels(self.labels, values)
+            samples.append((self.name + '_sum' + labels, total))
+            samples.append((self.name + '_count' + labels, count))
+        return samples
+
+
+
+class Registry(object):
+    """
+    I am a collection of metrics.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric):
+        """
+        Add a metric.
+
+        @return: C{metric}
+        """
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        """
+        Render my metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, _number(value)))
+        return ''.join([line + '\n' for line in lines])
+
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+
+def _labels(names, values):
+    """
+    Format the labels of a sample, such as C{{operation="get"}}.
+    """
+    if not names:
+        return ''
+    return '{%s}' % (','.join(['%s="%s"' % (name, _escape(value))
+        for name, value in zip(names, values)]),)
+
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+        '\\n')
@@ -1,10 +1,31 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
+import os
+import signal
+import urllib
+
 from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ProcessExitedAlready
 from twisted.python.filepath import FilePath
+from twisted.python import log, failure
+
+from siloscript.error import NotFound, Timeout
+from siloscript import limits as _limits
 
-from siloscript.error import NotFound
+
+
+def unixSocketURL(socket_path, scheme='http+unix'):
+    """
+    Make a data URL root for a data server listening on a Unix socket.
+    L{siloscript.client.Client} understands these URLs.
+
+    @param socket_path: Path of the socket.
+    @param scheme: C{'http+unix'} for the data API or C{'msgpack+unix'} for
+        the protocol in L{siloscript.dataproto}.
+    """
+    return '%s://%s' % (scheme, urllib.quote(os.path.abspath(socket_path),
+        safe=''))
 
 
 
@@ -15,20 +36,27 @@ class SiloWrapper(object):
     """
 
     DATASTORE_URL_ENV_NAME = 'DATASTORE_URL'
+    DATASTORE_BINARY_URL_ENV_NAME = 'DATASTORE_BINARY_URL'
 
 
-    def __init__(self, data_url_root, runner):
+    def __init__(self, data_url_root, runner, binary_url_root=None):
         """
         @param data_url_root: Root URL onto which silo keys will be appended
-            when given to the running processes.
+            when given to the running processes.  Scripts on this machine
+            can use a L{unixSocketURL}.
         @param runner: An object with a C{run} method of the same signature
             as L{LocalScriptRunner.run}.
+        @param binary_url_root: If given, the root URL of a
+            L{siloscript.dataproto} server, given to the running processes
+            as C{DATASTORE_BINARY_URL} the same way.
         """
         self.data_url_root = data_url_root
         self.runner = runner
+        self.binary_url_root = binary_url_root
 
 
-    def runWithSilo(self, silo_key, executable, args, env, logger=None):
+    def runWithSilo(self, silo_key, executable, args, env, logger=None,
+            timeout=None):
         """
         Run a script with access to the given silo.
 
@@ -37,39 +65,208 @@ class SiloWrapper(object):
         @param args: Any extra args to pass on command line when spawning
             process.
         @param env: Any additional environment variables to set for the process.
+        @param timeout: Optional number of seconds this run may take.  See
+            L{LocalScriptRunner.run}.
         """
         env.update({
             self.DATASTORE_URL_ENV_NAME: '%s/%s' % (
                 self.data_url_root, silo_key),
         })
-        return self.runner.run(executable, args, env, logger=logger)
+        if self.binary_url_root:
+            env[self.DATASTORE_BINARY_URL_ENV_NAME] = '%s/%s' % (
+                self.binary_url_root, silo_key)
+        return self.runner.run(executable, args, env, logger=logger,
+            timeout=timeout)
+
+
+
+class OutputBuffer(object):
+    """
+    I coalesce chunks of process output into fewer, larger messages before
+    handing them to a logger.
+
+    Output is held until C{interval} seconds have passed since the first
+    held chunk or until C{size} bytes are held, whichever comes first.
+    Consecutive output on the same channel is joined into one message.
+
+    If the logger returns a L{Deferred} that hasn't fired yet, I hold all
+    further messages (and pause my C{producer}, if I have one) until it
+    fires.
+    """
+
+    producer = None
+
+
+    def __init__(self, logger, interval=None, size=64 * 1024, lines=False,
+            clock=reactor):
+        """
+        @param logger: A function that will be called with message dicts.
+        @param interval: Maximum number of seconds to hold output.  If
+            C{None}, output is passed along as soon as it arrives.
+        @param size: Maximum number of bytes to hold.
+        @param lines: If C{True}, only whole lines are passed along until
+            more than C{size} bytes are held (or a non-output message, such
+            as the process exiting, comes along).
+        """
+        self.logger = logger
+        self.interval = interval
+        self.size = size
+        self.lines = lines
+        self.clock = clock
+
+        self._pending = []
+        self._pending_size = 0
+        self._timer = None
+        self._waiting = None
+        self._drained = []
+
+
+    def output(self, channel, data):
+        """
+        Some output was produced on C{channel}.
+        """
+        if (self._pending and self._pending[-1]['type'] == 'output'
+                and self._pending[-1]['channel'] == channel):
+            self._pending[-1]['data'].append(data)
+        else:
+            self._pending.append({
+                'type': 'output',
+                'channel': channel,
+                'data': [data],
+            })
+        self._pending_size += len(data)
+        if self.interval is None or self._pending_size >= self.size:
+            self.flush(force=self._pending_size >= self.size)
+        elif self._timer is None and self._waiting is None:
+            self._timer = self.clock.callLater(self.interval, self.flush)
+
+
+    def message(self, msg):
+        """
+        Pass along a non-output message (after any held output).
+        """
+        self._pending.append(msg)
+        self.flush(force=True)
+
+
+    def whenDrained(self):
+        """
+        @return: A L{Deferred} which fires once everything has been handed
+            to the logger (and the logger is done with it).
+        """
+        if not self._pending and self._waiting is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drained.append(d)
+        return d
+
+
+    def flush(self, force=False):
+        """
+        Hand held messages to the logger now.
+
+        @param force: If C{True}, include partial lines even if L{lines} is
+            set.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if self._waiting is not None:
+            return
+
+        keep = None
+        if self.lines and not force and self._pending:
+            last = self._pending[-1]
+            if last['type'] == 'output':
+                data = ''.join(last['data'])
+                i = data.rfind('\n') + 1
+                if i < len(data):
+                    last['data'] = [data[:i]]
+                    keep = dict(last, data=[data[i:]])
+                    if not i:
+                        self._pending.pop()
+
+        while self._pending:
+            msg = self._pending.pop(0)
+            if msg['type'] == 'output':
+                msg = dict(msg, data=''.join(msg['data']))
+                self._pending_size -= len(msg['data'])
+            r = self.logger(msg)
+            if isinstance(r, defer.Deferred) and not r.called:
+                self._waiting = r
+                if self.producer is not None:
+                    self.producer.pauseProducing()
+                r.addBoth(self._loggerReady)
+                break
+
+        if keep is not None:
+            if self._pending and self._pending[-1]['type'] == 'output' and \
+                    self._pending[-1]['channel'] == keep['channel']:
+                self._pending[-1]['data'].extend(keep['data'])
+            else:
+                self._pending.append(keep)
+            if self._timer is None and self._waiting is None:
+                self._timer = self.clock.callLater(self.interval or 0,
+                    self.flush, True)
+
+        if not self._pending and self._waiting is None:
+            drained = self._drained
+            self._drained = []
+            for d in drained:
+                d.callback(None)
+
+
+    def _loggerReady(self, result):
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Error in output logger')
+        self._waiting = None
+        if self.producer is not None:
+            self.producer.resumeProducing()
+        if self._pending:
+            self.flush(force=self._pending_size >= self.size or
+                self._pending[-1]['type'] != 'output')
+        else:
+            self.flush()
 
 
 
 class _ProcessProtocol(protocol.ProcessProtocol):
 
     
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, output=None):
+        """
+        @param logger: Function to be called with messages about the
+            process.
+        @param output: An L{OutputBuffer} to use instead of C{logger}.
+        """
         self._stdout = []
         self._stderr = []
         self._done = defer.Deferred()
-        self._logger = logger
-        if not logger:
+        self._timer = None
+        self._clock = None
+        self._process_group = False
+        self.timed_out = False
+        if output is None and logger:
+            output = OutputBuffer(logger)
+        self._output = output
+        if output is None:
             # make logging a no-op
             self.logOutput = lambda *a,**kw: None
             self._log = lambda *a,**kw: None
 
 
+    def connectionMade(self):
+        if self._output is not None:
+            self._output.producer = self.transport
+
+
     def _log(self, msg):
-        self._logger(msg)
+        self._output.message(msg)
 
 
     def logOutput(self, channel, data):
-        self._log({
-            'type': 'output',
-            'channel': channel,
-            'data': data,
-        })
+        self._output.output(channel, data)
 
 
     def stdout(self):
@@ -90,13 +287,75 @@ class _ProcessProtocol(protocol.ProcessProtocol):
         self.logOutput(2, data)
 
 
+    def setTimeout(self, timeout, grace, clock=reactor, process_group=False):
+        """
+        Terminate the process if it runs for more than C{timeout} seconds.
+        It is sent C{SIGTERM} first and then, if it's still around C{grace}
+        seconds later, C{SIGKILL}.
+
+        @param process_group: If C{True}, the process leads its own process
+            group and signals will be sent to the whole group.
+        """
+        self._clock = clock
+        self._process_group = process_group
+        self._timer = clock.callLater(timeout, self._terminate, grace)
+
+
+    def _terminate(self, grace):
+        self.timed_out = True
+        self._log({
+            'type': 'timeout',
+        })
+        self._signal('TERM')
+        self._timer = self._clock.callLater(grace, self._kill)
+
+
+    def kill(self):
+        """
+        Kill the process now.
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._kill()
+
+
+    def _kill(self):
+        self._timer = None
+        self._signal('KILL')
+        # Children of the script may still be holding our pipes open.
+        self.transport.loseConnection()
+
+
+    def _signal(self, name):
+        if self._process_group and self.transport.pid:
+            try:
+                os.killpg(self.transport.pid, getattr(signal, 'SIG' + name))
+                return
+            except OSError:
+                # It may not have made its group yet, in which case it
+                # hasn't started anything else either.
+                pass
+        try:
+            self.transport.signalProcess(name)
+        except (ProcessExitedAlready, OSError):
+            pass
+
+
     def processEnded(self, status):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
         rc = status.value.exitCode
         self._log({
             'type': 'exit',
             'code': rc,
         })
-        self._done.callback(rc)
+        if self._output is None:
+            self._done.callback(rc)
+        else:
+            self._output.producer = None
+            self._output.whenDrained().addCallback(lambda _:
+                self._done.callback(rc))
 
 
 
@@ -106,38 +365,129 @@ class LocalScriptRunner(object):
     the tools provided by Twisted.
     """
 
-    def __init__(self, root):
+    kill_grace = 5
+
+
+    def __init__(self, root, timeout=None, timeouts=None, kill_grace=None,
+            limits=None, cgroup=None, output_interval=None,
+            output_size=64 * 1024, output_lines=False, clock=reactor):
         """
         @param root: Root path of executable scripts.
+        @param timeout: Default number of seconds a script may run before
+            it's killed.  C{None} means forever.
+        @param timeouts: A dict of executable name to number of seconds which
+            overrides C{timeout} for particular scripts.
+        @param kill_grace: Seconds between sending C{SIGTERM} and C{SIGKILL}
+            to a script that has timed out.
+        @param limits: A dict of kernel resource limits to apply to scripts.
+            See L{siloscript.limits.RLIMITS} for the possible keys.
+        @param cgroup: Path of an existing cgroup directory to run scripts
+            in.
+        @param output_interval: Maximum seconds to hold output before giving
+            it to a run's logger.  See L{OutputBuffer}.
+        @param output_size: Maximum bytes of output to hold before giving
+            it to a run's logger.
+        @param output_lines: If C{True}, give loggers whole lines of output
+            when possible.
         """
         self.root = FilePath(root)
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        if kill_grace is not None:
+            self.kill_grace = kill_grace
+        self.limits = dict((k, v) for k, v in (limits or {}).items()
+            if v is not None)
+        self.cgroup = cgroup
+        self.output_interval = output_interval
+        self.output_size = output_size
+        self.output_lines = output_lines
+        self.clock = clock
+
+
+    def timeoutFor(self, executable, timeout=None):
+        """
+        Get the number of seconds C{executable} will be allowed to run.
+        """
+        if timeout is not None:
+            return timeout
+        return self.timeouts.get(executable, self.timeout)
 
 
-    @defer.inlineCallbacks
-    def run(self, executable, args=None, env=None, logger=None):
+    def run(self, executable, args=None, env=None, logger=None, timeout=None):
         """
-        Run a script.
+        Run a script.  Cancelling the returned L{Deferred} kills it.
 
         @param logger: A function that will be called with stdout/stderr
-            as the process runs.  It should expect a dict of data.
+            as the process runs.  It should expect a dict of data.  If it
+            returns a L{Deferred}, the script's output won't be read until
+            that fires.
+        @param timeout: Number of seconds this run may take, overriding
+            any configured timeouts.
+
+        @raise Timeout: If the script was killed for running too long.  The
+            exception's args are a message, the stdout and the stderr.
+        """
+        try:
+            proto, name, timeout = self._spawn(executable, args, env, logger,
+                timeout)
+        except Exception:
+            return defer.fail()
+        def finished(rc):
+            if proto.timed_out:
+                raise Timeout('Timed out after %ss: %r' % (timeout, name),
+                    proto.stdout(), proto.stderr())
+            return (proto.stdout(), proto.stderr(), rc)
+        def fire(result):
+            # (unless it has been cancelled)
+            if not d.called:
+                d.callback(result)
+        d = defer.Deferred(lambda _: proto.kill())
+        proto._done.addCallback(finished).addBoth(fire)
+        return d
+
+
+    def _spawn(self, executable, args, env, logger, timeout):
+        """
+        Start a script for L{run}.
+
+        @return: The L{_ProcessProtocol}, the script's name and its timeout.
         """
         args = args or []
         env = env or {}
+        timeout = self.timeoutFor(executable, timeout)
         script_fp = self.root
         for segment in executable.split('/'):
             script_fp = script_fp.child(segment)
         if not script_fp.exists():
             raise NotFound('Executable not found: %r' % (executable,))
 
+        name = executable
         executable = script_fp.path
         args = [executable] + args
         path = script_fp.parent().path
 
-        proto = _ProcessProtocol(logger=logger)
+        # Always go through limits.py, even without limits, so that the
+        # script leads its own session and a timeout can kill everything it
+        # started.
+        args = _limits.command(executable, args[1:], self.limits,
+            self.cgroup)
+        executable = args[0]
+
+        output = None
+        if logger:
+            output = OutputBuffer(logger,
+                interval=self.output_interval,
+                size=self.output_size,
+                lines=self.output_lines,
+                clock=self.clock)
+        proto = _ProcessProtocol(output=output)
+        proto._process_group = True
         reactor.spawnProcess(proto, executable,
             args,
             env=env,
             path=path)
-        rc = yield proto._done
-        defer.returnValue((proto.stdout(), proto.stderr(), rc))
+        if timeout is not None:
+            proto.setTimeout(timeout, self.kill_grace, clock=self.clock,
+                process_group=True)
+        return proto, name, timeout
 
@@ -12,6 +12,8 @@ import msgpack
 import pika
 from pika.adapters import twisted_connection
 
+from siloscript.error import Timeout
+
 PERSISTENT_DELIVERY = 2
 RUN_QUEUE = 'run_queue'
 DATABASE_RESULT_QUEUE = 'db_result_queue'
@@ -113,19 +115,26 @@ class RabbitMachine(object):
                 receiver = partial(self.questionReceiver, ch, properties.reply_to)
 
             # run the script
-            output = yield self.machine.run(
-                message['user'],
-                message['executable'],
-                message['args'],
-                message['env'],
-                channel_receiver=receiver)
-
-            log.msg('output = %r' % (output,), system='RabbitMachine')
-            # send the result
             result = {
                 'msg': message,
-                'result': output,
             }
+            try:
+                output = yield self.machine.run(
+                    message['user'],
+                    message['executable'],
+                    message['args'],
+                    message['env'],
+                    channel_receiver=receiver,
+                    timeout=message.get('timeout'),
+                    refresh=message.get('refresh', False))
+            except Timeout as e:
+                # the process is gone; tell the caller why
+                output = (e.args[1], e.args[2], None)
+                result['error'] = 'timeout'
+
+            log.msg('output = %r' % (output,), system='RabbitMachine')
+            # send the result
+            result['result'] = output
             yield ch.basic_publish(
                 exchange=RESULT_EXCHANGE,
                 routing_key='',
@@ -285,12 +294,16 @@ class RabbitClient(object):
 
     @defer.inlineCallbacks
     def run(self, user, executable, args, env, question_receiver=None,
-            return_result=False):
+            return_result=False, timeout=None, refresh=False):
         """
         Start a run 
 
         @param question_receiver: A function that will be called with questions
             for a human if information isn't available in the db.
+        @param timeout: Optional number of seconds the script may run.  If
+            it takes longer, the result will have an C{'error'} of
+            C{'timeout'}.
+        @param refresh: If C{True}, don't use a cached result.
         """
         log.msg('run(%r, %r, %r, %r, %r)' % (
             user, executable, args, env, question_receiver),
@@ -303,6 +316,10 @@ class RabbitClient(object):
             'args': args,
             'env': env,
         }
+        if timeout is not None:
+            message['timeout'] = timeout
+        if refresh:
+            message['refresh'] = True
 
         correlation_id = str(uuid.uuid4())
 
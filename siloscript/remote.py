@@ -0,0 +1,379 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import defer, protocol
+from twisted.internet.error import ConnectionLost, ConnectionDone
+from twisted.protocols import amp
+from twisted.python import log, failure
+
+import msgpack
+from uuid import uuid4
+
+from siloscript.error import NotFound, Timeout, Unavailable
+
+
+# AMP values can't be longer than this, so output is sent in pieces.
+CHUNK_SIZE = 60000
+
+
+
+class Run(amp.Command):
+    """
+    Dispatcher -> worker: run a script.  Its output comes back as L{Output}
+    and L{Event} commands for the same C{run_id} before this responds.
+    """
+    arguments = [
+        ('run_id', amp.String()),
+        ('executable', amp.String()),
+        ('args', amp.String()),
+        ('env', amp.String()),
+        ('timeout', amp.Float(optional=True)),
+    ]
+    response = [
+        ('rc', amp.Integer(optional=True)),
+    ]
+    errors = {
+        NotFound: 'NOT_FOUND',
+        Timeout: 'TIMEOUT',
+    }
+
+
+
+class Output(amp.Command):
+    """
+    Worker -> dispatcher: some output from a running script.
+    """
+    arguments = [
+        ('run_id', amp.String()),
+        ('channel', amp.Integer()),
+        ('data', amp.String()),
+    ]
+    response = []
+
+
+
+class Event(amp.Command):
+    """
+    Worker -> dispatcher: a non-output log message from a running script.
+    """
+    arguments = [
+        ('run_id', amp.String()),
+        ('message', amp.String()),
+    ]
+    response = []
+
+
+
+class WorkerProtocol(amp.AMP):
+    """
+    I run scripts on behalf of a L{RemoteScriptRunner}.  If the
+    dispatcher goes away, the scripts it started are killed.
+    """
+
+    def __init__(self, runner):
+        """
+        @param runner: A L{siloscript.process.LocalScriptRunner}.
+        """
+        amp.AMP.__init__(self)
+        self.runner = runner
+        self.runs = {}
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        for d in self.runs.values():
+            d.cancel()
+
+
+    @Run.responder
+    def run(self, run_id, executable, args, env, timeout=None):
+        d = self.runs[run_id] = self.runner.run(executable,
+            msgpack.unpackb(args),
+            msgpack.unpackb(env),
+            logger=lambda msg: self._sendMessage(run_id, msg),
+            timeout=timeout)
+        def done(result):
+            self.runs.pop(run_id, None)
+            return result
+        d.addBoth(done)
+        d.addCallbacks(lambda result: {'rc': result[2]}, self._trimTimeout)
+        return d
+
+
+    def _trimTimeout(self, err):
+        """
+        The dispatcher already has the output, so don't send it back as part
+        of the error.
+        """
+        if err.check(defer.CancelledError):
+            # the dispatcher is gone, so there's no one to tell
+            return {}
+        err.trap(Timeout)
+        raise Timeout(err.value.args[0])
+
+
+    def _sendMessage(self, run_id, msg):
+        """
+        Send a log message to the dispatcher.  The returned L{Deferred}
+        fires when the dispatcher is done with it, which keeps us from
+        reading the script's output faster than the dispatcher can take it.
+        """
+        if msg['type'] != 'output':
+            return self._callDispatcher(Event, run_id=run_id,
+                message=msgpack.packb(msg))
+        data = msg['data']
+        dl = []
+        for i in xrange(0, max(len(data), 1), CHUNK_SIZE):
+            dl.append(self._callDispatcher(Output, run_id=run_id,
+                channel=msg['channel'], data=data[i:i+CHUNK_SIZE]))
+        return defer.gatherResults(dl)
+
+
+    def _callDispatcher(self, command, **kwargs):
+        """
+        Call the dispatcher, if it's still there.  If it has gone, the run
+        is being killed and its messages can be dropped.
+        """
+        def gone(err):
+            err.trap(ConnectionLost, ConnectionDone)
+        return self.callRemote(command, **kwargs).addErrback(gone)
+
+
+
+class WorkerFactory(protocol.Factory):
+    """
+    I make L{WorkerProtocol}s for serving a L{RemoteScriptRunner}.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+
+
+    def buildProtocol(self, addr):
+        return WorkerProtocol(self.runner)
+
+
+
+class _RemoteRun(object):
+    """
+    I collect the output of a script running on a worker.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.stdout = []
+        self.stderr = []
+
+
+    def output(self, channel, data):
+        if channel == 1:
+            self.stdout.append(data)
+        else:
+            self.stderr.append(data)
+        return self.log({
+            'type': 'output',
+            'channel': channel,
+            'data': data,
+        })
+
+
+    def log(self, msg):
+        if self.logger:
+            return self.logger(msg)
+
+
+
+class _DispatcherProtocol(amp.AMP):
+    """
+    I am the L{RemoteScriptRunner}'s end of a connection to a worker.
+    """
+
+    def __init__(self, worker):
+        amp.AMP.__init__(self)
+        self.worker = worker
+        self.runs = {}
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.worker.disconnected(self)
+
+
+    @defer.inlineCallbacks
+    def run(self, executable, args, env, logger=None, timeout=None):
+        run_id = str(uuid4())
+        remote_run = self.runs[run_id] = _RemoteRun(logger)
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = float(timeout)
+        try:
+            result = yield self.callRemote(Run,
+                run_id=run_id,
+                executable=executable,
+                args=msgpack.packb(args),
+                env=msgpack.packb(env),
+                **kwargs)
+        except Timeout as e:
+            raise Timeout(e.args[0], ''.join(remote_run.stdout),
+                ''.join(remote_run.stderr))
+        finally:
+            del self.runs[run_id]
+        defer.returnValue((''.join(remote_run.stdout),
+            ''.join(remote_run.stderr), result['rc']))
+
+
+    @Output.responder
+    def output(self, run_id, channel, data):
+        d = defer.maybeDeferred(self.runs[run_id].output, channel, data)
+        d.addCallback(lambda _: {})
+        return d
+
+
+    @Event.responder
+    def event(self, run_id, message):
+        d = defer.maybeDeferred(self.runs[run_id].log,
+            msgpack.unpackb(message))
+        d.addCallback(lambda _: {})
+        return d
+
+
+
+class _Worker(object):
+    """
+    I keep a connection to one worker and count how many runs it has.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.protocol = None
+        self.load = 0
+        self._connecting = []
+
+
+    def connect(self):
+        """
+        Connect to the worker if not already connected.
+        """
+        if self.protocol is not None:
+            return defer.succeed(self.protocol)
+        d = defer.Deferred()
+        self._connecting.append(d)
+        if len(self._connecting) == 1:
+            factory = protocol.Factory()
+            factory.protocol = lambda: _DispatcherProtocol(self)
+            self.endpoint.connect(factory).addBoth(self._connected)
+        return d
+
+
+    def _connected(self, result):
+        if isinstance(result, _DispatcherProtocol):
+            self.protocol = result
+        waiting = self._connecting
+        self._connecting = []
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def disconnected(self, proto):
+        if self.protocol is proto:
+            self.protocol = None
+
+
+    @defer.inlineCallbacks
+    def run(self, *args, **kwargs):
+        """
+        Run a script on the worker.
+
+        @raise Unavailable: If I'm not connected to the worker or the
+            connection is lost during the run.
+        """
+        if self.protocol is None:
+            raise Unavailable('Not connected to worker %r' % (
+                self.endpoint,))
+        self.load += 1
+        try:
+            result = yield self.protocol.run(*args, **kwargs)
+        except (ConnectionLost, ConnectionDone):
+            raise Unavailable('Lost connection to worker %r' % (
+                self.endpoint,))
+        finally:
+            self.load -= 1
+        defer.returnValue(result)
+
+
+
+class RemoteScriptRunner(object):
+    """
+    I run scripts on other machines by sending them to worker daemons
+    (served by L{WorkerFactory}).  Each run goes to the connected worker
+    with the fewest runs in progress.
+
+    I have the same C{run} method as
+    L{siloscript.process.LocalScriptRunner}, so I can be wrapped in a
+    L{siloscript.process.SiloWrapper}.  Make sure the wrapper's data URL is
+    reachable from the workers.
+    """
+
+    def __init__(self, endpoints):
+        """
+        @param endpoints: A list of client endpoints of workers.
+        """
+        self.workers = [_Worker(ep) for ep in endpoints]
+
+
+    def connect(self):
+        """
+        Connect to any workers I'm not connected to.
+
+        @return: A L{Deferred} which fires once every worker has either
+            connected or failed to.
+        """
+        dl = []
+        for worker in self.workers:
+            d = worker.connect()
+            d.addErrback(lambda err, ep: log.msg('Could not connect to %r: %s'
+                % (ep, err.getErrorMessage()), system='RemoteScriptRunner'),
+                worker.endpoint)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+
+    def disconnect(self):
+        """
+        Disconnect from all workers.
+        """
+        for worker in self.workers:
+            if worker.protocol is not None:
+                worker.protocol.transport.loseConnection()
+
+
+    @defer.inlineCallbacks
+    def _pickWorker(self):
+        connected = [w for w in self.workers if w.protocol is not None]
+        if len(connected) < len(self.workers):
+            d = self.connect()
+            if not connected:
+                yield d
+                connected = [w for w in self.workers
+                    if w.protocol is not None]
+        if not connected:
+            raise Unavailable('No workers are available')
+        defer.returnValue(min(connected, key=lambda w: w.load))
+
+
+    @defer.inlineCallbacks
+    def run(self, executable, args=None, env=None, logger=None, timeout=None):
+        """
+        Run a script on a worker.
+
+        See L{siloscript.process.LocalScriptRunner.run}.
+
+        @raise Unavailable: If no workers can be reached.
+        """
+        worker = yield self._pickWorker()
+        result = yield worker.run(executable, args or [], env or {},
+            logger=logger, timeout=timeout)
+        defer.returnValue(result)
@@ -1,21 +1,45 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.protocols.basic import FileSender
+from twisted.internet.address import IPv4Address, UNIXAddress
 from klein import Klein
 from twisted.web.static import File
-from twisted.python import log
+from twisted.web.server import Site, Request, NOT_DONE_YET
+from twisted.web.resource import Resource
+from twisted.web.iweb import IBodyProducer
+from twisted.python import log, failure
 
 import hashlib
 
 import json
 from functools import partial, wraps
-from collections import defaultdict
+from collections import defaultdict, deque
 from uuid import uuid4
 
-from siloscript.storage import Silo
+from siloscript.storage import Silo, STREAM_THRESHOLD, storeMetrics
+from siloscript.silokey import MemoryRevocationList
+from siloscript.metrics import Registry, Gauge, Counter, Histogram
+from siloscript.jobs import JobStore, JobLog, _jsonable
+from siloscript.sse import EventStream
 from siloscript.util import async
 from siloscript.error import NotFound, InvalidKey, CryptError
+from siloscript.error import VersionMismatch, NoAnswer, Overloaded, Timeout
+
+
+
+def _timed(f):
+    """
+    Decorate a L{Machine} C{data_*} method to time it in C{data_seconds},
+    labelled by the rest of its name.
+    """
+    operation = f.__name__[len('data_'):]
+    @wraps(f)
+    def deco(self, *args, **kwargs):
+        return self.data_seconds.time((operation,), f, self, *args,
+            **kwargs)
+    return deco
 
 
 
@@ -31,14 +55,74 @@ class Machine(object):
     token_prefix = ':private:'
     token_salt = 'dssdfh09w83hof08hasodifaosdnfsadf'
 
+    # A siloscript.hub.HubClient when I'm one of several worker processes.
+    hub = None
 
-    def __init__(self, store, runner):
+
+    def __init__(self, store, runner, result_cache=None,
+            coalesce_runs=False, silo_keys=None, revoked=None,
+            question_timeout=None, clock=reactor):
+        """
+        @param store: A key-value store.  See L{siloscript.storage}.
+        @param runner: A script runner such as L{siloscript.process.SiloWrapper}.
+        @param result_cache: An optional L{siloscript.cache.ResultCache} for
+            remembering the results of successful runs.
+        @param coalesce_runs: If C{True}, a run requested while an identical
+            one (same user, executable, args and env) is in progress will
+            wait for and share the result of the one in progress.
+        @param silo_keys: An optional L{siloscript.silokey.SiloKeys} for
+            making signed silo keys, which any process with the same secret
+            (and store) can serve data requests for.
+        @param revoked: The revocation list of signed silo keys that have
+            been closed, shared by the processes serving them.  Defaults to
+            a L{siloscript.silokey.MemoryRevocationList}.
+        @param question_timeout: Seconds to wait for the answer to a
+            question before giving up on it (and failing the request that
+            asked it with L{NoAnswer}), or C{None} to wait forever.
+        """
         self.store = store
         self.runner = runner
+        self.result_cache = result_cache
+        self.coalesce_runs = coalesce_runs
+        self.silo_keys = silo_keys
+        if revoked is None:
+            revoked = MemoryRevocationList()
+        self.revoked = revoked
+        self._runs_in_progress = {}
+        self._ran_scripts = set()
+        # scripts being run by the runner
+        self._running = 0
+
+        self.question_timeout = question_timeout
+        self.clock = clock
+        self._question_deadlines = {}
 
-        self.receivers = defaultdict(list)
         self.silos = {}
         self.pending_questions = defaultdict(list)
+        # questions silos are waiting on, shared so that concurrent runs
+        # for a user don't ask the same thing more than once
+        self._asking = {}
+
+        self.metrics = Registry()
+        self.metrics.register(Gauge('siloscript_silos',
+            'Open data silos.', lambda: len(self.silos)))
+        self.metrics.register(Gauge('siloscript_pending_questions',
+            'Questions waiting for an answer.',
+            lambda: len(self.pending_questions)))
+        self.metrics.register(Gauge('siloscript_runs_running',
+            'Scripts running.', lambda: self._running))
+        self.run_seconds = self.metrics.register(Histogram(
+            'siloscript_run_seconds',
+            'Seconds scripts ran, by script (or "other" for names that have'
+            ' never been run) and exit code (or "timeout" or "error" if they'
+            ' were killed or could not be run).',
+            ['script', 'rc'], clock=clock))
+        self.data_seconds = self.metrics.register(Histogram(
+            'siloscript_data_seconds',
+            'Seconds taken to answer data requests, including waiting for'
+            ' people to answer questions.', ['operation'], clock=clock))
+        for metric in storeMetrics(store):
+            self.metrics.register(metric)
 
 
     def ask_question(self, receiver, question):
@@ -62,20 +146,47 @@ class Machine(object):
     def wait_for_answer(self, question_id):
         """
         Wait for the answer to a question.
+
+        @return: A L{Deferred} which fires with the answer, or fails with
+            L{NoAnswer} if there's none within L{question_timeout}.
         """
         d = defer.Deferred()
         self.pending_questions[question_id].append(d)
+        if (self.question_timeout is not None
+                and question_id not in self._question_deadlines):
+            self._question_deadlines[question_id] = self.clock.callLater(
+                self.question_timeout, self._expireQuestion, question_id)
         return d
 
 
-    def answer_question(self, question_id, answer):
+    def _expireQuestion(self, question_id):
+        """
+        Give up waiting for the answer to a question.
+        """
+        del self._question_deadlines[question_id]
+        for d in self.pending_questions.pop(question_id, []):
+            d.errback(NoAnswer(question_id))
+
+
+    def answer_question(self, question_id, answer, relay=True):
         """
         Answer a question posed by L{channel_prompt} and eventually received
         by receivers registered with L{channel_connect}.
 
         @param question_id: Id of question that was sent to receiver.
         @param answer: string answer.
+        @param relay: If C{True} and I'm linked to other workers by a
+            L{hub}, pass on answers to questions I didn't ask to them.
         """
+        if question_id not in self.pending_questions:
+            if relay and self.hub is not None:
+                # it may be another worker's question
+                self.hub.answer(question_id, answer)
+            # otherwise it has already been answered or given up on
+            return
+        deadline = self._question_deadlines.pop(question_id, None)
+        if deadline is not None:
+            deadline.cancel()
         for d in self.pending_questions.pop(question_id):
             d.callback(answer)
 
@@ -92,31 +203,75 @@ class Machine(object):
         @param channel_receiver: optional function if user input will be
             available when data is requested and not available from the data
             store.  The function will be called with question dictionaries.
+            While a question is waiting for an answer, silos for the same
+            user and subkey that need the same value with the same prompt
+            wait for it rather than asking again (so the question goes to
+            the first one's C{channel_receiver}).
 
         @return: string silo key.
         """
         func = None
         if channel_receiver:
             func = partial(self.ask_question, channel_receiver)
-        silo = Silo(self.store, user, subkey, func)
-        key = 'SILO-%s' % (uuid4(),)
+        silo = Silo(self.store, user, subkey, func, asking=self._asking)
+        if self.silo_keys is not None:
+            key = self.silo_keys.make(user, subkey)
+        else:
+            key = 'SILO-%s' % (uuid4(),)
         self.silos[key] = silo
         return key
 
 
     def control_closeSilo(self, silo_key):
         """
-        Close a silo so that no more reads/writes can be done on it.
+        Close a silo so that no more reads/writes can be done on it.  Signed
+        keys are revoked so that other processes stop serving them, too.
 
         @param silo_key: A string silo key as returned by L{control_makeSilo}.
         """
         self.silos.pop(silo_key)
+        if self.silo_keys is not None:
+            try:
+                _, _, run_id, expires = self.silo_keys.check(silo_key)
+            except NotFound:
+                # it has expired anyway
+                return
+            self.revoked.revoke(run_id, expires)
 
 
-    def run(self, user, executable, args, env, channel_receiver=None, logger=None):
+    def _getSilo(self, silo_key):
+        """
+        Get the silo for a key: the one made by L{control_makeSilo} in this
+        process or, for a valid signed key that hasn't been revoked, one
+        made from the key (which can't ask anyone questions).
+
+        @raise NotFound: If there's no such silo.
+        """
+        silo = self.silos.get(silo_key)
+        if silo is not None:
+            return silo
+        if self.silo_keys is not None and self.silo_keys.isSigned(silo_key):
+            user, subkey, run_id, _ = self.silo_keys.check(silo_key)
+            if not self.revoked.isRevoked(run_id):
+                return Silo(self.store, user, subkey)
+        raise NotFound(silo_key)
+
+
+    def run(self, user, executable, args, env, channel_receiver=None,
+            logger=None, timeout=None, refresh=False):
         """
         Create a data silo for the given user and script, then run the script.
 
+        If there's a L{result_cache} with a result for an identical run, that
+        is returned instead (and its output is given to C{logger} as though
+        the script had just run) and no silo is created.
+
+        If L{coalesce_runs} is set and an identical run (same user,
+        executable, args and env, and either both or neither with a
+        C{channel_receiver}) is in progress, its result is shared and its
+        questions are asked of every caller's C{channel_receiver}.  The
+        C{timeout} of the later run is ignored.
+
         The caller is responsible for authenticating the user.
 
         @param user: string user identifer.
@@ -126,12 +281,70 @@ class Machine(object):
         @param channel_receiver: If user input is available, this is a function
             that will be called with questions.  See also L{control_makeSilo}.
         @param logger: Logging function to be given messages as it goes.
+        @param timeout: Optional number of seconds the script may run before
+            it is killed, overriding the runner's configured timeouts.
+        @param refresh: If C{True}, run the script even if there's a cached
+            result (and cache the new result).
 
         @return: the (L{Deferred}) stdout, stderr, rc of the process or else
-            a failure.
+            a failure (L{Timeout} if the script was killed for taking too
+            long).
+        """
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache.key(user, executable, args, env)
+            if not refresh:
+                result = self.result_cache.get(cache_key)
+                if result is not None:
+                    return self._replayResult(result, logger)
+
+        if not self.coalesce_runs:
+            return self._run(user, executable, args, env, channel_receiver,
+                logger, timeout, cache_key)
+
+        run_key = (user, executable, json.dumps(args or [], sort_keys=True),
+            tuple(sorted((env or {}).items())), channel_receiver is not None)
+        shared = self._runs_in_progress.get(run_key)
+        if shared is not None:
+            return shared.attach(logger, channel_receiver)
+
+        shared = self._runs_in_progress[run_key] = _SharedRun(
+            self.wait_for_answer)
+        d = shared.attach(logger, channel_receiver)
+        run_d = self._run(user, executable, args, env,
+            shared.ask if channel_receiver is not None else None,
+            shared.log, timeout, cache_key)
+        def finished(result):
+            del self._runs_in_progress[run_key]
+            shared.finish(result)
+        run_d.addBoth(finished)
+        return d
+
+
+    def _run(self, user, executable, args, env, channel_receiver, logger,
+            timeout, cache_key):
+        """
+        Actually run a script for L{run}.
         """
         silo_key = self.control_makeSilo(user, executable, channel_receiver)
+        self._running += 1
+        start = self.clock.seconds()
         def cleanup(result):
+            self._running -= 1
+            rc = 'error'
+            if isinstance(result, tuple):
+                rc = str(result[2])
+            elif isinstance(result, failure.Failure) and result.check(Timeout):
+                rc = 'timeout'
+            if rc != 'error':
+                self._ran_scripts.add(executable)
+            # Anyone can ask to run anything, so only label scripts that
+            # exist to keep the number of labels down.
+            script = executable
+            if script not in self._ran_scripts:
+                script = 'other'
+            self.run_seconds.observe(self.clock.seconds() - start,
+                (script, rc))
             self.control_closeSilo(silo_key)
             return result
         d = self.runner.runWithSilo(
@@ -139,11 +352,48 @@ class Machine(object):
             executable=executable,
             args=args,
             env=env,
-            logger=logger)
+            logger=logger,
+            timeout=timeout)
         d.addBoth(cleanup)
+        if cache_key is not None:
+            d.addCallback(self._cacheResult, cache_key)
         return d
 
 
+    def _cacheResult(self, result, cache_key):
+        self.result_cache.put(cache_key, result)
+        return result
+
+
+    def _replayResult(self, result, logger):
+        """
+        Give C{logger} the output and exit messages of a cached result.
+
+        @return: A L{Deferred} which fires with C{result} once C{logger} is
+            done with the messages.
+        """
+        d = defer.succeed(None)
+        if logger is None:
+            return d.addCallback(lambda _: result)
+        out, err, rc = result
+        messages = []
+        for channel, data in [(1, out), (2, err)]:
+            if data:
+                messages.append({
+                    'type': 'output',
+                    'channel': channel,
+                    'data': data,
+                })
+        messages.append({
+            'type': 'exit',
+            'code': rc,
+            'cached': True,
+        })
+        for msg in messages:
+            d.addCallback(lambda _, msg=msg: logger(msg))
+        return d.addCallback(lambda _: result)
+
+
     def _data_validateUserSuppliedKey(self, key):
         """
         Validate that the given user key is okay.
@@ -152,6 +402,7 @@ class Machine(object):
             raise InvalidKey('Invalid key: %r' % (key,))
 
 
+    @_timed
     @async
     def data_get(self, silo_key, key, prompt=None, save=True, options=None):
         """
@@ -167,28 +418,128 @@ class Machine(object):
 
         @return: The L{Deferred} value (either cached or from the user).
         """
-        if silo_key not in self.silos:
-            raise NotFound(silo_key)
+        return self._get(silo_key, key, prompt, save, options)
+
+
+    @async
+    def _get(self, silo_key, key, prompt=None, save=True, options=None):
+        """
+        L{data_get}, without timing it.
+        """
+        silo = self._getSilo(silo_key)
         self._data_validateUserSuppliedKey(key)
-        return self.silos[silo_key].get(key, prompt, save=save,
-            options=options)
+        return silo.get(key, prompt, save=save, options=options)
 
 
+    @_timed
     @async
-    def data_put(self, silo_key, key, value):
+    def data_put(self, silo_key, key, value, if_version=None):
         """
         Put a value in the user-scope silo.
 
         @param silo_key: A key as returned by L{control_makeSilo}.
         @param key: string key of data.
         @param value: string value of data.
+        @param if_version: If given, only put the value if the current one
+            is at this version (see L{data_version}), or if there is one
+            when C{'*'}.
+
+        @raise VersionMismatch: If the current value isn't at C{if_version}.
+
+        @return: The L{Deferred} new version of the value.
+        """
+        silo = self._getSilo(silo_key)
+        self._data_validateUserSuppliedKey(key)
+        return silo.put(key, value, if_version=if_version)
+
+
+    @_timed
+    @async
+    def data_putStream(self, silo_key, key, stream, if_version=None):
+        """
+        Put a (large) value read from a file in a user-scoped silo without
+        reading it all into memory, if the store can help it.  See
+        L{data_put}.
+
+        @param stream: A file to read the value from.
+        """
+        silo = self._getSilo(silo_key)
+        self._data_validateUserSuppliedKey(key)
+        return silo.put_stream(key, stream, if_version=if_version)
+
+
+    @async
+    def data_getStream(self, silo_key, key):
         """
-        if silo_key not in self.silos:
-            raise NotFound(silo_key)
+        Get a stored value from a user-scoped silo without asking anyone for
+        it.  This isn't timed on its own, as it's part of a C{get} (see
+        L{dataGet}).
+
+        @param silo_key: A key as returned by L{control_makeSilo}.
+        @param key: string key of data.
+
+        @return: A L{Deferred} string or, for large values the store keeps
+            in files, open file, which the caller must close.  It fails
+            with L{KeyError} if there's no value.
+        """
+        silo = self._getSilo(silo_key)
         self._data_validateUserSuppliedKey(key)
-        return self.silos[silo_key].put(key, value)
+        return silo.get_stream(key)
+
+
+    @async
+    def data_version(self, silo_key, key):
+        """
+        Get the version of a value in a user-scoped silo without decrypting
+        it.  This isn't timed on its own, as it's part of a C{get} (see
+        L{dataGet}).
+
+        @param silo_key: A key as returned by L{control_makeSilo}.
+        @param key: string key of data.
+
+        @return: The L{Deferred} version, which fails with L{KeyError} if
+            there's no value.
+        """
+        silo = self._getSilo(silo_key)
+        self._data_validateUserSuppliedKey(key)
+        return silo.version(key)
+
+
+    @_timed
+    @async
+    def data_getMany(self, silo_key, requests):
+        """
+        Get several values from a user-scoped silo at once.
+
+        @param silo_key: A key as returned by L{control_makeSilo}.
+        @param requests: A list of dicts each with a C{'key'} and optionally
+            C{'prompt'}, C{'save'} and C{'options'} as for L{data_get}.
+
+        @return: A L{Deferred} dict of key to value.  Values that aren't
+            stored and weren't supplied by a person are left out.
+        """
+        silo = self._getSilo(silo_key)
+        for req in requests:
+            self._data_validateUserSuppliedKey(req['key'])
+        return silo.get_many(requests)
+
+
+    @_timed
+    @async
+    def data_putMany(self, silo_key, items):
+        """
+        Put several values in the user-scope silo at once.
+
+        @param silo_key: A key as returned by L{control_makeSilo}.
+        @param items: A dict of key to value.
+        """
+        silo = self._getSilo(silo_key)
+        for key in items:
+            self._data_validateUserSuppliedKey(key)
+        return silo.put_many(items)
 
 
+    @_timed
     @defer.inlineCallbacks
     def data_createToken(self, silo_key, value):
         """
@@ -201,9 +552,7 @@ class Machine(object):
         @param value: The probably sensitive piece of data you want to
             tokenize.
         """
-        if silo_key not in self.silos:
-            raise NotFound(silo_key)
-        silo = self.silos[silo_key]
+        silo = self._getSilo(silo_key)
         key = ':tokens'
         try:
             data = yield silo.get(key)
@@ -222,8 +571,254 @@ class Machine(object):
 
 
 
-def sseMsg(name, data):
-    return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data))
+class _SharedRun(object):
+    """
+    I let several callers wait for (and watch the output of, and answer
+    the questions of) one run.
+    """
+
+    def __init__(self, wait_for_answer, replay_size=1024 * 1024):
+        """
+        @param wait_for_answer: A function like L{Machine.wait_for_answer}
+            so that I know when questions have been answered.
+        @param replay_size: Maximum number of bytes of output to hold for
+            loggers that attach later.  Older output is dropped first.
+        """
+        self.wait_for_answer = wait_for_answer
+        self.replay_size = replay_size
+        self._waiters = []
+        self._loggers = []
+        self._messages = deque()
+        self._held = 0
+        self._receivers = []
+        self._questions = {}
+
+
+    def attach(self, logger=None, channel_receiver=None):
+        """
+        Wait for the run to finish.
+
+        @param logger: Optional logging function which will get its own copy
+            of every message logged by the run (including ones logged before
+            now, as far as L{replay_size} allows).
+        @param channel_receiver: Optional function which will be asked the
+            run's questions (including unanswered ones asked before now).
+
+        @return: A L{Deferred} which fires with the result of the run.
+        """
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if logger:
+            for msg in self._messages:
+                logger(dict(msg))
+            self._loggers.append(logger)
+        if channel_receiver:
+            for question in self._questions.values():
+                channel_receiver(dict(question))
+            self._receivers.append(channel_receiver)
+        return d
+
+
+    def ask(self, question):
+        """
+        Ask every attached channel receiver a question.
+        """
+        question_id = question['id']
+        self._questions[question_id] = question
+        def answered(_):
+            self._questions.pop(question_id, None)
+        self.wait_for_answer(question_id).addBoth(answered)
+        for receiver in list(self._receivers):
+            receiver(dict(question))
+
+
+    def log(self, msg):
+        """
+        Give a message to every attached logger.
+
+        @return: A L{Deferred} which fires once all the loggers that want
+            the run to pause are ready for more, or C{None} if none do.
+        """
+        self._messages.append(msg)
+        self._held += len(msg.get('data', ''))
+        while self._held > self.replay_size:
+            self._held -= len(self._messages.popleft().get('data', ''))
+
+        pauses = []
+        for logger in self._loggers:
+            r = logger(dict(msg))
+            if isinstance(r, defer.Deferred) and not r.called:
+                r.addErrback(log.err, 'Error in output logger')
+                pauses.append(r)
+        if pauses:
+            return defer.DeferredList(pauses)
+
+
+    def finish(self, result):
+        waiters = self._waiters
+        self._waiters = []
+        self._loggers = []
+        self._messages = deque()
+        self._held = 0
+        self._receivers = []
+        self._questions = {}
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+
+def dataGet(machine, request, silo_key, key):
+    """
+    Answer a request for a value.  The response has an C{ETag} if the value
+    is stored, and is a bodiless 304 if that matches C{If-None-Match}, in
+    which case the value isn't read (or decrypted).  The whole request is
+    timed as a C{get}.
+
+    @param machine: The L{Machine}.
+
+    @return: A L{Deferred} response body, which is an open file (see
+        L{_sendStream}) for large stored values.
+    """
+    return machine.data_seconds.time(('get',), _dataGet, machine, request,
+        silo_key, key)
+
+
+
+@defer.inlineCallbacks
+def _dataGet(machine, request, silo_key, key):
+    args = request.args
+    prompt = args.get('prompt', [None])[0]
+    save = args.get('save', ['True'])[0] == 'True'
+    options = args.get('options', None)
+    try:
+        # Get the version first so that if the value changes while it's
+        # being read, the ETag is the stale one rather than the content.
+        version = yield machine.data_version(silo_key, key)
+    except KeyError:
+        version = None
+    if version is not None:
+        request.setHeader('ETag', '"%s"' % (version,))
+        if version in _etags(request.getHeader('If-None-Match')):
+            request.setResponseCode(304)
+            defer.returnValue(None)
+    if prompt is None and save:
+        # Nobody will be asked, so a large value can be sent from a file.
+        value = yield machine.data_getStream(silo_key, key)
+    else:
+        value = yield machine._get(silo_key, key, prompt, save=save,
+            options=options)
+    defer.returnValue(value)
+
+
+
+def dataPut(machine, request, silo_key, key):
+    """
+    Answer a request to put a value.  With C{If-Match}, the value is only
+    put if the current one matches (or exists, for C{*}); otherwise the
+    L{Deferred} fails with L{VersionMismatch}.  The response has the new
+    value's C{ETag}.  Large values are streamed to the store (see
+    L{Machine.data_putStream}).
+
+    @param machine: The L{Machine}.
+
+    @return: A L{Deferred} (empty) response body.
+    """
+    if_version = None
+    if_match = request.getHeader('If-Match')
+    if if_match is not None:
+        if if_match.strip() == '*':
+            if_version = '*'
+        else:
+            versions = _etags(if_match)
+            if len(versions) != 1:
+                return defer.fail(ValueError(
+                    'If-Match must have one ETag: %r' % (if_match,)))
+            if_version = versions[0]
+    content = request.content
+    content.seek(0, 2)
+    size = content.tell()
+    content.seek(0)
+    if size > STREAM_THRESHOLD:
+        # twisted.web has spooled it to a temporary file.
+        d = machine.data_putStream(silo_key, key, content,
+            if_version=if_version)
+    else:
+        d = machine.data_put(silo_key, key, content.read(),
+            if_version=if_version)
+    def sent(version):
+        request.setHeader('ETag', '"%s"' % (version,))
+    return d.addCallback(sent)
+
+
+
+def _etags(header):
+    """
+    Get the versions in an C{If-None-Match} or C{If-Match} header.
+    """
+    if not header:
+        return []
+    versions = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        versions.append(etag.strip('"'))
+    return versions
+
+
+
+@defer.inlineCallbacks
+def dataBatch(machine, silo_key, body):
+    """
+    Get and put several values at once.  The request body is JSON like
+    this (both parts are optional):
+
+        {
+            "put": {"key1": "value1", ...},
+            "get": ["key2", {"key": "key3", "prompt": "Key 3?",
+                             "save": false, "options": ["a", "b"]}, ...]
+        }
+
+    Puts are done first.  The response is JSON with a C{"values"} dict
+    of the values gotten.  Values that don't exist (and weren't supplied
+    by a person) are left out.  Values must be UTF-8 text.
+
+    @param machine: The L{Machine}.
+    @param body: The request body.
+
+    @return: A L{Deferred} response body.
+    """
+    body = json.loads(body or '{}')
+    puts = dict([(_utf8(k), _utf8(v))
+        for k, v in body.get('put', {}).items()])
+    gets = []
+    for req in body.get('get', []):
+        if not isinstance(req, dict):
+            req = {'key': req}
+        req = dict([(str(k), v) for k, v in req.items()])
+        req['key'] = _utf8(req['key'])
+        if req.get('prompt') is not None:
+            req['prompt'] = _utf8(req['prompt'])
+        if req.get('options') is not None:
+            req['options'] = [_utf8(x) for x in req['options']]
+        gets.append(req)
+
+    if puts:
+        yield machine.data_putMany(silo_key, puts)
+    values = {}
+    if gets:
+        values = yield machine.data_getMany(silo_key, gets)
+    defer.returnValue(json.dumps({'values': values}))
+
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
 
 
 
@@ -239,6 +834,149 @@ def cors(f):
 
 
 
+def sized(f):
+    """
+    Decorate a handler to send a C{Content-Length} with its (string)
+    response instead of using chunked encoding.  Empty chunked responses
+    confuse some HTTP clients into dropping kept-alive connections.
+    """
+    @wraps(f)
+    def deco(instance, request, *args, **kwargs):
+        d = defer.maybeDeferred(f, instance, request, *args, **kwargs)
+        d.addCallback(_setLength, request)
+        return d
+    return deco
+
+
+def _overloaded(request, error):
+    """
+    Answer a request that was turned away because the server is too busy
+    (see L{siloscript.admission.Limiter}).
+    """
+    retry_after = 1
+    if len(error.args) > 1:
+        retry_after = error.args[1]
+    request.setResponseCode(503)
+    request.setHeader('Retry-After', str(retry_after))
+    return 'Too busy, try again later.'
+
+
+def _setLength(result, request):
+    if _isStream(result):
+        return _sendStream(request, result)
+    if result is None:
+        result = ''
+    if isinstance(result, str) and request.code != 304:
+        request.setHeader('Content-Length', str(len(result)))
+    return result or None
+
+
+
+def _isStream(result):
+    """
+    Is a response body an open file or an L{IBodyProducer}, to be sent with
+    L{_sendStream}, rather than a string?
+    """
+    return hasattr(result, 'read') or IBodyProducer.providedBy(result)
+
+
+
+def _closeStream(stream):
+    """
+    Close an open file or stop an L{IBodyProducer} that won't be sent.
+    """
+    if hasattr(stream, 'read'):
+        stream.close()
+    else:
+        stream.stopProducing()
+
+
+
+def _sendStream(request, stream):
+    """
+    Send an open file (see L{_sendFile}) or the output of an
+    L{IBodyProducer} (see L{_sendProducer}) as a response body.
+    """
+    if hasattr(stream, 'read'):
+        return _sendFile(request, stream)
+    return _sendProducer(request, stream)
+
+
+
+def _sendProducer(request, producer):
+    """
+    Send what an L{IBodyProducer} of unknown length produces as a chunked
+    response body.  It's registered as the request's producer, so it's
+    paused while the client isn't reading.  If it fails partway the
+    connection is dropped, so that the client doesn't mistake what it got
+    for the whole value.
+
+    @return: A L{Deferred} like L{_sendFile}'s.
+    """
+    d = defer.Deferred(lambda _: producer.stopProducing())
+    request.registerProducer(producer, True)
+    def done(result):
+        request.unregisterProducer()
+        if isinstance(result, failure.Failure):
+            log.msg('stopped sending a value: %s' % (
+                result.getErrorMessage(),))
+            transport = request.transport
+            getattr(transport, 'abortConnection', transport.loseConnection)()
+        else:
+            d.callback(None)
+    producer.startProducing(request).addBoth(done)
+    return d
+
+
+
+def _sendFile(request, f):
+    """
+    Send an open file as a response body with a C{Content-Length}, a chunk
+    at a time as the connection is ready for more, then close it.
+
+    @return: A L{Deferred} that fires with C{None} once it's all been
+        written.  If the connection is lost first, it doesn't fire until
+        it's cancelled (as Klein and L{DataResource} do when the request's
+        C{notifyFinish} fails).
+    """
+    f.seek(0, 2)
+    request.setHeader('Content-Length', str(f.tell()))
+    f.seek(0)
+    sender = FileSender()
+    d = defer.Deferred(lambda _: sender.stopProducing())
+    def done(result):
+        f.close()
+        if not isinstance(result, failure.Failure):
+            d.callback(None)
+    sender.beginFileTransfer(f, request).addBoth(done)
+    return d
+
+
+
+class _KleinRequest(Request):
+    """
+    Klein wants a port number for the server, which Unix sockets don't
+    have.
+    """
+
+    def getHost(self):
+        host = Request.getHost(self)
+        if isinstance(host, UNIXAddress):
+            return IPv4Address('TCP', '127.0.0.1', 80)
+        return host
+
+
+
+class KleinSite(Site):
+    """
+    I am a L{Site} for serving Klein apps (such as L{DataWebApp}) that
+    works on Unix sockets as well as TCP.
+    """
+
+    requestFactory = _KleinRequest
+
+
+
 class PublicWebApp(object):
 
     app = Klein()
@@ -251,11 +989,22 @@ class PublicWebApp(object):
     @cors
     def answer_question(self, request, question_id):
         """
-        Answer a question posed to a user.
+        Answer a question posed to a user.  The body is the answer or, for
+        a bundle of questions (one with C{'fields'}), a JSON object (sent
+        as C{application/json}) of each field's key to its answer.
         """
         if request.method == 'OPTIONS':
             return
         answer = request.content.read()
+        content_type = request.getHeader('Content-Type') or ''
+        if content_type.split(';')[0].strip() == 'application/json':
+            try:
+                valid = isinstance(json.loads(answer), dict)
+            except ValueError:
+                valid = False
+            if not valid:
+                request.setResponseCode(400)
+                return 'Expected a JSON object'
         self.machine.answer_question(question_id, answer)
 
 
@@ -264,11 +1013,67 @@ class ControlWebApp(object):
 
     app = Klein()
 
-    def __init__(self, machine, static_root):
+    # Most seconds a request for a job's status may wait for it to finish.
+    max_wait = 60
+
+    # Seconds between comments sent to idle channel connections to keep
+    # proxies from closing them.
+    heartbeat = 15
+
+    # Most bytes of questions to hold for a channel connection that isn't
+    # reading them before dropping it.
+    max_queued = 64 * 1024
+
+    # Seconds a client turned away from /run is told to wait.
+    run_retry_after = 5
+
+    def __init__(self, machine, static_root, jobs=None, max_runs=None):
+        """
+        @param jobs: The L{JobStore} to keep track of runs in.
+        @param max_runs: The most jobs started with C{/run} that may be
+            running at once, so that bulk submissions can't swamp the data
+            servers the running scripts need, or C{None} for no limit.
+        """
         self.machine = machine
         self.static_root = static_root
+        self.max_runs = max_runs
+        if jobs is None:
+            jobs = JobStore()
+        self.jobs = jobs
         self.channels = defaultdict(list)
         self.pending_questions = defaultdict(list)
+        # EventStreams of connected channel receivers
+        self._streams = set()
+        # EventStreams of clients following jobs
+        self._job_streams = set()
+        self._last_seq = 0
+        machine.metrics.register(Gauge('siloscript_channels',
+            'Channels with connected receivers.', lambda: len(self.channels)))
+        machine.metrics.register(Gauge('siloscript_channel_receivers',
+            'Receivers connected to channels.',
+            lambda: sum(map(len, self.channels.values()))))
+        machine.metrics.register(Gauge('siloscript_channel_questions',
+            'Unanswered questions offered to channels, including those'
+            ' asked by other workers.',
+            lambda: sum(map(len, self.pending_questions.values()))))
+        machine.metrics.register(Gauge('siloscript_channel_bytes_queued',
+            'Bytes of events held for channel receivers that are behind.',
+            lambda: sum([x.queued for x in self._streams])))
+        self.channel_connections = machine.metrics.register(Counter(
+            'siloscript_channel_connections_total',
+            'Connections made to channels.'))
+        self.channel_drops = machine.metrics.register(Counter(
+            'siloscript_channel_slow_receivers_dropped_total',
+            'Channel connections dropped for not reading fast enough.'))
+        machine.metrics.register(Gauge('siloscript_jobs_running',
+            'Jobs started with /run that are running.',
+            lambda: len(self.jobs.running)))
+        machine.metrics.register(Gauge('siloscript_jobs_finished',
+            'Finished jobs whose results are remembered.',
+            lambda: len(self.jobs.finished)))
+        machine.metrics.register(Gauge('siloscript_job_event_streams',
+            'Clients following jobs\' events.',
+            lambda: len(self._job_streams)))
 
 
     @app.route('/static', methods=['GET'], branch=True)
@@ -276,6 +1081,33 @@ class ControlWebApp(object):
         return File(self.static_root)
 
 
+    @app.handle_errors(NotFound)
+    def notfound(self, request, error):
+        request.setResponseCode(404)
+        return ''
+
+
+    @app.handle_errors(Overloaded)
+    def overloaded(self, request, error):
+        return _overloaded(request, error.value)
+
+
+    @app.handle_errors(ValueError)
+    def badrequest(self, request, error):
+        log.msg(error)
+        request.setResponseCode(400)
+        return ''
+
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics(self, request):
+        """
+        Report numbers about the server in the Prometheus text format.
+        """
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.machine.metrics.render()
+
+
     @app.route('/channel/open', methods=['GET'])
     def channel_open(self, request):
         """
@@ -286,62 +1118,234 @@ class ControlWebApp(object):
 
     @app.route('/channel/<string:channel_key>/events', methods=['GET'])
     def channel_events(self, request, channel_key):
-        request.setHeader('Content-type', 'text/event-stream')
-        request.write(sseMsg('channel_key', channel_key))
-
-        def receiver(request, data):
-            request.write(sseMsg('question', {
+        """
+        Stream a channel's questions as server-sent events: C{channel_key}
+        first, then a C{question} (with its C{id}, C{prompt} and any
+        C{options}, or C{fields} for a bundle) for each unanswered
+        question, now and as they're asked.
+
+        Each question event's id is its C{seq}, so a client reconnecting
+        with C{Last-Event-ID} is only sent the questions it hasn't seen.
+        Idle connections get a comment every L{heartbeat} seconds, and
+        connections that fall more than L{max_queued} bytes behind are
+        dropped.
+        """
+        try:
+            after = int(request.getHeader('Last-Event-ID') or 0)
+        except ValueError:
+            after = 0
+        stream = EventStream(request, frame_interval=0,
+            heartbeat=self.heartbeat, max_queued=self.max_queued,
+            clock=self.machine.clock)
+        stream.send('channel_key', channel_key)
+        self._streams.add(stream)
+        self.channel_connections.inc()
+
+        def receiver(data):
+            question = {
                 'id': data['id'],
                 'prompt': data['prompt'],
-            }))
+            }
+            for name in ['options', 'fields']:
+                if name in data:
+                    question[name] = data[name]
+            stream.send('question', question, event_id=data['seq'])
 
-        func = partial(receiver, request)
-        self.channels[channel_key].append(func)
+        self.channels[channel_key].append(receiver)
         
-        def rm(_, func):
+        def rm(_):
             # when the request has left, don't attempt to receive anymore.
-            self.channels[channel_key].remove(func)
+            self._streams.discard(stream)
+            if stream.too_slow:
+                self.channel_drops.inc()
+            self.channels[channel_key].remove(receiver)
+            if not self.channels[channel_key]:
+                del self.channels[channel_key]
 
-        request.notifyFinish().addCallback(rm, func)
+        request.notifyFinish().addBoth(rm)
 
         # ask pending questions
-        for question in self.pending_questions[channel_key]:
-            func(question)
+        for question in self.pending_questions.get(channel_key, []):
+            if question['seq'] > after:
+                receiver(question)
 
-        return defer.Deferred()
+        return stream.done
 
     @app.route('/run/<string:user>', methods=['POST'])
     def run(self, request, user):
         """
-        Run a script for a user.
+        Start running a script for a user.  The response is a JSON object
+        with the C{id} of the job, whose progress and result are at
+        C{/job/<id>}.  If L{max_runs} jobs are already running, the
+        response is a C{503} saying when to try again instead.
         """
+        if (self.max_runs is not None
+                and len(self.jobs.running) >= self.max_runs):
+            raise Overloaded('runs', self.run_retry_after)
         script = request.args.get('script', [None])[0]
         channel_key = request.args.get('channel_key', [None])[0]
         args = json.loads(request.args.get('args', ["[]"])[0])
+        timeout = request.args.get('timeout', [None])[0]
+        if timeout is not None:
+            timeout = float(timeout)
+        refresh = request.args.get('refresh', ['False'])[0] == 'True'
 
         func = partial(self.ask_channel, channel_key)
-        d = self.machine.run(user, script, args, {}, channel_receiver=func)
-        # just return output
-        # XXX change this later to look at exit code
-        d.addCallback(lambda x: x[0])
-        return d
+        job_log = JobLog()
+        d = self.machine.run(user, script, args, {}, channel_receiver=func,
+            logger=job_log.log, timeout=timeout, refresh=refresh)
+        job = self.jobs.start(d, user, script, args, log=job_log)
+        request.setResponseCode(202)
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Location', '/job/%s' % (job.id,))
+        return json.dumps({'id': job.id})
+
+
+    @app.route('/job/<string:job_id>', methods=['GET'])
+    def job(self, request, job_id):
+        """
+        Get a job's status as JSON: its C{state} (C{'running'}, C{'done'} or
+        C{'failed'}) and, once it's done, its C{stdout}, C{stderr} and
+        C{rc}, or the C{error} it failed with.  With C{wait=SECONDS}, wait
+        that long (up to L{max_wait}) for a running job to finish first.
+        """
+        wait = min(float(request.args.get('wait', ['0'])[0]), self.max_wait)
+        def respond(status):
+            if status is None:
+                raise NotFound(job_id)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps(status)
+        return self.job_status(job_id, wait).addCallback(respond)
+
+
+    @app.route('/job/<string:job_id>/events', methods=['GET'])
+    def job_events(self, request, job_id):
+        """
+        Stream a job's log as server-sent events as it runs: C{output} (with
+        the C{channel}, 1 or 2, and C{data}), C{exit}, C{timeout} and
+        finally C{end} with the job's status.  Each event's id is its
+        number in the log; the log's tail is replayed to late subscribers,
+        starting after C{Last-Event-ID} (or C{?after=N}) if given.  Events
+        that can't be sent, because they're no longer in the tail or the
+        client is too slow, are counted in a C{dropped} event.
+        """
+        after = request.getHeader('Last-Event-ID') or \
+            request.args.get('after', ['0'])[0]
+        after = int(after)
+        stream = EventStream(request)
+        self._job_streams.add(stream)
+        stream.done.addBoth(lambda _: self._job_streams.discard(stream))
+        request.notifyFinish().addBoth(
+            lambda _: self._job_streams.discard(stream))
+        last = [after]
+
+        def send(seq, msg):
+            if seq > last[0] + 1:
+                stream.send('dropped', {'count': seq - last[0] - 1})
+            last[0] = seq
+            stream.send(msg['type'], _jsonable(msg), event_id=seq)
+            if msg['type'] == 'end':
+                stream.close()
+
+        def watching(stop):
+            if stop is None:
+                raise NotFound(job_id)
+            # (at once, if the job was over and its end has been sent)
+            stream.done.addBoth(lambda _: stop())
+            return stream.done
+        return self.watch_job(job_id, send, after).addCallback(watching)
+
+
+    def watch_job(self, job_id, listener, after=0, relay=True):
+        """
+        Call C{listener(seq, msg)} with the messages in a job's log after
+        number C{after}, then with new ones as they come (see
+        L{siloscript.jobs.JobLog.listen}).
+
+        @param relay: If C{True} and I'm linked to other workers by a hub,
+            watch jobs I don't have on them.
+
+        @return: A L{Deferred} function to call to stop watching, or
+            C{None} if there's no such job.
+        """
+        try:
+            job = self.jobs.get(job_id)
+        except NotFound:
+            if relay and self.machine.hub is not None:
+                return self.machine.hub.watchJob(job_id, listener, after)
+            return defer.succeed(None)
+        return defer.succeed(job.log.listen(listener, after))
+
+
+    def job_status(self, job_id, wait=0, relay=True):
+        """
+        Get the status of a job (see L{siloscript.jobs.Job.status}).
+
+        @param wait: Seconds to wait for it to finish.
+        @param relay: If C{True} and I'm linked to other workers by a hub,
+            ask them about jobs I don't have.
+
+        @return: A L{Deferred} status dict, or C{None} if there's no such
+            job.
+        """
+        try:
+            d = self.jobs.wait(job_id, wait)
+        except NotFound:
+            if relay and self.machine.hub is not None:
+                return self.machine.hub.jobStatus(job_id, wait)
+            return defer.succeed(None)
+        return d.addCallback(lambda job: job.status())
 
 
     def ask_channel(self, channel_key, question):
         """
-        Ask a channel 
+        Ask a channel a question, and tell any other workers about it.
         """
-        self.pending_questions[channel_key].append(question)
-        
-        def rmQuestion(answer, question):
-            self.pending_questions[channel_key].remove(question)
+        hub = self.machine.hub
+
+        def rmQuestion(_, question):
+            # answered or given up on
+            self.channel_answered(channel_key, question['id'])
+            if self.machine.hub is not None:
+                self.machine.hub.answered(channel_key, question['id'])
         answer_d = self.machine.wait_for_answer(question['id'])
-        answer_d.addCallback(rmQuestion, question)
+        answer_d.addBoth(rmQuestion, question)
+
+        # Numbered by when they're asked (by the clock every worker
+        # shares), so that receivers can resume after the last they saw
+        # from any worker.
+        seq = max(int(self.machine.clock.seconds() * 1000000),
+            self._last_seq + 1)
+        self._last_seq = seq
+        question = dict(question, seq=seq)
+
+        self.channel_question(channel_key, question)
+        if hub is not None:
+            hub.ask(channel_key, question)
 
-        for receiver in self.channels[channel_key]:
+
+    def channel_question(self, channel_key, question):
+        """
+        Send a question to a channel's receivers, and to any that connect
+        before it's answered.
+        """
+        self.pending_questions[channel_key].append(question)
+        for receiver in self.channels.get(channel_key, []):
             receiver(question)
 
 
+    def channel_answered(self, channel_key, question_id):
+        """
+        Stop sending an answered question to a channel's receivers.
+        """
+        questions = [q for q in self.pending_questions.get(channel_key, [])
+            if q['id'] != question_id]
+        if questions:
+            self.pending_questions[channel_key] = questions
+        else:
+            self.pending_questions.pop(channel_key, None)
+
+
 
 class DataWebApp(object):
 
@@ -351,7 +1355,15 @@ class DataWebApp(object):
         self.machine = machine
 
 
+    @app.handle_errors(TypeError, ValueError)
+    @sized
+    def badrequest(self, request, error):
+        log.msg(error)
+        request.setResponseCode(400)
+
+
     @app.handle_errors(NotFound, KeyError)
+    @sized
     def notfound(self, request, error):
         log.msg(error)
         request.setResponseCode(404)
@@ -359,30 +1371,172 @@ class DataWebApp(object):
 
 
     @app.handle_errors(CryptError)
+    @sized
     def crypt_error(self, request, error):
         request.setResponseCode(500)
         return 'Error, try again later.'
 
 
+    @app.handle_errors(VersionMismatch)
+    @sized
+    def version_mismatch(self, request, error):
+        log.msg(error)
+        request.setResponseCode(412)
+
+
+    @app.handle_errors(NoAnswer)
+    @sized
+    def no_answer(self, request, error):
+        request.setResponseCode(504)
+        return 'No answer to the question.'
+
+
+    @app.handle_errors(Overloaded)
+    @sized
+    def overloaded(self, request, error):
+        return _overloaded(request, error.value)
+
+
     @app.route('/<string:silo_key>/<string:key>', methods=['GET'])
+    @sized
     def data_GET(self, request, silo_key, key):
-        prompt = request.args.get('prompt', [None])[0]
-        save = request.args.get('save', ['True'])[0] == 'True'
-        options = request.args.get('options', None)
-        return self.machine.data_get(silo_key, key, prompt,
-            save=save, options=options)
+        """
+        Get a value.  See L{dataGet}.
+        """
+        return dataGet(self.machine, request, silo_key, key)
 
 
     @app.route('/<string:silo_key>/<string:key>', methods=['PUT'])
+    @sized
     def data_PUT(self, request, silo_key, key):
-        value = request.content.read()
-        return self.machine.data_put(silo_key, key, value)
+        """
+        Put a value.  See L{dataPut}.
+        """
+        return dataPut(self.machine, request, silo_key, key)
+
+
+    @app.route('/<string:silo_key>/:batch', methods=['POST'])
+    @sized
+    @defer.inlineCallbacks
+    def data_batch(self, request, silo_key):
+        """
+        Get and put several values at once.  See L{dataBatch}.
+        """
+        result = yield dataBatch(self.machine, silo_key,
+            request.content.read())
+        request.setHeader('Content-Type', 'application/json')
+        defer.returnValue(result)
 
 
     @app.route('/<string:silo_key>', methods=['POST'])
+    @sized
     def data_getID(self, request, silo_key):
         value = request.args.get('value', [''])[0]
         return self.machine.data_createToken(silo_key, value)
 
 
 
+
+
+class DataResource(Resource):
+    """
+    I serve the same URLs, with the same status codes, as L{DataWebApp}
+    but directly on L{twisted.web.resource} instead of through Klein's
+    routing and error handling, which cost more per request than looking
+    up a value in memory does.
+
+    Use me with a plain L{Site}: C{siloscript serve --data-server raw}.
+    C{bench/data_rps.py} compares the two.
+    """
+
+    isLeaf = True
+
+    def __init__(self, machine):
+        Resource.__init__(self)
+        self.machine = machine
+
+
+    def render(self, request):
+        path = request.postpath
+        method = request.method
+        if len(path) == 2 and path[0] and path[1]:
+            silo_key, key = path
+            if method == 'GET' or method == 'HEAD':
+                d = dataGet(self.machine, request, silo_key, key)
+            elif method == 'PUT':
+                d = dataPut(self.machine, request, silo_key, key)
+            elif method == 'POST' and key == ':batch':
+                d = dataBatch(self.machine, silo_key, request.content.read())
+                d.addCallback(self._json, request)
+            elif key == ':batch':
+                return self._notAllowed(request, 'GET, HEAD, PUT, POST')
+            else:
+                return self._notAllowed(request, 'GET, HEAD, PUT')
+        elif len(path) == 1 and path[0]:
+            if method != 'POST':
+                return self._notAllowed(request, 'POST')
+            d = self.machine.data_createToken(path[0],
+                request.args.get('value', [''])[0])
+        else:
+            self._finish(None, request, 404)
+            return NOT_DONE_YET
+        d.addCallbacks(self._finish, self._failed, (request,), None,
+            (request,))
+        d.addErrback(log.err)
+        return NOT_DONE_YET
+
+
+    def _json(self, result, request):
+        request.setHeader('Content-Type', 'application/json')
+        return result
+
+
+    def _notAllowed(self, request, allowed):
+        request.setHeader('Allow', allowed)
+        self._finish(None, request, 405)
+        return NOT_DONE_YET
+
+
+    def _failed(self, err, request):
+        if err.check(TypeError, ValueError):
+            log.msg(err.value)
+            self._finish(None, request, 400)
+        elif err.check(NotFound, KeyError):
+            log.msg(err.value)
+            self._finish(None, request, 404)
+        elif err.check(VersionMismatch):
+            log.msg(err.value)
+            self._finish(None, request, 412)
+        elif err.check(NoAnswer):
+            self._finish('No answer to the question.', request, 504)
+        elif err.check(Overloaded):
+            self._finish(_overloaded(request, err.value), request, 503)
+        else:
+            if not err.check(CryptError):
+                log.err(err)
+            self._finish('Error, try again later.', request, 500)
+
+
+    def _finish(self, result, request, code=200):
+        """
+        Send a whole response with a C{Content-Length} (see L{sized}).
+        """
+        if request.channel is None:
+            # the client went away
+            if _isStream(result):
+                _closeStream(result)
+            return
+        if _isStream(result):
+            request.setResponseCode(code)
+            d = _sendStream(request, result)
+            request.notifyFinish().addErrback(lambda _: d.cancel())
+            d.addCallback(lambda _: request.finish())
+            d.addErrback(lambda err: err.trap(defer.CancelledError))
+            return
+        body = _utf8(result or '')
+        if request.code != 304:
+            request.setResponseCode(code)
+            request.setHeader('Content-Length', str(len(body)))
+        if body:
+            request.write(body)
+        request.finish()
@@ -0,0 +1,206 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Self-contained silo keys.
+
+Ordinary silo keys name a L{siloscript.storage.Silo} held in the memory of
+the process that started the run, so data requests have to go to that
+process.  A signed key instead carries the user, subkey and run id it was
+made for, an expiry time and an HMAC of all of those, so any process with
+the same secret can check it and serve the request.
+
+Closing a silo can't take back a key that's already been handed out, so
+L{siloscript.server.Machine.control_closeSilo} puts its run id on a
+revocation list that the processes share until the key would have expired
+anyway.
+"""
+
+from twisted.internet import reactor
+
+import hmac
+import json
+import base64
+import hashlib
+from uuid import uuid4
+
+from siloscript.error import NotFound
+
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _equal(a, b):
+    """
+    Compare two strings in a time that doesn't depend on where they
+    differ, so that a signature can't be found a byte at a time.  Like
+    C{hmac.compare_digest}, which isn't in Python 2.6 or 2.7 before 2.7.7.
+    """
+    a = _utf8(a)
+    b = _utf8(b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip('=')
+
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+
+class SiloKeys(object):
+    """
+    I make and check signed silo keys, which look like
+    C{SILO-<payload>.<signature>}.  The payload is the (unencrypted) user,
+    subkey, run id and expiry time, so don't use me if scripts mustn't
+    learn those.
+    """
+
+    prefix = 'SILO-'
+
+    def __init__(self, secret, ttl=86400, clock=reactor):
+        """
+        @param secret: The secret shared by all processes that make or
+            check keys.
+        @param ttl: Seconds a key is good for.  It should be longer than
+            any script runs.
+        """
+        self.secret = secret
+        self.ttl = ttl
+        self.clock = clock
+
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload,
+            hashlib.sha256).digest())
+
+
+    def isSigned(self, silo_key):
+        """
+        Return C{True} if C{silo_key} looks like one of mine (whether or not
+        it's valid).
+        """
+        return silo_key.startswith(self.prefix) and '.' in silo_key
+
+
+    def make(self, user, subkey):
+        """
+        Make a key for a new run.
+
+        @return: The key.
+        """
+        expires = int(self.clock.seconds() + self.ttl)
+        payload = _b64encode(json.dumps([user, subkey, uuid4().hex,
+            expires]))
+        return '%s%s.%s' % (self.prefix, payload, self._sign(payload))
+
+
+    def check(self, silo_key):
+        """
+        Check a key's signature and expiry.
+
+        @raise NotFound: If it's not a valid key or has expired.
+
+        @return: A tuple of user, subkey, run id and expiry time.
+        """
+        if not self.isSigned(silo_key):
+            raise NotFound(silo_key)
+        payload, signature = silo_key[len(self.prefix):].rsplit('.', 1)
+        if not _equal(self._sign(payload), signature):
+            raise NotFound(silo_key)
+        try:
+            user, subkey, run_id, expires = json.loads(_b64decode(payload))
+        except (TypeError, ValueError):
+            raise NotFound(silo_key)
+        if expires <= self.clock.seconds():
+            raise NotFound(silo_key)
+        return (_utf8(user), _utf8(subkey), str(run_id), expires)
+
+
+
+class MemoryRevocationList(object):
+    """
+    I remember revoked run ids in memory, for when one process makes and
+    serves all the keys.
+    """
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self._revoked = {}
+
+
+    def revoke(self, run_id, expires):
+        """
+        Revoke a run's key until it expires (after which it's no good
+        anyway).
+        """
+        now = self.clock.seconds()
+        for k, v in self._revoked.items():
+            if v <= now:
+                del self._revoked[k]
+        self._revoked[run_id] = expires
+
+
+    def isRevoked(self, run_id):
+        return run_id in self._revoked
+
+
+
+class SQLiteRevocationList(object):
+    """
+    I remember revoked run ids in an sqlite database, which processes on
+    the same machine can share.  Like L{siloscript.storage.SQLiteStore}, I
+    am synchronous.
+    """
+
+    def __init__(self, filename, clock=reactor):
+        """
+        @param filename: SQLite filename.  It can be the same as a
+            L{siloscript.storage.SQLiteStore}'s.
+        """
+        from pysqlite2 import dbapi2 as sqlite
+        self.conn = sqlite.connect(filename)
+        self.clock = clock
+
+
+    @classmethod
+    def create(cls, filename, clock=reactor):
+        inst = SQLiteRevocationList(filename, clock)
+        inst.conn.execute('''
+            CREATE TABLE IF NOT EXISTS silo_revoked (
+                run_id TEXT PRIMARY KEY,
+                expires INTEGER
+            );
+        ''')
+        inst.conn.commit()
+        return inst
+
+
+    def revoke(self, run_id, expires):
+        """
+        Revoke a run's key until it expires.  Revocations of keys that have
+        expired are forgotten.
+        """
+        self.conn.execute('DELETE FROM silo_revoked WHERE expires <= ?',
+            (self.clock.seconds(),))
+        self.conn.execute('''
+            INSERT OR REPLACE INTO silo_revoked (run_id, expires)
+            VALUES (?, ?)
+        ''', (run_id, expires))
+        self.conn.commit()
+
+
+    def isRevoked(self, run_id):
+        r = self.conn.execute('SELECT 1 FROM silo_revoked WHERE run_id=?',
+            (run_id,))
+        return r.fetchone() is not None
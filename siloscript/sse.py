@@ -0,0 +1,215 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+Server-sent events (the C{text/event-stream} format read by browsers'
+C{EventSource}), both sending and receiving.
+"""
+
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+import json
+
+
+
+def sseMsg(name, data, event_id=None):
+    """
+    Format one event.
+
+    @param data: Something JSON-able.
+    @param event_id: The event's id, which a client that reconnects sends
+        back as C{Last-Event-ID}.
+    """
+    if event_id is None:
+        return 'event: %s\ndata: %s\n\n' % (name, json.dumps(data))
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, name,
+        json.dumps(data))
+
+
+
+@implementer(IPushProducer)
+class EventStream(object):
+    """
+    I send events to a client over an HTTP response, a frame at a time:
+    events sent within C{frame_interval} seconds of each other are written
+    together.
+
+    I'm the response's producer, so when the client isn't reading fast
+    enough the transport pauses me.  What happens to events sent while I'm
+    paused depends on C{max_queued}:
+
+      - If it's C{None}, I drop them instead of letting them pile up in
+        memory, and once the client catches up I send it a C{dropped}
+        event saying how many it missed.
+
+      - Otherwise I hold up to C{max_queued} bytes of them until I'm
+        resumed.  If more than that are sent, the client is too slow: I
+        drop the connection (and set C{too_slow}) so that it can
+        reconnect and resume where it left off.
+
+    @ivar queued: Bytes of events I'm holding.
+    @ivar done: A L{Deferred} which fires when I'm L{close}d.  Return it
+        from a Klein handler.
+    """
+
+    too_slow = False
+
+    def __init__(self, request, frame_interval=0.05, heartbeat=None,
+            max_queued=None, clock=reactor):
+        """
+        @param heartbeat: If not C{None}, write a comment every this many
+            seconds so that proxies don't close idle connections.
+        """
+        self.request = request
+        self.frame_interval = frame_interval
+        self.heartbeat = heartbeat
+        self.max_queued = max_queued
+        self.clock = clock
+        self.paused = False
+        self.closed = False
+        self.dropped = 0
+        self.queued = 0
+        self.done = defer.Deferred()
+        self._frame = []
+        self._timer = None
+        self._beat = None
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.registerProducer(self, True)
+        # send the headers now, not with the first event
+        request.write('')
+        request.notifyFinish().addBoth(lambda _: self.stopProducing())
+        if heartbeat is not None:
+            self._beat = clock.callLater(heartbeat, self._heartbeat)
+
+
+    def send(self, name, data, event_id=None):
+        """
+        Send an event (in the next frame).
+        """
+        if self.closed:
+            return
+        if self.paused and self.max_queued is None:
+            self.dropped += 1
+            return
+        self._queue(sseMsg(name, data, event_id))
+
+
+    def _queue(self, msg):
+        self._frame.append(msg)
+        self.queued += len(msg)
+        if self.paused:
+            if self.queued > self.max_queued:
+                self._abort()
+        elif self._timer is None:
+            self._timer = self.clock.callLater(self.frame_interval,
+                self.flush)
+
+
+    def _heartbeat(self):
+        self._beat = self.clock.callLater(self.heartbeat, self._heartbeat)
+        if not (self.paused or self._frame):
+            self._queue(':\n\n')
+
+
+    def _abort(self):
+        self.too_slow = True
+        self.stopProducing()
+        transport = self.request.transport
+        getattr(transport, 'abortConnection', transport.loseConnection)()
+
+
+    def flush(self):
+        """
+        Write the events I'm holding now.
+        """
+        self._cancel('_timer')
+        if self._frame and not self.closed:
+            frame, self._frame = self._frame, []
+            self.queued = 0
+            self.request.write(''.join(frame))
+
+
+    def close(self):
+        """
+        Send what I'm holding and end the response.
+        """
+        if self.closed:
+            return
+        self.flush()
+        self.stopProducing()
+        self.request.unregisterProducer()
+        self.done.callback(None)
+
+
+    def _cancel(self, name):
+        call = getattr(self, name)
+        if call is not None:
+            if call.active():
+                call.cancel()
+            setattr(self, name, None)
+
+
+    def pauseProducing(self):
+        self.paused = True
+        self._cancel('_timer')
+        if self.max_queued is None:
+            self.dropped += len(self._frame)
+            self._frame = []
+            self.queued = 0
+
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.send('dropped', {'count': dropped})
+        elif self._frame:
+            self.flush()
+
+
+    def stopProducing(self):
+        self.closed = True
+        self._frame = []
+        self.queued = 0
+        self._cancel('_timer')
+        self._cancel('_beat')
+
+
+
+class EventReader(protocol.Protocol):
+    """
+    I parse an event stream (as the body of a response; see
+    C{IResponse.deliverBody}) and call C{receiver(name, data, event_id)}
+    with each event, the data decoded from JSON.
+
+    @ivar done: A L{Deferred} which fires when the stream ends.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.done = defer.Deferred()
+        self._buffer = ''
+        self._event = {}
+
+
+    def dataReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip('\r')
+            if not line:
+                if 'data' in self._event:
+                    self.receiver(self._event.get('event', 'message'),
+                        json.loads(self._event['data']),
+                        self._event.get('id'))
+                self._event = {}
+            elif not line.startswith(':') and ':' in line:
+                field, value = line.split(':', 1)
+                self._event[field] = value[1:] if value.startswith(' ') \
+                    else value
+
+
+    def connectionLost(self, reason):
+        self.done.callback(None)
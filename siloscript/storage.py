@@ -1,11 +1,80 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, protocol, reactor
+from twisted.internet.error import ProcessExitedAlready
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
 from twisted.python import log
+from zope.interface import implementer
+
+import os
+import json
+import re
+import errno
+import hashlib
+import tempfile
+from uuid import uuid4
+from StringIO import StringIO
 
 from siloscript.util import async
-from siloscript.error import CryptError
+from siloscript.metrics import Gauge, Counter, Histogram
+from siloscript.error import CryptError, VersionMismatch
+
+
+# Values bigger than this many bytes should be put with a store's
+# put_stream rather than put.  twisted.web spools request bodies bigger than
+# this to disk, too.
+STREAM_THRESHOLD = 100000
+
+# Bytes read at a time when copying a stream.
+CHUNK_SIZE = 65536
+
+
+
+def copyStream(src, dst):
+    """
+    Copy one file to another a chunk at a time.
+
+    @return: The number of bytes copied.
+    """
+    copied = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return copied
+        dst.write(chunk)
+        copied += len(chunk)
+
+
+
+def valueVersion(stored):
+    """
+    Compute the version of a value as it is stored (that is, encrypted if
+    the store is wrapped by L{gnupgWrapper}) so that it can be checked
+    without decrypting it.
+    """
+    if isinstance(stored, unicode):
+        stored = stored.encode('utf-8')
+    return hashlib.sha1(str(stored)).hexdigest()
+
+
+
+def checkVersion(stored, if_version):
+    """
+    Raise L{VersionMismatch} unless C{stored} (C{None} if there's no value)
+    is at C{if_version}.  An C{if_version} of C{'*'} matches any value.
+    """
+    if stored is None:
+        raise VersionMismatch('No value', if_version)
+    if if_version != '*' and valueVersion(stored) != if_version:
+        raise VersionMismatch('Value has changed', if_version)
+
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
 
 
 
@@ -22,13 +91,47 @@ class MemoryStore(object):
         return self._data[(user, silo, key)]
 
     @async
-    def put(self, user, silo, key, value):
+    def version(self, user, silo, key):
+        return valueVersion(self._data[(user, silo, key)])
+
+    @async
+    def put(self, user, silo, key, value, if_version=None):
+        if if_version is not None:
+            checkVersion(self._data.get((user, silo, key)), if_version)
         self._data[(user, silo, key)] = value
+        return valueVersion(value)
+
+    def get_stream(self, user, silo, key):
+        """
+        Get a value as a string or, if it is large, as an open file.  I
+        always give a string.
+        """
+        return self.get(user, silo, key)
+
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        """
+        Put a value read from a file.  I keep values in memory, so I read
+        it all.  Wrap me in a L{BlobStore} to keep large values on disk.
+        """
+        return self.put(user, silo, key, stream.read(), if_version=if_version)
 
     @async
     def delete(self, user, silo, key):
         self._data.pop((user, silo, key))
 
+    @async
+    def get_many(self, user, silo, keys):
+        result = {}
+        for key in keys:
+            if (user, silo, key) in self._data:
+                result[key] = self._data[(user, silo, key)]
+        return result
+
+    @async
+    def put_many(self, user, silo, items):
+        for key, value in items.items():
+            self._data[(user, silo, key)] = value
+
 
 
 class SQLiteStore(object):
@@ -69,16 +172,46 @@ class SQLiteStore(object):
 
 
     @async
-    def put(self, user, silo, key, value):
+    def put(self, user, silo, key, value, if_version=None):
+        if if_version is not None:
+            try:
+                current = self._get(user, silo, key)
+            except KeyError:
+                current = None
+            checkVersion(current, if_version)
         self.conn.execute('''
             INSERT OR REPLACE INTO silo_kv_data (user, silo, key, value)
             VALUES (?, ?, ?, ?)
         ''', (user, silo, key, value))
         self.conn.commit()
+        return valueVersion(value)
 
 
     @async
     def get(self, user, silo, key):
+        return self._get(user, silo, key)
+
+
+    @async
+    def version(self, user, silo, key):
+        return valueVersion(self._get(user, silo, key))
+
+
+    def get_stream(self, user, silo, key):
+        """
+        Get a value.  See L{MemoryStore.get_stream}.
+        """
+        return self.get(user, silo, key)
+
+
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        """
+        Put a value read from a file.  See L{MemoryStore.put_stream}.
+        """
+        return self.put(user, silo, key, stream.read(), if_version=if_version)
+
+
+    def _get(self, user, silo, key):
         r = self.conn.execute('''
             SELECT value FROM silo_kv_data
             WHERE
@@ -92,6 +225,34 @@ class SQLiteStore(object):
         return row[0]
 
 
+    @async
+    def put_many(self, user, silo, items):
+        self.conn.executemany('''
+            INSERT OR REPLACE INTO silo_kv_data (user, silo, key, value)
+            VALUES (?, ?, ?, ?)
+        ''', [(user, silo, k, v) for k, v in items.items()])
+        self.conn.commit()
+
+
+    @async
+    def get_many(self, user, silo, keys):
+        keys = list(keys)
+        result = {}
+        # stay well under SQLite's limit on the number of parameters
+        for i in xrange(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            r = self.conn.execute('''
+                SELECT key, value FROM silo_kv_data
+                WHERE
+                    user=?
+                    AND silo=?
+                    AND key IN (%s)
+            ''' % (','.join(['?'] * len(chunk)),), [user, silo] + chunk)
+            for key, value in r:
+                result[str(key)] = value
+        return result
+
+
     @async
     def delete(self, user, silo, key):
         r = self.conn.execute('''
@@ -107,6 +268,376 @@ class SQLiteStore(object):
 
 
 
+class BlobStore(object):
+    """
+    I wrap a key-value store, keeping values put with L{put_stream} in
+    files of their own in a directory and only the name of the file in the
+    wrapped store.  That keeps large values (downloaded statements, say)
+    out of memory and out of the database.  Values put with L{put} are
+    kept in the wrapped store as usual.
+
+    Wrap me in a L{gnupgWrapper}, rather than the other way around, so that
+    the files are encrypted.
+    """
+
+    # Values in the wrapped store starting with this name a file.
+    pointer_prefix = '\x01blob:'
+
+    def __init__(self, directory, store):
+        """
+        @param directory: The directory to keep files in.  It's made if it
+            doesn't exist.
+        @param store: A data store.
+        """
+        self.directory = directory
+        self._store = store
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def _blobName(self, stored):
+        """
+        Get the name of the file a value in the wrapped store points to, or
+        C{None} if the value is kept there.
+        """
+        if stored is None:
+            return None
+        stored = str(stored)
+        if stored.startswith(self.pointer_prefix):
+            return stored[len(self.pointer_prefix):]
+        return None
+
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def _write(self, stream):
+        """
+        Copy a file into a new file of my own.
+
+        @return: The new file's name.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                copyStream(stream, f)
+                f.flush()
+                os.fsync(f.fileno())
+            name = uuid4().hex
+            os.rename(tmp, self._path(name))
+        except:
+            os.remove(tmp)
+            raise
+        return name
+
+
+    def _read(self, name):
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+
+    def _remove(self, stored):
+        """
+        Remove the file a value in the wrapped store points to, if it does.
+        """
+        name = self._blobName(stored)
+        if name is None:
+            return
+        try:
+            os.remove(self._path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def _stored(self, user, silo, key):
+        """
+        Get a value from the wrapped store, or C{None} if there isn't one.
+        """
+        d = self._store.get(user, silo, key)
+        def missing(err):
+            err.trap(KeyError)
+            return None
+        return d.addErrback(missing)
+
+
+    @defer.inlineCallbacks
+    def _replace(self, user, silo, key, stored, if_version):
+        """
+        Put a value in the wrapped store and remove the file of the value
+        it replaces, if any.  If the put fails, remove C{stored}'s file
+        instead.
+        """
+        old = yield self._stored(user, silo, key)
+        try:
+            version = yield self._store.put(user, silo, key, stored,
+                if_version=if_version)
+        except:
+            self._remove(stored)
+            raise
+        self._remove(old)
+        defer.returnValue(version)
+
+
+    @defer.inlineCallbacks
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        """
+        Put a value read from a file, which is copied (in a thread) into a
+        file of my own.
+        """
+        name = yield threads.deferToThread(self._write, stream)
+        version = yield self._replace(user, silo, key,
+            self.pointer_prefix + name, if_version)
+        defer.returnValue(version)
+
+
+    @defer.inlineCallbacks
+    def get_stream(self, user, silo, key):
+        """
+        Get a value as a string or, if it was put with L{put_stream}, as an
+        open file.
+        """
+        stored = yield self._store.get(user, silo, key)
+        name = self._blobName(stored)
+        if name is None:
+            defer.returnValue(stored)
+        defer.returnValue(open(self._path(name), 'rb'))
+
+
+    def put(self, user, silo, key, value, if_version=None):
+        if self._blobName(value) is not None:
+            # Don't mistake it for a pointer later.
+            return self.put_stream(user, silo, key, StringIO(value),
+                if_version=if_version)
+        return self._replace(user, silo, key, value, if_version)
+
+
+    @defer.inlineCallbacks
+    def get(self, user, silo, key):
+        stored = yield self._store.get(user, silo, key)
+        name = self._blobName(stored)
+        if name is not None:
+            stored = yield threads.deferToThread(self._read, name)
+        defer.returnValue(stored)
+
+
+    def version(self, user, silo, key):
+        """
+        Get the version of a value.  For values in files, this is the
+        version of the file's name, which changes every time one is put.
+        """
+        return self._store.version(user, silo, key)
+
+
+    @defer.inlineCallbacks
+    def delete(self, user, silo, key):
+        old = yield self._stored(user, silo, key)
+        yield self._store.delete(user, silo, key)
+        self._remove(old)
+
+
+    @defer.inlineCallbacks
+    def put_many(self, user, silo, items):
+        items = dict(items)
+        for key, value in items.items():
+            if self._blobName(value) is not None:
+                name = yield threads.deferToThread(self._write,
+                    StringIO(value))
+                items[key] = self.pointer_prefix + name
+        old = yield self._store.get_many(user, silo, items.keys())
+        try:
+            yield self._store.put_many(user, silo, items)
+        except:
+            for stored in items.values():
+                self._remove(stored)
+            raise
+        for stored in old.values():
+            self._remove(stored)
+
+
+    @defer.inlineCallbacks
+    def get_many(self, user, silo, keys):
+        result = yield self._store.get_many(user, silo, keys)
+        for key, stored in result.items():
+            name = self._blobName(stored)
+            if name is not None:
+                result[key] = yield threads.deferToThread(self._read, name)
+        defer.returnValue(result)
+
+
+
+def _fileno(f):
+    """
+    @return: The file descriptor of an open file, or C{None} if C{f} isn't
+        one (a C{StringIO}, say).
+    """
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+
+def _gpgVersion(version):
+    """
+    @param version: A gpg version string, like C{'2.2.40'}.
+
+    @return: The major and minor version as a tuple of ints.
+    """
+    return tuple(int(x) for x in re.findall(r'\d+', version or '')[:2])
+
+
+
+class _GPGProcess(protocol.ProcessProtocol):
+    """
+    I'm gpg run by L{gnupgWrapper._spawn}.  I give it a passphrase, if
+    there is one, and anything it should read that isn't an open file, and
+    keep what it says on stderr for error messages.
+
+    @ivar ended: A L{Deferred} that fires with gpg's exit code when it's
+        done.
+    """
+
+    stdin = None
+
+    def __init__(self, passphrase=None):
+        self.passphrase = passphrase
+        self.stderr = []
+        self.ended = defer.Deferred()
+
+
+    def connectionMade(self):
+        if self.passphrase is not None:
+            self.transport.writeToChild(3, '%s\n' % (self.passphrase,))
+            self.transport.closeChildFD(3)
+        if self.stdin is not None:
+            self.transport.writeToChild(0, self.stdin)
+            self.stdin = None
+            self.transport.closeChildFD(0)
+
+
+    def childDataReceived(self, fd, data):
+        if fd == 2:
+            self.stderr.append(data)
+
+
+    def processEnded(self, reason):
+        self.ended.callback(reason.value.exitCode)
+
+
+
+@implementer(IBodyProducer)
+class DecryptingProducer(_GPGProcess):
+    """
+    I'm gpg decrypting a file, and produce the plaintext for a consumer as
+    gpg writes it, so that only a chunk of it is in memory at a time.  I'm
+    a push producer: while I'm paused I stop reading from gpg, which then
+    waits.  The plaintext's length isn't known until gpg is done.
+
+    @ivar ready: A L{Deferred} that fires with me once gpg has written some
+        plaintext or finished, or fails with L{CryptError} if it fails
+        before writing any.
+    """
+
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, passphrase=None):
+        _GPGProcess.__init__(self, passphrase)
+        self.ready = defer.Deferred()
+        self._consumer = None
+        self._buffered = []
+        self._done = None
+        self._error = None
+        self._ended = False
+        self._stopped = False
+
+
+    def childDataReceived(self, fd, data):
+        if fd != 1:
+            return _GPGProcess.childDataReceived(self, fd, data)
+        if self._stopped:
+            return
+        if self._consumer is not None:
+            self._consumer.write(data)
+            return
+        # hold gpg until there's somewhere to send what it's written
+        self._buffered.append(data)
+        self.transport.pauseProducing()
+        if not self.ready.called:
+            self.ready.callback(self)
+
+
+    def processEnded(self, reason):
+        _GPGProcess.processEnded(self, reason)
+        self._ended = True
+        code = reason.value.exitCode
+        if code != 0:
+            self._error = CryptError('Could not decrypt', code,
+                ''.join(self.stderr))
+        if not self.ready.called:
+            if self._error is not None:
+                self.ready.errback(self._error)
+                return
+            self.ready.callback(self)
+        self._finish()
+
+
+    def _finish(self):
+        if not self._ended or self._done is None or self._stopped:
+            return
+        if self._error is not None:
+            self._done.errback(self._error)
+        else:
+            self._done.callback(None)
+
+
+    def startProducing(self, consumer):
+        """
+        Start writing the plaintext to C{consumer}.
+
+        @return: A L{Deferred} that fires when it's all been written, or
+            fails with L{CryptError} if gpg fails partway.  It doesn't fire
+            if I'm stopped first.
+        """
+        self._consumer = consumer
+        self._done = defer.Deferred()
+        for data in self._buffered:
+            consumer.write(data)
+        self._buffered = []
+        if self._ended:
+            self._finish()
+        else:
+            self.transport.resumeProducing()
+        return self._done
+
+
+    def pauseProducing(self):
+        if not self._ended:
+            self.transport.pauseProducing()
+
+
+    def resumeProducing(self):
+        if not self._ended:
+            self.transport.resumeProducing()
+
+
+    def stopProducing(self):
+        """
+        Stop gpg, whether or not I've started.
+        """
+        self._stopped = True
+        self._buffered = []
+        if not self._ended:
+            try:
+                self.transport.signalProcess('KILL')
+            except ProcessExitedAlready:
+                pass
+            # read to the end, to notice it's gone
+            self.transport.resumeProducing()
+
+
+
 class gnupgWrapper(object):
     """
     I wrap a key-value store with encryption.
@@ -122,6 +653,19 @@ class gnupgWrapper(object):
         self._store = store
         self._passphrase = passphrase
         self._sem = defer.DeferredSemaphore(1)
+        self.gpg_seconds = Histogram('siloscript_gpg_seconds',
+            'Seconds taken to encrypt or decrypt a value with gpg,'
+            ' including waiting for a thread.', ['operation'])
+        self.metrics = [self.gpg_seconds]
+
+
+    def _inThread(self, operation, f, *args, **kwargs):
+        """
+        Run a gpg C{operation} (C{'encrypt'} or C{'decrypt'}) in a thread,
+        timing it.
+        """
+        return self.gpg_seconds.time((operation,), threads.deferToThread, f,
+            *args, **kwargs)
 
 
     def _getKey(self):
@@ -153,38 +697,315 @@ class gnupgWrapper(object):
 
 
     @defer.inlineCallbacks
-    def put(self, user, silo, key, value):
+    def put(self, user, silo, key, value, if_version=None):
         crypto_key = yield self._getKey()
-        cipher = yield threads.deferToThread(self._gpg.encrypt,
+        cipher = yield self._inThread('encrypt', self._gpg.encrypt,
             value, crypto_key['keyid'], passphrase=self._passphrase)
         if not cipher.ok:
             raise CryptError('Could not encrypt', cipher.status, cipher.stderr)
-        result = yield self._store.put(user, silo, key, str(cipher))
+        result = yield self._store.put(user, silo, key, str(cipher),
+            if_version=if_version)
         defer.returnValue(result)
 
 
+    def version(self, user, silo, key):
+        """
+        Get the version of a value without decrypting it.  The version is
+        that of the encrypted value, so putting the same value again changes
+        it.
+        """
+        return self._store.version(user, silo, key)
+
+
     @defer.inlineCallbacks
     def get(self, user, silo, key):
         cipher = yield self._store.get(user, silo, key)
+        plain = yield self._decrypt(cipher)
+        defer.returnValue(plain)
+
+
+    @defer.inlineCallbacks
+    def _decrypt(self, cipher):
         yield self._getKey()
-        plain = yield threads.deferToThread(self._gpg.decrypt, cipher,
+        plain = yield self._inThread('decrypt', self._gpg.decrypt, cipher,
             passphrase=self._passphrase)
         if not plain.ok:
             raise CryptError('Could not decrypt', plain.status, plain.stderr)
         defer.returnValue(str(plain))
 
 
+    @defer.inlineCallbacks
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        """
+        Encrypt a value read from a file into an anonymous temporary file,
+        and put that with the wrapped store's C{put_stream}.  gpg reads and
+        writes the files itself, so the value is never held in memory.
+        """
+        crypto_key = yield self._getKey()
+        f = tempfile.TemporaryFile()
+        try:
+            proto = _GPGProcess()
+            self._spawn(proto, ['--encrypt', '--always-trust',
+                '--recipient', crypto_key['keyid']], stream, f)
+            code = yield self.gpg_seconds.time(('encrypt',),
+                lambda: proto.ended)
+            if code != 0:
+                raise CryptError('Could not encrypt', code,
+                    ''.join(proto.stderr))
+            f.seek(0)
+            result = yield self._store.put_stream(user, silo, key, f,
+                if_version=if_version)
+        finally:
+            f.close()
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def get_stream(self, user, silo, key):
+        """
+        Get a value as a string or, if the wrapped store gives an open file,
+        as a L{DecryptingProducer} that streams the plaintext from gpg as
+        it's decrypted, so that it's never all in memory or on disk.
+        """
+        cipher = yield self._store.get_stream(user, silo, key)
+        if isinstance(cipher, basestring):
+            plain = yield self._decrypt(cipher)
+            defer.returnValue(plain)
+        try:
+            yield self._getKey()
+            producer = DecryptingProducer(self._passphrase)
+            self._spawn(producer, ['--decrypt'], cipher)
+        finally:
+            cipher.close()
+        self.gpg_seconds.time(('decrypt',), lambda: producer.ended)
+        yield producer.ready
+        defer.returnValue(producer)
+
+
+    def _spawn(self, proto, args, stdin, stdout=None):
+        """
+        Run gpg with C{args} and the same home directory as my python-gnupg
+        instance, reading the file C{stdin} and writing to the
+        file C{stdout} (or to C{proto}, if it's C{None}).  Open files are
+        handed to gpg as they are; any other file is read and written to
+        it.
+
+        @param proto: A L{_GPGProcess}.
+        """
+        gpg = self._gpg
+        command = [gpg.binary, '--no-options', '--no-tty', '--batch',
+            '--quiet', '--homedir', gpg.homedir]
+        fds = {1: 'r', 2: 'r'}
+        if proto.passphrase is not None:
+            command += ['--passphrase-fd', '3']
+            if _gpgVersion(gpg.binary_version) >= (2, 1):
+                # otherwise gpg asks the agent's pinentry instead
+                command += ['--pinentry-mode', 'loopback']
+            fds[3] = 'w'
+        command += args
+        fd = _fileno(stdin)
+        if fd is None:
+            proto.stdin = stdin.read()
+            fds[0] = 'w'
+        else:
+            # gpg starts reading where the file object would
+            os.lseek(fd, stdin.tell(), os.SEEK_SET)
+            fds[0] = fd
+        if stdout is not None:
+            fds[1] = stdout.fileno()
+        reactor.spawnProcess(proto, gpg.binary, command,
+            env={'LANGUAGE': 'en'}, childFDs=fds)
+
+
     def delete(self, user, silo, key):
         return self._store.delete(user, silo, key)
 
 
+    @defer.inlineCallbacks
+    def put_many(self, user, silo, items):
+        crypto_key = yield self._getKey()
+        keys = items.keys()
+        ciphers = yield defer.gatherResults([
+            self._inThread('encrypt', self._gpg.encrypt,
+                items[key], crypto_key['keyid'], passphrase=self._passphrase)
+            for key in keys])
+        for cipher in ciphers:
+            if not cipher.ok:
+                raise CryptError('Could not encrypt', cipher.status,
+                    cipher.stderr)
+        result = yield self._store.put_many(user, silo,
+            dict(zip(keys, [str(x) for x in ciphers])))
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def get_many(self, user, silo, keys):
+        ciphers = yield self._store.get_many(user, silo, keys)
+        if not ciphers:
+            defer.returnValue({})
+        yield self._getKey()
+        found = ciphers.keys()
+        plains = yield defer.gatherResults([
+            self._inThread('decrypt', self._gpg.decrypt, ciphers[key],
+                passphrase=self._passphrase)
+            for key in found])
+        for plain in plains:
+            if not plain.ok:
+                raise CryptError('Could not decrypt', plain.status,
+                    plain.stderr)
+        defer.returnValue(dict(zip(found, [str(x) for x in plains])))
+
+
+
+class TimedStore(object):
+    """
+    I wrap a key-value store and time its operations, labelled by
+    operation, in my C{seconds} histogram.  Wrap the store that keeps the
+    data (in front of any L{BlobStore}, behind the L{gnupgWrapper}) to see
+    how long the database and disk take apart from encryption.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self.seconds = Histogram('siloscript_store_seconds',
+            'Seconds taken by operations of the underlying store.',
+            ['operation'])
+        self.metrics = [self.seconds]
+
+
+    def get(self, user, silo, key):
+        return self.seconds.time(('get',), self._store.get, user, silo, key)
+
+
+    def version(self, user, silo, key):
+        return self.seconds.time(('version',), self._store.version, user,
+            silo, key)
+
+
+    def put(self, user, silo, key, value, if_version=None):
+        return self.seconds.time(('put',), self._store.put, user, silo, key,
+            value, if_version=if_version)
+
+
+    def get_stream(self, user, silo, key):
+        return self.seconds.time(('get_stream',), self._store.get_stream,
+            user, silo, key)
+
+
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        return self.seconds.time(('put_stream',), self._store.put_stream,
+            user, silo, key, stream, if_version=if_version)
+
+
+    def delete(self, user, silo, key):
+        return self.seconds.time(('delete',), self._store.delete, user,
+            silo, key)
+
+
+    def get_many(self, user, silo, keys):
+        return self.seconds.time(('get_many',), self._store.get_many, user,
+            silo, keys)
+
+
+    def put_many(self, user, silo, items):
+        return self.seconds.time(('put_many',), self._store.put_many, user,
+            silo, items)
+
+
+
+def storeMetrics(store):
+    """
+    Get the metrics (the C{metrics} lists) of a store and of the stores it
+    wraps.
+    """
+    metrics = []
+    while store is not None:
+        metrics.extend(getattr(store, 'metrics', []))
+        store = getattr(store, '_store', None)
+    return metrics
+
+
+
+class LimitedStore(object):
+    """
+    I wrap a key-value store so that a L{siloscript.admission.Limiter}
+    decides how many of its operations may be in progress at once.  When
+    the store (or the encryption in front of it) is saturated, operations
+    that would wait too long fail with L{siloscript.error.Overloaded}
+    instead of making everyone wait longer.
+
+    @ivar urgent: A store like me whose operations go ahead of mine and are
+        never turned away (see L{siloscript.admission.Limiter.runUrgent}).
+        L{Silo}s save what people answer with it, since an answer that was
+        turned away would be lost and the person asked again.
+    """
+
+    def __init__(self, store, limiter, urgent=False):
+        """
+        @param urgent: If C{True}, I'm the L{urgent} store of another.
+        """
+        self._store = store
+        self.limiter = limiter
+        if urgent:
+            self._run = limiter.runUrgent
+            self.urgent = self
+            return
+        self._run = limiter.run
+        self.urgent = LimitedStore(store, limiter, urgent=True)
+        self.metrics = [
+            Gauge('siloscript_store_in_flight',
+                'Store operations in progress.',
+                lambda: limiter.in_flight),
+            Gauge('siloscript_store_queued',
+                'Store operations waiting for their turn.',
+                lambda: len(limiter.queue) + len(limiter.urgent)),
+            Counter('siloscript_store_rejected_total',
+                'Store operations turned away because the store was busy.',
+                lambda: limiter.rejected),
+        ]
+
+
+    def get(self, user, silo, key):
+        return self._run(self._store.get, user, silo, key)
+
+
+    def version(self, user, silo, key):
+        return self._run(self._store.version, user, silo, key)
+
+
+    def put(self, user, silo, key, value, if_version=None):
+        return self._run(self._store.put, user, silo, key, value,
+            if_version=if_version)
+
+
+    def get_stream(self, user, silo, key):
+        return self._run(self._store.get_stream, user, silo, key)
+
+
+    def put_stream(self, user, silo, key, stream, if_version=None):
+        return self._run(self._store.put_stream, user, silo, key, stream,
+            if_version=if_version)
+
+
+    def delete(self, user, silo, key):
+        return self._run(self._store.delete, user, silo, key)
+
+
+    def get_many(self, user, silo, keys):
+        return self._run(self._store.get_many, user, silo, keys)
+
+
+    def put_many(self, user, silo, items):
+        return self._run(self._store.put_many, user, silo, items)
+
+
 
 class Silo(object):
     """
     I provide access to a restricted set of data in a key-value store.
     """
 
-    def __init__(self, store, user, silo, prompt_func=None):
+    def __init__(self, store, user, silo, prompt_func=None, asking=None):
         """
         @param store: A key-value store with get/put methods.
             See L{MemoryStore}
@@ -195,11 +1016,16 @@ class Silo(object):
             at least a C{'prompt'} key with a human-readable string to give
             a user.  It may also contain a C{'options'} key with a list of
             possible options.
+        @param asking: An optional dict shared by silos (of the same store)
+            so that while a question is waiting for an answer, L{get}s of
+            the same value with the same prompt by any of them wait for
+            that answer instead of asking again.
         """
         self.store = store
         self.user = user
         self.silo = silo
         self.prompt_func = prompt_func
+        self.asking = asking
 
 
     def get(self, key, prompt=None, save=True, options=None):
@@ -228,24 +1054,191 @@ class Silo(object):
         Prompt the user for the value and save it if desired.
         """
         err.trap(KeyError)
-        
+        if self.asking is None:
+            d = self._prompt(prompt, options)
+            if save:
+                d.addCallback(self._save, key)
+            return d
+
+        # Each asker gets a Deferred of its own, so that one giving up
+        # doesn't cancel the question for the rest.
+        waiter = defer.Deferred()
+        ask_key = (self.user, self.silo, key, prompt)
+        asked = self.asking.get(ask_key)
+        if asked is not None:
+            asked['save'] = asked['save'] or save
+            asked['waiting'].append(waiter)
+            return waiter
+
+        asked = self.asking[ask_key] = {'save': save, 'waiting': [waiter]}
+        def answered(value):
+            # saved once, if any of the askers wants it saved
+            if asked['save']:
+                return self._save(value, key)
+            return value
+        def done(result):
+            del self.asking[ask_key]
+            for waiter in asked['waiting']:
+                if not waiter.called:
+                    waiter.callback(result)
+        self._prompt(prompt, options).addCallback(answered).addBoth(done)
+        return waiter
+
+
+    def _prompt(self, prompt, options=None):
+        """
+        Ask a person for a value.
+        """
         question = {'prompt': prompt}
         if options:
             question['options'] = options
-        d = defer.maybeDeferred(self.prompt_func, question)
-        if save:
-            d.addCallback(self._save, key)
-        return d
+        return defer.maybeDeferred(self.prompt_func, question)
 
 
     def _save(self, value, key):
-        d = self.put(key, value)
+        d = self._answerStore().put(self.user, self.silo, key, value)
         d.addCallback(lambda _: value)
         return d
 
 
-    def put(self, key, value):
+    def _answerStore(self):
+        """
+        Get the store to save what a person answered in: the store's
+        C{urgent} one if it limits how many operations it runs (see
+        L{LimitedStore}), so that the answer isn't lost to a busy store.
+        """
+        return getattr(self.store, 'urgent', self.store)
+
+
+    def put(self, key, value, if_version=None):
         """
         Set a value within the silo.
+
+        @param if_version: If given, only set the value if its current
+            version is this (see L{version}) or, if C{'*'}, if it has one.
+
+        @raise VersionMismatch: If the value isn't at C{if_version}.
+
+        @return: A L{Deferred} new version of the value.
+        """
+        return self.store.put(self.user, self.silo, key, value,
+            if_version=if_version)
+
+
+    def put_stream(self, key, stream, if_version=None):
+        """
+        Set a value read from a file, without reading it all into memory if
+        the store can help it.  See L{put}.
+        """
+        return self.store.put_stream(self.user, self.silo, key, stream,
+            if_version=if_version)
+
+
+    def get_stream(self, key):
+        """
+        Get a stored value without asking anyone for it.
+
+        @return: A L{Deferred} string or, for large values the store keeps
+            in files, open file.  It fails with L{KeyError} if there's no
+            value.
+        """
+        return self.store.get_stream(self.user, self.silo, key)
+
+
+    def version(self, key):
+        """
+        Get an opaque version of a value, which changes when the value does.
+        Getting it doesn't involve decrypting the value.
+
+        @return: A L{Deferred} version string, or a L{KeyError} failure if
+            there's no value.
+        """
+        return self.store.version(self.user, self.silo, key)
+
+
+    @defer.inlineCallbacks
+    def get_many(self, requests):
+        """
+        Get several values from the silo at once.  Values in the store are
+        fetched together.  Missing values with a prompt are asked for (if
+        there's anyone to ask) in one question (see L{_askBundle}) and the
+        ones to be saved are saved together.
+
+        @param requests: A list of dicts each with a C{'key'} and optionally
+            C{'prompt'}, C{'save'} and C{'options'} as for L{get}.
+
+        @return: A L{Deferred} dict of key to value.  Values that aren't in
+            the store and weren't supplied by a person are left out.
+        """
+        for req in requests:
+            if not req.get('save', True) and not req.get('prompt'):
+                raise TypeError("You must prompt if you're not going to save"
+                    " for key: %r" % (req['key'],))
+
+        stored_keys = [x['key'] for x in requests if x.get('save', True)]
+        result = yield self.store.get_many(self.user, self.silo, stored_keys)
+
+        to_ask = [x for x in requests if x['key'] not in result
+            and x.get('prompt') and self.prompt_func]
+        if len(to_ask) == 1:
+            answer = yield self._prompt(to_ask[0]['prompt'],
+                to_ask[0].get('options'))
+            answers = {to_ask[0]['key']: answer}
+        elif to_ask:
+            answers = yield self._askBundle(to_ask)
+        else:
+            answers = {}
+
+        to_save = {}
+        for req in to_ask:
+            if req['key'] not in answers:
+                continue
+            answer = answers[req['key']]
+            result[req['key']] = answer
+            if req.get('save', True):
+                to_save[req['key']] = answer
+        if to_save:
+            yield self._answerStore().put_many(self.user, self.silo, to_save)
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def _askBundle(self, requests):
+        """
+        Ask a person for several values with one question, a bundle.  Its
+        C{'prompt'} is all the prompts (for receivers that don't know about
+        bundles) and its C{'fields'} are a C{'key'}, C{'prompt'} and maybe
+        C{'options'} for each value.  The answer is a JSON object (or a
+        dict) of key to value; keys left out of it weren't answered.
+
+        @return: A L{Deferred} dict of key to value.
+        """
+        fields = []
+        for req in requests:
+            field = {'key': req['key'], 'prompt': req['prompt']}
+            if req.get('options'):
+                field['options'] = req['options']
+            fields.append(field)
+        question = {
+            'prompt': '\n'.join([x['prompt'] for x in fields]),
+            'fields': fields,
+        }
+        answer = yield defer.maybeDeferred(self.prompt_func, question)
+        if isinstance(answer, basestring):
+            answer = json.loads(answer)
+        if not (isinstance(answer, dict) and all([isinstance(x, basestring)
+                for x in answer.values()])):
+            raise ValueError('Not an answer to a bundle: %r' % (answer,))
+        keys = set([x['key'] for x in fields])
+        answers = dict([(_utf8(k), _utf8(v)) for k, v in answer.items()])
+        defer.returnValue(dict([(k, v) for k, v in answers.items()
+            if k in keys]))
+
+
+    def put_many(self, items):
+        """
+        Set several values within the silo at once.
+
+        @param items: A dict of key to value.
         """
-        return self.store.put(self.user, self.silo, key, value)
\ No newline at end of file
+        return self.store.put_many(self.user, self.silo, items)
@@ -0,0 +1,210 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+from siloscript.admission import Limiter
+from siloscript.storage import MemoryStore, LimitedStore, Silo
+from siloscript.error import Overloaded
+
+
+
+class LimiterTest(TestCase):
+
+
+    def test_inFlight(self):
+        """
+        Calls up to C{max_in_flight} run straight away; later ones wait
+        for a running one to finish, first come first served.
+        """
+        limiter = Limiter('test', 2, clock=task.Clock())
+        running = [defer.Deferred() for i in range(2)]
+        results = [limiter.run(lambda d: d, d) for d in running]
+        called = []
+        waiting = limiter.run(lambda: called.append('a') or 'a')
+        limiter.run(lambda: called.append('b'))
+        self.assertEqual(limiter.in_flight, 2)
+        self.assertEqual(len(limiter.queue), 2)
+        self.assertEqual(called, [])
+
+        running[1].callback('done')
+        self.assertEqual(self.successResultOf(results[1]), 'done')
+        self.assertEqual(self.successResultOf(waiting), 'a')
+        self.assertEqual(called, ['a', 'b'])
+        self.assertEqual(limiter.in_flight, 1)
+
+
+    def test_failure(self):
+        """
+        A call that fails frees its place too.
+        """
+        limiter = Limiter('test', 1, clock=task.Clock())
+        failed = limiter.run(lambda: 1 / 0)
+        self.failureResultOf(failed, ZeroDivisionError)
+        self.assertEqual(self.successResultOf(limiter.run(lambda: 'ok')),
+            'ok')
+        self.assertEqual(limiter.in_flight, 0)
+
+
+    def test_queueTimeout(self):
+        """
+        Calls that wait longer than C{queue_timeout} fail with
+        L{Overloaded} saying when to try again, and are never made.
+        """
+        clock = task.Clock()
+        limiter = Limiter('test', 1, queue_timeout=5, retry_after=3,
+            clock=clock)
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        called = []
+        d = limiter.run(called.append, 'x')
+        clock.advance(5)
+        err = self.failureResultOf(d, Overloaded)
+        self.assertEqual(err.value.args, ('test', 3))
+        running.callback(None)
+        self.assertEqual(called, [])
+        self.assertEqual(limiter.rejected, 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_queueFull(self):
+        """
+        Calls beyond C{max_queued} fail straight away.
+        """
+        limiter = Limiter('test', 1, max_queued=1, clock=task.Clock())
+        limiter.run(defer.Deferred)
+        limiter.run(defer.Deferred)
+        self.failureResultOf(limiter.run(defer.Deferred), Overloaded)
+        self.assertEqual(limiter.rejected, 1)
+
+
+    def test_cancel(self):
+        """
+        A waiting call can be cancelled, as when its client goes away,
+        and isn't made.
+        """
+        clock = task.Clock()
+        limiter = Limiter('test', 1, clock=clock)
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        called = []
+        d = limiter.run(called.append, 'x')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(limiter.queue), 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        running.callback(None)
+        self.assertEqual(called, [])
+        self.assertEqual(limiter.in_flight, 0)
+
+
+    def test_urgent(self):
+        """
+        Urgent calls go ahead of waiting ones, and are never turned away
+        or timed out.
+        """
+        clock = task.Clock()
+        limiter = Limiter('test', 1, max_queued=1, queue_timeout=5,
+            clock=clock)
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        called = []
+        waiting = limiter.run(called.append, 'waiting')
+        urgent = limiter.runUrgent(called.append, 'urgent')
+        urgent2 = limiter.runUrgent(called.append, 'urgent2')
+
+        clock.advance(5)
+        self.failureResultOf(waiting, Overloaded)
+        self.assertNoResult(urgent)
+        self.assertEqual(limiter.rejected, 1)
+
+        running.callback(None)
+        self.successResultOf(urgent)
+        self.successResultOf(urgent2)
+        self.assertEqual(called, ['urgent', 'urgent2'])
+        self.assertEqual(limiter.in_flight, 0)
+
+
+    def test_urgentFirst(self):
+        """
+        Urgent calls are made before ones that were waiting longer.
+        """
+        limiter = Limiter('test', 1, clock=task.Clock())
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        called = []
+        limiter.run(called.append, 'waiting')
+        limiter.runUrgent(called.append, 'urgent')
+        running.callback(None)
+        self.assertEqual(called, ['urgent', 'waiting'])
+
+
+    def test_urgentCancel(self):
+        """
+        A waiting urgent call can be cancelled, and isn't made.
+        """
+        limiter = Limiter('test', 1, clock=task.Clock())
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        called = []
+        d = limiter.runUrgent(called.append, 'x')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(limiter.urgent), 0)
+        running.callback(None)
+        self.assertEqual(called, [])
+        self.assertEqual(limiter.in_flight, 0)
+
+
+
+class LimitedStoreTest(TestCase):
+
+
+    def test_limited(self):
+        """
+        Store operations go through the limiter.
+        """
+        limiter = Limiter('store', 1, max_queued=0, clock=task.Clock())
+        store = LimitedStore(MemoryStore(), limiter)
+        self.successResultOf(store.put('jim', 'silo', 'foo', 'bar'))
+        self.assertEqual(self.successResultOf(
+            store.get('jim', 'silo', 'foo')), 'bar')
+
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        self.failureResultOf(store.get('jim', 'silo', 'foo'), Overloaded)
+        self.failureResultOf(store.put_many('jim', 'silo', {'a': 'b'}),
+            Overloaded)
+
+
+    def test_answersSaved(self):
+        """
+        What a person answers is saved even when the store is too busy
+        for other operations, so they aren't asked again.
+        """
+        limiter = Limiter('store', 1, max_queued=0, clock=task.Clock())
+        store = LimitedStore(MemoryStore(), limiter)
+        answers = {}
+        def prompt(question):
+            answers[question['prompt']] = defer.Deferred()
+            return answers[question['prompt']]
+        silo = Silo(store, 'jim', 'silo', prompt)
+
+        one = silo.get('foo', prompt='Foo?')
+        many = silo.get_many([{'key': 'bar', 'prompt': 'Bar?'}])
+        running = defer.Deferred()
+        limiter.run(lambda: running)
+        answers['Foo?'].callback('foo answer')
+        answers['Bar?'].callback('bar answer')
+        self.assertNoResult(one)
+        self.assertNoResult(many)
+
+        running.callback(None)
+        self.assertEqual(self.successResultOf(one), 'foo answer')
+        self.assertEqual(self.successResultOf(many), {'bar': 'bar answer'})
+        self.assertEqual(self.successResultOf(
+            store.get('jim', 'silo', 'foo')), 'foo answer')
+        self.assertEqual(self.successResultOf(
+            store.get('jim', 'silo', 'bar')), 'bar answer')
+        self.assertEqual(limiter.rejected, 0)
@@ -0,0 +1,88 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+
+try:
+    import asyncio
+    from siloscript.aioclient import Client
+except ImportError:
+    asyncio = None
+
+from siloscript.error import NotFound
+
+
+
+class Functional_AsyncioClientTest(TestCase):
+
+    if asyncio is None:
+        skip = 'asyncio is not available'
+
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.requests = []
+        self.store = {}
+
+
+    def serve(self, reader, writer):
+        """
+        A tiny pipelining GET/PUT server.
+        """
+        def gotHead(future):
+            if future.exception() is not None:
+                writer.close()
+                return
+            head = future.result().decode('latin-1').split('\r\n')
+            method, path = head[0].split(' ')[:2]
+            self.requests.append((method, path))
+            length = 0
+            for line in head[1:]:
+                if line.lower().startswith('content-length:'):
+                    length = int(line.split(':')[1])
+            body = asyncio.ensure_future(reader.readexactly(length),
+                loop=self.loop)
+            body.add_done_callback(lambda f: gotBody(method, path,
+                f.result()))
+        def gotBody(method, path, body):
+            key = path.split('/')[-1]
+            status, data = '200 OK', b''
+            if method == 'PUT':
+                self.store[key] = body
+            elif key in self.store:
+                data = self.store[key]
+            else:
+                status = '404 Not Found'
+            writer.write(('HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n' % (
+                status, len(data))).encode('latin-1') + data)
+            readHead()
+        def readHead():
+            head = asyncio.ensure_future(reader.readuntil(b'\r\n\r\n'),
+                loop=self.loop)
+            head.add_done_callback(gotHead)
+        readHead()
+
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+
+    def test_values(self):
+        """
+        Values can be put and gotten, with many requests outstanding.
+        """
+        server = self.wait(asyncio.start_server(self.serve, '127.0.0.1', 0))
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+
+        client = Client('http://127.0.0.1:%d/SILO' % (port,), pool_size=1,
+            cache=False, loop=self.loop)
+        self.wait(client.putValue('foo', 'bar'))
+        results = self.wait(asyncio.gather(
+            *[client.getValue('foo') for i in range(5)]))
+        self.assertEqual(results, ['bar'] * 5)
+        self.assertRaises(NotFound, self.wait, client.getValue('missing'))
+        self.assertEqual(self.requests[0], ('PUT', '/SILO/foo'))
+        client.close()
+        # let the server notice
+        self.wait(asyncio.sleep(0.01))
@@ -0,0 +1,134 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+
+from siloscript.cache import ResultCache
+
+
+
+class ResultCacheTest(TestCase):
+
+
+    def test_basic(self):
+        """
+        Successful results can be remembered and retrieved by key.
+        """
+        cache = ResultCache(ttl=10, clock=task.Clock())
+        key = cache.key('jim', 'foo.sh', ['a'], {})
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, ('out', 'err', 0))
+        self.assertEqual(cache.get(key), ('out', 'err', 0))
+
+
+    def test_key(self):
+        """
+        The key includes the user, executable, args and only the selected
+        environment variables.
+        """
+        cache = ResultCache(env_keys=['ACCOUNT'])
+        k1 = cache.key('jim', 'foo.sh', ['a'], {'ACCOUNT': '1', 'X': 'y'})
+        self.assertEqual(k1, cache.key('jim', 'foo.sh', ['a'],
+            {'ACCOUNT': '1', 'X': 'z'}))
+        self.assertNotEqual(k1, cache.key('jim', 'foo.sh', ['a'],
+            {'ACCOUNT': '2'}))
+        self.assertNotEqual(k1, cache.key('bob', 'foo.sh', ['a'],
+            {'ACCOUNT': '1'}))
+        self.assertNotEqual(k1, cache.key('jim', 'foo.sh', ['b'],
+            {'ACCOUNT': '1'}))
+
+
+    def test_key_structuredArgs(self):
+        """
+        Args containing lists and dicts (as JSON args for C{/run} may) can
+        be keyed, and equal args give equal keys.
+        """
+        cache = ResultCache(ttl=10, clock=task.Clock())
+        k1 = cache.key('jim', 'foo.sh', ['a', [1, 2], {'x': 1, 'y': 2}], {})
+        self.assertEqual(hash(k1), hash(cache.key('jim', 'foo.sh',
+            ['a', [1, 2], {'y': 2, 'x': 1}], {})))
+        self.assertNotEqual(k1, cache.key('jim', 'foo.sh',
+            ['a', [2, 1], {'x': 1, 'y': 2}], {}))
+        cache.put(k1, ('out', '', 0))
+        self.assertEqual(cache.get(k1), ('out', '', 0))
+
+
+    def test_onlySuccess(self):
+        """
+        Only results with an exit code of 0 are cached.
+        """
+        cache = ResultCache()
+        key = cache.key('jim', 'foo.sh', [], {})
+        cache.put(key, ('out', 'err', 1))
+        self.assertEqual(cache.get(key), None)
+
+
+    def test_ttl(self):
+        """
+        Results are forgotten after the TTL, which can be set per executable.
+        """
+        clock = task.Clock()
+        cache = ResultCache(ttl=10, ttls={'fast.sh': 2, 'never.sh': 0},
+            clock=clock)
+        slow = cache.key('jim', 'slow.sh', [], {})
+        fast = cache.key('jim', 'fast.sh', [], {})
+        never = cache.key('jim', 'never.sh', [], {})
+        cache.put(slow, ('a', '', 0))
+        cache.put(fast, ('b', '', 0))
+        cache.put(never, ('c', '', 0))
+        self.assertEqual(cache.get(never), None)
+
+        clock.advance(3)
+        self.assertEqual(cache.get(fast), None)
+        self.assertEqual(cache.get(slow), ('a', '', 0))
+
+        clock.advance(8)
+        self.assertEqual(cache.get(slow), None)
+        self.assertEqual(len(cache), 0)
+
+
+    def test_maxEntries(self):
+        """
+        The oldest results are forgotten when there are too many.
+        """
+        cache = ResultCache(max_entries=2, clock=task.Clock())
+        keys = [cache.key('jim', 'foo.sh', [str(i)], {}) for i in range(3)]
+        for key in keys:
+            cache.put(key, ('out', '', 0))
+        self.assertEqual(cache.get(keys[0]), None)
+        self.assertEqual(cache.get(keys[1]), ('out', '', 0))
+        self.assertEqual(cache.get(keys[2]), ('out', '', 0))
+
+
+    def test_maxBytes(self):
+        """
+        The oldest results are forgotten when they take too much space.
+        """
+        cache = ResultCache(max_bytes=10, clock=task.Clock())
+        k1 = cache.key('jim', 'foo.sh', ['1'], {})
+        k2 = cache.key('jim', 'foo.sh', ['2'], {})
+        k3 = cache.key('jim', 'foo.sh', ['3'], {})
+        cache.put(k1, ('12345', '', 0))
+        cache.put(k2, ('12345', '', 0))
+        cache.put(k3, ('123', '', 0))
+        self.assertEqual(cache.get(k1), None)
+        self.assertEqual(cache.get(k2), ('12345', '', 0))
+        cache.put(k1, ('x' * 11, '', 0))
+        self.assertEqual(cache.get(k1), None, "Too big to cache at all")
+
+
+    def test_replace(self):
+        """
+        Putting a result for a key that's already cached replaces it.
+        """
+        cache = ResultCache(max_entries=2, clock=task.Clock())
+        k1 = cache.key('jim', 'foo.sh', ['1'], {})
+        k2 = cache.key('jim', 'foo.sh', ['2'], {})
+        for i in range(10):
+            cache.put(k1, (str(i), '', 0))
+        cache.put(k2, ('b', '', 0))
+        self.assertEqual(cache.get(k1), ('9', '', 0))
+        self.assertEqual(cache.get(k2), ('b', '', 0))
+        cache.invalidate(k1)
+        self.assertEqual(cache.get(k1), None)
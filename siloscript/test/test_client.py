@@ -1,41 +1,202 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
 from twisted.internet import reactor, endpoints, defer, threads
-from twisted.web.server import Site
 from twisted.python import log
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from zope.interface import implementer
 
-from siloscript.storage import MemoryStore
-from siloscript.server import Machine, DataWebApp
+from siloscript.storage import MemoryStore, BlobStore
+from siloscript.server import Machine, DataWebApp, DataResource, KleinSite
 from siloscript.client import Client
-from siloscript.error import NotFound
+from siloscript.process import unixSocketURL
 
+import os
+import tempfile
+from functools import partial
+import httplib
+import urlparse
+from StringIO import StringIO
+from siloscript.error import NotFound, VersionMismatch, NoAnswer
+from siloscript.error import Overloaded
 
 
-class Functional_ClientTest(TestCase):
 
-    timeout = 5
+class CountingSite(KleinSite):
+    """
+    I count connections and can close the ones clients keep alive.
+    """
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        proto = KleinSite.buildProtocol(self, addr)
+        if not hasattr(self, 'open'):
+            self.open = {}
+        lost = self.open[proto] = defer.Deferred()
+        original = proto.connectionLost
+        def connectionLost(reason):
+            original(reason)
+            self.open.pop(proto)
+            lost.callback(None)
+        proto.connectionLost = connectionLost
+        return proto
+
+
+    def closeAll(self):
+        dl = []
+        for proto, lost in getattr(self, 'open', {}).items():
+            proto.transport.loseConnection()
+            dl.append(lost)
+        return defer.DeferredList(dl)
+
+
+
+class BusyStore(MemoryStore):
+    """
+    I turn away the first C{busy} puts as if I were overloaded.
+    """
+
+    busy = 0
+
+    def put(self, *args, **kwargs):
+        if self.busy:
+            self.busy -= 1
+            return defer.fail(Overloaded('store', 0))
+        return MemoryStore.put(self, *args, **kwargs)
+
+
+
+@implementer(IBodyProducer)
+class PieceProducer(object):
+    """
+    I produce a value a piece at a time, like
+    L{siloscript.storage.DecryptingProducer}, and then maybe fail.
+    """
+
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, pieces, error=None):
+        self.pieces = list(pieces)
+        self.error = error
+        self.stopped = False
+
+
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        self.done = defer.Deferred()
+        reactor.callLater(0, self._produce)
+        return self.done
+
+
+    def _produce(self):
+        if self.stopped:
+            return
+        if self.pieces:
+            self.consumer.write(self.pieces.pop(0))
+            reactor.callLater(0, self._produce)
+        elif self.error is not None:
+            self.done.errback(self.error)
+        else:
+            self.done.callback(None)
+
+
+    def pauseProducing(self):
+        pass
+
+
+    def resumeProducing(self):
+        pass
+
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+
+class ProducingStore(MemoryStore):
+    """
+    I give values as L{PieceProducer}s from C{get_stream}, failing partway
+    through values that start with C{'bad'}.
+    """
+
+    def get_stream(self, user, silo, key):
+        d = self.get(user, silo, key)
+        def produce(value):
+            pieces = [value[i:i + 1000] for i in range(0, len(value), 1000)]
+            error = None
+            if value.startswith('bad'):
+                pieces = pieces[:len(pieces) // 2]
+                error = Exception('gpg failed')
+            return PieceProducer(pieces, error)
+        return d.addCallback(produce)
+
+
+
+class DataServerMixin(object):
+    """
+    I start data servers for client tests.
+    """
+
+    def dataResource(self, machine):
+        """
+        Make the resource that serves the data API.
+        """
+        return DataWebApp(machine).app.resource()
+
+
+    def dataStore(self):
+        """
+        Make the store the data server uses.
+        """
+        return MemoryStore()
+
 
     @defer.inlineCallbacks
-    def startServer(self, answers=None):
+    def startServer(self, answers=None, unix=False, question_timeout=None,
+            answer_delay=None):
         """
         Start a server.
+
+        @param answers: A dict of prompt to answer.  Other questions are
+            left unanswered.
+        @param unix: If C{True}, listen on a Unix socket instead of TCP.
+        @param answer_delay: If given, seconds to wait before answering.
         """
         answers = answers or {}
 
         # start a server
-        self.store = MemoryStore()
-        machine = Machine(self.store, None)
-        data_app = DataWebApp(machine)
-        ep = endpoints.serverFromString(reactor, 'tcp:0:interface=127.0.0.1')
-        p = yield ep.listen(Site(data_app.app.resource()))
+        self.store = self.dataStore()
+        machine = Machine(self.store, None, question_timeout=question_timeout)
+        if unix:
+            # trial's temp paths can be too long for a socket
+            tmpdir = FilePath(tempfile.mkdtemp())
+            self.addCleanup(tmpdir.remove)
+            socket_path = tmpdir.child('data.sock').path
+            ep = endpoints.UNIXServerEndpoint(reactor, socket_path)
+        else:
+            ep = endpoints.serverFromString(reactor,
+                'tcp:0:interface=127.0.0.1')
+        self.site = CountingSite(self.dataResource(machine))
+        p = yield ep.listen(self.site)
+        self.addCleanup(self.site.closeAll)
         self.addCleanup(p.stopListening)
-        host = p.getHost()
-        url = 'http://%s:%s' % (host.host, host.port)
+        if unix:
+            url = unixSocketURL(socket_path)
+        else:
+            host = p.getHost()
+            url = 'http://%s:%s' % (host.host, host.port)
 
         def receiver(question):
-            answer = answers.get(question['prompt'])
-            machine.answer_question(question['id'], answer)
+            if question['prompt'] in answers:
+                answer = partial(machine.answer_question, question['id'],
+                    answers[question['prompt']])
+                if answer_delay is None:
+                    answer()
+                else:
+                    reactor.callLater(answer_delay, answer)
 
         receiver_func = None
         if answers:
@@ -48,6 +209,12 @@ class Functional_ClientTest(TestCase):
         defer.returnValue(url)
 
 
+
+class Functional_ClientTest(DataServerMixin, TestCase):
+
+    timeout = 5
+
+
     @defer.inlineCallbacks
     def test_getValue_prompt_withUserInteraction(self):
         """
@@ -65,6 +232,25 @@ class Functional_ClientTest(TestCase):
         self.assertEqual(result, '12345')
 
 
+    @defer.inlineCallbacks
+    def test_getValue_prompt_slowAnswer(self):
+        """
+        Requests that prompt wait for the answer however long it takes,
+        even longer than the client's C{timeout}.
+        """
+        url = yield self.startServer(answers={
+            'Name?': 'joe',
+        }, answer_delay=0.5)
+        client = Client(url, timeout=0.1)
+        self.addCleanup(client.close)
+        result = yield threads.deferToThread(client.getValue, 'name',
+            prompt='Name?')
+        self.assertEqual(result, 'joe')
+        result = yield threads.deferToThread(client.getValues, [
+            {'key': 'other', 'prompt': 'Name?'}])
+        self.assertEqual(result, {'other': 'joe'})
+
+
     @defer.inlineCallbacks
     def test_getValue_prompt_noSave(self):
         """
@@ -86,6 +272,19 @@ class Functional_ClientTest(TestCase):
             'account_id'), NotFound)
 
 
+    @defer.inlineCallbacks
+    def test_getValue_prompt_noAnswer(self):
+        """
+        If the user doesn't answer in time, getting the value fails with
+        NoAnswer.
+        """
+        url = yield self.startServer(answers={'Other?': 'x'},
+            question_timeout=0.1)
+        client = Client(url)
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'account_id', prompt='Account ID?'), NoAnswer)
+
+
     @defer.inlineCallbacks
     def test_getValue_prompt_noUserInteraction(self):
         """
@@ -163,6 +362,24 @@ class Functional_ClientTest(TestCase):
         self.assertEqual(result, 'bar')
 
 
+    @defer.inlineCallbacks
+    def test_putValue_overloaded(self):
+        """
+        Requests the server is too busy for are tried again a few times,
+        then fail with L{Overloaded}.
+        """
+        self.dataStore = BusyStore
+        url = yield self.startServer()
+        self.store.busy = 2
+        yield threads.deferToThread(Client(url).putValue, 'foo', 'bar')
+        self.assertEqual(self.store.busy, 0)
+
+        self.store.busy = 1
+        yield self.assertFailure(threads.deferToThread(
+            Client(url, retries=0).putValue, 'foo', 'baz'), Overloaded)
+        yield self.site.closeAll()
+
+
     @defer.inlineCallbacks
     def test_putValue_badURL(self):
         """
@@ -205,11 +422,395 @@ class Functional_ClientTest(TestCase):
             client.getToken, 'foo'), NotFound)
 
 
+    @defer.inlineCallbacks
+    def test_keepAlive(self):
+        """
+        Connections are reused between requests.
+        """
+        url = yield self.startServer()
+
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        yield threads.deferToThread(client.getValue, 'foo')
+        yield threads.deferToThread(client.getToken, 'foo')
+        self.assertEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def test_keepAlive_emptyValue(self):
+        """
+        Empty values don't break kept-alive connections.
+        """
+        url = yield self.startServer()
+
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', '')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, '')
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        """
+        Clients can be used as context managers which close their
+        connections.
+        """
+        url = yield self.startServer()
+
+        def use():
+            with Client(url) as client:
+                client.putValue('foo', 'bar')
+                return client
+        client = yield threads.deferToThread(use)
+        self.assertEqual(client._session, None)
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar', "Can still be used after closing")
+        client.close()
+
+
+    @defer.inlineCallbacks
+    def test_getValues_putValues(self):
+        """
+        You can put and get several values in one request.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        })
+
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValues, {
+            'a': 'A',
+            'b': u'\u00e9'.encode('utf-8'),
+        })
+        result = yield threads.deferToThread(client.getValues, [
+            'a',
+            'b',
+            'missing',
+            {'key': 'color', 'prompt': 'Color?', 'options': ['blue', 'red']},
+        ])
+        self.assertEqual(result, {
+            'a': 'A',
+            'b': u'\u00e9'.encode('utf-8'),
+            'color': 'blue',
+        })
+        result = yield threads.deferToThread(client.getValue, 'color')
+        self.assertEqual(result, 'blue', "Should have saved the answer")
+
+
+    @defer.inlineCallbacks
+    def test_getValues_badURL(self):
+        """
+        It will fail if you try to getValues on a bad url.
+        """
+        url = yield self.startServer()
+
+        client = Client(url + 'fake')
+        self.addCleanup(client.close)
+        yield self.assertFailure(threads.deferToThread(
+            client.getValues, ['foo']), NotFound)
+        yield self.assertFailure(threads.deferToThread(
+            client.getValue, 'foo'), NotFound)
+        yield self.assertFailure(threads.deferToThread(
+            client.putValues, {'foo': 'bar'}), NotFound)
+
+
+    @defer.inlineCallbacks
+    def test_unixSocket(self):
+        """
+        Clients can talk to a data server over a Unix socket.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        }, unix=True)
+        self.assertTrue(url.startswith('http+unix://'))
 
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        result = yield threads.deferToThread(client.getValues, [
+            {'key': 'color', 'prompt': 'Color?'}])
+        self.assertEqual(result, {'color': 'blue'})
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'missing'), NotFound)
+        self.assertEqual(self.site.connections, 1)
 
 
+    @defer.inlineCallbacks
+    def test_cache(self):
+        """
+        Values gotten or put are remembered for the life of the client, so
+        getting them again doesn't make a request.
+        """
+        url = yield self.startServer()
 
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        yield self.store.put('foo', 'bar', 'foo', 'changed')
+        yield self.store.put('foo', 'bar', 'other', 'other value')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar', "Should remember put values")
+        result = yield threads.deferToThread(client.getValue, 'other')
+        self.assertEqual(result, 'other value')
+        yield self.store.put('foo', 'bar', 'other', 'changed')
+        result = yield threads.deferToThread(client.getValues, ['other'])
+        self.assertEqual(result, {'other': 'other value'},
+            "Should remember gotten values")
+
+        client.forget()
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'changed')
 
 
+    @defer.inlineCallbacks
+    def test_cache_noSave(self):
+        """
+        Values gotten with save=False are never remembered.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        })
+
+        client = Client(url)
+        self.addCleanup(client.close)
+        result = yield threads.deferToThread(client.getValue, 'color',
+            prompt='Color?', save=False)
+        self.assertEqual(result, 'blue')
+        result = yield threads.deferToThread(client.getValues, [
+            {'key': 'color2', 'prompt': 'Color?', 'save': False}])
+        self.assertEqual(result, {'color2': 'blue'})
+        self.assertEqual(client.cache, {})
+
+
+    @defer.inlineCallbacks
+    def test_cache_off(self):
+        """
+        The cache can be turned off.
+        """
+        url = yield self.startServer()
+
+        client = Client(url, cache=False)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        yield self.store.put('foo', 'bar', 'foo', 'changed')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'changed')
+
+
+    @defer.inlineCallbacks
+    def test_revalidate(self):
+        """
+        Remembered values can be revalidated, which doesn't read the value
+        again if it hasn't changed.
+        """
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+
+        reads = []
+        original = self.store.get
+        def get(*args):
+            reads.append(args)
+            return original(*args)
+        self.store.get = get
+        result = yield threads.deferToThread(client.getValue, 'foo',
+            revalidate=True)
+        self.assertEqual(result, 'bar')
+        self.assertEqual(reads, [], "Shouldn't have read the value")
+
+        yield self.store.put('foo', 'bar', 'foo', 'changed')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        result = yield threads.deferToThread(client.getValue, 'foo',
+            revalidate=True)
+        self.assertEqual(result, 'changed')
+        self.assertEqual(len(reads), 1)
 
 
+    @defer.inlineCallbacks
+    def test_putValue_ifVersion(self):
+        """
+        Values can be put only if they haven't changed since they were
+        gotten or put.
+        """
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        other = Client(url)
+        self.addCleanup(other.close)
+
+        v1 = yield threads.deferToThread(client.putValue, 'foo', 'a')
+        self.assertEqual(client.getVersion('foo'), v1)
+        yield threads.deferToThread(other.getValue, 'foo')
+        self.assertEqual(other.getVersion('foo'), v1)
+
+        v2 = yield threads.deferToThread(other.putValue, 'foo', 'b',
+            if_version=other.getVersion('foo'))
+        self.assertNotEqual(v1, v2)
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'foo', 'c', if_version=client.getVersion('foo')),
+            VersionMismatch)
+        self.assertEqual(client.getVersion('foo'), None)
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'b')
+        yield threads.deferToThread(client.putValue, 'foo', 'c',
+            if_version=client.getVersion('foo'))
+
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'new', 'x', if_version='*'), VersionMismatch)
+
+
+
+    @defer.inlineCallbacks
+    def test_files(self):
+        """
+        Large values can be put from and gotten into files, whether or not
+        their size is known.  The server streams them to and from disk.
+        """
+        directory = self.mktemp()
+        self.dataStore = lambda: BlobStore(directory, MemoryStore())
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        value = os.urandom(300000)
+
+        v1 = yield threads.deferToThread(client.putFile, 'foo',
+            StringIO(value))
+        self.assertEqual(client.getVersion('foo'), v1)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        f = StringIO()
+        version = yield threads.deferToThread(client.getFile, 'foo', f)
+        self.assertEqual(version, v1)
+        self.assertEqual(f.getvalue(), value)
+
+        yield threads.deferToThread(client.putFile, 'foo',
+            Pipe(value[::-1]), if_version=v1)
+        f = StringIO()
+        yield threads.deferToThread(client.getFile, 'foo', f)
+        self.assertEqual(f.getvalue(), value[::-1])
+
+        yield self.assertFailure(threads.deferToThread(client.getFile,
+            'missing', StringIO()), NotFound)
+
+
+
+    @defer.inlineCallbacks
+    def test_producedValue(self):
+        """
+        Values a store produces a piece at a time (as it decrypts them, say)
+        are sent chunked as they're produced.  If the store fails partway,
+        the connection is dropped rather than a short value sent.
+        """
+        self.dataStore = ProducingStore
+        url = yield self.startServer()
+        client = Client(url, cache=False)
+        self.addCleanup(client.close)
+        value = 'value' * 2000
+        yield threads.deferToThread(client.putValue, 'foo', value)
+        got = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(got, value)
+        f = StringIO()
+        yield threads.deferToThread(client.getFile, 'foo', f)
+        self.assertEqual(f.getvalue(), value)
+
+        yield threads.deferToThread(client.putValue, 'bar', 'bad' + value)
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'bar'), IOError)
+
+
+
+class Pipe(object):
+    """
+    I am a file that can't seek, so my size can't be known.
+    """
+
+    def __init__(self, data):
+        self._file = StringIO(data)
+
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+
+class Functional_ClientTest_DataResource(Functional_ClientTest):
+    """
+    The client works with L{DataResource} as it does with L{DataWebApp}.
+    """
+
+    def dataResource(self, machine):
+        return DataResource(machine)
+
+
+
+class Functional_DataResourceStatusTest(DataServerMixin, TestCase):
+
+    timeout = 5
+
+
+    def fetch(self, url, method, path, body=None):
+        """
+        Make a request and return its status code.
+        """
+        conn = httplib.HTTPConnection(urlparse.urlsplit(url).netloc)
+        try:
+            conn.request(method, path, body)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+
+    @defer.inlineCallbacks
+    def statuses(self, requests):
+        url = yield self.startServer()
+        silo_key = url.split('/')[-1]
+        yield threads.deferToThread(Client(url).putValue, 'foo', 'bar')
+        statuses = []
+        for method, path, body in requests:
+            status = yield threads.deferToThread(self.fetch, url, method,
+                path.replace('SILO', silo_key), body)
+            statuses.append(status)
+        yield self.site.closeAll()
+        defer.returnValue(statuses)
+
+
+    @defer.inlineCallbacks
+    def test_sameStatuses(self):
+        """
+        L{DataResource} responds with the same status codes as
+        L{DataWebApp}.
+        """
+        requests = [
+            ('GET', '/SILO/foo', None),
+            ('GET', '/SILO/missing', None),
+            ('GET', '/SILO/:tokens', None),
+            ('PUT', '/SILO/:tokens', 'x'),
+            ('GET', '/NOSILO/foo', None),
+            ('PUT', '/SILO/foo', 'baz'),
+            ('PUT', '/NOSILO/foo', 'baz'),
+            ('DELETE', '/SILO/foo', None),
+            ('POST', '/SILO/foo', ''),
+            ('POST', '/SILO/:batch', '{"get": ["foo", "missing"]}'),
+            ('POST', '/SILO/:batch', 'not json'),
+            ('POST', '/NOSILO/:batch', '{"get": ["foo"]}'),
+            ('POST', '/SILO?value=secret', ''),
+            ('POST', '/NOSILO?value=secret', ''),
+            ('GET', '/SILO', None),
+            ('GET', '/', None),
+            ('GET', '/SILO/foo/extra', None),
+        ]
+        expected = yield self.statuses(requests)
+        self.dataResource = DataResource
+        actual = yield self.statuses(requests)
+        self.assertEqual(zip(requests, actual), zip(requests, expected))
+        self.assertEqual(expected[:2], [200, 404])
+        self.flushLoggedErrors()
@@ -0,0 +1,216 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+
+from siloscript.clientcore import ResponseParser, ConnectionPool
+from siloscript.clientcore import PipelinedConnection, encodeRequest
+from siloscript.clientcore import splitURL
+from siloscript.error import Unavailable
+
+
+
+class ResponseParserTest(TestCase):
+
+
+    def test_contentLength(self):
+        """
+        Bodies can be sized by Content-Length, and several responses can
+        arrive at once.
+        """
+        parser = ResponseParser()
+        responses = parser.feed(
+            'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n'
+            'Content-Type: text/plain\r\n\r\nfoo'
+            'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+        self.assertEqual([(r.status, r.body) for r in responses],
+            [(200, 'foo'), (404, '')])
+        self.assertEqual(responses[0].header('Content-Type'), 'text/plain')
+
+
+    def test_pieces(self):
+        """
+        Responses can arrive a byte at a time.
+        """
+        data = ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            '3\r\nfoo\r\n4;ext=1\r\nbars\r\n0\r\nX-Trailer: 1\r\n\r\n'
+            'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nhi')
+        parser = ResponseParser()
+        responses = []
+        for c in data:
+            responses.extend(parser.feed(c))
+        self.assertEqual([r.body for r in responses], ['foobars', 'hi'])
+
+
+    def test_untilClose(self):
+        """
+        Without a length, the body runs until the connection closes.
+        """
+        parser = ResponseParser()
+        self.assertEqual(parser.feed('HTTP/1.0 200 OK\r\n\r\nsome'), [])
+        self.assertEqual(parser.feed(' data'), [])
+        response = parser.finish()
+        self.assertEqual(response.body, 'some data')
+        self.assertTrue(response.willClose)
+
+
+    def test_noBody(self):
+        """
+        204 responses and informational responses have no body.
+        """
+        parser = ResponseParser()
+        responses = parser.feed('HTTP/1.1 100 Continue\r\n\r\n'
+            'HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n')
+        self.assertEqual([(r.status, r.body) for r in responses],
+            [(204, '')])
+        self.assertTrue(responses[0].willClose)
+        self.assertEqual(parser.finish(), None)
+
+
+
+class FakeConnector(object):
+
+    def __init__(self):
+        self.attempts = 0
+        self.written = []
+        self.closed = []
+
+    def connect(self):
+        self.attempts += 1
+
+    def connection(self):
+        return PipelinedConnection(self.written.append,
+            lambda: self.closed.append(True))
+
+
+
+class ConnectionPoolTest(TestCase):
+
+
+    def request(self, pool, data, retry=False):
+        result = []
+        pool.request(data, result.append, result.append, retry)
+        return result
+
+
+    def test_pipeline(self):
+        """
+        Requests wait for the first connection and then are spread over
+        connections, favoring idle ones.
+        """
+        connector = FakeConnector()
+        pool = ConnectionPool(connector.connect, size=2)
+        r1 = self.request(pool, 'a')
+        r2 = self.request(pool, 'b')
+        self.assertEqual(connector.attempts, 2)
+        r3 = self.request(pool, 'c')
+        self.assertEqual(connector.attempts, 2)
+
+        c1 = connector.connection()
+        pool.added(c1)
+        self.assertEqual(connector.written, ['a', 'b', 'c'])
+        c1.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nA')
+        self.assertEqual(r1[0].body, 'A')
+
+        c2 = connector.connection()
+        pool.added(c2)
+        r4 = self.request(pool, 'd')
+        self.assertEqual(list(c2.pending)[0].data, 'd')
+        c1.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nB'
+            'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nC')
+        c2.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nD')
+        self.assertEqual([r[0].body for r in [r2, r3, r4]], ['B', 'C', 'D'])
+
+
+    def test_lost(self):
+        """
+        Requests that are safe to repeat are sent once more if they're
+        unanswered when a connection is lost.  Others fail, since the
+        server may have acted on them.
+        """
+        connector = FakeConnector()
+        pool = ConnectionPool(connector.connect, size=1)
+        result = self.request(pool, 'a', retry=True)
+        put = self.request(pool, 'b')
+        c1 = connector.connection()
+        pool.added(c1)
+        pool.lost(c1)
+        self.assertIsInstance(put[0], Unavailable)
+        self.assertEqual(connector.attempts, 2)
+        c2 = connector.connection()
+        pool.added(c2)
+        self.assertEqual(connector.written, ['a', 'b', 'a'])
+        pool.lost(c2)
+        self.assertIsInstance(result[0], Unavailable)
+
+
+    def test_abandon(self):
+        """
+        An abandoned request isn't sent if it's still waiting, nor again if
+        its connection is lost, and its response is thrown away.
+        """
+        connector = FakeConnector()
+        pool = ConnectionPool(connector.connect, size=1)
+        waiting = []
+        pool.abandon(pool.request('a', waiting.append, waiting.append))
+        sent = []
+        pending = pool.request('b', sent.append, sent.append, retry=True)
+        c1 = connector.connection()
+        pool.added(c1)
+        self.assertEqual(connector.written, ['b'])
+
+        pool.abandon(pending)
+        c1.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        pool.request('c', sent.append, sent.append, retry=True)
+        pool.lost(c1)
+        self.assertEqual(connector.written, ['b', 'c'])
+        self.assertEqual(waiting, [])
+        self.assertEqual(sent, [])
+
+
+    def test_failed(self):
+        """
+        If no connection can be made, waiting requests fail.
+        """
+        connector = FakeConnector()
+        pool = ConnectionPool(connector.connect, size=1)
+        result = self.request(pool, 'a')
+        err = Exception('refused')
+        pool.failed(err)
+        self.assertEqual(result, [err])
+
+
+    def test_closing(self):
+        """
+        Connections the server will close aren't given more requests.
+        """
+        connector = FakeConnector()
+        pool = ConnectionPool(connector.connect, size=1)
+        self.request(pool, 'a')
+        c1 = connector.connection()
+        pool.added(c1)
+        c1.dataReceived('HTTP/1.1 200 OK\r\nConnection: close\r\n'
+            'Content-Length: 0\r\n\r\n')
+        self.request(pool, 'b')
+        self.assertEqual(connector.attempts, 2)
+        self.assertEqual(len(c1.pending), 0)
+
+
+
+class HelpersTest(TestCase):
+
+
+    def test_encodeRequest(self):
+        self.assertEqual(encodeRequest('PUT', '/SILO/foo', 'bar'),
+            'PUT /SILO/foo HTTP/1.1\r\nHost: localhost\r\n'
+            'Content-Length: 3\r\n\r\nbar')
+        self.assertEqual(encodeRequest('GET', '/SILO/foo',
+            headers={'If-None-Match': '"v1"'}),
+            'GET /SILO/foo HTTP/1.1\r\nHost: localhost\r\n'
+            'Content-Length: 0\r\nIf-None-Match: "v1"\r\n\r\n')
+
+
+    def test_splitURL(self):
+        self.assertEqual(splitURL('http://127.0.0.1:8600/SILO-1'),
+            ('http', ('127.0.0.1', 8600), '/SILO-1'))
+        self.assertEqual(splitURL('http+unix://%2Ftmp%2Fdata.sock/SILO-1'),
+            ('http+unix', '/tmp/data.sock', '/SILO-1'))
@@ -0,0 +1,282 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, threads, reactor, endpoints, task
+from twisted.python.filepath import FilePath
+from twisted.test.proto_helpers import StringTransport
+
+import struct
+import tempfile
+
+import msgpack
+
+from siloscript.dataproto import DataFactory
+from siloscript.binclient import Client
+from siloscript.server import Machine
+from siloscript.storage import MemoryStore
+from siloscript.process import unixSocketURL
+from siloscript.clientcore import OK, NOT_FOUND, BAD_REQUEST, ERROR
+from siloscript.error import NotFound, InvalidKey, Unavailable
+from siloscript.error import VersionMismatch, Timeout
+
+
+
+def frame(*msg):
+    data = msgpack.packb(list(msg))
+    return struct.pack('!I', len(data)) + data
+
+
+
+def unframe(data):
+    responses = []
+    while data:
+        size = struct.unpack('!I', data[:4])[0]
+        responses.append(msgpack.unpackb(data[4:4+size]))
+        data = data[4+size:]
+    return responses
+
+
+
+class FakeMachine(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def data_get(self, silo_key, key, prompt=None, save=True, options=None):
+        d = defer.Deferred()
+        self.calls.append((silo_key, key, prompt, d))
+        return d
+
+    def data_put(self, silo_key, key, value):
+        if key == 'bad':
+            raise InvalidKey(key)
+        raise Exception('broken')
+
+
+
+class DataProtocolTest(TestCase):
+
+
+    def connect(self):
+        self.machine = FakeMachine()
+        proto = DataFactory(self.machine).buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+
+    def test_outOfOrder(self):
+        """
+        Requests are dispatched as they arrive and answered as soon as
+        they're done, in whatever order that is.
+        """
+        proto, transport = self.connect()
+        proto.dataReceived(frame(1, 'get', 'SILO', 'a', 'A?')
+            + frame(2, 'get', 'SILO', 'b'))
+        self.assertEqual([x[:3] for x in self.machine.calls],
+            [('SILO', 'a', 'A?'), ('SILO', 'b', None)])
+        self.machine.calls[1][3].callback('B')
+        self.machine.calls[0][3].errback(NotFound('a'))
+        self.assertEqual(unframe(transport.value()),
+            [[2, OK, 'B'], [1, NOT_FOUND, 'Not found']])
+
+
+    def test_errors(self):
+        """
+        Bad requests and unexpected errors are reported with their own
+        statuses.
+        """
+        proto, transport = self.connect()
+        proto.dataReceived(frame(1, 'put', 'SILO', 'bad', 'x')
+            + frame(2, 'put', 'SILO', 'foo', 'x')
+            + frame(3, 'delete', 'SILO', 'foo'))
+        responses = unframe(transport.value())
+        self.assertEqual([x[:2] for x in responses],
+            [[1, BAD_REQUEST], [2, ERROR], [3, BAD_REQUEST]])
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+
+
+    def test_badFrame(self):
+        """
+        A frame that isn't a msgpack request closes the connection.
+        """
+        proto, transport = self.connect()
+        proto.dataReceived(struct.pack('!I', 1) + '\xc1')
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+
+
+    def test_lost(self):
+        """
+        Nothing is written after the connection is lost.
+        """
+        proto, transport = self.connect()
+        proto.dataReceived(frame(1, 'get', 'SILO', 'a'))
+        proto.connectionLost(None)
+        self.machine.calls[0][3].callback('A')
+        self.assertEqual(transport.value(), '')
+
+
+
+class RecordingFactory(DataFactory):
+
+    def __init__(self, machine):
+        DataFactory.__init__(self, machine)
+        self.protocols = []
+
+    def buildProtocol(self, addr):
+        proto = DataFactory.buildProtocol(self, addr)
+        self.protocols.append(proto)
+        return proto
+
+
+
+class Functional_BinaryClientTest(TestCase):
+
+    timeout = 5
+
+
+    @defer.inlineCallbacks
+    def startServer(self, receiver=None, unix=False):
+        self.store = MemoryStore()
+        self.machine = Machine(self.store, None)
+        if unix:
+            tmpdir = FilePath(tempfile.mkdtemp())
+            self.addCleanup(tmpdir.remove)
+            socket_path = tmpdir.child('binary.sock').path
+            ep = endpoints.UNIXServerEndpoint(reactor, socket_path)
+        else:
+            ep = endpoints.serverFromString(reactor,
+                'tcp:0:interface=127.0.0.1')
+        self.factory = RecordingFactory(self.machine)
+        p = yield ep.listen(self.factory)
+        self.addCleanup(p.stopListening)
+        if unix:
+            url = unixSocketURL(socket_path, scheme='msgpack+unix')
+        else:
+            host = p.getHost()
+            url = 'msgpack+tcp://%s:%s' % (host.host, host.port)
+        silo_key = self.machine.control_makeSilo('foo', 'bar', receiver)
+        client = Client('%s/%s' % (url, silo_key), cache=False)
+        self.addCleanup(client.close)
+        defer.returnValue(client)
+
+
+    @defer.inlineCallbacks
+    def test_values(self):
+        """
+        Values can be put, gotten and tokenized.
+        """
+        client = yield self.startServer()
+        yield threads.deferToThread(client.putValue, 'foo', u'\u00e9')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, u'\u00e9')
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'missing'), NotFound)
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'bad/key'), NotFound)
+
+        yield threads.deferToThread(client.putValues, {'a': 'A', 'b': 'B'})
+        result = yield threads.deferToThread(client.getValues,
+            ['a', {'key': 'b'}, 'missing'])
+        self.assertEqual(result, {'a': 'A', 'b': 'B'})
+
+        version = yield threads.deferToThread(client.putValue, 'v', '1')
+        self.assertEqual(client.getVersion('v'), version)
+        yield threads.deferToThread(client.putValue, 'v', '2',
+            if_version=version)
+        yield self.assertFailure(threads.deferToThread(client.putValue, 'v',
+            '3', if_version=version), VersionMismatch)
+
+        token1 = yield threads.deferToThread(client.getToken, 'secret')
+        token2 = yield threads.deferToThread(client.getToken, 'secret')
+        self.assertEqual(token1, token2)
+        self.assertTrue(token1.startswith('TK-'))
+        self.assertEqual(len(self.factory.protocols), 1)
+
+
+    @defer.inlineCallbacks
+    def test_unixSocket(self):
+        """
+        The protocol can be served on a Unix socket.
+        """
+        client = yield self.startServer(unix=True)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+
+
+    @defer.inlineCallbacks
+    def test_sharedByThreads(self):
+        """
+        Threads share one connection, and one waiting for a prompt doesn't
+        hold up the others.
+        """
+        questions = []
+        client = yield self.startServer(receiver=questions.append)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        prompted = threads.deferToThread(client.getValue, 'color',
+            prompt='Color?')
+        while not questions:
+            yield threads.deferToThread(lambda: None)
+        results = yield defer.gatherResults([
+            threads.deferToThread(client.getValue, 'foo')
+            for i in range(5)])
+        self.assertEqual(results, ['bar'] * 5)
+        self.assertFalse(prompted.called)
+        self.machine.answer_question(questions[0]['id'], 'blue')
+        result = yield prompted
+        self.assertEqual(result, 'blue')
+        self.assertEqual(len(self.factory.protocols), 1)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        """
+        A request that takes longer than C{timeout} fails with L{Timeout}
+        without disturbing the others on the connection, and requests
+        that prompt wait for their answer however long it takes.
+        """
+        def receiver(question):
+            reactor.callLater(0.8, self.machine.answer_question,
+                question['id'], 'blue')
+        client = yield self.startServer(receiver=receiver)
+        client.timeout = 0.2
+        get = self.store.get
+        def slowGet(user, silo, key):
+            if key == 'slow':
+                return task.deferLater(reactor, 0.4, get, user, silo, 'foo')
+            return get(user, silo, key)
+        self.store.get = slowGet
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+
+        prompted = threads.deferToThread(client.getValue, 'color',
+            prompt='Color?')
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'slow'), Timeout)
+        result = yield prompted
+        self.assertEqual(result, 'blue')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        self.assertEqual(len(self.factory.protocols), 1)
+        self.assertEqual(client._abandoned, set())
+
+
+    @defer.inlineCallbacks
+    def test_connectionLost(self):
+        """
+        Requests outstanding when the connection is lost fail, and the next
+        request reconnects.
+        """
+        questions = []
+        client = yield self.startServer(receiver=questions.append)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        prompted = threads.deferToThread(client.getValue, 'color',
+            prompt='Color?')
+        while not questions:
+            yield threads.deferToThread(lambda: None)
+        self.factory.protocols[0].transport.loseConnection()
+        yield self.assertFailure(prompted, Unavailable)
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        self.assertEqual(len(self.factory.protocols), 2)
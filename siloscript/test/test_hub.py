@@ -0,0 +1,286 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, endpoints, defer, task
+
+from siloscript.storage import MemoryStore
+from siloscript.server import Machine, ControlWebApp
+from siloscript.hub import HubFactory, HubClient
+from siloscript.jobs import JobLog
+from siloscript.workers import workerEndpoint, workerURL
+
+
+
+class HubTest(TestCase):
+
+    timeout = 5
+
+
+    @defer.inlineCallbacks
+    def startWorkers(self, count=2, **machine_kwargs):
+        """
+        Start a hub and connect some workers (each a L{Machine} and
+        L{ControlWebApp}) to it.
+
+        @param machine_kwargs: Extra arguments for each L{Machine}.
+
+        @return: A list of the workers' L{ControlWebApp}s.
+        """
+        path = self.mktemp()
+        hub = HubFactory()
+        port = yield endpoints.UNIXServerEndpoint(reactor, path).listen(hub)
+        self.addCleanup(port.stopListening)
+        controls = []
+        for i in range(count):
+            machine = Machine(MemoryStore(), None, **machine_kwargs)
+            control = ControlWebApp(machine, None)
+            client = HubClient(machine, control)
+            yield endpoints.connectProtocol(
+                endpoints.UNIXClientEndpoint(reactor, path), client)
+            self.addCleanup(lambda c=client: c.disconnected)
+            self.addCleanup(client.transport.loseConnection)
+            controls.append(control)
+        # wait for the hub to know about all of them
+        while len(hub.workers) < count:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        defer.returnValue(controls)
+
+
+    def receive(self, control, channel_key):
+        """
+        Connect a receiver to a channel.
+
+        @return: A L{Deferred} which fires with the first question it
+            receives.
+        """
+        d = defer.Deferred()
+        def receiver(question):
+            control.channels[channel_key].remove(receiver)
+            d.callback(question)
+        control.channels[channel_key].append(receiver)
+        return d
+
+
+    @defer.inlineCallbacks
+    def test_questionAndAnswer(self):
+        """
+        A question asked on one worker is sent to channels connected to the
+        others, and an answer given to any of them reaches the asker.  Once
+        it's answered, the others stop offering it.
+        """
+        a, b, c = yield self.startWorkers(3)
+        received = self.receive(b, 'chan')
+
+        answer_d = a.machine.ask_question(
+            lambda q: a.ask_channel('chan', q), {'prompt': 'Name?'})
+        question = yield received
+        self.assertEqual(question['prompt'], 'Name?')
+        self.assertEqual(b.pending_questions['chan'], [question])
+
+        c.machine.answer_question(question['id'], 'Joe')
+        answer = yield answer_d
+        self.assertEqual(answer, 'Joe')
+
+        # a's own bookkeeping happens after the test's callback
+        yield task.deferLater(reactor, 0, lambda: None)
+
+        # a later question arriving means the hub has passed on everything
+        # sent before it
+        received = self.receive(b, 'chan')
+        a.machine.ask_question(lambda q: a.ask_channel('chan', q),
+            {'prompt': 'Age?'})
+        question2 = yield received
+        self.assertEqual(b.pending_questions['chan'], [question2])
+        self.assertEqual([q['id'] for q in a.pending_questions['chan']],
+            [question2['id']])
+
+
+    @defer.inlineCallbacks
+    def test_relayedQuestionExpires(self):
+        """
+        A worker stops offering another worker's question once the asker
+        would have given up on it, even if it never says so.
+        """
+        clock = task.Clock()
+        a, b = yield self.startWorkers(2, question_timeout=10, clock=clock)
+        received = self.receive(b, 'chan')
+        a.machine.ask_question(lambda q: a.ask_channel('chan', q),
+            {'prompt': 'Name?'}).addErrback(lambda f: None)
+        question = yield received
+        self.assertEqual(b.pending_questions['chan'], [question])
+
+        # as though a had died before it could say
+        a.machine.hub.answered = lambda *args: None
+        clock.advance(10)
+        self.assertEqual(b.pending_questions.get('chan'), None)
+        self.assertEqual(b.machine.hub._relayed, {})
+
+
+    @defer.inlineCallbacks
+    def test_relayedQuestionsDroppedWithHub(self):
+        """
+        A worker that loses the hub stops offering other workers' questions,
+        since it won't hear when they're answered.
+        """
+        a, b = yield self.startWorkers(2)
+        received = self.receive(b, 'chan')
+        a.machine.ask_question(lambda q: a.ask_channel('chan', q),
+            {'prompt': 'Name?'})
+        yield received
+        hub = b.machine.hub
+        hub.transport.loseConnection()
+        yield hub.disconnected
+        self.assertEqual(b.pending_questions.get('chan'), None)
+
+
+    @defer.inlineCallbacks
+    def test_bigQuestionAndAnswer(self):
+        """
+        Questions and answers bigger than an AMP value can be relayed.
+        """
+        a, b = yield self.startWorkers(2)
+        received = self.receive(b, 'chan')
+        options = ['option %d' % (i,) for i in range(10000)]
+        answer_d = a.machine.ask_question(
+            lambda q: a.ask_channel('chan', q),
+            {'prompt': 'Pick', 'options': options})
+        question = yield received
+        self.assertEqual(question['options'], options)
+
+        b.machine.answer_question(question['id'], 'x' * 100000)
+        answer = yield answer_d
+        self.assertEqual(answer, 'x' * 100000)
+
+
+    @defer.inlineCallbacks
+    def test_localAnswer(self):
+        """
+        Answers to a worker's own questions aren't sent to the others.
+        """
+        a, b = yield self.startWorkers(2)
+        sent = []
+        a.machine.hub.answer = lambda *args: sent.append(args)
+        answer_d = a.machine.ask_question(
+            lambda q: a.ask_channel('chan', q), {'prompt': 'Name?'})
+        question = a.pending_questions['chan'][0]
+        a.machine.answer_question(question['id'], 'Joe')
+        answer = yield answer_d
+        self.assertEqual(answer, 'Joe')
+        self.assertEqual(sent, [])
+
+        a.machine.answer_question('Q-unknown', 'Joe')
+        self.assertEqual(sent, [('Q-unknown', 'Joe')])
+
+
+
+    @defer.inlineCallbacks
+    def test_jobStatus(self):
+        """
+        Workers can get the status of jobs run by other workers, however
+        much output they have.
+        """
+        a, b, c = yield self.startWorkers(3)
+        run_d = defer.Deferred()
+        job = a.jobs.start(run_d, 'jim', 'foo.sh', [])
+
+        status = yield b.job_status(job.id)
+        self.assertEqual(status['state'], 'running')
+
+        status_d = c.job_status(job.id, wait=5)
+        run_d.callback(('x' * 200000, 'err', 0))
+        status = yield status_d
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['stdout'], 'x' * 200000)
+
+        status = yield b.job_status('JOB-nope')
+        self.assertEqual(status, None)
+
+
+    @defer.inlineCallbacks
+    def test_watchJob(self):
+        """
+        Workers can follow the logs of jobs run by other workers, from the
+        start or after a given message.
+        """
+        a, b = yield self.startWorkers(2)
+        run_d = defer.Deferred()
+        job_log = JobLog()
+        job = a.jobs.start(run_d, 'jim', 'foo.sh', [], log=job_log)
+        job_log.log({'type': 'output', 'channel': 1, 'data': 'hello'})
+
+        received = []
+        ended = defer.Deferred()
+        def listener(seq, msg):
+            received.append((seq, msg))
+            if msg['type'] == 'end':
+                ended.callback(None)
+        stop = yield b.watch_job(job.id, listener)
+        self.assertNotEqual(stop, None)
+        job_log.log({'type': 'output', 'channel': 2, 'data': 'x' * 100000})
+        run_d.callback(('hello', 'x' * 100000, 0))
+        yield ended
+        self.assertEqual([seq for seq, msg in received], [1, 2, 3])
+        self.assertEqual(received[0][1]['data'], 'hello')
+        self.assertEqual(received[1][1]['data'], 'x' * 100000)
+        self.assertEqual(received[2][1]['rc'], 0)
+        self.assertNotIn('stdout', received[2][1])
+        stop()
+
+        later = defer.Deferred()
+        stop = yield b.watch_job(job.id, lambda seq, msg: later.callback(seq),
+            after=2)
+        self.assertEqual((yield later), 3)
+        stop()
+
+        stop = yield b.watch_job('JOB-nope', listener)
+        self.assertEqual(stop, None)
+
+
+    @defer.inlineCallbacks
+    def test_watchJob_binaryOutput(self):
+        """
+        Output that isn't UTF-8 is passed along with the bad bytes replaced,
+        as it is to local watchers.
+        """
+        a, b = yield self.startWorkers(2)
+        run_d = defer.Deferred()
+        job_log = JobLog()
+        job = a.jobs.start(run_d, 'jim', 'foo.sh', [], log=job_log)
+
+        received = defer.Deferred()
+        stop = yield b.watch_job(job.id,
+            lambda seq, msg: received.callback(msg))
+        job_log.log({'type': 'output', 'channel': 1, 'data': 'a\xffb'})
+        msg = yield received
+        self.assertEqual(msg['data'], u'a\ufffdb')
+        stop()
+        run_d.callback(('', '', 0))
+
+
+class WorkerAddressTest(TestCase):
+
+
+    def test_endpoint(self):
+        """
+        Each worker gets its own port or socket.
+        """
+        self.assertEqual(workerEndpoint('tcp:8600', 2), 'tcp:8602')
+        self.assertEqual(workerEndpoint('tcp:8600:interface=127.0.0.1', 1),
+            'tcp:8601:interface=127.0.0.1')
+        self.assertEqual(workerEndpoint('tcp:interface=127.0.0.1:port=8600',
+            1), 'tcp:interface=127.0.0.1:port=8601')
+        self.assertEqual(workerEndpoint('unix:/tmp/d.sock:mode=600', 3),
+            'unix:/tmp/d.sock.3:mode=600')
+
+
+    def test_url(self):
+        """
+        Scripts are given the URL of their worker's data endpoint.
+        """
+        self.assertEqual(workerURL('http://127.0.0.1:8600', 2),
+            'http://127.0.0.1:8602')
+        self.assertEqual(workerURL('msgpack+tcp://10.0.0.1:8601', 1),
+            'msgpack+tcp://10.0.0.1:8602')
+        self.assertEqual(workerURL('http+unix://%2Ftmp%2Fd.sock', 1),
+            'http+unix://%2Ftmp%2Fd.sock.1')
@@ -0,0 +1,163 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+from siloscript.jobs import JobStore, JobLog
+from siloscript.error import NotFound, Timeout
+
+
+
+class JobLogTest(TestCase):
+
+
+    def test_listen(self):
+        """
+        Listeners get the messages logged before they started listening
+        (after the one they ask for) and then each new one, numbered.
+        """
+        job_log = JobLog()
+        job_log.log({'type': 'output', 'data': 'a'})
+        job_log.log({'type': 'output', 'data': 'b'})
+        received = []
+        stop = job_log.listen(lambda *args: received.append(args), after=1)
+        job_log.log({'type': 'exit'})
+        self.assertEqual(received, [
+            (2, {'type': 'output', 'data': 'b'}),
+            (3, {'type': 'exit'}),
+        ])
+        stop()
+        job_log.log({'type': 'end'})
+        self.assertEqual(len(received), 2)
+
+
+    def test_bounds(self):
+        """
+        Only the last C{max_events} messages, holding at most C{max_bytes}
+        of output, are kept.
+        """
+        job_log = JobLog(max_events=3, max_bytes=10)
+        for i in range(5):
+            job_log.log({'type': 'exit'})
+        self.assertEqual([e[0] for e in job_log.events], [3, 4, 5])
+        job_log.log({'type': 'output', 'data': 'x' * 8})
+        job_log.log({'type': 'output', 'data': 'y' * 8})
+        self.assertEqual([e[0] for e in job_log.events], [7])
+        self.assertEqual(job_log.count, 7)
+
+
+
+class JobStoreTest(TestCase):
+
+
+    def test_done(self):
+        """
+        A job is running until its run finishes, and then has its whole
+        result.
+        """
+        jobs = JobStore(clock=task.Clock())
+        d = defer.Deferred()
+        job = jobs.start(d, 'jim', 'foo.sh', ['a'])
+        self.assertIs(jobs.get(job.id), job)
+        status = job.status()
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['script'], 'foo.sh')
+        self.assertNotIn('rc', status)
+
+        d.callback(('out', 'err', 3))
+        seq, end = list(job.log.events)[-1][:2]
+        self.assertEqual(end['type'], 'end')
+        self.assertEqual(end['rc'], 3)
+        self.assertNotIn('stdout', end)
+        status = jobs.get(job.id).status()
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['stdout'], 'out')
+        self.assertEqual(status['stderr'], 'err')
+        self.assertEqual(status['rc'], 3)
+
+
+    def test_failed(self):
+        """
+        A run that fails makes a failed job with the error's message.
+        """
+        jobs = JobStore(clock=task.Clock())
+        job = jobs.start(defer.fail(Timeout('too slow')), 'jim', 'foo.sh',
+            [])
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.status()['error'], 'too slow')
+
+
+    def test_unknown(self):
+        """
+        Getting a job that doesn't exist is an error.
+        """
+        jobs = JobStore(clock=task.Clock())
+        self.assertRaises(NotFound, jobs.get, 'JOB-nope')
+        self.assertRaises(NotFound, jobs.wait, 'JOB-nope', 10)
+
+
+    def test_ttl(self):
+        """
+        Finished jobs are forgotten C{ttl} seconds after they finish.
+        Running jobs aren't.
+        """
+        clock = task.Clock()
+        jobs = JobStore(ttl=10, clock=clock)
+        job = jobs.start(defer.succeed(('', '', 0)), 'jim', 'foo.sh', [])
+        running = jobs.start(defer.Deferred(), 'jim', 'foo.sh', [])
+        clock.advance(9)
+        jobs.get(job.id)
+        clock.advance(1)
+        self.assertRaises(NotFound, jobs.get, job.id)
+        jobs.get(running.id)
+        self.assertEqual(len(jobs), 1)
+
+
+    def test_maxJobs(self):
+        """
+        At most C{max_jobs} finished jobs are remembered; the ones that
+        finished first are forgotten first.
+        """
+        jobs = JobStore(max_jobs=2, clock=task.Clock())
+        ds = [defer.Deferred() for i in range(3)]
+        started = [jobs.start(d, 'jim', 'foo.sh', []) for d in ds]
+        for i in [1, 0, 2]:
+            ds[i].callback(('', '', 0))
+        self.assertRaises(NotFound, jobs.get, started[1].id)
+        jobs.get(started[0].id)
+        jobs.get(started[2].id)
+
+
+    def test_wait(self):
+        """
+        Waiting for a job fires when it finishes or when the time is up.
+        """
+        clock = task.Clock()
+        jobs = JobStore(clock=clock)
+        d = defer.Deferred()
+        job = jobs.start(d, 'jim', 'foo.sh', [])
+
+        timed_out = jobs.wait(job.id, 5)
+        finished = jobs.wait(job.id, 10)
+        clock.advance(5)
+        self.assertEqual(self.successResultOf(timed_out).state, 'running')
+        self.assertNoResult(finished)
+        d.callback(('out', '', 0))
+        self.assertEqual(self.successResultOf(finished).state, 'done')
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(self.successResultOf(jobs.wait(job.id, 10)).state,
+            'done')
+
+
+    def test_cancelWait(self):
+        """
+        A wait can be cancelled, as when the client goes away.
+        """
+        clock = task.Clock()
+        jobs = JobStore(clock=clock)
+        job = jobs.start(defer.Deferred(), 'jim', 'foo.sh', [])
+        d = jobs.wait(job.id, 10)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(clock.getDelayedCalls(), [])
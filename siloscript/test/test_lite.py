@@ -0,0 +1,341 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, threads, protocol, reactor
+
+import os
+import sys
+import json
+import socket
+import httplib
+import subprocess
+from StringIO import StringIO
+
+from siloscript.lite import Client
+from siloscript.error import NotFound, VersionMismatch, Overloaded
+from siloscript.storage import MemoryStore, BlobStore
+from siloscript.test.test_client import DataServerMixin, Pipe, BusyStore
+
+import siloscript
+
+
+
+class ImportTest(TestCase):
+
+
+    def importSiloscript(self):
+        """
+        Import siloscript in a new interpreter.  (How long it takes is
+        measured by C{bench/import_time.py}, not here.)
+
+        @return: The list of modules imported.
+        """
+        root = os.path.dirname(os.path.dirname(siloscript.__file__))
+        env = dict(os.environ, PYTHONPATH=root)
+        # (not check_output, which Python 2.6 doesn't have)
+        out, _ = subprocess.Popen([sys.executable, '-c',
+            'import sys, json; import siloscript;'
+            ' print json.dumps(sys.modules.keys())'],
+            env=env, stdout=subprocess.PIPE).communicate()
+        return json.loads(out)
+
+
+    def test_noHeavyImports(self):
+        """
+        Importing siloscript doesn't import requests, Twisted or even
+        httplib.
+        """
+        modules = self.importSiloscript()
+        for name in ['requests', 'twisted', 'httplib', 'siloscript.server']:
+            self.assertNotIn(name, modules)
+
+
+
+class ScriptedHTTP(protocol.Protocol):
+    """
+    I handle each request with the next of my factory's C{actions}:
+    C{'ok'} answers it, C{'close'} closes the connection and C{'silent'}
+    does nothing.  My factory's C{requests} records their request lines.
+    """
+
+    def connectionMade(self):
+        self.buffer = ''
+
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while '\r\n\r\n' in self.buffer:
+            head, rest = self.buffer.split('\r\n\r\n', 1)
+            lines = head.split('\r\n')
+            length = 0
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                if name.lower() == 'content-length':
+                    length = int(value)
+            if len(rest) < length:
+                return
+            self.buffer = rest[length:]
+            self.factory.requests.append(lines[0])
+            action = self.factory.actions.pop(0)
+            if action == 'ok':
+                self.transport.write('HTTP/1.1 200 OK\r\n'
+                    'Content-Length: 2\r\n\r\nok')
+            elif action == 'close':
+                self.transport.loseConnection()
+
+
+
+class ScriptedHTTPTest(TestCase):
+
+    timeout = 5
+
+
+    @defer.inlineCallbacks
+    def client(self, actions):
+        """
+        Start a L{ScriptedHTTP} server doing C{actions}.
+
+        @return: A L{Client} for it that times out after 0.2 seconds.
+        """
+        factory = protocol.ServerFactory.forProtocol(ScriptedHTTP)
+        factory.actions = actions
+        factory.requests = self.requests = []
+        port = yield reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        client = Client('http://127.0.0.1:%d/SILO' % (port.getHost().port,),
+            timeout=0.2, cache=False)
+        self.addCleanup(client.close)
+        defer.returnValue(client)
+
+
+    @defer.inlineCallbacks
+    def test_timeoutNotResent(self):
+        """
+        A request that times out on a kept-alive connection isn't sent
+        again.
+        """
+        client = yield self.client(['ok', 'silent', 'ok'])
+        result = yield threads.deferToThread(client.getValue, 'a')
+        self.assertEqual(result, 'ok')
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'b'), socket.timeout)
+        self.assertEqual(len(self.requests), 2)
+
+
+    @defer.inlineCallbacks
+    def test_closedBeforeAnswer(self):
+        """
+        If the server closes a kept-alive connection after getting a
+        request but before answering it, a C{GET} is sent again on a new
+        connection but a C{PUT}, which may have been done, isn't.
+        """
+        client = yield self.client(['ok', 'close', 'ok', 'close'])
+        yield threads.deferToThread(client.getValue, 'a')
+        result = yield threads.deferToThread(client.getValue, 'b')
+        self.assertEqual(result, 'ok')
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'c', 'C'), httplib.HTTPException, socket.error)
+        self.assertEqual([x.split()[0] for x in self.requests],
+            ['GET', 'GET', 'GET', 'PUT'])
+
+
+
+class Functional_LiteClientTest(DataServerMixin, TestCase):
+
+    timeout = 5
+
+
+    @defer.inlineCallbacks
+    def test_values(self):
+        """
+        The lite client can get, put and tokenize values.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        })
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        result = yield threads.deferToThread(client.getValue, 'color',
+            prompt='Color?', save=False, options=['blue', 'red'])
+        self.assertEqual(result, 'blue')
+        yield self.assertFailure(threads.deferToThread(client.getValue,
+            'color'), NotFound)
+        yield threads.deferToThread(client.putValues, {'a': 'A'})
+        result = yield threads.deferToThread(client.getValues, ['a', 'b'])
+        self.assertEqual(result, {'a': 'A'})
+        token = yield threads.deferToThread(client.getToken, 'foo')
+        self.assertNotEqual(token, 'foo')
+        self.assertEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def test_prompt_slowAnswer(self):
+        """
+        Requests that prompt wait for the answer however long it takes,
+        even longer than the client's C{timeout}.
+        """
+        url = yield self.startServer(answers={
+            'Name?': 'joe',
+        }, answer_delay=0.5)
+        client = Client(url, timeout=0.1)
+        self.addCleanup(client.close)
+        result = yield threads.deferToThread(client.getValue, 'name',
+            prompt='Name?')
+        self.assertEqual(result, 'joe')
+
+
+    @defer.inlineCallbacks
+    def test_badURL(self):
+        """
+        Requests to a bad URL fail with L{NotFound}.
+        """
+        url = yield self.startServer()
+        client = Client(url + 'fake')
+        self.addCleanup(client.close)
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'foo', 'bar'), NotFound)
+        yield self.assertFailure(threads.deferToThread(client.getToken,
+            'foo'), NotFound)
+
+
+    @defer.inlineCallbacks
+    def test_overloaded(self):
+        """
+        Requests the server is too busy for are tried again a few times,
+        then fail with L{Overloaded}.
+        """
+        self.dataStore = BusyStore
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        self.store.busy = 2
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        self.assertEqual(self.store.busy, 0)
+
+        self.store.busy = 4
+        client.retries = 3
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'foo', 'baz'), Overloaded)
+        self.assertEqual(self.store.busy, 0)
+
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        """
+        If the server closes a kept-alive connection, the client connects
+        again.
+        """
+        url = yield self.startServer()
+        client = Client(url, cache=False)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        yield self.site.closeAll()
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        self.assertEqual(self.site.connections, 2)
+
+
+    @defer.inlineCallbacks
+    def test_unixSocket(self):
+        """
+        The lite client can talk over a Unix socket.
+        """
+        url = yield self.startServer(unix=True)
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', u'\u00e9')
+        result = yield threads.deferToThread(client.getValues, ['foo'])
+        self.assertEqual(result, {'foo': u'\u00e9'.encode('utf-8')})
+
+
+    @defer.inlineCallbacks
+    def test_cache(self):
+        """
+        Values gotten or put are remembered, except ones not saved.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        })
+        client = Client(url)
+        self.addCleanup(client.close)
+        yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        yield threads.deferToThread(client.putValues, {'a': 'A'})
+        yield self.store.put('foo', 'bar', 'foo', 'changed')
+        yield self.store.put('foo', 'bar', 'a', 'changed')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'bar')
+        result = yield threads.deferToThread(client.getValues, ['a', 'b'])
+        self.assertEqual(result, {'a': 'A'})
+
+        result = yield threads.deferToThread(client.getValue, 'color',
+            prompt='Color?', save=False)
+        self.assertEqual(result, 'blue')
+        self.assertNotIn('color', client.cache)
+
+        client.forget('foo')
+        result = yield threads.deferToThread(client.getValue, 'foo')
+        self.assertEqual(result, 'changed')
+
+
+    @defer.inlineCallbacks
+    def test_versions(self):
+        """
+        Remembered values can be revalidated and values can be put only if
+        they haven't changed.
+        """
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        v1 = yield threads.deferToThread(client.putValue, 'foo', 'bar')
+        self.assertEqual(client.getVersion('foo'), v1)
+        result = yield threads.deferToThread(client.getValue, 'foo',
+            revalidate=True)
+        self.assertEqual(result, 'bar')
+
+        yield self.store.put('foo', 'bar', 'foo', 'changed')
+        yield self.assertFailure(threads.deferToThread(client.putValue,
+            'foo', 'mine', if_version=v1), VersionMismatch)
+        result = yield threads.deferToThread(client.getValue, 'foo',
+            revalidate=True)
+        self.assertEqual(result, 'changed')
+        v2 = yield threads.deferToThread(client.putValue, 'foo', 'mine',
+            if_version=client.getVersion('foo'))
+        self.assertNotEqual(v1, v2)
+
+
+    @defer.inlineCallbacks
+    def test_files(self):
+        """
+        Large values can be put from and gotten into files, in chunks when
+        their size isn't known.
+        """
+        directory = self.mktemp()
+        self.dataStore = lambda: BlobStore(directory, MemoryStore())
+        url = yield self.startServer()
+        client = Client(url)
+        self.addCleanup(client.close)
+        value = os.urandom(300000)
+
+        v1 = yield threads.deferToThread(client.putFile, 'foo',
+            StringIO(value))
+        self.assertEqual(len(os.listdir(directory)), 1)
+        f = StringIO()
+        version = yield threads.deferToThread(client.getFile, 'foo', f)
+        self.assertEqual(version, v1)
+        self.assertEqual(f.getvalue(), value)
+
+        yield threads.deferToThread(client.putFile, 'foo',
+            Pipe(value[::-1]), if_version=v1)
+        f = StringIO()
+        yield threads.deferToThread(client.getFile, 'foo', f)
+        self.assertEqual(f.getvalue(), value[::-1])
+
+        # the connection is still usable
+        yield threads.deferToThread(client.putValue, 'bar', 'small')
+        result = yield threads.deferToThread(client.getValue, 'bar')
+        self.assertEqual(result, 'small')
+        yield self.assertFailure(threads.deferToThread(client.getFile,
+            'missing', StringIO()), NotFound)
@@ -0,0 +1,82 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+
+from siloscript.metrics import Registry, Counter, Histogram
+
+
+
+class HistogramTest(TestCase):
+
+
+    def test_render(self):
+        """
+        Observations are counted in cumulative buckets for each combination
+        of label values, with their sum and count.
+        """
+        registry = Registry()
+        histogram = registry.register(Histogram('op_seconds', 'Op time.',
+            ['op'], buckets=[0.1, 1.0]))
+        histogram.observe(0.1, ('get',))
+        histogram.observe(0.5, ('get',))
+        histogram.observe(2, ('get',))
+        histogram.observe(0.01, ('put',))
+        self.assertEqual(registry.render(), ''.join([
+            '# HELP op_seconds Op time.\n',
+            '# TYPE op_seconds histogram\n',
+            'op_seconds_bucket{op="get",le="0.1"} 1\n',
+            'op_seconds_bucket{op="get",le="1.0"} 2\n',
+            'op_seconds_bucket{op="get",le="+Inf"} 3\n',
+            'op_seconds_sum{op="get"} 2.6\n',
+            'op_seconds_count{op="get"} 3\n',
+            'op_seconds_bucket{op="put",le="0.1"} 1\n',
+            'op_seconds_bucket{op="put",le="1.0"} 1\n',
+            'op_seconds_bucket{op="put",le="+Inf"} 1\n',
+            'op_seconds_sum{op="put"} 0.01\n',
+            'op_seconds_count{op="put"} 1\n',
+        ]))
+
+
+    def test_escape(self):
+        """
+        Backslashes, quotes and newlines in label values are escaped.
+        """
+        histogram = Histogram('h', 'H.', ['script'], buckets=[])
+        histogram.observe(1, (u'a"b\\c\nd\xe9',))
+        self.assertEqual(histogram.samples()[0][0],
+            'h_bucket{script="a\\"b\\\\c\\nd\xc3\xa9",le="+Inf"}')
+
+
+    def test_time(self):
+        """
+        How long a call's L{Deferred} takes to fire is observed, whether it
+        succeeds or fails.
+        """
+        clock = task.Clock()
+        histogram = Histogram('h', 'H.', ['op'], buckets=[1, 5], clock=clock)
+        d = defer.Deferred()
+        result = histogram.time(('get',), lambda x: d, 'x')
+        clock.advance(3)
+        d.callback('value')
+        self.assertEqual(self.successResultOf(result), 'value')
+        self.failureResultOf(histogram.time(('get',), lambda: 1 / 0),
+            ZeroDivisionError)
+        samples = dict(histogram.samples())
+        self.assertEqual(samples['h_bucket{op="get",le="1"}'], 1)
+        self.assertEqual(samples['h_bucket{op="get",le="5"}'], 2)
+        self.assertEqual(samples['h_sum{op="get"}'], 3)
+
+
+
+class CounterTest(TestCase):
+
+
+    def test_func(self):
+        """
+        A counter can be read from a function.
+        """
+        counts = [3]
+        counter = Counter('things_total', 'Things.', lambda: counts[0])
+        self.assertEqual(counter.samples(), [('things_total', 3)])
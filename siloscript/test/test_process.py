@@ -3,10 +3,13 @@
 
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
-from twisted.internet import defer
+from twisted.internet import defer, task, reactor
 
-from siloscript.process import LocalScriptRunner, SiloWrapper
-from siloscript.error import NotFound
+import os
+
+from siloscript.process import LocalScriptRunner, SiloWrapper, OutputBuffer
+from siloscript.process import unixSocketURL
+from siloscript.error import NotFound, Timeout
 
 
 
@@ -39,6 +42,179 @@ class SiloWrapperTest(TestCase):
         self.assertEqual(rc, 0)
 
 
+    @defer.inlineCallbacks
+    def test_runWithSilo_DATASTORE_BINARY_URL(self):
+        """
+        If there's a binary url root, the runner is given a
+        DATASTORE_BINARY_URL too.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\necho $DATASTORE_BINARY_URL')
+
+        wrapped = SiloWrapper('http://www.example.com/foo',
+            LocalScriptRunner(root.path),
+            binary_url_root='msgpack+tcp://127.0.0.1:8601')
+        out, err, rc = yield wrapped.runWithSilo(
+            silo_key='THE-KEY',
+            executable='foo.sh',
+            args=[],
+            env={})
+        self.assertEqual(out, 'msgpack+tcp://127.0.0.1:8601/THE-KEY\n')
+
+
+    def test_unixSocketURL(self):
+        """
+        Data URLs for Unix sockets have the quoted socket path as the host.
+        """
+        self.assertEqual(unixSocketURL('/tmp/silo script/data.sock'),
+            'http+unix://%2Ftmp%2Fsilo%20script%2Fdata.sock')
+        self.assertEqual(unixSocketURL('/tmp/d.sock', scheme='msgpack+unix'),
+            'msgpack+unix://%2Ftmp%2Fd.sock')
+
+
+
+
+class FakeProducer(object):
+
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class OutputBufferTest(TestCase):
+
+
+    def test_noInterval(self):
+        """
+        Without an interval, output is passed along as it arrives.
+        """
+        called = []
+        buf = OutputBuffer(called.append)
+        buf.output(1, 'a')
+        buf.output(1, 'b')
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': 'a'},
+            {'type': 'output', 'channel': 1, 'data': 'b'},
+        ])
+
+
+    def test_interval(self):
+        """
+        Output is held for the interval and consecutive chunks on a channel
+        are joined.
+        """
+        clock = task.Clock()
+        called = []
+        buf = OutputBuffer(called.append, interval=1, clock=clock)
+        buf.output(1, 'a')
+        buf.output(1, 'b')
+        buf.output(2, 'c')
+        buf.output(1, 'd')
+        self.assertEqual(called, [])
+        clock.advance(1)
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': 'ab'},
+            {'type': 'output', 'channel': 2, 'data': 'c'},
+            {'type': 'output', 'channel': 1, 'data': 'd'},
+        ])
+
+
+    def test_size(self):
+        """
+        Output is passed along early once enough has been held.
+        """
+        clock = task.Clock()
+        called = []
+        buf = OutputBuffer(called.append, interval=1, size=4, clock=clock)
+        buf.output(1, 'ab')
+        self.assertEqual(called, [])
+        buf.output(1, 'cd')
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': 'abcd'},
+        ])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_message(self):
+        """
+        Other messages flush any held output and are passed along in order.
+        """
+        clock = task.Clock()
+        called = []
+        buf = OutputBuffer(called.append, interval=1, clock=clock)
+        buf.output(1, 'a')
+        buf.message({'type': 'exit', 'code': 0})
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': 'a'},
+            {'type': 'exit', 'code': 0},
+        ])
+
+
+    def test_lines(self):
+        """
+        In line mode, partial lines are held a while longer.
+        """
+        clock = task.Clock()
+        called = []
+        buf = OutputBuffer(called.append, interval=1, lines=True,
+            clock=clock)
+        buf.output(1, 'hello\nwor')
+        clock.advance(1)
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': 'hello\n'},
+        ])
+        buf.output(1, 'ld\n')
+        clock.advance(1)
+        self.assertEqual(called[1:], [
+            {'type': 'output', 'channel': 1, 'data': 'world\n'},
+        ])
+        buf.output(1, 'partial')
+        clock.advance(1)
+        self.assertEqual(len(called), 2)
+        clock.advance(1)
+        self.assertEqual(called[2:], [
+            {'type': 'output', 'channel': 1, 'data': 'partial'},
+        ], "Partial lines are not held forever")
+
+
+    def test_backpressure(self):
+        """
+        If the logger returns an unfired Deferred, nothing more is passed
+        along and the producer is paused until it fires.
+        """
+        called = []
+        d = defer.Deferred()
+        waiting = [d]
+        def logger(msg):
+            called.append(msg)
+            if waiting:
+                return waiting.pop()
+        buf = OutputBuffer(logger)
+        buf.producer = FakeProducer()
+        buf.output(1, 'a')
+        self.assertTrue(buf.producer.paused)
+        buf.output(1, 'b')
+        buf.output(1, 'c')
+        buf.message({'type': 'exit', 'code': 0})
+        drained = buf.whenDrained()
+        self.assertEqual(len(called), 1)
+        self.assertNoResult(drained)
+
+        d.callback(None)
+        self.assertFalse(buf.producer.paused)
+        self.assertEqual(called[1:], [
+            {'type': 'output', 'channel': 1, 'data': 'bc'},
+            {'type': 'exit', 'code': 0},
+        ])
+        self.successResultOf(drained)
+
 
 
 class LocalScriptRunnerTest(TestCase):
@@ -106,3 +282,150 @@ class LocalScriptRunnerTest(TestCase):
         self.assertEqual(err, 'stderr?\n')
         self.assertEqual(out, 'hello\n\n')
         self.assertIn({'type': 'exit', 'code': 0}, called)
+
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        """
+        Cancelling a run kills the script.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        root.child('foo.sh').setContent('#!/bin/bash\nexec sleep 10')
+        exited = defer.Deferred()
+        def logger(msg):
+            if msg['type'] == 'exit':
+                exited.callback(msg)
+        runner = LocalScriptRunner(root.path)
+        d = runner.run('foo.sh', logger=logger)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        msg = yield exited
+        self.assertNotEqual(msg['code'], 0)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        """
+        A script that runs too long is killed and the run fails with
+        L{Timeout} which includes whatever output there was.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\necho started\nexec sleep 10')
+        called = []
+        runner = LocalScriptRunner(root.path, timeout=0.2)
+        err = yield self.assertFailure(runner.run('foo.sh',
+            logger=called.append), Timeout)
+        self.assertEqual(err.args[1], 'started\n')
+        self.assertIn({'type': 'timeout'}, called)
+
+
+    @defer.inlineCallbacks
+    def test_timeout_kill(self):
+        """
+        A script that ignores SIGTERM is sent SIGKILL after the grace period.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\ntrap "" TERM\n'
+            'while true; do sleep 0.05; done')
+        runner = LocalScriptRunner(root.path, timeout=0.2, kill_grace=0.2)
+        yield self.assertFailure(runner.run('foo.sh'), Timeout)
+
+
+    @defer.inlineCallbacks
+    def test_timeout_perExecutable(self):
+        """
+        Timeouts can be configured per executable and overridden per run.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        root.child('slow.sh').setContent('#!/bin/bash\nsleep 0.3\necho done')
+        runner = LocalScriptRunner(root.path, timeout=10,
+            timeouts={'slow.sh': 0.1})
+        self.assertEqual(runner.timeoutFor('slow.sh'), 0.1)
+        self.assertEqual(runner.timeoutFor('other.sh'), 10)
+        yield self.assertFailure(runner.run('slow.sh'), Timeout)
+        out, err, rc = yield runner.run('slow.sh', timeout=5)
+        self.assertEqual(out, 'done\n')
+        self.assertEqual(rc, 0)
+
+
+    @defer.inlineCallbacks
+    def test_limits(self):
+        """
+        Kernel resource limits can be applied to scripts.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\nulimit -n\nulimit -t\necho $1')
+        runner = LocalScriptRunner(root.path, limits={
+            'files': 32,
+            'cpu': 20,
+        })
+        out, err, rc = yield runner.run('foo.sh', args=['arg1'])
+        self.assertEqual(out, '32\n20\narg1\n')
+        self.assertEqual(rc, 0)
+
+
+    @defer.inlineCallbacks
+    def test_limits_timeout_killsChildren(self):
+        """
+        When limits are used, the script runs in its own process group and
+        a timeout kills everything it started.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\nsleep 10\necho never')
+        runner = LocalScriptRunner(root.path, timeout=0.2,
+            limits={'files': 64})
+        err = yield self.assertFailure(runner.run('foo.sh'), Timeout)
+        self.assertEqual(err.args[1], '')
+
+
+    @defer.inlineCallbacks
+    def test_timeout_killsChildren(self):
+        """
+        Even without limits, the script runs in its own process group and a
+        timeout kills everything it started.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        pid_fp = root.child('pid')
+        root.child('foo.sh').setContent('#!/bin/bash\n'
+            'sleep 10 &\necho $! > %s\nwait' % (pid_fp.path,))
+        runner = LocalScriptRunner(root.path, timeout=0.5, kill_grace=0.5)
+        yield self.assertFailure(runner.run('foo.sh'), Timeout)
+        pid = int(pid_fp.getContent())
+        for i in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        else:
+            self.fail("The script's child should have been killed")
+
+
+    @defer.inlineCallbacks
+    def test_logger_batched(self):
+        """
+        Output can be batched before it's given to the logger.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        foo = root.child('foo.sh')
+        foo.setContent('#!/bin/bash\nfor i in 1 2 3 4 5; do echo $i; done')
+        called = []
+        runner = LocalScriptRunner(root.path, output_interval=0.5,
+            output_lines=True)
+        out, err, rc = yield runner.run('foo.sh', logger=called.append)
+        self.assertEqual(called, [
+            {'type': 'output', 'channel': 1, 'data': '1\n2\n3\n4\n5\n'},
+            {'type': 'exit', 'code': 0},
+        ])
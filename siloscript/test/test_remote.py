@@ -0,0 +1,183 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor, endpoints, defer, task
+
+import os
+
+from siloscript.process import LocalScriptRunner, SiloWrapper
+from siloscript.remote import RemoteScriptRunner, WorkerFactory
+from siloscript.error import NotFound, Timeout, Unavailable
+
+
+
+class CountingRunner(LocalScriptRunner):
+
+    count = 0
+
+    def run(self, *args, **kwargs):
+        self.count += 1
+        return LocalScriptRunner.run(self, *args, **kwargs)
+
+
+
+class RemoteScriptRunnerTest(TestCase):
+
+    timeout = 10
+
+
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+
+
+    @defer.inlineCallbacks
+    def startWorkers(self, count=2):
+        """
+        Start some workers on this machine.
+
+        @return: A L{RemoteScriptRunner} which uses them.
+        """
+        self.workers = []
+        client_endpoints = []
+        for i in range(count):
+            runner = CountingRunner(self.root.path)
+            ep = endpoints.serverFromString(reactor,
+                'tcp:0:interface=127.0.0.1')
+            p = yield ep.listen(WorkerFactory(runner))
+            self.addCleanup(p.stopListening)
+            self.workers.append(runner)
+            client_endpoints.append(endpoints.TCP4ClientEndpoint(reactor,
+                '127.0.0.1', p.getHost().port))
+        remote = RemoteScriptRunner(client_endpoints)
+        self.addCleanup(remote.disconnect)
+        defer.returnValue(remote)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        """
+        Scripts are run by a worker and their output comes back.
+        """
+        self.root.child('foo.sh').setContent('#!/bin/bash\n'
+            'echo hello\necho $FOO\necho $1\necho oops >&2\nexit 3')
+        remote = yield self.startWorkers()
+        called = []
+        out, err, rc = yield remote.run('foo.sh', args=['arg1'],
+            env={'FOO': 'hey'}, logger=called.append)
+        self.assertEqual(out, 'hello\nhey\narg1\n')
+        self.assertEqual(err, 'oops\n')
+        self.assertEqual(rc, 3)
+        self.assertIn({'type': 'exit', 'code': 3}, called)
+        self.assertEqual(''.join([x['data'] for x in called
+            if x['type'] == 'output' and x['channel'] == 1]), out)
+
+
+    @defer.inlineCallbacks
+    def test_largeOutput(self):
+        """
+        Output bigger than an AMP value is okay.
+        """
+        self.root.child('big.sh').setContent('#!/bin/bash\n'
+            'head -c 200000 /dev/zero')
+        remote = yield self.startWorkers(1)
+        out, err, rc = yield remote.run('big.sh')
+        self.assertEqual(out, '\x00' * 200000)
+
+
+    @defer.inlineCallbacks
+    def test_notFound(self):
+        """
+        A missing script is L{NotFound} just like with a local runner.
+        """
+        remote = yield self.startWorkers(1)
+        yield self.assertFailure(remote.run('nothing.sh'), NotFound)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        """
+        Timeouts are passed along and enforced by the worker.
+        """
+        self.root.child('slow.sh').setContent('#!/bin/bash\n'
+            'echo started\nexec sleep 10')
+        remote = yield self.startWorkers(1)
+        err = yield self.assertFailure(remote.run('slow.sh', timeout=0.2),
+            Timeout)
+        self.assertEqual(err.args[1], 'started\n')
+
+
+    @defer.inlineCallbacks
+    def test_leastLoaded(self):
+        """
+        Runs go to the worker with the fewest runs in progress.
+        """
+        self.root.child('slow.sh').setContent('#!/bin/bash\nsleep 0.3')
+        remote = yield self.startWorkers(2)
+        yield remote.connect()
+        yield defer.gatherResults([remote.run('slow.sh') for i in range(4)])
+        self.assertEqual([w.count for w in self.workers], [2, 2])
+
+
+    @defer.inlineCallbacks
+    def test_noWorkers(self):
+        """
+        If no workers can be reached, runs fail with L{Unavailable}.
+        """
+        remote = RemoteScriptRunner([endpoints.TCP4ClientEndpoint(reactor,
+            '127.0.0.1', 1)])
+        yield self.assertFailure(remote.run('foo.sh'), Unavailable)
+
+
+    @defer.inlineCallbacks
+    def test_lostConnection(self):
+        """
+        If the connection to a worker is lost during a run, the run fails
+        with L{Unavailable} and the worker kills the script.
+        """
+        pid_fp = self.root.child('pid')
+        self.root.child('slow.sh').setContent('#!/bin/bash\n'
+            'echo $$ > %s\necho started\nexec sleep 10' % (pid_fp.path,))
+        remote = yield self.startWorkers(1)
+        d = remote.run('slow.sh', logger=lambda msg: remote.disconnect())
+        yield self.assertFailure(d, Unavailable)
+
+        pid = int(pid_fp.getContent())
+        for i in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        else:
+            self.fail("Script should have been killed")
+
+
+    @defer.inlineCallbacks
+    def test_notConnected(self):
+        """
+        A worker that has disconnected since it was picked fails runs with
+        L{Unavailable}.
+        """
+        remote = yield self.startWorkers(1)
+        yield remote.connect()
+        worker = remote.workers[0]
+        remote.disconnect()
+        worker.protocol = None
+        yield self.assertFailure(worker.run('foo.sh', [], {}), Unavailable)
+        self.assertEqual(worker.load, 0)
+
+
+    @defer.inlineCallbacks
+    def test_siloWrapper(self):
+        """
+        A remote runner can be wrapped so that scripts get a DATASTORE_URL.
+        """
+        self.root.child('foo.sh').setContent('#!/bin/bash\n'
+            'echo $DATASTORE_URL')
+        remote = yield self.startWorkers()
+        wrapped = SiloWrapper('http://data.example.com', remote)
+        out, err, rc = yield wrapped.runWithSilo('KEY', 'foo.sh', [], {})
+        self.assertEqual(out, 'http://data.example.com/KEY\n')
@@ -3,12 +3,22 @@
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
 
 from mock import MagicMock
+from StringIO import StringIO
 
 from siloscript.storage import MemoryStore
-from siloscript.error import InvalidKey
-from siloscript.server import Machine, NotFound
+from siloscript.cache import ResultCache
+from siloscript.error import InvalidKey, NoAnswer, Overloaded, Timeout
+from siloscript.server import Machine, NotFound, ControlWebApp
+from siloscript.server import PublicWebApp, _SharedRun, dataGet
+from siloscript.silokey import SiloKeys, MemoryRevocationList
+from siloscript.jobs import JobLog
+from siloscript.sse import EventReader
+from siloscript.test.test_sse import StreamingRequest
 
 
 
@@ -102,6 +112,7 @@ class MachineTest(TestCase):
         self.assertEqual(kwargs['executable'], 'foo.sh')
         self.assertEqual(kwargs['args'], ['hey'])
         self.assertEqual(kwargs['env'], {'HEY': 'GUYS'})
+        self.assertEqual(kwargs['timeout'], None)
         self.assertIn(kwargs['silo_key'], machine.silos,
             "Should have made a real silo")
         # self.assertEqual(machine.silo_channel[kwargs['silo_key']], ch,
@@ -137,6 +148,326 @@ class MachineTest(TestCase):
         self.assertEqual(out, 'hi')
 
 
+    def test_run_metrics(self):
+        """
+        Running scripts are counted, and how long runs took is recorded by
+        script and exit code.
+        """
+        clock = Clock()
+        runner = MagicMock()
+        results = [defer.Deferred(), defer.Deferred()]
+        runner.runWithSilo.side_effect = results
+        machine = Machine(MemoryStore(), runner, clock=clock)
+        machine.run('jim', 'foo.sh', [], {}).addErrback(lambda _: None)
+        machine.run('jim', 'bar.sh', [], {})
+        self.assertIn('siloscript_runs_running 2\n', machine.metrics.render())
+
+        clock.advance(2)
+        results[0].errback(Timeout())
+        clock.advance(1)
+        results[1].callback(('out', '', 3))
+        text = machine.metrics.render()
+        self.assertIn('siloscript_runs_running 0\n', text)
+        self.assertIn('siloscript_run_seconds_count'
+            '{script="foo.sh",rc="timeout"} 1\n', text)
+        self.assertIn('siloscript_run_seconds_sum'
+            '{script="foo.sh",rc="timeout"} 2.0\n', text)
+        self.assertIn('siloscript_run_seconds_sum'
+            '{script="bar.sh",rc="3"} 3.0\n', text)
+
+
+    def test_run_metrics_unknownScript(self):
+        """
+        Runs of scripts that have never run (such as ones that don't exist)
+        are recorded as C{other}, so that callers can't make up labels.
+        """
+        runner = MagicMock()
+        machine = Machine(MemoryStore(), runner)
+        runner.runWithSilo.return_value = defer.fail(NotFound('nope.sh'))
+        self.failureResultOf(machine.run('jim', 'nope.sh', [], {}), NotFound)
+        runner.runWithSilo.return_value = defer.succeed(('', '', 0))
+        machine.run('jim', 'foo.sh', [], {})
+        runner.runWithSilo.return_value = defer.fail(Exception('lost'))
+        self.failureResultOf(machine.run('jim', 'foo.sh', [], {}))
+        text = machine.metrics.render()
+        self.assertNotIn('nope.sh', text)
+        self.assertIn('siloscript_run_seconds_count'
+            '{script="other",rc="error"} 1\n', text)
+        self.assertIn('siloscript_run_seconds_count'
+            '{script="foo.sh",rc="0"} 1\n', text)
+        self.assertIn('siloscript_run_seconds_count'
+            '{script="foo.sh",rc="error"} 1\n', text)
+
+
+    @defer.inlineCallbacks
+    def test_dataGet_metrics(self):
+        """
+        A data request for a value is timed once, as a C{get}, however it's
+        read.
+        """
+        machine = Machine(MemoryStore(), None)
+        silo_key = machine.control_makeSilo('jim', 'foo')
+        yield machine.data_put(silo_key, 'foo', 'bar')
+        value = yield dataGet(machine, StreamingRequest(['']), silo_key,
+            'foo')
+        self.assertEqual(value, 'bar')
+        request = StreamingRequest([''])
+        request.args['prompt'] = ['Foo?']
+        value = yield dataGet(machine, request, silo_key, 'foo')
+        self.assertEqual(value, 'bar')
+        text = machine.metrics.render()
+        self.assertIn('siloscript_data_seconds_count{operation="get"} 2\n',
+            text)
+        self.assertNotIn('operation="version"', text)
+        self.assertNotIn('operation="getStream"', text)
+
+
+    @defer.inlineCallbacks
+    def test_data_metrics(self):
+        """
+        How long data requests take is recorded by operation, whether they
+        succeed or fail.
+        """
+        machine = Machine(MemoryStore(), None)
+        silo_key = machine.control_makeSilo('jim', 'foo')
+        yield machine.data_put(silo_key, 'foo', 'bar')
+        yield machine.data_get(silo_key, 'foo')
+        yield self.assertFailure(machine.data_get(silo_key, 'nope'),
+            KeyError)
+        yield machine.data_createToken(silo_key, 'secret')
+        text = machine.metrics.render()
+        self.assertIn('siloscript_data_seconds_count{operation="get"} 2\n',
+            text)
+        self.assertIn('siloscript_data_seconds_count{operation="put"} 1\n',
+            text)
+        self.assertIn('siloscript_data_seconds_count'
+            '{operation="createToken"} 1\n', text)
+
+
+    @defer.inlineCallbacks
+    def test_run_resultCache(self):
+        """
+        If there's a result cache, identical successful runs are answered
+        from it without making a silo or running anything.
+        """
+        runner = MagicMock()
+        runner.runWithSilo.return_value = defer.succeed(('out', '', 0))
+        machine = Machine(MemoryStore(), runner, result_cache=ResultCache())
+
+        out = yield machine.run('jim', 'foo.sh', ['hey'], {})
+        self.assertEqual(out, ('out', '', 0))
+        self.assertEqual(runner.runWithSilo.call_count, 1)
+
+        machine.control_makeSilo = MagicMock()
+        out = yield machine.run('jim', 'foo.sh', ['hey'], {})
+        self.assertEqual(out, ('out', '', 0))
+        self.assertEqual(runner.runWithSilo.call_count, 1,
+            "Should not have run again")
+        self.assertEqual(machine.control_makeSilo.call_count, 0,
+            "Should not have made a silo")
+
+
+    @defer.inlineCallbacks
+    def test_run_resultCache_output(self):
+        """
+        The output of a cached result is given to the logger of a run
+        answered from the cache, followed by an exit message.
+        """
+        runner = MagicMock()
+        runner.runWithSilo.return_value = defer.succeed(('out', 'err', 0))
+        machine = Machine(MemoryStore(), runner, result_cache=ResultCache())
+        yield machine.run('jim', 'foo.sh', [], {})
+
+        messages = []
+        paused = defer.Deferred()
+        def logger(msg):
+            messages.append(msg)
+            if len(messages) == 1:
+                return paused
+        d = machine.run('jim', 'foo.sh', [], {}, logger=logger)
+        self.assertEqual(messages, [
+            {'type': 'output', 'channel': 1, 'data': 'out'},
+        ], "Should wait for the logger")
+        self.assertNoResult(d)
+        paused.callback(None)
+        out = yield d
+        self.assertEqual(out, ('out', 'err', 0))
+        self.assertEqual(messages[1:], [
+            {'type': 'output', 'channel': 2, 'data': 'err'},
+            {'type': 'exit', 'code': 0, 'cached': True},
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_run_resultCache_refresh(self):
+        """
+        You can force a run even if there's a cached result.
+        """
+        runner = MagicMock()
+        runner.runWithSilo.return_value = defer.succeed(('out', '', 0))
+        machine = Machine(MemoryStore(), runner, result_cache=ResultCache())
+
+        yield machine.run('jim', 'foo.sh', [], {})
+        runner.runWithSilo.return_value = defer.succeed(('new', '', 0))
+        out = yield machine.run('jim', 'foo.sh', [], {}, refresh=True)
+        self.assertEqual(out, ('new', '', 0))
+        out = yield machine.run('jim', 'foo.sh', [], {})
+        self.assertEqual(out, ('new', '', 0), "Should cache the new result")
+
+
+    def test_run_coalesce(self):
+        """
+        If coalescing is turned on, identical runs that are requested while
+        one is in progress share its result and each get their own copy of
+        its output messages.
+        """
+        runner = MagicMock()
+        result = defer.Deferred()
+        other = defer.Deferred()
+        runner.runWithSilo.side_effect = [result, other]
+        machine = Machine(MemoryStore(), runner, coalesce_runs=True)
+
+        log1 = []
+        log2 = []
+        d1 = machine.run('jim', 'foo.sh', ['a'], {}, logger=log1.append)
+        logger = runner.runWithSilo.call_args[1]['logger']
+        logger({'type': 'output', 'channel': 1, 'data': 'early'})
+
+        d2 = machine.run('jim', 'foo.sh', ['a'], {}, logger=log2.append)
+        d3 = machine.run('jim', 'foo.sh', ['b'], {})
+        self.assertEqual(runner.runWithSilo.call_count, 2,
+            "Should only run the different one")
+        logger({'type': 'output', 'channel': 1, 'data': 'late'})
+
+        result.callback(('out', '', 0))
+        self.assertEqual(self.successResultOf(d1), ('out', '', 0))
+        self.assertEqual(self.successResultOf(d2), ('out', '', 0))
+        self.assertNoResult(d3)
+        other.callback(('other', '', 0))
+        self.assertEqual(self.successResultOf(d3), ('other', '', 0))
+        self.assertEqual(log1, log2)
+        self.assertEqual([x['data'] for x in log2], ['early', 'late'],
+            "Late arrivals should get the earlier output too")
+        self.assertIsNot(log1[0], log2[0], "Should get their own copy")
+        self.assertEqual(len(machine.silos), 0)
+
+        runner.runWithSilo.side_effect = None
+        runner.runWithSilo.return_value = defer.succeed(('again', '', 0))
+        d4 = machine.run('jim', 'foo.sh', ['a'], {})
+        self.assertEqual(self.successResultOf(d4), ('again', '', 0),
+            "Should run again once the first has finished")
+
+
+    def test_sharedRun_replaySize(self):
+        """
+        Only the most recent output, up to C{replay_size} bytes, is held for
+        loggers that attach later.
+        """
+        shared = _SharedRun(None, replay_size=10)
+        for data in ['aaaa', 'bbbb', 'cccc']:
+            shared.log({'type': 'output', 'channel': 1, 'data': data})
+        shared.log({'type': 'exit', 'code': 0})
+        messages = []
+        shared.attach(messages.append)
+        self.assertEqual(messages, [
+            {'type': 'output', 'channel': 1, 'data': 'bbbb'},
+            {'type': 'output', 'channel': 1, 'data': 'cccc'},
+            {'type': 'exit', 'code': 0},
+        ])
+
+
+    def test_sharedRun_pause(self):
+        """
+        If any logger returns an unfired L{Deferred}, C{log} returns one
+        which fires once they all have, so that the run's output is paused.
+        """
+        shared = _SharedRun(None)
+        d1 = defer.Deferred()
+        d2 = defer.Deferred()
+        shared.attach(lambda msg: d1)
+        shared.attach(lambda msg: None)
+        shared.attach(lambda msg: d2)
+        d = shared.log({'type': 'output', 'channel': 1, 'data': 'x'})
+        self.assertNoResult(d)
+        d1.callback(None)
+        self.assertNoResult(d)
+        d2.errback(Exception('oops'))
+        self.successResultOf(d)
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+
+        shared = _SharedRun(None)
+        shared.attach(lambda msg: None)
+        self.assertEqual(shared.log({'type': 'exit', 'code': 0}), None)
+
+
+    def test_run_coalesce_differentEnv(self):
+        """
+        Runs with different environments or structured args are not
+        coalesced unless they're equal.
+        """
+        runner = MagicMock()
+        runner.runWithSilo.side_effect = lambda **kw: defer.Deferred()
+        machine = Machine(MemoryStore(), runner, coalesce_runs=True)
+
+        machine.run('jim', 'foo.sh', [{'a': [1]}], {'X': '1'})
+        machine.run('jim', 'foo.sh', [{'a': [1]}], {'X': '2'})
+        self.assertEqual(runner.runWithSilo.call_count, 2)
+        machine.run('jim', 'foo.sh', [{'a': [1]}], {'X': '1'})
+        self.assertEqual(runner.runWithSilo.call_count, 2)
+
+
+    def test_run_coalesce_channels(self):
+        """
+        The questions of a coalesced run are asked of every caller's channel
+        receiver, including unanswered questions asked before a caller
+        joined.  A run with a channel isn't coalesced with one without.
+        """
+        runner = MagicMock()
+        runner.runWithSilo.side_effect = lambda **kw: defer.Deferred()
+        machine = Machine(MemoryStore(), runner, coalesce_runs=True)
+
+        q1 = []
+        q2 = []
+        machine.run('jim', 'foo.sh', [], {}, channel_receiver=q1.append)
+        silo_key = runner.runWithSilo.call_args[1]['silo_key']
+        d1 = machine.data_get(silo_key, 'a', prompt='A?')
+        d2 = machine.data_get(silo_key, 'b', prompt='B?')
+        machine.answer_question(q1[0]['id'], 'a')
+        self.assertEqual(self.successResultOf(d1), 'a')
+
+        machine.run('jim', 'foo.sh', [], {}, channel_receiver=q2.append)
+        self.assertEqual(runner.runWithSilo.call_count, 1)
+        self.assertEqual([x['prompt'] for x in q2], ['B?'],
+            "Should get the unanswered question")
+        d3 = machine.data_get(silo_key, 'c', prompt='C?')
+        self.assertEqual([x['prompt'] for x in q1], ['A?', 'B?', 'C?'])
+        self.assertEqual([x['prompt'] for x in q2], ['B?', 'C?'])
+        machine.answer_question(q2[0]['id'], 'b')
+        machine.answer_question(q1[2]['id'], 'c')
+        self.assertEqual(self.successResultOf(d2), 'b')
+        self.assertEqual(self.successResultOf(d3), 'c')
+
+        machine.run('jim', 'foo.sh', [], {})
+        self.assertEqual(runner.runWithSilo.call_count, 2,
+            "Should not share a run with a channel with one without")
+
+
+    def test_run_coalesce_failure(self):
+        """
+        Failures are shared with everyone waiting.
+        """
+        runner = MagicMock()
+        result = defer.Deferred()
+        runner.runWithSilo.return_value = result
+        machine = Machine(MemoryStore(), runner, coalesce_runs=True)
+
+        d1 = machine.run('jim', 'foo.sh', [], {})
+        d2 = machine.run('jim', 'foo.sh', [], {})
+        result.errback(NotFound('foo.sh'))
+        self.failureResultOf(d1, NotFound)
+        self.failureResultOf(d2, NotFound)
+
+
     @defer.inlineCallbacks
     def test_data_put_keyRestrictions(self):
         """
@@ -179,6 +510,24 @@ class MachineTest(TestCase):
             KeyError)
 
 
+    @defer.inlineCallbacks
+    def test_data_get_sharedQuestion(self):
+        """
+        Concurrent runs for the same user and script that need the same
+        value with the same prompt share one question.
+        """
+        machine = Machine(MemoryStore(), None)
+        questions = []
+        silo_keys = [machine.control_makeSilo('jim', 'bank.sh',
+            channel_receiver=questions.append) for i in range(3)]
+        ds = [machine.data_get(k, 'password', prompt='Password?')
+            for k in silo_keys]
+        self.assertEqual(len(questions), 1)
+        machine.answer_question(questions[0]['id'], 'secret')
+        values = yield defer.gatherResults(ds)
+        self.assertEqual(values, ['secret'] * 3)
+
+
     @defer.inlineCallbacks
     def test_data_get_options(self):
         """
@@ -197,6 +546,26 @@ class MachineTest(TestCase):
         self.assertEqual(value, 'answer')
 
 
+    @defer.inlineCallbacks
+    def test_data_many(self):
+        """
+        You can get and put several values at once.
+        """
+        machine = Machine(MemoryStore(), None)
+        silo_key = machine.control_makeSilo('foo', 'bar')
+        yield machine.data_putMany(silo_key, {'a': '1', 'b': '2'})
+        result = yield machine.data_getMany(silo_key, [
+            {'key': 'a'}, {'key': 'c'}])
+        self.assertEqual(result, {'a': '1'})
+        yield self.assertFailure(machine.data_putMany(silo_key,
+            {':a': 'x'}), InvalidKey)
+        yield self.assertFailure(machine.data_getMany(silo_key,
+            [{'key': ':a'}]), InvalidKey)
+        machine.control_closeSilo(silo_key)
+        yield self.assertFailure(machine.data_getMany(silo_key,
+            [{'key': 'a'}]), NotFound)
+
+
     @defer.inlineCallbacks
     def test_createToken_unique(self):
         """
@@ -225,6 +594,42 @@ class MachineTest(TestCase):
             NotFound)
 
 
+    @defer.inlineCallbacks
+    def test_signedSiloKeys(self):
+        """
+        With signed silo keys, another machine with the same secret, store
+        and revocation list can serve a silo's data requests until the silo
+        is closed, though it can't ask anyone questions.
+        """
+        store = MemoryStore()
+        revoked = MemoryRevocationList()
+        machine = Machine(store, None, silo_keys=SiloKeys('secret'),
+            revoked=revoked)
+        other = Machine(store, None, silo_keys=SiloKeys('secret'),
+            revoked=revoked)
+        stranger = Machine(store, None, silo_keys=SiloKeys('wrong'),
+            revoked=revoked)
+        def receiver(question):
+            machine.answer_question(question['id'], 'answer')
+
+        silo_key = machine.control_makeSilo('foo', 'bar', receiver)
+        yield other.data_put(silo_key, 'a', 'A')
+        value = yield machine.data_get(silo_key, 'a')
+        self.assertEqual(value, 'A')
+        yield self.assertFailure(other.data_get(silo_key, 'b',
+            prompt='B?'), KeyError)
+        value = yield machine.data_get(silo_key, 'b', prompt='B?')
+        self.assertEqual(value, 'answer')
+        token = yield other.data_createToken(silo_key, 'x')
+        self.assertEqual((yield machine.data_createToken(silo_key, 'x')),
+            token)
+        yield self.assertFailure(stranger.data_get(silo_key, 'a'), NotFound)
+
+        machine.control_closeSilo(silo_key)
+        yield self.assertFailure(other.data_get(silo_key, 'a'), NotFound)
+        yield self.assertFailure(machine.data_get(silo_key, 'a'), NotFound)
+
+
     @defer.inlineCallbacks
     def test_makeSilo_noChannel(self):
         """
@@ -239,3 +644,270 @@ class MachineTest(TestCase):
             'something', prompt='Something?'), KeyError)
 
 
+
+
+    @defer.inlineCallbacks
+    def test_questionTimeout(self):
+        """
+        A question that isn't answered within question_timeout is given up
+        on, failing the request that asked it with NoAnswer (which isn't a
+        script L{Timeout}).  A late answer is ignored.
+        """
+        clock = Clock()
+        machine = Machine(MemoryStore(), None, question_timeout=60,
+            clock=clock)
+        received = []
+        silo_key = machine.control_makeSilo('jim', 'something',
+            received.append)
+        d = machine.data_get(silo_key, 'something', prompt='Something?')
+        clock.advance(59)
+        self.assertEqual(len(machine.pending_questions), 1)
+        clock.advance(1)
+        err = yield self.assertFailure(d, NoAnswer)
+        self.assertNotIsInstance(err, Timeout)
+        self.assertEqual(len(machine.pending_questions), 0)
+
+        machine.answer_question(received[0]['id'], 'late')
+
+
+    @defer.inlineCallbacks
+    def test_answerCancelsTimeout(self):
+        """
+        Answering a question stops its timer.
+        """
+        clock = Clock()
+        machine = Machine(MemoryStore(), None, question_timeout=60,
+            clock=clock)
+        received = []
+        silo_key = machine.control_makeSilo('jim', 'something',
+            received.append)
+        d = machine.data_get(silo_key, 'something', prompt='Something?')
+        machine.answer_question(received[0]['id'], 'answer')
+        self.assertEqual((yield d), 'answer')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+
+class ControlWebAppTest(TestCase):
+
+
+    def test_pruneQuestions(self):
+        """
+        Questions are forgotten by channels once they're answered or given
+        up on, and channels with no questions or receivers are forgotten.
+        """
+        clock = Clock()
+        machine = Machine(MemoryStore(), None, question_timeout=60,
+            clock=clock)
+        control = ControlWebApp(machine, None)
+        received = []
+        control.channels['chan'].append(received.append)
+
+        machine.ask_question(lambda q: control.ask_channel('chan', q),
+            {'prompt': 'A?'}).addErrback(lambda _: None)
+        machine.ask_question(lambda q: control.ask_channel('chan', q),
+            {'prompt': 'B?'})
+        self.assertEqual(len(received), 2)
+        self.assertEqual(len(control.pending_questions['chan']), 2)
+
+        machine.answer_question(received[1]['id'], 'answer')
+        self.assertEqual(control.pending_questions['chan'], [received[0]])
+        clock.advance(60)
+        self.assertEqual(dict(control.pending_questions), {})
+        self.assertEqual(dict(machine.pending_questions), {})
+
+
+    def test_metrics(self):
+        """
+        The numbers of pending questions and connected channels are
+        reported.
+        """
+        machine = Machine(MemoryStore(), None)
+        control = ControlWebApp(machine, None)
+        control.channels['chan'].append(lambda q: None)
+        machine.ask_question(lambda q: control.ask_channel('chan', q),
+            {'prompt': 'A?'})
+        text = machine.metrics.render()
+        self.assertIn('siloscript_pending_questions 1\n', text)
+        self.assertIn('siloscript_channels 1\n', text)
+        self.assertIn('siloscript_channel_questions 1\n', text)
+        self.assertIn('# TYPE siloscript_channels gauge\n', text)
+
+
+    def test_maxRuns(self):
+        """
+        While C{max_runs} jobs are running, C{/run} answers C{503} saying
+        when to try again.
+        """
+        machine = Machine(MemoryStore(), None)
+        control = ControlWebApp(machine, None, max_runs=1)
+        control.jobs.start(defer.Deferred(), 'jim', 'foo.sh', [])
+        request = StreamingRequest([''])
+        err = self.assertRaises(Overloaded, control.run, request, 'jim')
+        control.overloaded(request, Failure(err))
+        self.assertEqual(request.responseCode, 503)
+        self.assertEqual(request.outgoingHeaders['retry-after'],
+            str(control.run_retry_after))
+        self.assertEqual(len(control.jobs.running), 1)
+
+
+    def test_badParams(self):
+        """
+        Malformed query parameters get a C{400} rather than a C{500}.
+        """
+        machine = Machine(MemoryStore(), None)
+        control = ControlWebApp(machine, None)
+        job = control.jobs.start(defer.Deferred(), 'jim', 'foo.sh', [])
+        calls = [
+            (control.run, 'jim', {'args': ['[nope']}),
+            (control.run, 'jim', {'timeout': ['soon']}),
+            (control.job, job.id, {'wait': ['a while']}),
+            (control.job_events, job.id, {'after': ['the start']}),
+        ]
+        for handler, arg, params in calls:
+            request = StreamingRequest([''])
+            request.args.update(params)
+            err = self.assertRaises(ValueError, handler, request, arg)
+            self.assertEqual(control.badrequest(request, Failure(err)), '')
+            self.assertEqual(request.responseCode, 400)
+        self.assertEqual(len(control.jobs.running), 1)
+
+
+    def test_jobEvents(self):
+        """
+        A job's log is streamed as events, starting after C{Last-Event-ID},
+        until it ends.
+        """
+        machine = Machine(MemoryStore(), None)
+        control = ControlWebApp(machine, None)
+        run_d = defer.Deferred()
+        job_log = JobLog()
+        job = control.jobs.start(run_d, 'jim', 'foo.sh', [], log=job_log)
+        job_log.log({'type': 'output', 'channel': 1, 'data': 'a'})
+        job_log.log({'type': 'output', 'channel': 1, 'data': 'b\xff'})
+
+        request = StreamingRequest([''])
+        request.headers['last-event-id'] = '1'
+        d = control.job_events(request, job.id)
+        self.assertNoResult(d)
+        self.assertIn('siloscript_job_event_streams 1\n',
+            machine.metrics.render())
+        run_d.callback(('ab\xff', '', 0))
+        self.successResultOf(d)
+        self.assertIn('siloscript_job_event_streams 0\n',
+            machine.metrics.render())
+        events = []
+        EventReader(lambda *args: events.append(args)).dataReceived(
+            ''.join(request.written))
+        self.assertEqual(events[0], ('output',
+            {'type': 'output', 'channel': 1, 'data': u'b\ufffd'}, '2'))
+        self.assertEqual(events[1][0], 'end')
+        self.assertEqual(events[1][1]['rc'], 0)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(job_log.listeners, [])
+
+        self.failureResultOf(control.job_events(StreamingRequest(['']),
+            'JOB-nope'), NotFound)
+
+
+    def test_channelResume(self):
+        """
+        A receiver reconnecting with C{Last-Event-ID} is only sent the
+        questions asked after that one.
+        """
+        clock = Clock()
+        clock.advance(100)
+        machine = Machine(MemoryStore(), None, clock=clock)
+        control = ControlWebApp(machine, None)
+        for prompt in ['A?', 'B?', 'C?']:
+            machine.ask_question(lambda q: control.ask_channel('chan', q),
+                {'prompt': prompt})
+        seqs = [q['seq'] for q in control.pending_questions['chan']]
+        self.assertEqual(sorted(set(seqs)), seqs)
+
+        request = StreamingRequest([''])
+        request.headers['last-event-id'] = str(seqs[0])
+        control.channel_events(request, 'chan')
+        clock.advance(0)
+        events = []
+        EventReader(lambda *args: events.append(args)).dataReceived(
+            ''.join(request.written))
+        self.assertEqual(events[0], ('channel_key', 'chan', None))
+        self.assertEqual([(data['prompt'], event_id)
+            for name, data, event_id in events[1:]], [
+                ('B?', str(seqs[1])),
+                ('C?', str(seqs[2])),
+            ])
+
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(dict(control.channels), {})
+        self.assertEqual(control.channel_connections.value, 1)
+
+
+    def test_slowChannel(self):
+        """
+        Receivers that stop reading are dropped once too many questions
+        are waiting to be sent to them, and counted.
+        """
+        clock = Clock()
+        machine = Machine(MemoryStore(), None, clock=clock)
+        control = ControlWebApp(machine, None)
+        control.max_queued = 500
+        request = StreamingRequest([''])
+        control.channel_events(request, 'chan')
+        stream = list(control._streams)[0]
+        stream.pauseProducing()
+        machine.ask_question(lambda q: control.ask_channel('chan', q),
+            {'prompt': 'A?'})
+        self.assertNotIn('siloscript_channel_bytes_queued 0\n',
+            machine.metrics.render())
+        for i in range(5):
+            machine.ask_question(lambda q: control.ask_channel('chan', q),
+                {'prompt': 'x' * 100})
+        self.assertTrue(request.transport.disconnecting)
+        request.processingFailed(Failure(ConnectionDone()))
+        text = machine.metrics.render()
+        self.assertIn(
+            'siloscript_channel_slow_receivers_dropped_total 1\n', text)
+        self.assertIn('siloscript_channel_bytes_queued 0\n', text)
+        self.assertEqual(dict(control.channels), {})
+
+
+
+class PublicWebAppTest(TestCase):
+
+
+    def answer(self, public, question_id, body, content_type):
+        request = StreamingRequest([''])
+        request.method = 'POST'
+        request.content = StringIO(body)
+        request.headers['content-type'] = content_type
+        return request, public.answer_question(request, question_id)
+
+
+    def test_answerBundle(self):
+        """
+        A bundle of questions is answered with one JSON object, and the
+        answers are given to the script together.
+        """
+        machine = Machine(MemoryStore(), None)
+        questions = []
+        silo_key = machine.control_makeSilo('jim', 'bank.sh',
+            channel_receiver=questions.append)
+        d = machine.data_getMany(silo_key, [
+            {'key': 'user', 'prompt': 'Username?'},
+            {'key': 'pass', 'prompt': 'Password?'},
+        ])
+        self.assertEqual([x['key'] for x in questions[0]['fields']],
+            ['user', 'pass'])
+
+        public = PublicWebApp(machine)
+        request, _ = self.answer(public, questions[0]['id'], '{"user": ',
+            'application/json')
+        self.assertEqual(request.responseCode, 400)
+        self.assertNoResult(d)
+        self.answer(public, questions[0]['id'],
+            '{"user": "jim", "pass": "secret"}',
+            'application/json; charset=utf-8')
+        self.assertEqual(self.successResultOf(d),
+            {'user': 'jim', 'pass': 'secret'})
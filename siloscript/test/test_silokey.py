@@ -0,0 +1,122 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from siloscript.silokey import SiloKeys, MemoryRevocationList
+from siloscript.silokey import SQLiteRevocationList, _equal
+from siloscript.error import NotFound
+
+
+
+class SiloKeysTest(TestCase):
+
+
+    def test_makeAndCheck(self):
+        """
+        A key can be checked by anything with the same secret, giving the
+        user, subkey and run id it was made for.
+        """
+        clock = Clock()
+        keys = SiloKeys('secret', ttl=10, clock=clock)
+        key = keys.make('jim', u'script\u00e9')
+        self.assertTrue(key.startswith('SILO-'))
+        self.assertTrue(keys.isSigned(key))
+        user, subkey, run_id, expires = SiloKeys('secret',
+            clock=clock).check(key)
+        self.assertEqual(user, 'jim')
+        self.assertEqual(subkey, u'script\u00e9'.encode('utf-8'))
+        self.assertEqual(expires, 10)
+        self.assertNotEqual(keys.check(keys.make('jim', 'script'))[2],
+            run_id, "Each key should have its own run id")
+
+
+    def test_badKeys(self):
+        """
+        Keys with the wrong signature, that have been tampered with or that
+        aren't signed at all aren't valid.
+        """
+        keys = SiloKeys('secret', clock=Clock())
+        key = keys.make('jim', 'script')
+        self.assertRaises(NotFound, SiloKeys('other', clock=Clock()).check,
+            key)
+        payload, signature = key.split('.')
+        forged = keys.make('bob', 'script').split('.')[0] + '.' + signature
+        self.assertRaises(NotFound, keys.check, forged)
+        self.assertRaises(NotFound, keys.check, 'SILO-abc.def')
+        self.assertRaises(NotFound, keys.check, 'SILO-1234')
+        self.assertFalse(keys.isSigned('SILO-1234'))
+
+
+    def test_equal(self):
+        """
+        Signatures are compared without C{hmac.compare_digest}, which older
+        Pythons don't have.
+        """
+        self.assertTrue(_equal('abc', 'abc'))
+        self.assertTrue(_equal(u'abc', 'abc'))
+        self.assertFalse(_equal('abc', 'abd'))
+        self.assertFalse(_equal('abc', 'ab'))
+        self.assertFalse(_equal('', 'a'))
+
+
+    def test_expired(self):
+        """
+        Keys aren't valid after their TTL.
+        """
+        clock = Clock()
+        keys = SiloKeys('secret', ttl=10, clock=clock)
+        key = keys.make('jim', 'script')
+        clock.advance(9)
+        keys.check(key)
+        clock.advance(1)
+        self.assertRaises(NotFound, keys.check, key)
+
+
+
+class RevocationListMixin(object):
+
+
+    def getList(self, clock):
+        raise NotImplementedError("You must implement getList")
+
+
+    def test_revoke(self):
+        """
+        Revoked run ids are remembered until they expire.
+        """
+        clock = Clock()
+        revoked = self.getList(clock)
+        self.assertFalse(revoked.isRevoked('a'))
+        revoked.revoke('a', 10)
+        self.assertTrue(revoked.isRevoked('a'))
+        clock.advance(10)
+        revoked.revoke('b', 20)
+        self.assertFalse(revoked.isRevoked('a'))
+        self.assertTrue(revoked.isRevoked('b'))
+
+
+
+class MemoryRevocationListTest(TestCase, RevocationListMixin):
+
+
+    def getList(self, clock):
+        return MemoryRevocationList(clock)
+
+
+
+class SQLiteRevocationListTest(TestCase, RevocationListMixin):
+
+
+    def getList(self, clock):
+        return SQLiteRevocationList.create(self.mktemp(), clock)
+
+
+    def test_shared(self):
+        """
+        Revocations are seen by other lists using the same file.
+        """
+        filename = self.mktemp()
+        SQLiteRevocationList.create(filename).revoke('a', 2 ** 40)
+        self.assertTrue(SQLiteRevocationList.create(filename).isRevoked('a'))
@@ -0,0 +1,170 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.test.requesthelper import DummyRequest
+
+from siloscript.sse import sseMsg, EventStream, EventReader
+
+
+
+class StreamingRequest(DummyRequest):
+    """
+    A L{DummyRequest} that takes push producers, and doesn't record empty
+    writes (which only send the headers).
+    """
+
+    producer = None
+
+    def __init__(self, *args, **kwargs):
+        DummyRequest.__init__(self, *args, **kwargs)
+        self.transport = StringTransport()
+
+
+    def write(self, data):
+        if data:
+            DummyRequest.write(self, data)
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+
+class EventStreamTest(TestCase):
+
+
+    def stream(self, **kwargs):
+        clock = task.Clock()
+        request = StreamingRequest([''])
+        return EventStream(request, frame_interval=0.05, clock=clock,
+            **kwargs), request, clock
+
+
+    def test_frames(self):
+        """
+        Events sent close together are written in one frame.
+        """
+        stream, request, clock = self.stream()
+        self.assertEqual(request.outgoingHeaders['content-type'],
+            'text/event-stream')
+        stream.send('output', {'data': 'a'}, event_id=1)
+        stream.send('output', {'data': 'b'}, event_id=2)
+        self.assertEqual(request.written, [])
+        clock.advance(0.05)
+        self.assertEqual(request.written, [
+            sseMsg('output', {'data': 'a'}, 1) +
+            sseMsg('output', {'data': 'b'}, 2)])
+
+
+    def test_pause(self):
+        """
+        Events are dropped while the transport has paused me, and the
+        client is told how many once it's resumed.
+        """
+        stream, request, clock = self.stream()
+        stream.send('output', {'data': 'a'})
+        stream.pauseProducing()
+        stream.send('output', {'data': 'b'})
+        clock.advance(1)
+        self.assertEqual(request.written, [])
+        stream.resumeProducing()
+        clock.advance(1)
+        self.assertEqual(request.written, [sseMsg('dropped', {'count': 2})])
+
+
+    def test_queue(self):
+        """
+        With C{max_queued}, events sent while paused are held until I'm
+        resumed.
+        """
+        stream, request, clock = self.stream(max_queued=1000)
+        stream.pauseProducing()
+        stream.send('question', {'id': 'a'}, event_id=1)
+        clock.advance(1)
+        self.assertEqual(request.written, [])
+        self.assertEqual(stream.queued,
+            len(sseMsg('question', {'id': 'a'}, 1)))
+        stream.resumeProducing()
+        self.assertEqual(request.written,
+            [sseMsg('question', {'id': 'a'}, 1)])
+        self.assertEqual(stream.queued, 0)
+
+
+    def test_tooSlow(self):
+        """
+        A client that falls more than C{max_queued} bytes behind is
+        disconnected.
+        """
+        stream, request, clock = self.stream(max_queued=100)
+        stream.pauseProducing()
+        stream.send('question', {'prompt': 'x' * 50})
+        self.assertFalse(stream.too_slow)
+        stream.send('question', {'prompt': 'y' * 50})
+        self.assertTrue(stream.too_slow)
+        self.assertTrue(request.transport.disconnecting)
+        self.assertEqual(stream.queued, 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_heartbeat(self):
+        """
+        A comment is written every C{heartbeat} seconds, unless paused,
+        until the stream is closed.
+        """
+        stream, request, clock = self.stream(heartbeat=10)
+        clock.advance(10)
+        clock.advance(0.05)
+        self.assertEqual(request.written, [':\n\n'])
+        stream.pauseProducing()
+        clock.advance(10)
+        stream.resumeProducing()
+        self.assertEqual(request.written, [':\n\n'])
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_close(self):
+        """
+        Closing writes what's pending and fires C{done}.
+        """
+        stream, request, clock = self.stream()
+        stream.send('end', {})
+        stream.close()
+        self.assertEqual(request.written, [sseMsg('end', {})])
+        self.successResultOf(stream.done)
+        self.assertEqual(request.producer, None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        stream.send('output', {})
+        self.assertEqual(len(request.written), 1)
+
+
+
+class EventReaderTest(TestCase):
+
+
+    def test_parse(self):
+        """
+        Events split anywhere are put back together, and comments are
+        ignored.
+        """
+        received = []
+        reader = EventReader(lambda *args: received.append(args))
+        data = (': hello\n\n' + sseMsg('output', {'data': u'\xe9'}, 3) +
+            sseMsg('end', {'rc': 0}))
+        for c in data:
+            reader.dataReceived(c)
+        reader.connectionLost(None)
+        self.assertEqual(received, [
+            ('output', {'data': u'\xe9'}, '3'),
+            ('end', {'rc': 0}, None),
+        ])
+        self.successResultOf(reader.done)
@@ -4,13 +4,39 @@
 from twisted.trial.unittest import TestCase
 from twisted.internet import defer
 from twisted.python.procutils import which
+from twisted.web.iweb import IBodyProducer
 
 from mock import MagicMock
 
+import os
+import json
 import gnupg
+import shutil
+import atexit
+import tempfile
+import subprocess
+from StringIO import StringIO
 
 from siloscript.storage import Silo, MemoryStore, gnupgWrapper, SQLiteStore
-from siloscript.error import CryptError
+from siloscript.storage import BlobStore, TimedStore, LimitedStore
+from siloscript.storage import DecryptingProducer
+from siloscript.storage import storeMetrics
+from siloscript.admission import Limiter
+from siloscript.error import CryptError, VersionMismatch, NoAnswer
+
+
+def produce(producer):
+    """
+    Collect what an L{IBodyProducer} produces.
+
+    @return: A L{Deferred} string.
+    """
+    written = []
+    consumer = MagicMock()
+    consumer.write.side_effect = written.append
+    d = producer.startProducing(consumer)
+    return d.addCallback(lambda _: ''.join(written))
+
 
 
 class StoreMixin(object):
@@ -92,6 +118,88 @@ class StoreMixin(object):
         yield self.assertFailure(store.delete('jim', 'silo1', 'foo'), KeyError)
 
 
+    @defer.inlineCallbacks
+    def test_many(self):
+        """
+        You can put and get several values at once.  Values that aren't there
+        are left out.
+        """
+        store = yield self.getEmptyStore()
+        yield store.put_many('jim', 'silo1', {'a': 'A', 'b': '\x00B'})
+        yield store.put('jim', 'silo2', 'c', 'C')
+        val = yield store.get('jim', 'silo1', 'b')
+        self.assertEqual(val, '\x00B')
+        vals = yield store.get_many('jim', 'silo1', ['a', 'b', 'c'])
+        self.assertEqual(vals, {'a': 'A', 'b': '\x00B'})
+        vals = yield store.get_many('jim', 'silo1', [])
+        self.assertEqual(vals, {})
+
+
+    @defer.inlineCallbacks
+    def test_version(self):
+        """
+        Putting a value returns its version, which changes with the value.
+        """
+        store = yield self.getEmptyStore()
+        yield self.assertFailure(store.version('jim', 'silo1', 'foo'),
+            KeyError)
+        v1 = yield store.put('jim', 'silo1', 'foo', 'FOO')
+        version = yield store.version('jim', 'silo1', 'foo')
+        self.assertEqual(version, v1)
+        v2 = yield store.put('jim', 'silo1', 'foo', 'BAR')
+        self.assertNotEqual(v1, v2)
+        version = yield store.version('jim', 'silo1', 'foo')
+        self.assertEqual(version, v2)
+
+
+    @defer.inlineCallbacks
+    def test_put_ifVersion(self):
+        """
+        A put with C{if_version} only happens if the value is still at that
+        version, or exists at all for C{'*'}.
+        """
+        store = yield self.getEmptyStore()
+        yield self.assertFailure(store.put('jim', 'silo1', 'foo', 'FOO',
+            if_version='*'), VersionMismatch)
+        v1 = yield store.put('jim', 'silo1', 'foo', 'FOO')
+        v2 = yield store.put('jim', 'silo1', 'foo', 'BAR', if_version=v1)
+        yield self.assertFailure(store.put('jim', 'silo1', 'foo', 'BAZ',
+            if_version=v1), VersionMismatch)
+        val = yield store.get('jim', 'silo1', 'foo')
+        self.assertEqual(val, 'BAR')
+        yield store.put('jim', 'silo1', 'foo', 'BAZ', if_version='*')
+        yield self.assertFailure(store.put('jim', 'silo1', 'foo', 'QUUX',
+            if_version=v2), VersionMismatch)
+
+
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        """
+        Values can be put from a file, and gotten as either a string or an
+        open file.
+        """
+        store = yield self.getEmptyStore()
+        value = '\x00' + 'x' * 200000
+        v1 = yield store.put_stream('jim', 'silo1', 'foo', StringIO(value))
+        version = yield store.version('jim', 'silo1', 'foo')
+        self.assertEqual(version, v1)
+        val = yield store.get('jim', 'silo1', 'foo')
+        self.assertEqual(val, value)
+        val = yield store.get_stream('jim', 'silo1', 'foo')
+        if hasattr(val, 'read'):
+            f = val
+            val = f.read()
+            f.close()
+        elif IBodyProducer.providedBy(val):
+            val = yield produce(val)
+        self.assertEqual(val, value)
+        yield self.assertFailure(store.put_stream('jim', 'silo1', 'foo',
+            StringIO('new'), if_version='nope'), VersionMismatch)
+        yield self.assertFailure(store.get_stream('jim', 'silo1', 'bar'),
+            KeyError)
+
+
 
 class MemoryStoreTest(TestCase, StoreMixin):
 
@@ -109,11 +217,115 @@ class SQLiteStoreTest(TestCase, StoreMixin):
 
 
 
+class BlobStoreTest(TestCase, StoreMixin):
+
+
+    def getEmptyStore(self):
+        self.inner = MemoryStore()
+        self.directory = self.mktemp()
+        return BlobStore(self.directory, self.inner)
+
+
+    def files(self):
+        return [x for x in os.listdir(self.directory)
+            if not x.startswith('.')]
+
+
+    @defer.inlineCallbacks
+    def test_files(self):
+        """
+        Values put from files are kept in files of their own, which are
+        removed when the value is replaced or deleted.  Values put as
+        strings are kept in the wrapped store.
+        """
+        store = self.getEmptyStore()
+        yield store.put_stream('jim', 'silo1', 'foo', StringIO('big'))
+        self.assertEqual(len(self.files()), 1)
+        f = yield store.get_stream('jim', 'silo1', 'foo')
+        self.assertEqual(f.read(), 'big')
+        f.close()
+        pointer = yield self.inner.get('jim', 'silo1', 'foo')
+        self.assertNotIn('big', pointer)
+
+        yield store.put_stream('jim', 'silo1', 'foo', StringIO('bigger'))
+        self.assertEqual(len(self.files()), 1)
+        yield store.put('jim', 'silo1', 'foo', 'small')
+        self.assertEqual(self.files(), [])
+        val = yield store.get_stream('jim', 'silo1', 'foo')
+        self.assertEqual(val, 'small')
+
+        yield store.put_stream('jim', 'silo1', 'foo', StringIO('big'))
+        yield store.delete('jim', 'silo1', 'foo')
+        self.assertEqual(self.files(), [])
+
+
+    @defer.inlineCallbacks
+    def test_failedPut(self):
+        """
+        If a value can't be put, its file is removed.
+        """
+        store = self.getEmptyStore()
+        yield self.assertFailure(store.put_stream('jim', 'silo1', 'foo',
+            StringIO('big'), if_version='*'), VersionMismatch)
+        self.assertEqual(self.files(), [])
+
+
+    @defer.inlineCallbacks
+    def test_pointerLike(self):
+        """
+        A value that looks like it names a file is kept in a file, so it
+        isn't mistaken for one.
+        """
+        store = self.getEmptyStore()
+        value = store.pointer_prefix + 'foo'
+        yield store.put('jim', 'silo1', 'foo', value)
+        yield store.put_many('jim', 'silo1', {'bar': value})
+        self.assertEqual(len(self.files()), 2)
+        val = yield store.get('jim', 'silo1', 'foo')
+        self.assertEqual(val, value)
+        vals = yield store.get_many('jim', 'silo1', ['foo', 'bar'])
+        self.assertEqual(vals, {'foo': value, 'bar': value})
+
+
+
 gpg_bin = which('gpg')[0]
 gpg_homedir = None
 
 
 
+class TimedStoreTest(TestCase, StoreMixin):
+
+
+    def getEmptyStore(self):
+        return TimedStore(MemoryStore())
+
+
+    @defer.inlineCallbacks
+    def test_timed(self):
+        """
+        Operations are timed, labelled by operation, and the metrics of all
+        the layers of a store can be found.
+        """
+        store = TimedStore(MemoryStore())
+        yield store.put('jim', 'silo1', 'foo', 'FOO')
+        yield store.get('jim', 'silo1', 'foo')
+        yield self.assertFailure(store.get('jim', 'silo1', 'bar'), KeyError)
+        samples = dict(store.seconds.samples())
+        self.assertEqual(samples['siloscript_store_seconds_count'
+            '{operation="get"}'], 2)
+        self.assertEqual(samples['siloscript_store_seconds_count'
+            '{operation="put"}'], 1)
+
+        limited = LimitedStore(store, Limiter('store', 1))
+        self.assertEqual([m.name for m in storeMetrics(limited)], [
+            'siloscript_store_in_flight',
+            'siloscript_store_queued',
+            'siloscript_store_rejected_total',
+            'siloscript_store_seconds',
+        ])
+
+
+
 class gnupgWrapperTest(TestCase, StoreMixin):
 
 
@@ -126,6 +338,19 @@ class gnupgWrapperTest(TestCase, StoreMixin):
         return gnupgWrapper(gpg, MemoryStore())
 
 
+class gnupgWrapperTest_blobs(TestCase, StoreMixin):
+
+
+    def getEmptyStore(self):
+        global gpg_homedir
+        if not gpg_homedir:
+            gpg_homedir = self.mktemp()
+        gpg = gnupg.GPG(homedir=gpg_homedir,
+            binary=gpg_bin)
+        return gnupgWrapper(gpg, BlobStore(self.mktemp(), MemoryStore()))
+
+
+
 class gnupgWrapperTest_with_passphrase(TestCase, StoreMixin):
 
 
@@ -164,6 +389,154 @@ class gnupgWrapperTest_with_passphrase(TestCase, StoreMixin):
 
 
 
+def _gpgVersion():
+    out = subprocess.Popen([gpg_bin, '--version'],
+        stdout=subprocess.PIPE).communicate()[0]
+    return tuple(int(x) for x in out.split()[2].split('.')[:2])
+
+
+# a home directory with a key without a passphrase and a key with one,
+# made once since starting gpg's agent for a new one takes seconds
+stream_gpg = None
+
+
+
+class gnupgWrapperStreamTest(TestCase):
+    """
+    Values put and gotten as streams are run through gpg as a child
+    process.  The keys are made with gpg's command line, which is quicker
+    and doesn't depend on python-gnupg being able to parse the key
+    listings of this version of gpg.
+    """
+
+    if _gpgVersion() < (2, 1):
+        skip = 'needs gpg 2.1 or later to make keys quickly'
+
+
+    def setUp(self):
+        global stream_gpg
+        if stream_gpg is None:
+            # gpg's agent socket must have a short path
+            homedir = tempfile.mkdtemp(prefix='siloscript-gpg-')
+            atexit.register(shutil.rmtree, homedir, True)
+            atexit.register(subprocess.call, ['gpgconf', '--homedir',
+                homedir, '--kill', 'gpg-agent'])
+            stream_gpg = (homedir, self.makeKey(homedir, 'plain', ''),
+                self.makeKey(homedir, 'protected', 'foo'))
+        self.homedir, self.plain_key, self.protected_key = stream_gpg
+
+
+    def makeKey(self, homedir, name, passphrase):
+        """
+        @return: The new key's fingerprint.
+        """
+        self.gpg(homedir, '--pinentry-mode', 'loopback', '--passphrase',
+            passphrase, '--quick-gen-key', name, 'future-default', 'default',
+            'never')
+        out = self.gpg(homedir, '--with-colons', '--list-secret-keys', name)
+        return [line.split(':')[9] for line in out.splitlines()
+            if line.startswith('fpr:')][0]
+
+
+    def gpg(self, homedir, *args):
+        """
+        Run gpg's command line, quietly unless it fails.
+
+        @return: What it wrote to stdout.
+        """
+        proc = subprocess.Popen([gpg_bin, '--homedir', homedir, '--batch']
+            + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            self.fail('gpg failed: %s' % (err,))
+        return out
+
+
+    def getStore(self, key, passphrase=None, store=None):
+        """
+        Make a L{gnupgWrapper} that uses C{key}.
+        """
+        gpg = gnupg.GPG(homedir=self.homedir, binary=gpg_bin)
+        self.patch(gpg, 'list_keys', lambda secret=False: [{'keyid': key}])
+        if store is None:
+            self.directory = self.mktemp()
+            store = BlobStore(self.directory, MemoryStore())
+        return gnupgWrapper(gpg, store, passphrase=passphrase)
+
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        """
+        A value put from a file is encrypted to a file by gpg, and gotten
+        as a L{DecryptingProducer} that produces it as gpg decrypts it.
+        """
+        store = self.getStore(self.plain_key)
+        value = '\x00' + 'x' * 1000000
+        yield store.put_stream('jim', 'silo1', 'foo', StringIO(value))
+        [name] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            self.assertNotIn('xxxx', f.read())
+
+        producer = yield store.get_stream('jim', 'silo1', 'foo')
+        self.assertIsInstance(producer, DecryptingProducer)
+        plain = yield produce(producer)
+        self.assertEqual(plain, value)
+        code = yield producer.ended
+        self.assertEqual(code, 0)
+
+
+    @defer.inlineCallbacks
+    def test_stream_openFile(self):
+        """
+        An open file is read by gpg itself, from where the file object is.
+        """
+        store = self.getStore(self.plain_key)
+        f = tempfile.TemporaryFile()
+        self.addCleanup(f.close)
+        f.write('skip' + 'value' * 100000)
+        f.seek(4)
+        yield store.put_stream('jim', 'silo1', 'foo', f)
+        producer = yield store.get_stream('jim', 'silo1', 'foo')
+        plain = yield produce(producer)
+        self.assertEqual(plain, 'value' * 100000)
+
+
+    @defer.inlineCallbacks
+    def test_stream_passphrase(self):
+        """
+        A key's passphrase is given to gpg, and if it's wrong getting the
+        value fails before anything is produced.
+        """
+        store = self.getStore(self.protected_key, 'foo')
+        yield store.put_stream('jim', 'silo1', 'foo', StringIO('secret'))
+        producer = yield store.get_stream('jim', 'silo1', 'foo')
+        plain = yield produce(producer)
+        self.assertEqual(plain, 'secret')
+
+        # forget the passphrase gpg's agent remembers
+        subprocess.check_call(['gpgconf', '--homedir', self.homedir,
+            '--reload', 'gpg-agent'])
+        wrong = self.getStore(self.protected_key, 'not foo', store._store)
+        yield self.assertFailure(wrong.get_stream('jim', 'silo1', 'foo'),
+            CryptError)
+
+
+    @defer.inlineCallbacks
+    def test_stream_stop(self):
+        """
+        Stopping a L{DecryptingProducer}, say because the client went away,
+        kills gpg.
+        """
+        store = self.getStore(self.plain_key)
+        yield store.put_stream('jim', 'silo1', 'foo',
+            StringIO('x' * 1000000))
+        producer = yield store.get_stream('jim', 'silo1', 'foo')
+        producer.stopProducing()
+        code = yield producer.ended
+        self.assertNotEqual(code, 0)
+
+
+
 class SiloTest(TestCase):
 
 
@@ -261,6 +634,67 @@ class SiloTest(TestCase):
             KeyError)
 
 
+    def test_get_sharedQuestion(self):
+        """
+        Silos sharing C{asking} that need the same value with the same
+        prompt while it's being asked for wait for the one answer, which is
+        saved once.
+        """
+        store = MemoryStore()
+        store.put = MagicMock(wraps=store.put)
+        questions = []
+        def ask(question):
+            d = defer.Deferred()
+            questions.append((question, d))
+            return d
+        asking = {}
+        silo1 = Silo(store, 'jim', 'africa', ask, asking)
+        silo2 = Silo(store, 'jim', 'africa', ask, asking)
+        other = Silo(store, 'jim', 'asia', ask, asking)
+
+        d1 = silo1.get('name', prompt='name?', save=False)
+        d2 = silo2.get('name', prompt='name?')
+        d3 = silo2.get('name', prompt='name?')
+        d3.cancel()
+        other.get('name', prompt='name?')
+        silo2.get('name', prompt='Your name?')
+        self.assertEqual(len(questions), 3)
+
+        questions[0][1].callback('joe')
+        self.assertEqual(self.successResultOf(d1), 'joe')
+        self.assertEqual(self.successResultOf(d2), 'joe')
+        self.failureResultOf(d3, defer.CancelledError)
+        self.assertEqual(store.put.call_count, 1)
+        self.assertEqual(self.successResultOf(
+            store.get('jim', 'africa', 'name')), 'joe')
+        self.assertEqual(sorted(asking), [
+            ('jim', 'africa', 'name', 'Your name?'),
+            ('jim', 'asia', 'name', 'name?'),
+        ])
+
+
+    def test_get_sharedQuestion_failure(self):
+        """
+        If a shared question isn't answered, everyone waiting for it gets
+        the failure, and the next get asks again.
+        """
+        questions = []
+        def ask(question):
+            d = defer.Deferred()
+            questions.append(d)
+            return d
+        asking = {}
+        silo = Silo(MemoryStore(), 'jim', 'africa', ask, asking)
+        d1 = silo.get('name', prompt='name?')
+        d2 = silo.get('name', prompt='name?')
+        questions[0].errback(NoAnswer('Q-1'))
+        self.failureResultOf(d1, NoAnswer)
+        self.failureResultOf(d2, NoAnswer)
+        self.assertEqual(asking, {})
+        silo.get('name', prompt='name?')
+        self.assertEqual(len(questions), 2)
+
+
     @defer.inlineCallbacks
     def test_get_no_save_no_prompt(self):
         """
@@ -303,3 +737,101 @@ class SiloTest(TestCase):
         silo = Silo(store, 'jim', 'africa', ask)
         yield self.assertFailure(silo.get('name', prompt='name?'), CryptError)
 
+
+    @defer.inlineCallbacks
+    def test_get_many(self):
+        """
+        You can get several values at once.  Missing ones with prompts are
+        asked for in one question and the answers are saved together.
+        """
+        store = MemoryStore()
+        yield store.put('jim', 'africa', 'stored', 'STORED')
+        called = []
+        def ask(question):
+            called.extend([x['prompt'] for x in question['fields']])
+            return dict([(x['key'], x['prompt'].upper())
+                for x in question['fields']])
+        silo = Silo(store, 'jim', 'africa', ask)
+        store.put_many = MagicMock(wraps=store.put_many)
+
+        result = yield silo.get_many([
+            {'key': 'stored', 'prompt': 'stored?'},
+            {'key': 'name', 'prompt': 'name?'},
+            {'key': 'color', 'prompt': 'color?', 'save': False},
+            {'key': 'missing'},
+        ])
+        self.assertEqual(result, {
+            'stored': 'STORED',
+            'name': 'NAME?',
+            'color': 'COLOR?',
+        })
+        self.assertEqual(sorted(called), ['color?', 'name?'])
+        self.assertEqual(store.put_many.call_count, 1)
+        self.assertEqual(store.put_many.call_args[0],
+            ('jim', 'africa', {'name': 'NAME?'}))
+        yield self.assertFailure(silo.get('color'), KeyError)
+
+
+    @defer.inlineCallbacks
+    def test_get_many_bundle(self):
+        """
+        Several missing values are asked for in one question, a bundle,
+        whose answer is a JSON object.  Values left out of it aren't
+        answered.
+        """
+        store = MemoryStore()
+        questions = []
+        def ask(question):
+            questions.append(question)
+            return json.dumps({'user': u'\u00e9', 'other': 'x'})
+        silo = Silo(store, 'jim', 'africa', ask)
+        result = yield silo.get_many([
+            {'key': 'user', 'prompt': 'Username?'},
+            {'key': 'pin', 'prompt': 'PIN?', 'options': ['1', '2']},
+        ])
+        self.assertEqual(result, {'user': u'\u00e9'.encode('utf-8')})
+        self.assertEqual(questions, [{
+            'prompt': 'Username?\nPIN?',
+            'fields': [
+                {'key': 'user', 'prompt': 'Username?'},
+                {'key': 'pin', 'prompt': 'PIN?', 'options': ['1', '2']},
+            ],
+        }])
+        value = yield store.get('jim', 'africa', 'user')
+        self.assertEqual(value, u'\u00e9'.encode('utf-8'))
+
+
+    def test_get_many_badBundleAnswer(self):
+        """
+        An answer to a bundle that isn't a JSON object of strings is an
+        error.
+        """
+        answers = ['not json', '["a"]', '{"a": 1}']
+        silo = Silo(MemoryStore(), 'jim', 'africa',
+            lambda q: answers.pop(0))
+        for i in range(3):
+            self.failureResultOf(silo.get_many([
+                {'key': 'a', 'prompt': 'A?'},
+                {'key': 'b', 'prompt': 'B?'},
+            ]), ValueError)
+
+
+    def test_get_many_no_save_no_prompt(self):
+        """
+        It's an error to not save something without a prompt.
+        """
+        silo = Silo(MemoryStore(), 'jim', 'africa')
+        self.failureResultOf(silo.get_many([{'key': 'a', 'save': False}]),
+            TypeError)
+
+
+    @defer.inlineCallbacks
+    def test_put_many(self):
+        """
+        You can put several values at once.
+        """
+        store = MemoryStore()
+        silo = Silo(store, 'jim', 'africa')
+        yield silo.put_many({'a': '1', 'b': '2'})
+        result = yield silo.get('b')
+        self.assertEqual(result, '2')
@@ -0,0 +1,235 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.internet.error import ConnectionRefusedError
+from zope.interface.verify import verifyObject
+
+from siloscript.txclient import Client
+from siloscript.interfaces import IClientLoop
+from siloscript.error import NotFound, Overloaded, Unavailable, Timeout
+from siloscript.error import VersionMismatch
+from siloscript.test.test_client import DataServerMixin, BusyStore
+
+
+
+class _HangUp(protocol.Protocol):
+    """
+    I count the requests I get, and hang up after the first, or never
+    answer at all if my factory's C{hang_up} is C{False}.
+    """
+
+    def dataReceived(self, data):
+        self.factory.requests += data.count('\r\n\r\n')
+        if self.factory.hang_up:
+            self.transport.loseConnection()
+
+
+
+class Functional_TwistedClientTest(DataServerMixin, TestCase):
+
+    timeout = 5
+
+
+    def makeClient(self, url, **kwargs):
+        client = Client(url, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+
+    @defer.inlineCallbacks
+    def test_values(self):
+        """
+        The client can get, put and tokenize values.
+        """
+        url = yield self.startServer(answers={
+            'Color?': 'blue',
+        })
+        client = self.makeClient(url)
+        yield client.putValue('foo', 'bar')
+        result = yield client.getValue('foo')
+        self.assertEqual(result, 'bar')
+        result = yield client.getValue('color', prompt='Color?', save=False,
+            options=['blue', 'red'])
+        self.assertEqual(result, 'blue')
+        yield self.assertFailure(client.getValue('color'), NotFound)
+        yield client.putValues({'a': 'A'})
+        result = yield client.getValues(['a', 'b'])
+        self.assertEqual(result, {'a': 'A'})
+        token = yield client.getToken('foo')
+        self.assertNotEqual(token, 'foo')
+        token2 = yield client.getToken('foo')
+        self.assertEqual(token, token2)
+
+
+    @defer.inlineCallbacks
+    def test_badURL(self):
+        """
+        Requests to a bad URL fail with L{NotFound}.
+        """
+        url = yield self.startServer()
+        client = self.makeClient(url + 'fake')
+        yield self.assertFailure(client.putValue('foo', 'bar'), NotFound)
+        yield self.assertFailure(client.getValues(['foo']), NotFound)
+
+
+    @defer.inlineCallbacks
+    def test_overloaded(self):
+        """
+        Requests the server is too busy for are tried again a few times,
+        then fail with L{Overloaded}.
+        """
+        self.dataStore = BusyStore
+        url = yield self.startServer()
+        client = self.makeClient(url)
+        self.store.busy = 2
+        yield client.putValue('foo', 'bar')
+        self.assertEqual(self.store.busy, 0)
+
+        self.store.busy = 1
+        client.retries = 0
+        yield self.assertFailure(client.putValue('foo', 'baz'), Overloaded)
+
+
+    @defer.inlineCallbacks
+    def test_pipelining(self):
+        """
+        Many requests can be outstanding on one connection.
+        """
+        url = yield self.startServer()
+        for i in range(20):
+            yield self.store.put('foo', 'bar', 'key%d' % (i,), 'value%d' % (i,))
+        client = self.makeClient(url, pool_size=1, cache=False)
+        results = yield defer.gatherResults([
+            client.getValue('key%d' % (i,)) for i in range(20)])
+        self.assertEqual(results, ['value%d' % (i,) for i in range(20)])
+        self.assertEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def test_pool(self):
+        """
+        Requests are spread over at most C{pool_size} connections.
+        """
+        url = yield self.startServer()
+        client = self.makeClient(url, pool_size=3, cache=False)
+        yield defer.gatherResults([
+            client.putValue('key%d' % (i,), 'v') for i in range(20)])
+        self.assertEqual(self.site.connections, 3)
+
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        """
+        If the server closes a connection, the client connects again.
+        """
+        url = yield self.startServer()
+        client = self.makeClient(url, pool_size=1, cache=False)
+        yield client.putValue('foo', 'bar')
+        yield self.site.closeAll()
+        result = yield client.getValue('foo')
+        self.assertEqual(result, 'bar')
+        self.assertEqual(self.site.connections, 2)
+
+
+    @defer.inlineCallbacks
+    def test_unixSocket(self):
+        """
+        The client can talk over a Unix socket.
+        """
+        url = yield self.startServer(unix=True)
+        client = self.makeClient(url)
+        yield client.putValue('foo', u'\u00e9')
+        result = yield client.getValues(['foo'])
+        self.assertEqual(result, {'foo': u'\u00e9'.encode('utf-8')})
+
+
+    def test_interface(self):
+        """
+        The client's event loop provides L{IClientLoop}.
+        """
+        client = self.makeClient('http://127.0.0.1:1/SILO')
+        verifyObject(IClientLoop, client.client_loop)
+
+
+    @defer.inlineCallbacks
+    def test_versions(self):
+        """
+        Versions can be gotten and used to put only if a value hasn't
+        changed, and remembered values can be revalidated.
+        """
+        url = yield self.startServer()
+        client = self.makeClient(url)
+        other = self.makeClient(url)
+        v1 = yield client.putValue('foo', 'bar')
+        self.assertEqual(client.getVersion('foo'), v1)
+        v2 = yield other.putValue('foo', 'baz')
+        yield self.assertFailure(client.putValue('foo', 'qux', if_version=v1),
+            VersionMismatch)
+        self.assertEqual(client.getVersion('foo'), None)
+
+        result = yield client.getValue('foo', revalidate=True)
+        self.assertEqual(result, 'baz')
+        self.assertEqual(client.getVersion('foo'), v2)
+        result = yield client.getValue('foo', revalidate=True)
+        self.assertEqual(result, 'baz')
+        yield client.putValue('foo', 'qux', if_version=v2)
+        result = yield other.getValue('foo', revalidate=True)
+        self.assertEqual(result, 'qux')
+
+
+    @defer.inlineCallbacks
+    def startHangUp(self, hang_up=True):
+        """
+        Start a server that answers nothing (see L{_HangUp}).
+
+        @return: A L{Deferred} of the factory and a client of the server.
+        """
+        factory = protocol.Factory.forProtocol(_HangUp)
+        factory.requests = 0
+        factory.hang_up = hang_up
+        port = yield endpoints.serverFromString(reactor,
+            'tcp:0:interface=127.0.0.1').listen(factory)
+        self.addCleanup(port.stopListening)
+        client = self.makeClient('http://127.0.0.1:%d/SILO' % (
+            port.getHost().port,), pool_size=1, timeout=0.2)
+        defer.returnValue((factory, client))
+
+
+    @defer.inlineCallbacks
+    def test_lostConnection(self):
+        """
+        A request that may have changed something isn't sent again when the
+        connection is lost before it's answered.  Gets are tried once more.
+        """
+        factory, client = yield self.startHangUp()
+        yield self.assertFailure(client.putValue('foo', 'bar'), Unavailable)
+        self.assertEqual(factory.requests, 1)
+        yield self.assertFailure(client.getToken('foo'), Unavailable)
+        self.assertEqual(factory.requests, 2)
+        yield self.assertFailure(client.getValue('foo'), Unavailable)
+        self.assertEqual(factory.requests, 4)
+
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        """
+        Requests that aren't answered within the timeout fail with
+        L{Timeout}, except for those that ask a person.
+        """
+        factory, client = yield self.startHangUp(hang_up=False)
+        yield self.assertFailure(client.getValue('foo'), Timeout)
+        d = client.getValue('foo', prompt='Foo?')
+        yield self.assertFailure(client.putValue('foo', 'bar'), Timeout)
+        self.assertFalse(d.called)
+        yield client.close()
+        yield self.assertFailure(d, Unavailable)
+
+
+    def test_connectionRefused(self):
+        """
+        If the server can't be reached, requests fail.
+        """
+        client = Client('http://127.0.0.1:1/SILO')
+        return self.assertFailure(client.getValue('foo'),
+            ConnectionRefusedError)
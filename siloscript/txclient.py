@@ -0,0 +1,127 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import defer, endpoints, protocol
+from zope.interface import implementer
+
+from siloscript.clientcore import AsyncClient, PipelinedConnection
+from siloscript.clientcore import UNIX_SCHEME
+from siloscript.interfaces import IClientLoop
+
+
+
+class _DataProtocol(protocol.Protocol):
+    """
+    I connect a L{PipelinedConnection} to a transport.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.conn = None
+        self.lost = defer.Deferred()
+
+
+    def connectionMade(self):
+        self.conn = PipelinedConnection(self.transport.write,
+            self.transport.loseConnection)
+        self.client._protocols.add(self)
+        self.client.pool.added(self.conn)
+
+
+    def dataReceived(self, data):
+        self.conn.dataReceived(data)
+
+
+    def connectionLost(self, reason):
+        self.client._protocols.discard(self)
+        self.client.pool.lost(self.conn)
+        self.lost.callback(None)
+
+
+
+@implementer(IClientLoop)
+class _TwistedLoop(object):
+    """
+    I'm the L{IClientLoop} of a Twisted reactor.  My futures are
+    L{Deferred}s.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+
+    def connect(self, client):
+        if client.scheme == UNIX_SCHEME:
+            endpoint = endpoints.UNIXClientEndpoint(self.reactor,
+                client.address)
+        else:
+            endpoint = endpoints.TCP4ClientEndpoint(self.reactor,
+                client.address[0], client.address[1])
+        d = endpoint.connect(protocol.Factory.forProtocol(
+            lambda: _DataProtocol(client)))
+        d.addErrback(lambda err: client.pool.failed(err))
+
+
+    def newFuture(self):
+        d = defer.Deferred()
+        def callback(result):
+            if not d.called:
+                d.callback(result)
+        def errback(exc):
+            if not d.called:
+                d.errback(exc)
+        return d, callback, errback
+
+
+    def then(self, d, f, *args):
+        return d.addCallback(f, *args)
+
+
+    def succeed(self, result):
+        return defer.succeed(result)
+
+
+    def callLater(self, delay, f):
+        return self.reactor.callLater(delay, f)
+
+
+
+class Client(AsyncClient):
+    """
+    I am a non-blocking client for the data API for scripts that use
+    Twisted.  My methods are those of L{siloscript.client.Client} (but for
+    C{getFile} and C{putFile}) but return L{Deferred}s.
+
+        client = Client(os.environ['DATASTORE_URL'])
+        d = defer.gatherResults([
+            client.getValue('username'),
+            client.getValue('password', prompt='Password?'),
+        ])
+
+    Many requests can be outstanding at once.  They are pipelined over up
+    to C{pool_size} connections.  Keep in mind that a request waiting for a
+    person to answer a prompt holds up the ones pipelined behind it.
+    """
+
+    def __init__(self, data_url, pool_size=2, cache=True, timeout=None,
+            reactor=None):
+        """
+        See L{siloscript.clientcore.AsyncClient}.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self._protocols = set()
+        AsyncClient.__init__(self, data_url, _TwistedLoop(reactor),
+            pool_size=pool_size, cache=cache, timeout=timeout)
+
+
+    def close(self):
+        """
+        Close my connections.
+
+        @return: A L{Deferred} which fires once they're closed.
+        """
+        lost = [p.lost for p in self._protocols]
+        AsyncClient.close(self)
+        return defer.DeferredList(lost)
@@ -0,0 +1,83 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+import socket
+import urllib
+import urlparse
+import requests.adapters
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+
+
+
+class _UnixConnection(HTTPConnection):
+    """
+    An HTTP connection over a Unix socket.
+    """
+
+    socket_path = None
+
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+
+class _UnixConnectionPool(HTTPConnectionPool):
+    """
+    A pool of L{_UnixConnection}s to one socket.
+    """
+
+    def __init__(self, socket_path, **kwargs):
+        HTTPConnectionPool.__init__(self, 'localhost', **kwargs)
+        self.socket_path = socket_path
+
+
+    def _new_conn(self):
+        self.num_connections += 1
+        conn = _UnixConnection('localhost',
+            timeout=self.timeout.connect_timeout,
+            strict=self.strict)
+        conn.socket_path = self.socket_path
+        return conn
+
+
+
+class UnixAdapter(requests.adapters.HTTPAdapter):
+    """
+    I let L{requests} talk to C{http+unix://} URLs, whose host is the
+    url-quoted path of a Unix socket.
+    """
+
+    def __init__(self, pool_maxsize):
+        requests.adapters.HTTPAdapter.__init__(self, pool_connections=1,
+            pool_maxsize=pool_maxsize)
+        self._pools = {}
+
+
+    def get_connection(self, url, proxies=None):
+        socket_path = urllib.unquote(urlparse.urlparse(url).netloc)
+        pool = self._pools.get(socket_path)
+        if pool is None:
+            pool = self._pools[socket_path] = _UnixConnectionPool(socket_path,
+                maxsize=self._pool_maxsize)
+        return pool
+
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+
+    def close(self):
+        requests.adapters.HTTPAdapter.close(self)
+        for pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
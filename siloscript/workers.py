@@ -0,0 +1,201 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+"""
+I run C{siloscript serve --workers N}: N copies of C{siloscript serve},
+each with its own reactor, that accept connections on the same public and
+control ports (with C{SO_REUSEPORT}, so the kernel spreads connections
+among them) and are linked by a L{siloscript.hub}.
+
+A silo lives in the memory of the worker that started its run, so each
+worker serves the data API on its own endpoint (see L{workerEndpoint} and
+L{workerURL}) and its scripts are told to use that one.
+"""
+
+from twisted.internet import protocol, defer
+from twisted.python import log
+
+import os
+import socket
+from urllib import quote, unquote
+from urlparse import urlsplit, urlunsplit
+
+from siloscript.clientcore import UNIX_SCHEME, BINARY_UNIX_SCHEME
+
+
+
+def _splitDescription(description):
+    kind, rest = description.split(':', 1)
+    return kind, rest.split(':')
+
+
+def _shift(parts, name, change):
+    """
+    Change the first positional argument, or the one called C{name}, of a
+    split endpoint description.
+    """
+    for i, part in enumerate(parts):
+        if '=' not in part:
+            parts[i] = change(part)
+            return
+        if part.startswith(name + '='):
+            parts[i] = name + '=' + change(part[len(name) + 1:])
+            return
+    raise ValueError('No %s in endpoint' % (name,))
+
+
+def workerEndpoint(description, index):
+    """
+    Get the endpoint worker C{index} serves on in place of C{description}:
+    the port is C{index} more for TCP, and C{.index} is appended to the
+    path for Unix sockets.
+    """
+    kind, parts = _splitDescription(description)
+    if kind == 'tcp':
+        _shift(parts, 'port', lambda port: str(int(port) + index))
+    elif kind == 'unix':
+        _shift(parts, 'address', lambda path: '%s.%d' % (path, index))
+    else:
+        raise ValueError('Unsupported endpoint: %r' % (description,))
+    return ':'.join([kind] + parts)
+
+
+def workerURL(url, index):
+    """
+    Get the URL scripts run by worker C{index} should use in place of
+    C{url}, to match L{workerEndpoint}.
+    """
+    parsed = urlsplit(url)
+    if parsed.scheme in (UNIX_SCHEME, BINARY_UNIX_SCHEME):
+        netloc = quote('%s.%d' % (unquote(parsed.netloc), index), safe='')
+    else:
+        netloc = '%s:%d' % (parsed.netloc.rsplit(':', 1)[0],
+            (parsed.port or 80) + index)
+    return urlunsplit((parsed.scheme, netloc, parsed.path, parsed.query,
+        parsed.fragment))
+
+
+def listenReusePort(reactor, description, factory):
+    """
+    Listen on a TCP endpoint (such as C{tcp:7600:interface=127.0.0.1}) with
+    C{SO_REUSEPORT}, so that other processes can listen on it too.
+
+    @return: The listening port.
+    """
+    kind, parts = _splitDescription(description)
+    if kind != 'tcp':
+        raise ValueError('Only tcp endpoints can be shared: %r' % (
+            description,))
+    kwargs = {'interface': '', 'backlog': '50'}
+    for part in parts:
+        if '=' in part:
+            name, value = part.split('=', 1)
+            kwargs[name] = value
+        else:
+            kwargs.setdefault('port', part)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((kwargs['interface'], int(kwargs['port'])))
+        sock.listen(int(kwargs['backlog']))
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET,
+            factory)
+    finally:
+        # the reactor has its own copy
+        sock.close()
+
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+
+    def connectionMade(self):
+        if self.pool.stdin is not None:
+            self.transport.writeToChild(0, self.pool.stdin)
+        self.transport.closeChildFD(0)
+
+
+    def processEnded(self, reason):
+        self.pool._ended(self.index, reason)
+
+
+
+class WorkerPool(object):
+    """
+    I start worker processes and restart any that exit until I'm stopped.
+    Their output goes to mine.
+    """
+
+    restart_delay = 1
+
+
+    def __init__(self, reactor, count, args, stdin=None):
+        """
+        @param count: Number of workers.
+        @param args: A function that, given a worker's index, returns the
+            args to run it with (starting with the executable).
+        @param stdin: A string to write to each worker's stdin, such as a
+            passphrase.
+        """
+        self.reactor = reactor
+        self.count = count
+        self.args = args
+        self.stdin = stdin
+        self.processes = {}
+        self._restarts = {}
+        self._stopping = False
+        self._stopped = []
+
+
+    def start(self):
+        """
+        Start all the workers.
+        """
+        for index in range(self.count):
+            self._spawn(index)
+
+
+    def _spawn(self, index):
+        self._restarts.pop(index, None)
+        args = self.args(index)
+        self.processes[index] = proc = _WorkerProcess(self, index)
+        self.reactor.spawnProcess(proc, args[0], args, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2})
+
+
+    def _ended(self, index, reason):
+        del self.processes[index]
+        if self._stopping:
+            if not self.processes:
+                stopped, self._stopped = self._stopped, []
+                for d in stopped:
+                    d.callback(None)
+            return
+        log.msg('worker %d exited (%s); restarting it' % (index,
+            reason.getErrorMessage()), system='workers')
+        self._restarts[index] = self.reactor.callLater(self.restart_delay,
+            self._spawn, index)
+
+
+    def stop(self):
+        """
+        Stop all the workers.
+
+        @return: A L{Deferred} that fires once they've all exited.
+        """
+        self._stopping = True
+        for call in self._restarts.values():
+            call.cancel()
+        self._restarts.clear()
+        if not self.processes:
+            return defer.succeed(None)
+        for proc in self.processes.values():
+            proc.transport.signalProcess('TERM')
+        d = defer.Deferred()
+        self._stopped.append(d)
+        return d